@@ -0,0 +1,75 @@
+"""
+Compares the python converter (mkidpipeline.hdf.bin2hdf.convert) with the compiled Bin2HDF.
+
+Converts the .bin files of a Bin2HDF config file with both (Bin2HDF in single pass mode, see
+README.md), reports their photons/sec and checks that the PhotonTables, PixelIndexes and
+TimeIndexes are the same. The Wavelength column can differ in the last bit of a few photons,
+since Bin2HDF converts phases with a rounded RAD2DEG.
+
+usage: python bin2hdfBenchmark.py <Bin2HDF.cfg> <path to compiled Bin2HDF> [nProcs ...]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tables
+
+from mkidpipeline.hdf.batchBin2HDF import writeBin2HDFConfig
+from mkidpipeline.hdf.bin2hdf import convert, readBin2HDFConfig
+
+
+def runBin2HDF(bin2hdf, config, outPath):
+    """Runs the compiled Bin2HDF in single pass mode. Returns the output file and the run time."""
+    cfgFile = os.path.join(outPath, 'bin2hdf.cfg')
+    writeBin2HDFConfig(cfgFile, config['xPix'], config['yPix'], config['binPath'], config['startTime'],
+                       config['nFiles'], config['beamFile'], config['mapFlag'], outPath)
+    start = time.time()
+    subprocess.run([os.path.abspath(bin2hdf), cfgFile], cwd=os.path.dirname(os.path.abspath(bin2hdf)),
+                   stdout=subprocess.DEVNULL, check=True)
+    return os.path.join(outPath, '{}.h5'.format(config['startTime'])), time.time() - start
+
+
+def compareFiles(fileName1, fileName2):
+    """Returns a dict of which photon table nodes match and the largest Wavelength difference"""
+    with tables.open_file(fileName1) as f1, tables.open_file(fileName2) as f2:
+        photons1 = f1.root.Photons.PhotonTable.read()
+        photons2 = f2.root.Photons.PhotonTable.read()
+        same = {'nPhotons': len(photons1) == len(photons2)}
+        if same['nPhotons']:
+            for column in ('ResID', 'Time'):
+                same[column] = np.array_equal(photons1[column], photons2[column])
+            same['maxWvlDiff'] = float(np.max(np.abs(photons1['Wavelength'] - photons2['Wavelength']), initial=0))
+        for node in ('/Photons/PixelIndex', '/Photons/TimeIndex'):
+            same[node] = node in f1 and node in f2 and np.array_equal(f1.get_node(node).read(),
+                                                                      f2.get_node(node).read())
+    return same
+
+
+if __name__=='__main__':
+    if len(sys.argv) < 3:
+        print('usage: python bin2hdfBenchmark.py <Bin2HDF.cfg> <path to compiled Bin2HDF> [nProcs ...]')
+        exit(0)
+    config = readBin2HDFConfig(sys.argv[1])
+    nProcsList = [int(arg) for arg in sys.argv[3:]] or [1]
+    outPath = tempfile.mkdtemp()
+
+    cFile, cTime = runBin2HDF(sys.argv[2], config, outPath)
+    with tables.open_file(cFile) as f:
+        nPhotons = f.root.Photons.PhotonTable.nrows
+    print('{} photons in {} files'.format(nPhotons, config['nFiles']))
+    print('Bin2HDF:                {:6.2f} s {:12.0f} photons/sec'.format(cTime, nPhotons/cTime))
+
+    for nProcs in nProcsList:
+        pyFile = os.path.join(outPath, 'python_{}.h5'.format(nProcs))
+        start = time.time()
+        convert(config['binPath'], config['startTime'], config['nFiles'], config['beamFile'], pyFile,
+                config['xPix'], config['yPix'], config['mapFlag'], nProcs)
+        pyTime = time.time() - start
+        print('bin2hdf.convert, {:2d} procs: {:6.2f} s {:12.0f} photons/sec'.format(nProcs, pyTime, nPhotons/pyTime))
+        print('    same as Bin2HDF: {}'.format(compareFiles(cFile, pyFile)))
+        os.remove(pyFile)
+    os.remove(cFile)
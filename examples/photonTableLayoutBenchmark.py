@@ -0,0 +1,137 @@
+"""
+Benchmarks PhotonTable layouts (compression filters and rows per HDF5 chunk) on synthetic data.
+
+For each layout it writes a consolidated, indexed h5 file (header, beammap, PhotonTable,
+PixelIndex and TimeIndex, like Bin2HDF and consolidatePhotonTables.py make), then reports the
+file size, the write throughput and the ObsFile read latency of getPixelPhotonList (random
+pixels) and getPixelCountImage (1 s and the full exposure).
+
+Reads hit the OS page cache after the first one, so the latencies are mostly decompression and
+HDF5 overhead; over the network the file size also matters. Existing files can be converted to
+another layout with ptrepack, e.g.
+    ptrepack --complib blosc:lz4 --complevel 5 --shuffle 1 --chunkshape "(65536,)" in.h5:/ out.h5:/
+
+usage: python photonTableLayoutBenchmark.py [nXPix nYPix expTime countRate [outDir]]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tables
+
+from mkidpipeline.core.headers import ObsFileCols, ObsHeader
+from mkidpipeline.hdf.consolidatePhotonTables import createPhotonTable, getPhotonTableFilters, writePixelIndex, writeTimeIndex
+from mkidpipeline.hdf.darkObsFile import ObsFile
+
+# (name, complib, complevel, shuffle, chunkRows)
+layouts = [('none, 300 rows', 'zlib', 0, False, 300),
+           ('none, 64k rows', 'zlib', 0, False, 65536),
+           ('zlib 1, 64k rows', 'zlib', 1, True, 65536),
+           ('blosc:lz4 5, 8k rows', 'blosc:lz4', 5, True, 8192),
+           ('blosc:lz4 5, 64k rows', 'blosc:lz4', 5, True, 65536),
+           ('blosc:lz4 5, 256k rows', 'blosc:lz4', 5, True, 262144),
+           ('blosc:zstd 5, 64k rows', 'blosc:zstd', 5, True, 65536),
+           ('blosc2:lz4 5, 64k rows', 'blosc2:lz4', 5, True, 65536)]
+
+
+def makeSyntheticPhotons(nXPix, nYPix, expTime, countRate, seed=0):
+    """
+    Makes a ResID sorted photon list like a real observation: Poisson counts per pixel, sorted
+    times, wavelengths scattered around a few lines and unit weights.
+
+    Returns
+    -------
+    beamImage, photons (ObsFileCols dtype)
+    """
+    rng = np.random.default_rng(seed)
+    nPix = nXPix*nYPix
+    beamImage = (np.arange(nPix, dtype=np.uint32) + 10000).reshape(nXPix, nYPix)
+    counts = rng.poisson(countRate*expTime*rng.uniform(0.5, 1.5, nPix))
+    nPhotons = counts.sum()
+    photons = np.zeros(nPhotons, dtype=tables.dtype_from_descr(ObsFileCols))
+    photons['ResID'] = np.repeat(beamImage.flatten(), counts)
+    times = rng.integers(0, expTime*1000000, nPhotons, dtype=np.uint32)
+    pixelOrdinal = np.repeat(np.arange(nPix, dtype=np.uint64), counts)
+    photons['Time'] = times[np.argsort((pixelOrdinal << np.uint64(32)) + times, kind='stable')]
+    lines = rng.choice([808., 920., 980., 1120., 1310.], nPhotons)
+    photons['Wavelength'] = lines + rng.normal(0, lines/8., nPhotons)
+    photons['SpecWeight'] = 1
+    photons['NoiseWeight'] = 1
+    return beamImage, photons
+
+
+def writeLayout(fileName, beamImage, photons, expTime, complib, complevel, shuffle, chunkRows):
+    """Writes a consolidated, indexed h5 file with the given layout. Returns the write time in seconds."""
+    tStart = time.time()
+    with tables.open_file(fileName, mode='w') as hfile:
+        hfile.create_group('/', 'header', 'Header')
+        header = hfile.create_table('/header', 'header', ObsHeader, 'Header')
+        row = header.row
+        row['startTime'] = 0
+        row['expTime'] = expTime
+        row['wvlBinStart'] = 700
+        row['wvlBinEnd'] = 1500
+        row['energyBinWidth'] = 0.1
+        row.append()
+        header.flush()
+        hfile.create_group('/', 'BeamMap')
+        hfile.create_array('/BeamMap', 'Map', beamImage)
+        hfile.create_array('/BeamMap', 'Flag', np.zeros(beamImage.shape, dtype=np.uint32))
+
+        hfile.create_group('/', 'Photons')
+        photonTable = createPhotonTable(hfile, len(photons), getPhotonTableFilters(complib, complevel, shuffle), chunkRows)
+        photonTable.append(photons)
+        photonTable.flush()
+        resIDs, startRows, nRows = np.unique(photons['ResID'], return_index=True, return_counts=True)
+        writePixelIndex(hfile, resIDs, startRows, nRows)
+        writeTimeIndex(hfile)
+    return time.time() - tStart
+
+
+def timeReads(fileName, nPixels=200, seed=1):
+    """
+    Returns the median getPixelPhotonList time (s) over nPixels random pixels, and the
+    getPixelCountImage times (s) for the first second and for the whole exposure.
+    """
+    rng = np.random.default_rng(seed)
+    obs = ObsFile(fileName)
+    pixelTimes = []
+    for x, y in zip(rng.integers(0, obs.nXPix, nPixels), rng.integers(0, obs.nYPix, nPixels)):
+        tStart = time.time()
+        obs.getPixelPhotonList(x, y)
+        pixelTimes.append(time.time() - tStart)
+    tStart = time.time()
+    obs.getPixelCountImage(firstSec=0, integrationTime=1, applyWeight=False, applyTPFWeight=False)
+    imageTime1s = time.time() - tStart
+    tStart = time.time()
+    obs.getPixelCountImage(applyWeight=False, applyTPFWeight=False)
+    imageTimeAll = time.time() - tStart
+    obs.file.close()
+    return np.median(pixelTimes), imageTime1s, imageTimeAll
+
+
+if __name__=='__main__':
+    nXPix, nYPix, expTime, countRate = 20, 25, 10, 200
+    if len(sys.argv)>=5:
+        nXPix, nYPix, expTime, countRate = [int(arg) for arg in sys.argv[1:5]]
+    outDir = sys.argv[5] if len(sys.argv)>5 else tempfile.mkdtemp()
+
+    beamImage, photons = makeSyntheticPhotons(nXPix, nYPix, expTime, countRate)
+    rawSize = photons.nbytes
+    print('{} photons ({:.1f} MB) in {}x{} pixels, {} s'.format(len(photons), rawSize/1e6, nXPix, nYPix, expTime))
+    print('{:<24} {:>9} {:>7} {:>12} {:>11} {:>10} {:>10}'.format('layout', 'size (MB)', 'ratio', 'write (Mph/s)',
+                                                                 'pixel (ms)', 'image 1s (s)', 'image all (s)'))
+    for name, complib, complevel, shuffle, chunkRows in layouts:
+        if complevel>0 and complib not in tables.filters.all_complibs:
+            print('{:<24} {} is not available'.format(name, complib))
+            continue
+        fileName = os.path.join(outDir, 'layout_{}_{}_{}.h5'.format(complib.replace(':', '_'), complevel, chunkRows))
+        writeTime = writeLayout(fileName, beamImage, photons, expTime, complib, complevel, shuffle, chunkRows)
+        size = os.path.getsize(fileName)
+        pixelTime, imageTime1s, imageTimeAll = timeReads(fileName)
+        print('{:<24} {:>9.1f} {:>7.2f} {:>12.1f} {:>11.2f} {:>10.3f} {:>10.3f}'.format(
+            name, size/1e6, rawSize/size, len(photons)/writeTime/1e6, pixelTime*1e3, imageTime1s, imageTimeAll))
+        os.remove(fileName)
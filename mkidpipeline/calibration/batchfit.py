@@ -0,0 +1,467 @@
+"""
+Vectorized least squares fits of many small data sets at once, used by wavecal.py to fit all
+of the pixels' phase histograms (and phase to energy relations) together instead of one lmfit
+call at a time.
+
+fitGaussianAndExp fits the 'gaussian_and_exp' model (see wavecalplots.fitModels) to a batch of
+histograms, in groups with the same number of bins. Every iteration updates all of the fits in
+a group with one set of array operations. The groups aren't padded to a common length because
+numpy rounds sums of different lengths differently, which would make a fit's result depend on
+the other histograms of the batch. The iteration is the one lmfit's leastsq method runs
+(MINPACK's lmdif: trust region Levenberg-Marquardt steps with the same scaling, step bound
+updates, forward difference Jacobian and convergence tests), and bounded parameters are fit
+through lmfit's (MINUIT style) internal parameters, so most fits converge to the same
+solutions as lmfit from the same initial guesses. The steps are computed with different
+rounding than MINPACK's QR factorization though, so a few fits with slowly converging, nearly
+degenerate paths end in a different local minimum. Most of those start with a varied parameter
+on one of its bounds, where its internal parameter has no gradient; wavecal.py fits those
+guesses with lmfit. The covariance is the inverse Hessian of the internal parameters scaled
+back to the external ones and by the reduced chi squared, like lmfit's.
+
+Fits that don't converge within max_iterations (mostly ones that lmfit stops at its
+max_nfev limit), evaluate the model to inf or NaN, or have fewer bins than free parameters
+are returned with success False; wavecal.py redoes those with lmfit.
+
+fitPolynomial fits the phase to energy relations of WaveCal.calculateCoefficients (a
+'quadratic', 'linear' or 'linear_zero' polynomial through a few points per pixel) without
+iterating. The phase errors are turned into energy errors with the slope of the unweighted
+least squares solution (np.polyfit's, the guess of _fitEnergy), and the weighted least squares
+problem with those errors is solved for all of the pixels at once from stacked normal
+equations. This is a different fit than _fitEnergy's: lmfit minimizes the sum of the fourth
+powers of the residuals of WaveCal._energyChi2 (it squares them again), with the slope of the
+fit itself, and stops early on that flat sum. So the batched solutions differ from lmfit's:
+over the range of the points the energies typically agree to better than 0.1%, but a few
+percent of the fits differ by up to a few percent (more if the points scatter by more than
+their errors), and pixels near the vertex and slope checks of calculateCoefficients can end
+with a different flag. It is only used with the batch_energy_fit option.
+"""
+
+import numpy as np
+
+tiny = 1.0e-15  # internal values smaller than this are set to 0, like lmfit
+
+
+def _toInternal(values, lower, upper):
+    """
+    Returns the lmfit internal parameter values of the (clipped to the bounds) external values
+    """
+    values = np.clip(values, lower, upper)
+    internal = values.copy()
+    has_lower = np.isfinite(lower)
+    has_upper = np.isfinite(upper)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        both = has_lower & has_upper
+        internal[both] = np.arcsin(2 * (values[both] - lower[both]) / (upper[both] - lower[both]) - 1)
+        lower_only = has_lower & ~has_upper
+        internal[lower_only] = np.sqrt((values[lower_only] - lower[lower_only] + 1)**2 - 1)
+        upper_only = ~has_lower & has_upper
+        internal[upper_only] = np.sqrt((upper[upper_only] - values[upper_only] + 1)**2 - 1)
+    internal[np.abs(internal) < tiny] = 0
+    return internal
+
+
+def _toExternal(internal, lower, upper):
+    """
+    Returns the external parameter values and their derivatives with respect to the internal
+    values (lmfit's Parameter.from_internal and Parameter.scale_gradient)
+    """
+    has_lower = np.isfinite(lower)
+    has_upper = np.isfinite(upper)
+    root = np.sqrt(internal**2 + 1)
+    with np.errstate(invalid='ignore'):
+        values = np.where(has_lower & has_upper, lower + (np.sin(internal) + 1) * (upper - lower) / 2,
+                          np.where(has_lower, lower - 1 + root, np.where(has_upper, upper + 1 - root, internal)))
+        gradient = np.where(has_lower & has_upper, np.cos(internal) * (upper - lower) / 2,
+                            np.where(has_lower, internal / root, np.where(has_upper, -internal / root, 1.0)))
+    return values, gradient
+
+
+def _gaussianAndExp(x, values):
+    """
+    Evaluates a * exp(b * x) + c * exp(-((x - d) / f)**2 / 2) for each row of x (nFits, nBins)
+    and values (nFits, 5)
+    """
+    a, b, c, d, f = [values[:, [i]] for i in range(5)]
+    return a * np.exp(b * x) + c * np.exp(-((x - d) / f)**2 / 2)
+
+
+def _padHistograms(centers, counts):
+    """
+    Stacks the histograms into (nFits, nBins) arrays of centers, counts and lmfit weights
+    (1 / (sqrt(counts + 0.25) + 0.5)), with zero weight in the padding, and returns the number
+    of bins of each histogram.
+    """
+    n_bins = np.array([len(c) for c in centers], dtype=int)
+    x = np.zeros((len(centers), max(n_bins.max(initial=0), 1)))
+    y = np.zeros_like(x)
+    weights = np.zeros_like(x)
+    for i, (centers_i, counts_i) in enumerate(zip(centers, counts)):
+        x[i, :n_bins[i]] = centers_i
+        y[i, :n_bins[i]] = counts_i
+        weights[i, :n_bins[i]] = 1 / (np.sqrt(np.asarray(counts_i) + 0.25) + 0.5)
+    return x, y, weights, n_bins
+
+
+def _levenbergMarquardtStep(jac, residual, scale, delta, par, vary):
+    """
+    Returns the Levenberg-Marquardt steps (and parameters) of each fit: the Gauss-Newton step
+    if its scaled length |scale * step| is at most 1.1 * delta, otherwise the step of the
+    Levenberg-Marquardt parameter par for which it is within 10% of delta (MINPACK's lmpar,
+    solved with a singular value decomposition of the scaled Jacobian instead of a QR
+    factorization). The Jacobian is decomposed, not the Hessian, so that the small singular
+    values near degenerate solutions aren't lost to rounding.
+    """
+    n_fits = len(jac)
+    matrix = np.where(vary[:, np.newaxis, :], jac / scale[:, np.newaxis, :], 0)
+    if matrix.shape[1] < matrix.shape[2]:
+        # at least as many rows as parameters, so that there is a singular value for each
+        matrix = np.concatenate([matrix, np.zeros((n_fits, matrix.shape[2] - matrix.shape[1],
+                                                   matrix.shape[2]))], axis=1)
+        residual = np.concatenate([residual, np.zeros((n_fits, matrix.shape[2] - residual.shape[1]))],
+                                  axis=1)
+    left, singular_values, right = np.linalg.svd(matrix, full_matrices=False)
+    eigenvalues = singular_values**2
+    eigenvectors = right.transpose(0, 2, 1)
+    rotated = singular_values * np.einsum('nbi,nb->ni', left, residual)
+
+    def scaledStep(par):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefficients = np.where(rotated == 0, 0, rotated / (eigenvalues + par[:, np.newaxis]))
+        norm = np.sqrt(np.sum(coefficients**2, axis=1))
+        return coefficients, norm
+
+    # Gauss-Newton step, with the (numerically) singular directions left out
+    singular = singular_values <= np.finfo(float).eps * np.max(singular_values, axis=1, keepdims=True)
+    coefficients = np.where(singular, 0, rotated / np.where(singular, 1, eigenvalues))
+    norm = np.sqrt(np.sum(coefficients**2, axis=1))
+    difference = norm - delta
+    gauss_newton = difference <= 0.1 * delta
+    todo = ~gauss_newton
+
+    # bracket the zero of |step| - delta: the Newton step gives the lower bound if the
+    # Jacobian has full rank, |gradient| / delta the upper one
+    with np.errstate(divide='ignore', invalid='ignore'):
+        newton = np.sum(np.where(singular, 0, coefficients**2 / np.where(singular, 1, eigenvalues)), axis=1)
+        lower = np.where(singular.any(axis=1), 0, difference / delta / (newton / norm**2))
+    lower[~np.isfinite(lower)] = 0
+    gradient_norm = np.sqrt(np.sum(rotated**2, axis=1))
+    with np.errstate(divide='ignore'):
+        upper = gradient_norm / delta
+        upper = np.where(upper == 0, np.finfo(float).tiny / np.minimum(delta, 0.1), upper)
+        par = np.minimum(np.maximum(par, lower), upper)
+        par = np.where(par == 0, gradient_norm / norm, par)
+    par[~np.isfinite(par)] = 0
+
+    # Newton's method on 1 / |step| (MINPACK's lmpar iteration)
+    for iteration in range(10):
+        if not todo.any():
+            break
+        par = np.where(todo & (par == 0), np.maximum(np.finfo(float).tiny, 0.001 * upper), par)
+        new_coefficients, new_norm = scaledStep(par)
+        coefficients[todo] = new_coefficients[todo]
+        norm[todo] = new_norm[todo]
+        previous = difference
+        difference = np.where(todo, norm - delta, difference)
+        todo &= ~((np.abs(difference) <= 0.1 * delta) |
+                  ((lower == 0) & (difference <= previous) & (previous < 0)) | (iteration == 9))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cubic = np.sum(new_coefficients**2 / (eigenvalues + par[:, np.newaxis]), axis=1)
+            correction = norm**2 / cubic * difference / delta
+        correction[~np.isfinite(correction)] = 0
+        lower = np.where(todo & (difference > 0), np.maximum(lower, par), lower)
+        upper = np.where(todo & (difference < 0), np.minimum(upper, par), upper)
+        par = np.where(todo, np.maximum(lower, par + correction), par)
+    par = np.where(gauss_newton, 0.0, par)
+    step = -np.einsum('nij,nj->ni', eigenvectors, coefficients) / scale
+    step[~vary] = 0
+    return step, norm, par
+
+
+def _leastsq(evaluate, values, vary, success, max_iterations, ftol, xtol):
+    """
+    Runs MINPACK's lmdif iteration (what lmfit's leastsq calls, with factor=100, mode=1 and
+    gtol=0) on all of the fits with success True at once. evaluate(indices, values,
+    jacobian=False) returns the residuals and chi squared of the fits indices at values, a
+    boolean array that is False for the ones whose model isn't finite, and the Jacobian if
+    jacobian is True. Returns the best fit values, their chi squared and success, which is
+    False for the fits that weren't finite or didn't converge within max_iterations.
+    """
+    n_fits = len(values)
+    values = values.copy()
+    success = success.copy()
+    epsilon = np.finfo(float).eps
+    residual, chi2, finite = evaluate(np.arange(n_fits), values)
+    success &= finite
+    active = success.copy()
+    scale = np.zeros(values.shape)
+    delta = np.zeros(n_fits)
+    par = np.zeros(n_fits)
+    first = np.ones(n_fits, dtype=bool)
+    for _ in range(max_iterations):
+        indices = np.flatnonzero(active)
+        if len(indices) == 0:
+            break
+        residual, _, _, jac = evaluate(indices, values[indices], jacobian=True)
+        hessian = np.einsum('nbi,nbj->nij', jac, jac)
+        gradient = np.einsum('nbi,nb->ni', jac, residual)
+        fnorm = np.sqrt(chi2[indices])
+        column_norms = np.sqrt(np.diagonal(hessian, axis1=1, axis2=2))
+
+        # scale the parameters by the largest column norms of the Jacobian seen so far
+        start = first[indices] & (delta[indices] == 0)
+        scale[indices] = np.maximum(scale[indices], column_norms)
+        scale[indices[start]] = np.where(column_norms[start] > 0, column_norms[start], 1)
+        scale[indices] = np.where((scale[indices] > 0) & vary[indices], scale[indices], 1)
+        x_norm = np.sqrt(np.sum(np.where(vary[indices], scale[indices] * values[indices], 0)**2, axis=1))
+        delta[indices[start]] = np.where(x_norm[start] > 0, 100 * x_norm[start], 100)
+
+        # the residuals are orthogonal to the Jacobian (gtol test)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosines = np.abs(gradient) / (column_norms * fnorm[:, np.newaxis])
+        g_norm = np.max(np.where(column_norms > 0, cosines, 0), axis=1)
+        g_norm[fnorm == 0] = 0
+        orthogonal = g_norm <= epsilon
+
+        step, p_norm, par[indices] = _levenbergMarquardtStep(jac, residual, scale[indices], delta[indices],
+                                                             par[indices], vary[indices])
+        delta[indices] = np.where(first[indices], np.minimum(delta[indices], p_norm), delta[indices])
+
+        new_values = values[indices] + step
+        _, new_chi2, finite = evaluate(indices, new_values)
+        new_fnorm = np.sqrt(new_chi2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            actual = np.where(0.1 * new_fnorm < fnorm, 1 - (new_fnorm / fnorm)**2, -1)
+            linear = np.sqrt(np.sum(np.einsum('nbi,ni->nb', jac, step)**2, axis=1)) / fnorm
+            damped = np.sqrt(par[indices]) * p_norm / fnorm
+            predicted = linear**2 + damped**2 / 0.5
+            directional = -(linear**2 + damped**2)
+            ratio = np.where(predicted != 0, actual / predicted, 0)
+        actual[~np.isfinite(actual)] = -1
+        ratio[~np.isfinite(ratio)] = 0
+
+        # update the step bound
+        shrink = ratio <= 0.25
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(actual >= 0, 0.5, 0.5 * directional / (directional + 0.5 * actual))
+        factor[(0.1 * new_fnorm >= fnorm) | (factor < 0.1) | ~np.isfinite(factor)] = 0.1
+        grow = ~shrink & ((par[indices] == 0) | (ratio >= 0.75))
+        delta[indices] = np.where(shrink, factor * np.minimum(delta[indices], p_norm / 0.1),
+                                  np.where(grow, p_norm / 0.5, delta[indices]))
+        par[indices] = np.where(shrink, par[indices] / factor, np.where(grow, 0.5 * par[indices], par[indices]))
+
+        accept = finite & (ratio >= 1e-4)
+        values[indices[accept]] = new_values[accept]
+        chi2[indices[accept]] = new_chi2[accept]
+        first[indices[accept]] = False
+        x_norm = np.sqrt(np.sum(np.where(vary[indices], scale[indices] * values[indices], 0)**2, axis=1))
+
+        small_reduction = (np.abs(actual) <= ftol) & (predicted <= ftol) & (0.5 * ratio <= 1)
+        converged = orthogonal | small_reduction | (delta[indices] <= max(xtol, epsilon) * x_norm)
+        success[indices[~finite]] = False
+        active[indices[~finite | converged]] = False
+    success &= ~active  # hit max_iterations
+    return values, chi2, success
+
+
+def fitGaussianAndExp(centers, counts, values, lower, upper, vary, max_iterations=200,
+                      ftol=1.5e-8, xtol=1.5e-8, epsfcn=1.0e-10):
+    """
+    Fits the 'gaussian_and_exp' model to many phase histograms at once (see the module
+    docstring).
+
+    Args:
+        centers: list of 1D arrays, the bin centers of each histogram
+        counts: list of 1D arrays, the counts of each histogram
+        values: (nFits, 5) array of the initial a, b, c, d, f of each fit
+        lower, upper: (nFits, 5) arrays of the parameter bounds (+/-np.inf for none)
+        vary: (nFits, 5) boolean array, False for parameters held at their initial value
+        max_iterations: fits that haven't converged after this many iterations fail
+        ftol, xtol: convergence tolerances on the relative chi squared decrease and
+                    relative step size (lmfit's leastsq defaults)
+        epsfcn: relative step of the forward difference Jacobian is sqrt(epsfcn)
+                (lmfit's leastsq default)
+
+    Returns:
+        a dictionary with keys
+        'values': (nFits, 5) array of the best fit parameters
+        'covar': (nFits, 5, 5) array of the parameter covariances, scaled by the reduced
+                 chi squared, with zeros in the rows and columns of fixed parameters. All
+                 NaN if the Hessian is singular (lmfit's covar is None).
+        'chi2': (nFits,) array of the chi squared of each fit
+        'success': (nFits,) boolean array, False for fits that have to be redone with lmfit
+    """
+    n_fits = len(centers)
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    vary = np.asarray(vary, dtype=bool)
+    lengths = np.array([len(c) for c in centers], dtype=int)
+    if len(np.unique(lengths)) > 1:
+        # fit the histograms with the same number of bins together (see the module docstring)
+        result = {'values': np.zeros((n_fits, 5)), 'covar': np.zeros((n_fits, 5, 5)),
+                  'chi2': np.zeros(n_fits), 'success': np.zeros(n_fits, dtype=bool)}
+        values = np.asarray(values, dtype=float)
+        for length in np.unique(lengths):
+            group = np.flatnonzero(lengths == length)
+            group_result = fitGaussianAndExp([centers[i] for i in group], [counts[i] for i in group],
+                                             values[group], lower[group], upper[group], vary[group],
+                                             max_iterations, ftol, xtol, epsfcn)
+            for key in result:
+                result[key][group] = group_result[key]
+        return result
+    x, y, weights, n_bins = _padHistograms(centers, counts)
+    fixed_values = np.clip(np.asarray(values, dtype=float), lower, upper)
+    internal = _toInternal(fixed_values, lower, upper)
+    n_vary = vary.sum(axis=1)
+    epsilon = np.finfo(float).eps
+    difference_step = np.sqrt(max(epsfcn, epsilon))
+
+    def evaluate(indices, internal_values, jacobian=False):
+        external, _ = _toExternal(internal_values, lower[indices], upper[indices])
+        external = np.where(vary[indices], external, fixed_values[indices])
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            model = _gaussianAndExp(x[indices], external)
+            residual = (model - y[indices]) * weights[indices]
+            finite = np.all(np.isfinite(model) | (weights[indices] == 0), axis=1)
+            residual[~np.isfinite(residual)] = 0
+        chi2 = np.sum(residual**2, axis=1)
+        if not jacobian:
+            return residual, chi2, finite
+        # forward differences like lmdif, the analytic derivatives are 0 at the bounds. The
+        # 5 shifted parameter sets of each fit are evaluated together.
+        steps = np.where(internal_values == 0, difference_step, difference_step * np.abs(internal_values))
+        shifted = internal_values[:, np.newaxis, :] + steps[:, np.newaxis, :] * np.eye(5)
+        shifted_residual, _, _ = evaluate(np.repeat(indices, 5), shifted.reshape(-1, 5))
+        shifted_residual = shifted_residual.reshape(len(indices), 5, -1).transpose(0, 2, 1)
+        jac = (shifted_residual - residual[:, :, np.newaxis]) / steps[:, np.newaxis, :]
+        jac[~np.broadcast_to(vary[indices, np.newaxis, :], jac.shape)] = 0
+        return residual, chi2, finite, jac
+
+    success = (n_bins >= n_vary) & np.all(np.isfinite(internal) | ~vary, axis=1)
+    internal, chi2, success = _leastsq(evaluate, internal, vary, success, max_iterations, ftol, xtol)
+
+    # covariance like lmfit: inverse internal Hessian scaled to the external parameters
+    external, gradient = _toExternal(internal, lower, upper)
+    external = np.where(vary, external, fixed_values)
+    covar = np.full((n_fits, 5, 5), np.nan)
+    eye = np.eye(5)
+    indices = np.flatnonzero(success)
+    if len(indices) > 0:
+        _, chi2[indices], _, jac = evaluate(indices, internal[indices], jacobian=True)
+        hessian = np.einsum('nbi,nbj->nij', jac, jac)
+        hessian[~vary[indices]] = eye[np.nonzero(~vary[indices])[1]]
+        try:
+            covar_internal = np.linalg.inv(hessian)
+        except np.linalg.LinAlgError:
+            # some are singular, find them one at a time
+            covar_internal = np.full_like(hessian, np.nan)
+            for i in range(len(indices)):
+                try:
+                    covar_internal[i] = np.linalg.inv(hessian[i])
+                except np.linalg.LinAlgError:
+                    pass
+        grad = np.where(vary[indices], gradient[indices], 0)
+        red_chi2 = chi2[indices] / np.maximum(1, n_bins[indices] - n_vary[indices])
+        covar[indices] = (covar_internal * grad[:, :, np.newaxis] * grad[:, np.newaxis, :] *
+                          red_chi2[:, np.newaxis, np.newaxis])
+        covar[~np.all(np.isfinite(covar), axis=(1, 2))] = np.nan
+
+    return {'values': external, 'covar': covar, 'chi2': chi2, 'success': success}
+
+
+polynomialPowers = {'quadratic': [2, 1, 0], 'linear': [1, 0], 'linear_zero': [1]}
+
+
+def _padPoints(phases, energies, errors):
+    """
+    Stacks the points into (nFits, nPoints) arrays of phases, energies and errors and a mask
+    that is False in the padding, and returns the number of points of each fit.
+    """
+    n_points = np.array([len(p) for p in phases], dtype=int)
+    x = np.zeros((len(phases), max(n_points.max(initial=0), 1)))
+    y = np.zeros_like(x)
+    sigma = np.ones_like(x)
+    mask = np.zeros(x.shape, dtype=bool)
+    for i, (phases_i, energies_i, errors_i) in enumerate(zip(phases, energies, errors)):
+        x[i, :n_points[i]] = phases_i
+        y[i, :n_points[i]] = energies_i
+        sigma[i, :n_points[i]] = errors_i
+        mask[i, :n_points[i]] = True
+    return x, y, sigma, mask, n_points
+
+
+def fitPolynomial(phases, energies, errors, fit_type):
+    """
+    Fits polynomials of energy vs phase to many pixels at once with closed form weighted
+    least squares (see the module docstring).
+
+    Args:
+        phases: list of 1D arrays, the phases of each fit
+        energies: list of 1D arrays, the energies of each fit
+        errors: list of 1D arrays, the phase errors of each fit
+        fit_type: 'quadratic' (a, b, c), 'linear' (b, c) or 'linear_zero' (b)
+
+    Returns:
+        a dictionary with keys
+        'values': (nFits, 3) array of the best fit a, b, c of each fit (0 for the ones
+                  that aren't fit)
+        'covar': (nFits, 3, 3) array of the parameter covariances, scaled by the reduced
+                 chi squared, with zeros in the rows and columns of the ones that aren't
+                 fit. All NaN if the weighted normal equations are singular.
+        'chi2': (nFits,) array of the weighted sum of squared energy residuals of each fit
+        'success': (nFits,) boolean array, False for fits that have to be redone with lmfit
+    """
+    powers = np.array(polynomialPowers[fit_type])
+    n_fits = len(phases)
+    n_parameters = len(powers)
+    x, y, sigma, mask, n_points = _padPoints(phases, energies, errors)
+    # derivatives of the polynomial and of its slope with respect to the parameters
+    design = np.where(mask[:, :, np.newaxis], x[:, :, np.newaxis]**powers, 0)
+    slope_design = np.where(mask[:, :, np.newaxis] & (powers > 0),
+                            powers * x[:, :, np.newaxis]**np.maximum(powers - 1, 0), 0)
+    eye = np.eye(n_parameters)
+
+    def solve(weights):
+        # normal equations scaled to a unit diagonal, the powers of the phases and the
+        # weights span many orders of magnitude
+        normal = np.einsum('nbi,nb,nbj->nij', design, weights, design)
+        with np.errstate(divide='ignore'):
+            scale = 1 / np.sqrt(np.diagonal(normal, axis1=1, axis2=2))
+        scale[~np.isfinite(scale)] = 0
+        normal *= scale[:, :, np.newaxis] * scale[:, np.newaxis, :]
+        solvable = (n_points >= n_parameters) & (np.linalg.matrix_rank(normal) == n_parameters)
+        normal[~solvable] = eye
+        values = np.linalg.solve(normal, (scale * np.einsum('nbi,nb,nb->ni', design, weights,
+                                                            y))[:, :, np.newaxis])[:, :, 0]
+        return values * scale, normal, scale, solvable
+
+    # unweighted solution (np.polyfit's), which gives the slopes that turn the phase errors
+    # into energy errors
+    values, _, _, success = solve(mask.astype(float))
+    with np.errstate(divide='ignore', over='ignore'):
+        energy_errors = np.einsum('nbi,ni->nb', slope_design, values) * sigma
+        weights = np.where(mask, 1 / energy_errors**2, 0)
+    success &= np.all(np.isfinite(weights), axis=1)
+    weights[~success] = mask[~success]
+    values, normal, scale, solvable = solve(weights)
+    success &= solvable
+
+    # covariance like lmfit: inverse Hessian scaled by the reduced chi squared
+    residual = np.einsum('nbi,ni->nb', design, values) - y
+    chi2 = np.sum(weights * residual**2, axis=1)
+    red_chi2 = chi2 / np.maximum(1, n_points - n_parameters)
+    with np.errstate(invalid='ignore', over='ignore'):
+        covar = (np.linalg.inv(normal) * scale[:, :, np.newaxis] * scale[:, np.newaxis, :] *
+                 red_chi2[:, np.newaxis, np.newaxis])
+    # a polynomial through all of the points
+    covar[n_points == n_parameters] = 0
+    covar[~success] = np.nan
+    covar[~np.all(np.isfinite(covar), axis=(1, 2))] = np.nan
+    success &= np.all(np.isfinite(values), axis=1)
+
+    # a, b, c with zeros for the parameters that aren't fit
+    columns = [[2, 1, 0].index(power) for power in powers]
+    all_values = np.zeros((n_fits, 3))
+    all_values[:, columns] = values
+    all_covar = np.zeros((n_fits, 3, 3))
+    all_covar[:, np.array(columns)[:, np.newaxis], columns] = covar
+    return {'values': all_values, 'covar': all_covar, 'chi2': chi2, 'success': success}
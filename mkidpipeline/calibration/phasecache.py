@@ -0,0 +1,109 @@
+"""
+On-disk cache of the phases that wavecal histograms, so that reruns with new fit settings
+don't read the laser .h5 files again.
+
+For each laser file the cache has every pixel's phases that are left after WaveCal's tail
+riding photon cut (only the negative ones, the ones WaveCal._histogramPhotons uses), the
+pixel's number of photons and its event rate [#/s] before the cut. Histograms are made from
+the cached phases, so bin_width, the guesses and the model can change between runs and only
+the fits are repeated. The cut depends on dt, so a cache file is keyed by dt and by the path,
+size and modification time of its laser file (see getCacheFile); a new one is made when any
+of them changes. Hashing the contents of the laser files would mean reading all of them
+again on every run.
+
+A cache file is an h5 file with the phases of all pixels in one /phases array (ordered by
+ResID) and (rows, columns) arrays /start, /n_phases, /n_photons and /rate indexing it.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import tables as tb
+
+
+def getCacheFile(cache_directory, file_name, dt):
+    """
+    Returns the cache file of a laser .h5 file and dt:
+    <cache_directory>/<file name>_<key>.h5
+    """
+    stat = os.stat(file_name)
+    key = '{}:{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns, dt)
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(cache_directory, '{}_{}.h5'.format(name, key))
+
+
+class PhaseCacheWriter:
+    """
+    Writes a cache file. The file is written under a temporary name and only gets its
+    name when close() is called, so an interrupted write isn't taken for a cache.
+
+    Args:
+        cache_file: file to write (see getCacheFile())
+        rows, columns: array size
+        source_file: the laser .h5 file
+        dt: dt of the tail riding photon cut
+    """
+    def __init__(self, cache_file, rows, columns, source_file, dt):
+        self.cache_file = cache_file
+        self.tmp_file = cache_file + '.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.file = tb.open_file(self.tmp_file, mode='w')
+        self.phases = self.file.create_earray('/', 'phases', tb.Float32Atom(), shape=(0,),
+                                              chunkshape=(2**16,))
+        self.start = np.zeros((rows, columns), dtype=np.int64)
+        self.n_phases = np.zeros((rows, columns), dtype=np.int64)
+        self.n_photons = np.zeros((rows, columns), dtype=np.int64)
+        self.rate = np.full((rows, columns), np.nan)
+        self.file.root._v_attrs.source_file = os.path.abspath(source_file)
+        self.file.root._v_attrs.dt = dt
+
+    def addPixels(self, pixels, phase_lists, n_photons, rates):
+        """
+        Appends the phases, number of photons and event rate (None if there is at most one
+        photon) of each (row, column) in pixels
+        """
+        start = self.phases.nrows
+        for (row, column), phases, n, rate in zip(pixels, phase_lists, n_photons, rates):
+            self.start[row, column] = start
+            self.n_phases[row, column] = len(phases)
+            self.n_photons[row, column] = n
+            self.rate[row, column] = np.nan if rate is None else rate
+            start += len(phases)
+        if phase_lists:
+            self.phases.append(np.concatenate(phase_lists).astype(np.float32))
+
+    def close(self):
+        """Writes the index and moves the file to cache_file"""
+        for name in ('start', 'n_phases', 'n_photons', 'rate'):
+            self.file.create_array('/', name, getattr(self, name))
+        self.file.close()
+        os.replace(self.tmp_file, self.cache_file)
+
+
+class PhaseCache:
+    """
+    Reads the phases of single pixels from a cache file. Keep one per process, the file
+    stays open.
+    """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.file = tb.open_file(cache_file, mode='r')
+        self.phases = self.file.root.phases
+        self.start = self.file.root.start.read()
+        self.n_phases = self.file.root.n_phases.read()
+        self.n_photons = self.file.root.n_photons.read()
+        self.rate = self.file.root.rate.read()
+
+    def getPixelPhases(self, row, column):
+        """
+        Returns the cached phases, number of photons and event rate [#/s] (NaN if there
+        is at most one photon) of a pixel
+        """
+        start = self.start[row, column]
+        phases = self.phases[start:start + self.n_phases[row, column]]
+        return phases, self.n_photons[row, column], self.rate[row, column]
+
+    def close(self):
+        self.file.close()
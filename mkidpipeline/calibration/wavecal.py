@@ -20,7 +20,9 @@ from matplotlib.backends.backend_pdf import PdfPages
 from progressbar import Bar, ETA, Percentage, ProgressBar, Timer
 
 import mkidpipeline.utils.pipelinelog as pipelinelog
-from mkidpipeline.wavecal import fitModels, plotSummary
+from mkidpipeline.calibration.wavecalplots import fitModels, plotSummary
+from mkidpipeline.calibration.batchfit import fitGaussianAndExp, fitPolynomial
+from mkidpipeline.calibration.phasecache import PhaseCache, PhaseCacheWriter, getCacheFile
 from mkidpipeline.core import pixelflags
 from mkidpipeline.core.headers import (WaveCalDebugDescription, WaveCalDescription, WaveCalHeader)
 from mkidpipeline.hdf.darkObsFile import ObsFile
@@ -52,6 +54,24 @@ def makeHDFscripts(wavecfg):
     return scripts
 
 
+def makeHDFfiles(wavecfg, ncpu=1):
+    """
+    Converts the .bin files of each wavelength with mkidpipeline.hdf.bin2hdf.convert, in this
+    process, instead of running Bin2HDF through the scripts from makeHDFscripts.
+    """
+    from mkidpipeline.hdf.bin2hdf import convert
+
+    log = getLogger('WaveCal')
+    for wave, startt, intt in zip(wavecfg.wavelengths, wavecfg.startTimes, wavecfg.expTimes):
+        h5file = os.path.join(wavecfg.h5directory, '{}.h5'.format(startt))
+        log.info('Converting {} nm to {}'.format(wave, h5file))
+        result = convert(wavecfg.dataDir, startt, intt, wavecfg.beamDir, h5file, nXPix=wavecfg.xpix,
+                         nYPix=wavecfg.ypix, nProcs=ncpu)
+        for missing in result['missingFiles']:
+            log.warning('No .bin file for {}'.format(missing))
+        log.info('Converted {} photons ({:.0f} photons/s)'.format(result['nPhotons'], result['photonsPerSec']))
+
+
 def findDifferences(solution1, solution2):
     """
     Determines the pixels that were fit differently between the two solution files. This
@@ -100,6 +120,48 @@ def findDifferences(solution1, solution2):
     return good_to_bad, bad_to_good
 
 
+def findRefitPixels(solution, flags=(1, 2, 7, 8), reference=None, beam_image=None):
+    """
+    Determines the pixels of a solution file that an incremental calibration
+    (WaveCal.updateCalibration) should refit.
+
+    Args:
+        solution: the file name of the wavelength calibration .h5 file to update (string)
+        flags: pixels with a histogram fit flag (hist_flag) or an energy fit flag
+               (wave_flag) in flags are refit (see pixelflags.waveCal)
+        reference: the file name of an earlier wavelength calibration .h5 file. Pixels
+                   that changed between good and bad since it are refit (see
+                   findDifferences()). If None no pixels are refit for drifting.
+        beam_image: the (rows, columns) ResID array of the new data. If given, pixels
+                    without a solution or whose ResID changed are refit.
+
+    Returns:
+        pixels: list of tuples containing the pixels (row, column) to refit
+    """
+    with tb.open_file(solution, mode='r') as wave_cal:
+        calsoln = wave_cal.root.wavecal.calsoln.read()
+        debug_info = wave_cal.root.debug.debug_info.read(field='hist_flag')
+
+    flags = np.array(flags)
+    refit = (np.isin(calsoln['wave_flag'], flags) |
+             np.isin(debug_info, flags).reshape(len(debug_info), -1).any(axis=1))
+    pixels = set(zip(calsoln['pixel_row'][refit].tolist(), calsoln['pixel_col'][refit].tolist()))
+
+    if reference is not None:
+        good_to_bad, bad_to_good = findDifferences(reference, solution)
+        pixels.update((int(row), int(column)) for row, column in good_to_bad + bad_to_good)
+
+    if beam_image is not None:
+        solved = {(row, column): res_id for row, column, res_id in
+                  zip(calsoln['pixel_row'].tolist(), calsoln['pixel_col'].tolist(),
+                      calsoln['resid'].tolist())}
+        for (row, column), res_id in np.ndenumerate(beam_image):
+            if solved.get((row, column)) != res_id:
+                pixels.add((int(row), int(column)))
+
+    return sorted(pixels)
+
+
 class BIN2HDFConfig(object):
     #TODO this should not be part of wavecal
     template = ('{x} {y}\n'
@@ -173,6 +235,28 @@ class WaveCalConfig:
         self.summary_plot = ast.literal_eval(self.config['Output']['summary_plot'])
         self.templar_config = ast.literal_eval(self.config['Output']['templar_config'])
 
+        if self.config.has_option('Fit', 'parallel_mode'):
+            self.parallel_mode = ast.literal_eval(self.config['Fit']['parallel_mode'])
+        else:
+            self.parallel_mode = 'blocks'
+        if self.config.has_option('Fit', 'block_photons'):
+            self.block_photons = ast.literal_eval(self.config['Fit']['block_photons'])
+        else:
+            self.block_photons = 20000000
+        if self.config.has_option('Fit', 'batch_fit'):
+            self.batch_fit = ast.literal_eval(self.config['Fit']['batch_fit'])
+        else:
+            self.batch_fit = False
+        if self.config.has_option('Fit', 'batch_energy_fit'):
+            self.batch_energy_fit = ast.literal_eval(self.config['Fit']['batch_energy_fit'])
+        else:
+            self.batch_energy_fit = False
+
+        if self.config.has_option('Data', 'phase_cache'):
+            self.phase_cache = ast.literal_eval(self.config['Data']['phase_cache'])
+        else:
+            self.phase_cache = None
+
         if self.config.has_option('Data', 'bin2hdf_path'):
             self.bin2hdf_path = ast.literal_eval(self.config['Data']['bin2hdf_path'])
 
@@ -255,6 +339,14 @@ class WaveCalConfig:
         assert type(self.verbose) is bool, "verbose parameter bust be a boolean"
         assert type(self.logging) is bool, "logging parameter must be a boolean"
         assert type(self.parallel) is bool, "parallel parameter must be a boolean"
+        assert self.parallel_mode in ('blocks', 'gate'), \
+            "parallel_mode parameter must be 'blocks' or 'gate'"
+        assert type(self.block_photons) is int, "block_photons parameter must be an integer"
+        assert type(self.batch_fit) is bool, "batch_fit parameter must be a boolean"
+        assert type(self.batch_energy_fit) is bool, \
+            "batch_energy_fit parameter must be a boolean"
+        assert self.phase_cache is None or type(self.phase_cache) is str, \
+            "phase_cache parameter must be None or a string"
         assert type(self.summary_plot) is bool, "summary_plot parameter must be a boolean"
         assert type(self.plot_file_name) is str, \
             "plot_file_name parameter must be a string"
@@ -314,6 +406,7 @@ class WaveCalConfig:
                     'expTimes = {}\n'.format(self.expTimes) +
                     'dataDir = "{}"\n'.format(self.dataDir) +
                     'beamDir = "{}"\n'.format(self.beamDir) +
+                    'phase_cache = {!r}\n'.format(self.phase_cache) +
                     'xpix = {}\n'.format(self.xpix) +
                     'ypix = {}\n'.format(self.ypix) +
                     '\n'
@@ -323,6 +416,10 @@ class WaveCalConfig:
                     'bin_width = {}\n'.format(self.bin_width)+
                     'dt = {}\n'.format(self.dt)+
                     'parallel = {}\n'.format(self.parallel)+
+                    'parallel_mode = "{}"\n'.format(self.parallel_mode)+
+                    'block_photons = {}\n'.format(self.block_photons)+
+                    'batch_fit = {}\n'.format(self.batch_fit)+
+                    'batch_energy_fit = {}\n'.format(self.batch_energy_fit)+
                     '\n'
                     '[Output]\n'
                     '\n'
@@ -356,10 +453,11 @@ class WaveCal:
         worker_slave: determines if the object is in charge of computing the histogram
                       fits for the pixels assigned to it
 
-        If the object is a worker_slave, five more arguments are required.
+        If the object is a worker_slave, five more arguments are required (only pid if it
+        opens the .h5 files itself, see getPhaseHeightsBlocks).
         pid: Unique number to identify the process internally (integer)
         request_data: multiprocessing queue object used to request pixels from the
-                      data_slave.
+                      data_slave. If None, the worker_slave opens the .h5 files itself.
         load_data: multiprocessing queue used to retrieve .h5 file contents from the data
                    slave
         rows: number of rows in the array (needed because the .h5 files can't be opened
@@ -383,6 +481,8 @@ class WaveCal:
         self.load_data = load_data
         self.rows = rows
         self.columns = columns
+        self.photon_cache = None
+        self.phase_caches = None
         self._checkbasics()
 
         #load configuration
@@ -411,7 +511,7 @@ class WaveCal:
         indices = np.argsort(self.cfg.wavelengths)
         self.wavelengths = np.array(self.cfg.wavelengths)[indices]
         self.file_names = np.array(self.cfg.file_names)[indices]
-        if self.master or self.data_slave:
+        if self.master or self.data_slave or (self.worker_slave and self.request_data is None):
             self.obs = [ObsFile(os.path.join(self.cfg.h5directory, f)) for f in self.file_names]
 
             # get the array size from the beam map and check that all files are the same
@@ -465,7 +565,7 @@ class WaveCal:
                 assert np.shape(obs.beamImage) == (self.rows, self.columns), \
                     "All files must have the same beam map shape."
 
-    def makeCalibration(self, pixels=[]):
+    def makeCalibration(self, pixels=[], previous_solution=None):
         """
         Compute the wavelength calibration for the pixels in 'pixels' and save the data
         in the standard .h5 format.
@@ -474,6 +574,8 @@ class WaveCal:
             pixels: a list of length 2 lists containing the (row, column) of the pixels
                     on which to compute a phase-energy relation. If it isn't specified,
                     all of the pixels in the array are used.
+            previous_solution: the file name of a solution file to copy the other pixels
+                               from (see exportData()). If None only 'pixels' are saved.
 
         Returns:
             Nothing is returned but a .h5 solution file is saved in the output directory
@@ -486,11 +588,19 @@ class WaveCal:
                 if self.cfg.parallel:
                     self._checkParallelOptions()
                     self.cpu_count = int(np.ceil(mp.cpu_count() / 2))
-                    self.getPhaseHeightsParallel(self.cpu_count, pixels=pixels)
+                    if self.cfg.parallel_mode == 'gate':
+                        self.getPhaseHeightsParallel(self.cpu_count, pixels=pixels)
+                    else:
+                        # the workers open the cache themselves
+                        if self.cfg.phase_cache is not None:
+                            self.buildPhaseCache()
+                        self.getPhaseHeightsBlocks(self.cpu_count, pixels=pixels)
                 else:
+                    if self.cfg.phase_cache is not None:
+                        self.loadPhaseCache()
                     self.getPhaseHeights(pixels=pixels)
                 self.calculateCoefficients(pixels=pixels)
-                self.exportData(pixels=pixels)
+                self.exportData(pixels=pixels, previous_solution=previous_solution)
                 if self.cfg.summary_plot:
                     self.dataSummary()
             except (KeyboardInterrupt, BrokenPipeError):
@@ -498,6 +608,42 @@ class WaveCal:
             except UserError as err:
                 log.error(err)
 
+    def updateCalibration(self, solution, flags=(1, 2, 7, 8), reference=None, pixels=None):
+        """
+        Incremental version of makeCalibration(): refits only the pixels of an existing
+        solution file that failed or drifted and saves a new solution file with the other
+        pixels copied from it.
+
+        Args:
+            solution: the file name of the wavelength calibration .h5 file to update
+            flags, reference: which pixels to refit (see findRefitPixels()). Pixels
+                              that aren't in the solution or whose ResID changed are
+                              always refit.
+            pixels: a list of the (row, column) of the pixels to refit instead of the ones
+                    chosen by flags and reference
+
+        Returns:
+            Nothing is returned but a .h5 solution file is saved in the output directory
+            specified in the configuration file. Its header records the solution it was
+            made from and the refit pixels.
+        """
+        if pixels is None:
+            pixels = findRefitPixels(solution, flags, reference, self.obs[0].beamImage)
+        self._log.info("## updating {0}: refitting {1} pixels".format(solution, len(pixels)))
+        if self.cfg.verbose:
+            self._clog.info('refitting {0} pixels of {1}'.format(len(pixels), solution))
+        if len(pixels) == 0:
+            # nothing changed, but still make the new solution file
+            tmp_file = self.cal_file + '.tmp'
+            with tb.open_file(solution, mode='r') as file_:
+                file_.copy_file(tmp_file, overwrite=True)
+            with tb.open_file(tmp_file, mode='a') as file_:
+                self._saveProvenance(file_, solution, pixels)
+            os.replace(tmp_file, self.cal_file)
+            return
+        self.makeCalibration(pixels=[tuple(pixel) for pixel in pixels],
+                             previous_solution=solution)
+
     def getPhaseHeightsParallel(self, n_processes, pixels=[]):
         """
         Fits the phase height histogram to a model for a specified list of pixels. Uses
@@ -614,9 +760,106 @@ class WaveCal:
         for (row, column) in result_dict.keys():
             self.fit_data[row, column] = result_dict[(row, column)]
 
+    def getPhaseHeightsBlocks(self, n_processes, pixels=[]):
+        """
+        Parallel version of getPhaseHeights() without a process for accessing the .h5
+        files: each worker opens the files itself (read only) and is sent blocks of pixels
+        with consecutive ResIDs (see _getPixelBlocks). The photon lists of a block are read
+        with one getBatchedPixelPhotonList call per wavelength, which is a few contiguous
+        PhotonTable reads if the files have a PixelIndex, so no photon data goes through
+        queues and reading scales with the number of workers.
+
+        Args:
+            n_processes: number of processes to generate to compute the histogram fits.
+                         One more process prints the progress bar (if verbose is True in
+                         the config file).
+            pixels: a list of length 2 lists containing the (row, column) of the pixels
+                    on which to compute a phase-energy relation. If it isn't specified,
+                    all of the pixels in the array are used.
+
+        Returns:
+            Nothing is returned, but a self.fit_data attribute is created (see
+            getPhaseHeightsParallel()).
+        """
+        # check inputs
+        pixels = self._checkPixelInputs(pixels)
+
+        if self.cfg.verbose:
+            self._clog.info('fitting phase histograms')
+            progress_queue = mp.Queue()
+            progress = ProgressWorker(progress_queue, len(pixels))
+        else:
+            progress_queue = None
+
+        # make pixel block in and result out queues and the workers
+        in_queue = mp.Queue()
+        out_queue = mp.Queue()
+        workers = []
+        for i in range(n_processes):
+            workers.append(BlockWorker(in_queue, out_queue, progress_queue, self.cfg.file, i,
+                                       self._log))
+
+        try:
+            blocks = self._getPixelBlocks(pixels, n_processes)
+            for block in blocks:
+                in_queue.put(block)
+            for i in range(n_processes):
+                in_queue.put(None)
+
+            # collect the results of every block into a single result_dict
+            result_dict = {}
+            for i in range(len(blocks)):
+                result = out_queue.get()
+                if isinstance(result, Exception):
+                    raise result
+                result_dict.update(result)
+
+            if self.cfg.verbose:
+                progress.join()
+            for w in workers:
+                w.join()
+        except (KeyboardInterrupt, BrokenPipeError):
+            processes = workers + [progress] if self.cfg.verbose else workers
+            for p in processes:
+                self._clog.info("PID {0} ... exiting".format(p.pid))
+                p.terminate()
+                p.join()
+            raise KeyboardInterrupt
+
+        # populate fit_data with results from workers
+        self.fit_data = np.empty((self.rows, self.columns), dtype=object)
+        for ind, _ in np.ndenumerate(self.fit_data):
+            self.fit_data[ind] = []
+        for (row, column) in result_dict.keys():
+            self.fit_data[row, column] = result_dict[(row, column)]
+
+    def _getPixelBlocks(self, pixels, n_processes):
+        """
+        Sorts the pixels by ResID and splits them into blocks for getPhaseHeightsBlocks().
+        Each block has about a quarter of a worker's share of the photons (so the work is
+        balanced) but at most block_photons photons summed over all wavelengths (so a
+        block's photon lists fit in memory).
+        """
+        pixels = np.reshape(np.array(pixels, dtype=int), (-1, 2))
+        res_ids = self.obs[0].beamImage[pixels[:, 0], pixels[:, 1]]
+        pixels = pixels[np.argsort(res_ids, kind='stable')]
+
+        # without a PixelIndex every pixel counts as one photon
+        n_photons = np.ones(len(pixels))
+        for obs in self.obs:
+            if obs.pixelNRows is not None:
+                n_photons += obs.pixelNRows[pixels[:, 0], pixels[:, 1]]
+        block_photons = max(min(n_photons.sum() / (4 * n_processes), self.cfg.block_photons), 1)
+        block_indices = (np.cumsum(n_photons) - n_photons) // block_photons
+        boundaries = np.flatnonzero(np.diff(block_indices)) + 1
+        return [[(int(row), int(column)) for row, column in block]
+                for block in np.split(pixels, boundaries)]
+
     def getPhaseHeights(self, pixels=[]):
         """
-        Fits the phase height histogram to a model for a specified list of pixels.
+        Fits the phase height histogram to a model for a specified list of pixels. If the
+        batch_fit option is set (and save_plots isn't) all of the pixels are fit together
+        (see _getPhaseHeightsBatched()).
 
         Args:
             pixels: a list of length 2 lists containing the (row, column) of the pixels
@@ -650,119 +893,92 @@ class WaveCal:
         for ind, _ in np.ndenumerate(fit_data):
             fit_data[ind] = []
 
-        # loop over pixels and fit the phase histograms
-        for row, column in pixels:
-            # initialize rate parameter
-            rate = 2000
-            for wavelength_index, wavelength in enumerate(self.wavelengths):
-
-                start_time = datetime.now()
-                # pull out fits already done for this wavelength
-                fit_list = fit_data[row, column]
-
-                # load data
-                photon_list = self.loadPhotonData(row, column, wavelength_index)
-
-                # recalculate event rate [#/s] if it's been flaged as hot before
-                if rate > 1800 and len(photon_list['Wavelength']) > 1:
-                    rate = (len(photon_list['Wavelength']) /
-                            (max(photon_list['Time']) - min(photon_list['Time']))) * 1e6
-
-                # if there is no data go to next loop
-                if len(photon_list['Wavelength']) <= 1:
-                    fit_data[row, column].append((3, False, False,
-                                                  {'centers': np.array([]),
-                                                   'counts': np.array([])}))
-                    # update progress bar and log
-                    dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
-                    self._log.info("({0}, {1}) {2}nm: {3} : {4}".format(row, column, wavelength,
-                                    self.flag_dict[3], dt))
-                    if self.cfg.verbose and wavelength_index == len(self.wavelengths) - 1:
-                        self.pbar_iter += 1
-                        self.pbar.update(self.pbar_iter)
-                    continue
-
-                # cut photons too close together in time
-                photon_list = self._removeTailRidingPhotons(photon_list, self.cfg.dt)
-
-                # make the phase histogram
-                phase_hist = self._histogramPhotons(photon_list['Wavelength'])
-
-                # if there is not enough data or too much go to next loop
-                if len(phase_hist['centers']) == 0 or np.max(phase_hist['counts']) < 20:
-                    flag = 3
-                elif rate > 1800:
-                    flag = 10
-                else:
-                    flag = 0  # for now
-                if flag == 3 or flag == 10:
-                    fit_data[row, column].append((flag, False, False, phase_hist))
-                    # update progress bar and log
+        if self.cfg.batch_fit and not self.cfg.save_plots:
+            # fit all of the pixels together
+            self._getPhaseHeightsBatched(pixels, fit_data)
+        else:
+            # loop over pixels and fit the phase histograms
+            for row, column in pixels:
+                # initialize rate parameter
+                rate = 2000
+                for wavelength_index, wavelength in enumerate(self.wavelengths):
+
+                    start_time = datetime.now()
+                    # pull out fits already done for this wavelength
+                    fit_list = fit_data[row, column]
+
+                    # load data, make the phase histogram and go to next loop if there is not
+                    # enough data or too much
+                    phase_hist, flag, rate = self._loadPhaseHistogram(row, column, wavelength_index,
+                                                                      rate)
+                    if flag is not None:
+                        fit_data[row, column].append((flag, False, False, phase_hist))
+                        # update progress bar and log
+                        dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
+                        self._log.info("({0}, {1}) {2}nm: {3} : {4}".format(row, column, wavelength,
+                                        self.flag_dict[flag], dt))
+                        if self.cfg.verbose and wavelength_index == len(self.wavelengths) - 1:
+                            self.pbar_iter += 1
+                            self.pbar.update(self.pbar_iter)
+                        continue
+
+                    # get fit model
+                    fit_function = fitModels(self.cfg.model_name)
+
+                    # determine iteration range based on if there are other wavelength fits
+                    _, _, success = self._findLastGoodFit(fit_list)
+                    if success and self.cfg.model_name == 'gaussian_and_exp':
+                        fit_numbers = range(6)
+                    elif self.cfg.model_name == 'gaussian_and_exp':
+                        fit_numbers = range(5)
+                    else:
+                        raise ValueError('invalid model_name')
+
+                    fit_results = []
+                    flags = []
+                    for fit_number in fit_numbers:
+                        # get guess for fit
+                        setup = self._setupFit(phase_hist, fit_list, wavelength_index,
+                                               fit_number)
+                        # fit data
+                        fit_results.append(self._fitPhaseHistogram(phase_hist,
+                                                                    fit_function,
+                                                                    setup, row, column))
+                        # evaluate how the fit did
+                        flags.append(self._evaluateFit(phase_hist, fit_results[-1], fit_list,
+                                                        wavelength_index))
+                        if flags[-1] == 0:
+                            break
+                    # find best fit
+                    fit_result, flag = self._findBestFit(fit_results, flags, phase_hist)
+
+                    # save data in fit_data object
+                    fit_data[row, column].append((flag, fit_result[0], fit_result[1],
+                                                  phase_hist))
+
+                    # plot data (will skip if save_plots is set to be true)
+                    self._plotFit(phase_hist, fit_result, fit_function, flag, row, column)
+
+                    # update log
                     dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
                     self._log.info("({0}, {1}) {2}nm: {3} : {4}".format(row, column, wavelength,
-                                    self.flag_dict[3], dt))
-                    if self.cfg.verbose and wavelength_index == len(self.wavelengths) - 1:
-                        self.pbar_iter += 1
-                        self.pbar.update(self.pbar_iter)
-                    continue
+                                    self.flag_dict[flag], dt))
+                # check to see if fits at longer wavelengths can be used to fix fits at
+                # shorter wavelengths
+                fit_list = fit_data[row, column]
+                fit_list = self._reexamineFits(fit_list, row, column)
 
-                # get fit model
-                fit_function = fitModels(self.cfg.model_name)
+                # try to fit all of the histograms at once enforcing monotonicity
+                # full_fit = self._simultaneousFit(fit_list, row, column, vary=True)
+                # if full_fit is not None:
+                #     fit_list = full_fit
 
-                # determine iteration range based on if there are other wavelength fits
-                _, _, success = self._findLastGoodFit(fit_list)
-                if success and self.cfg.model_name == 'gaussian_and_exp':
-                    fit_numbers = range(6)
-                elif self.cfg.model_name == 'gaussian_and_exp':
-                    fit_numbers = range(5)
-                else:
-                    raise ValueError('invalid model_name')
-
-                fit_results = []
-                flags = []
-                for fit_number in fit_numbers:
-                    # get guess for fit
-                    setup = self._setupFit(phase_hist, fit_list, wavelength_index,
-                                           fit_number)
-                    # fit data
-                    fit_results.append(self._fitPhaseHistogram(phase_hist,
-                                                                fit_function,
-                                                                setup, row, column))
-                    # evaluate how the fit did
-                    flags.append(self._evaluateFit(phase_hist, fit_results[-1], fit_list,
-                                                    wavelength_index))
-                    if flags[-1] == 0:
-                        break
-                # find best fit
-                fit_result, flag = self._findBestFit(fit_results, flags, phase_hist)
-
-                # save data in fit_data object
-                fit_data[row, column].append((flag, fit_result[0], fit_result[1],
-                                              phase_hist))
-
-                # plot data (will skip if save_plots is set to be true)
-                self._plotFit(phase_hist, fit_result, fit_function, flag, row, column)
-
-                # update log
-                dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
-                self._log.info("({0}, {1}) {2}nm: {3} : {4}".format(row, column, wavelength,
-                                self.flag_dict[flag], dt))
-            # check to see if fits at longer wavelengths can be used to fix fits at
-            # shorter wavelengths
-            fit_list = fit_data[row, column]
-            fit_list = self._reexamineFits(fit_list, row, column)
-
-            # try to fit all of the histograms at once enforcing monotonicity
-            # full_fit = self._simultaneousFit(fit_list, row, column, vary=True)
-            # if full_fit is not None:
-            #     fit_list = full_fit
-
-            fit_data[row, column] = fit_list
+                fit_data[row, column] = fit_list
 
-            # update progress bar
-            if self.cfg.verbose:
-                self.pbar_iter += 1
-                self.pbar.update(self.pbar_iter)
+                # update progress bar
+                if self.cfg.verbose:
+                    self.pbar_iter += 1
+                    self.pbar.update(self.pbar_iter)
 
         # close progress bar
         if self.cfg.verbose:
@@ -773,10 +989,75 @@ class WaveCal:
 
         self.fit_data = fit_data
 
+    def _getPhaseHeightsBatched(self, pixels, fit_data):
+        """
+        Fits the phase height histograms of all of the pixels together, one wavelength and
+        fit attempt at a time, with batchfit.fitGaussianAndExp(). Each pixel gets the same
+        initial guesses, flags and refits as in the pixel by pixel loop of getPhaseHeights().
+        The fits are added to fit_data.
+        """
+        pixels = [tuple(pixel) for pixel in pixels]
+        rates = {pixel: 2000 for pixel in pixels}
+        for wavelength_index, wavelength in enumerate(self.wavelengths):
+            start_time = datetime.now()
+            # load data and make the phase histograms
+            phase_hists = {}
+            for pixel in pixels:
+                phase_hist, flag, rates[pixel] = self._loadPhaseHistogram(*pixel, wavelength_index,
+                                                                          rates[pixel])
+                if flag is not None:
+                    fit_data[pixel].append((flag, False, False, phase_hist))
+                    self._log.info("({0}, {1}) {2}nm: {3}".format(*pixel, wavelength,
+                                                                  self.flag_dict[flag]))
+                else:
+                    phase_hists[pixel] = phase_hist
+
+            # determine iteration range based on if there are other wavelength fits
+            if self.cfg.model_name != 'gaussian_and_exp':
+                raise ValueError('invalid model_name')
+            n_fits = {pixel: 6 if self._findLastGoodFit(fit_data[pixel])[2] else 5
+                      for pixel in phase_hists}
+
+            # fit each guess to the pixels without a good fit yet
+            fit_results = {pixel: [] for pixel in phase_hists}
+            flags = {pixel: [] for pixel in phase_hists}
+            for fit_number in range(max(n_fits.values(), default=0)):
+                batch = [pixel for pixel in phase_hists if len(flags[pixel]) < n_fits[pixel]
+                         and 0 not in flags[pixel]]
+                setups = [self._setupFit(phase_hists[pixel], fit_data[pixel], wavelength_index,
+                                         fit_number) for pixel in batch]
+                results = self._fitPhaseHistograms([phase_hists[pixel] for pixel in batch],
+                                                   setups, batch)
+                for pixel, fit_result in zip(batch, results):
+                    fit_results[pixel].append(fit_result)
+                    flags[pixel].append(self._evaluateFit(phase_hists[pixel], fit_result,
+                                                          fit_data[pixel], wavelength_index))
+
+            # find best fits and save them in the fit_data object
+            for pixel, phase_hist in phase_hists.items():
+                fit_result, flag = self._findBestFit(fit_results[pixel], flags[pixel],
+                                                     phase_hist)
+                fit_data[pixel].append((flag, fit_result[0], fit_result[1], phase_hist))
+                self._log.info("({0}, {1}) {2}nm: {3}".format(*pixel, wavelength,
+                                                              self.flag_dict[flag]))
+
+            # update log and progress bar
+            dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
+            self._log.info("{0}nm: fit {1} pixels : {2}".format(wavelength, len(pixels), dt))
+            if self.cfg.verbose:
+                self.pbar_iter = (len(pixels) * (wavelength_index + 1)) // len(self.wavelengths)
+                self.pbar.update(self.pbar_iter)
+
+        # check to see if fits at longer wavelengths can be used to fix fits at shorter
+        # wavelengths
+        self._reexamineFitsBatched(pixels, fit_data)
+
     def calculateCoefficients(self, pixels=[]):
         """
         Loop through the results of 'getPhaseHeights()' and fit energy vs phase height
-        to a parabola.
+        to a parabola. If the batch_energy_fit option is set the quadratic and linear fits
+        of all of the pixels are done together first with closed form weighted least
+        squares, which gives slightly different solutions (see _fitEnergies()).
 
         Args:
             pixels: a list of length 2 lists containing the (row, column) of the pixels
@@ -807,51 +1088,41 @@ class WaveCal:
         # initialize wavelength_cal structure
         wavelength_cal = np.empty((self.rows, self.columns), dtype=object)
 
+        # collect the good histogram fits of each pixel
+        energies = h.to('eV s').value * c.to('nm/s').value / np.array(self.wavelengths)
+        energy_data = {}
+        for row, column in pixels:
+            energy_data[row, column] = self._getEnergyData(self.fit_data[row, column],
+                                                           energies)
+
+        # fit all of the pixels with enough monotonic points together
+        batch_fits = {'quadratic': {}, 'linear': {}, 'linear_zero': {}}
+        fit_pixels = [pixel for pixel in pixels if energy_data[pixel]['fit']]
+        if self.cfg.batch_energy_fit and fit_pixels:
+            for fit_type in batch_fits.keys():
+                results = self._fitEnergies(fit_type,
+                                            [energy_data[pixel] for pixel in fit_pixels])
+                batch_fits[fit_type] = dict(zip(fit_pixels, results))
+
+        def fitEnergy(fit_type, phases, energies, errors, row, column):
+            # use the batched fit if there is one
+            fit_result = batch_fits[fit_type].get((row, column))
+            if fit_result is None:
+                fit_result = self._fitEnergy(fit_type, phases, energies, errors, row, column)
+            return fit_result
+
         for row, column in pixels:
             fit_results = self.fit_data[row, column]
+            data = energy_data[row, column]
+            phases, std, errors = data['phases'], data['std'], data['errors']
 
-            # count the number of good fits and save their data
-            count = 0
-            wavelengths = []
-            phases = []
-            std = []
-            errors = []
-            for index, fit_result in enumerate(fit_results):
-                if fit_result[0] == 0:
-                    count += 1
-                    wavelengths.append(self.wavelengths[index])
-                    if self.cfg.model_name == 'gaussian_and_exp':
-                        phases.append(fit_result[1][3])
-                        std.append(fit_result[1][4])
-                        if fit_result[2][3, 3] <= 0:
-                            errors.append(np.sqrt(fit_result[1][4]))
-                        else:
-                            errors.append(np.sqrt(fit_result[2][3, 3]))
-                    else:
-                        raise ValueError("{0} is not a valid fit model name"
-                                         .format(self.cfg.model_name))
-            phases = np.array(phases)
-            std = np.array(std)
-            errors = np.array(errors)
-
-            # mask out data points that are within error for monotonic consideration
-            if count > 1:
-                dE = np.diff(wavelengths) / np.mean(wavelengths)**2  # proportional to
-                diff = np.diff(phases)
-                mask = np.ones(diff.shape, dtype=bool)
-                for ind, _ in enumerate(mask):
-                    if diff[ind] < 0 and (-diff[ind] < errors[ind] or
-                                          -diff[ind] < errors[ind + 1]):
-                        mask[ind] = False
-
-            if count > 1 and ((diff < -2e8 * dE / np.mean(wavelengths))[mask].any()
-                              or sum(mask) == 0):
+            if data['flag'] == 7:
                 flag = 7  # data not monotonic enough
                 wavelength_cal[row, column] = (flag, False, False)
 
             # if there are enough points fit the wavelengths
-            elif count > 2:
-                energies = h.to('eV s').value * c.to('nm/s').value / np.array(wavelengths)
+            elif data['fit']:
+                energies = data['energies']
 
                 phase_list1 = []
                 phase_list2 = []
@@ -864,8 +1135,8 @@ class WaveCal:
                 max_width = np.max(bin_widths)
                 self.current_threshold = np.max(phase_list1) + max_width / 2
                 self.current_min = np.min(phase_list2) - max_width / 2
-                popt, pcov = self._fitEnergy('quadratic', phases, energies,
-                                              errors, row, column)
+                popt, pcov = fitEnergy('quadratic', phases, energies, errors, row,
+                                       column)
 
                 # refit if vertex is between wavelengths or slope is positive
                 ind_max = np.argmax(phases)
@@ -886,13 +1157,13 @@ class WaveCal:
                     conditions = conditions or (vertex_val < 0 or max_val < 0 or
                                                 min_val < 0)
                 if conditions:
-                    popt, pcov = self._fitEnergy('linear', phases, energies,
-                                                  errors, row, column)
+                    popt, pcov = fitEnergy('linear', phases, energies, errors, row,
+                                           column)
 
                     if popt is False or popt[1] > 0 or (max_phase > -popt[2] / popt[1]
                                                         and popt[1] < 0):
-                        popt, pcov = self._fitEnergy('linear_zero', phases, energies,
-                                                      errors, row, column)
+                        popt, pcov = fitEnergy('linear_zero', phases, energies, errors, row,
+                                               column)
                         if popt is False or popt[1] > 0:
                             flag = 8  # linear fit unsuccessful
                             wavelength_cal[row, column] = (flag, False, False)
@@ -920,7 +1191,7 @@ class WaveCal:
 
         self.wavelength_cal = wavelength_cal
 
-    def exportData(self, pixels=[]):
+    def exportData(self, pixels=[], previous_solution=None):
         """
         Saves data in the WaveCal format to the filename.
 
@@ -928,6 +1199,10 @@ class WaveCal:
             pixels: a list of length 2 lists containing the (row, column) of the pixels
                     on which to compute a phase-energy relation. If it isn't specified,
                     all of the pixels in the array are used.
+            previous_solution: the file name of a solution file (with the same
+                               wavelengths) to copy the other pixels from. Only pixels
+                               whose ResID hasn't changed are copied. The header records
+                               the previous solution and the pixels in 'pixels'.
 
         Returns:
             Nothing is returned, but a .h5 file is created with the fit information
@@ -939,6 +1214,11 @@ class WaveCal:
         # check inputs
         pixels = self._checkPixelInputs(pixels)
 
+        # load the pixels to copy from the previous solution
+        if previous_solution is not None:
+            old_calsoln, old_debug_info = self._readPreviousSolution(previous_solution,
+                                                                     pixels)
+
         # load wavecal header
         wavecal_description = WaveCalDescription(len(self.wavelengths))
 
@@ -968,6 +1248,8 @@ class WaveCal:
         info.row['model_name'] = self.cfg.model_name
         info.row.append()
         info.flush()
+        if previous_solution is not None:
+            self._saveProvenance(file_, previous_solution, pixels)
 
         # populate wavecal
         calsoln = file_.create_table(wavecal, 'calsoln', wavecal_description,
@@ -1017,6 +1299,9 @@ class WaveCal:
             if self.cfg.verbose:
                 self.pbar_iter += 1
                 self.pbar.update(self.pbar_iter)
+        if previous_solution is not None:
+            calsoln.append(old_calsoln)
+            self._sortByResID(calsoln)
         calsoln.flush()
 
         self._log.info("wavecal table saved")
@@ -1029,6 +1314,8 @@ class WaveCal:
                 phase_centers = fit_list[3]['centers']
                 lengths.append(len(phase_centers))
         max_l = np.max(lengths)
+        if previous_solution is not None and len(old_debug_info) > 0:
+            max_l = max(max_l, len(old_debug_info['phase_centers0'][0]))
 
         # make debug table
         if self.cfg.model_name == 'gaussian_and_exp':
@@ -1087,6 +1374,17 @@ class WaveCal:
             if self.cfg.verbose:
                 self.pbar_iter += 1
                 self.pbar.update(self.pbar_iter)
+        if previous_solution is not None:
+            # pad the histograms to the new length like above
+            copied = np.zeros(len(old_debug_info), dtype=debug_info.dtype)
+            for name in old_debug_info.dtype.names:
+                if name.startswith('phase_centers') or name.startswith('phase_counts'):
+                    copied[name] = 1 if name.startswith('phase_centers') else -1
+                    copied[name][:, :old_debug_info[name].shape[1]] = old_debug_info[name]
+                else:
+                    copied[name] = old_debug_info[name]
+            debug_info.append(copied)
+            self._sortByResID(debug_info)
         debug_info.flush()
 
         self._log.info("debug information saved")
@@ -1096,6 +1394,60 @@ class WaveCal:
         if self.cfg.verbose:
             self.pbar.finish()
 
+    def _readPreviousSolution(self, previous_solution, pixels):
+        """
+        Returns the calsoln and debug_info rows of a previous solution file for the
+        pixels that aren't in 'pixels' and still have the same ResID
+        """
+        with tb.open_file(previous_solution, mode='r') as file_:
+            wavelengths = file_.root.header.wavelengths.read()
+            calsoln = file_.root.wavecal.calsoln.read()
+            debug_info = file_.root.debug.debug_info.read()
+        if not np.array_equal(np.ravel(wavelengths), self.wavelengths):
+            raise ValueError("{0} has different wavelengths".format(previous_solution))
+
+        refit = set((int(row), int(column)) for row, column in pixels)
+        res_ids = self.obs[0].beamImage
+
+        def keep(table):
+            rows, columns = table['pixel_row'].astype(int), table['pixel_col'].astype(int)
+            inside = (rows < self.rows) & (columns < self.columns)
+            keep = np.zeros(len(table), dtype=bool)
+            keep[inside] = res_ids[rows[inside], columns[inside]] == table['resid'][inside]
+            keep &= np.array([pixel not in refit for pixel in zip(rows.tolist(), columns.tolist())],
+                             dtype=bool)
+            return table[keep]
+
+        calsoln = keep(calsoln)
+        debug_info = keep(debug_info)
+        self._log.info("copying {0} pixels from {1}".format(len(calsoln), previous_solution))
+        return calsoln, debug_info
+
+    def _saveProvenance(self, file_, previous_solution, pixels):
+        """
+        Records the solution file that a solution was updated from and the refit pixels
+        in its header
+        """
+        header = file_.root.header
+        header._v_attrs.previous_solution = os.path.abspath(previous_solution)
+        header._v_attrs.updated = str(datetime.utcnow())
+        if 'refitPixels' in header:  # the previous solution was an update too
+            file_.remove_node(header, 'refitPixels')
+        pixel_type = WaveCalDescription(len(self.wavelengths))['pixel_row'].dtype
+        file_.create_array(header, 'refitPixels',
+                           obj=np.array(pixels, dtype=pixel_type).reshape(-1, 2),
+                           title='(row, column) of the pixels refit in the update')
+
+    @staticmethod
+    def _sortByResID(table):
+        """
+        Sorts the rows of a solution file table by ResID, so that the copied rows of an
+        updated solution aren't all at the end
+        """
+        table.flush()
+        rows = table.read()
+        table.modify_rows(0, len(rows), rows=rows[np.argsort(rows['resid'], kind='stable')])
+
     def dataSummary(self):
         """
         Generates a summary plot of the data to the output directory. During calibration
@@ -1117,12 +1469,28 @@ class WaveCal:
                            'using plotSummary() in plotWaveCal.py', exc_info=True)
             self._log.error("summary plot failed", exc_info=True)
 
+    def preloadPhotonData(self, pixels):
+        """
+        Reads the photon lists of the pixels at every wavelength with one
+        getBatchedPixelPhotonList call per wavelength. loadPhotonData() hands them out
+        from memory (each one once).
+        """
+        self.photon_cache = {}
+        for wavelength_index, obs in enumerate(self.obs):
+            photon_lists = obs.getBatchedPixelPhotonList(pixels, returnViews=True,
+                                                         columns=['Time', 'Wavelength'])
+            for (row, column), photon_list in zip(pixels, photon_lists):
+                self.photon_cache[(row, column, wavelength_index)] = photon_list
+
     def loadPhotonData(self, row, column, wavelength_index):
         """
         Get a photon list for a single pixel and wavelength.
         """
         try:
-            if self.worker_slave:
+            if self.photon_cache is not None and \
+                    (row, column, wavelength_index) in self.photon_cache:
+                photon_list = self.photon_cache.pop((row, column, wavelength_index))
+            elif self.request_data is not None:
                 self.request_data.put([row, column, wavelength_index, self.pid])
                 photon_list = self.load_data.get()
             else:
@@ -1134,6 +1502,108 @@ class WaveCal:
             return np.array([], dtype=[('Time', '<u4'), ('Wavelength', '<f4'),
                                        ('SpecWeight', '<f4'), ('NoiseWeight', '<f4')])
 
+    def _getPhases(self, photon_list):
+        """
+        Returns the phases of a photon list that are left after the tail riding photon cut
+        (only the negative ones, see _histogramPhotons()), the number of photons in the
+        list and their event rate [#/s] (None if there is at most one photon)
+        """
+        n_photons = len(photon_list['Wavelength'])
+        if n_photons <= 1:
+            return np.array([], dtype=np.float32), n_photons, None
+        rate = n_photons / (max(photon_list['Time']) - min(photon_list['Time'])) * 1e6
+
+        # cut photons too close together in time
+        phases = self._removeTailRidingPhotons(photon_list, self.cfg.dt)['Wavelength']
+        return phases[phases < 0], n_photons, rate
+
+    def getPhaseCacheFiles(self):
+        """
+        Returns the phase cache file of each laser file (see phasecache.py)
+        """
+        return [getCacheFile(self.cfg.phase_cache, os.path.join(self.cfg.h5directory, f),
+                             self.cfg.dt) for f in self.file_names]
+
+    def buildPhaseCache(self):
+        """
+        Writes the phase cache files (see phasecache.py) of the laser files that don't have
+        one for the current dt, with the phases of every pixel in the array. Each file is
+        read once, in blocks of pixels with consecutive ResIDs.
+        """
+        all_pixels = [(row, column) for row in range(self.rows)
+                      for column in range(self.columns)]
+        for wavelength_index, cache_file in enumerate(self.getPhaseCacheFiles()):
+            if os.path.isfile(cache_file):
+                continue
+            start_time = datetime.now()
+            file_name = os.path.join(self.cfg.h5directory, self.file_names[wavelength_index])
+            # open the file again, a parallel master has closed it
+            obs = ObsFile(file_name)
+            writer = PhaseCacheWriter(cache_file, self.rows, self.columns, file_name,
+                                      self.cfg.dt)
+            try:
+                for block in self._getPixelBlocks(all_pixels, 1):
+                    photon_lists = obs.getBatchedPixelPhotonList(block, returnViews=True,
+                                                                 columns=['Time', 'Wavelength'])
+                    phases, n_photons, rates = zip(*[self._getPhases(photon_list)
+                                                     for photon_list in photon_lists])
+                    writer.addPixels(block, list(phases), n_photons, rates)
+                writer.close()
+            finally:
+                obs.file.close()
+            dt = str(round((datetime.now() - start_time).total_seconds(), 2)) + ' s'
+            self._log.info("{0}nm: wrote phase cache {1} : {2}".format(
+                self.wavelengths[wavelength_index], cache_file, dt))
+
+    def loadPhaseCache(self):
+        """
+        Builds the missing phase cache files and opens them. The phases are then read from
+        the cache instead of the .h5 files.
+        """
+        self.buildPhaseCache()
+        self.phase_caches = [PhaseCache(f) for f in self.getPhaseCacheFiles()]
+
+    def _loadPhaseHistogram(self, row, column, wavelength_index, rate):
+        """
+        Loads the photons of a pixel for a wavelength, cuts the tail riding photons and
+        histograms their phases.
+
+        Args:
+            row, column: the pixel
+            wavelength_index: index of the wavelength in self.wavelengths
+            rate: event rate [#/s] of the last wavelength (2000 for the first)
+
+        Returns:
+            the phase histogram, the flag if it can't be fit (3 for not enough data, 10 for
+            too much) or None, and the event rate
+        """
+        if self.phase_caches is not None:
+            phases, n_photons, pixel_rate = \
+                self.phase_caches[wavelength_index].getPixelPhases(row, column)
+        else:
+            photon_list = self.loadPhotonData(row, column, wavelength_index)
+            phases, n_photons, pixel_rate = self._getPhases(photon_list)
+
+        # recalculate event rate [#/s] if it's been flaged as hot before
+        if rate > 1800 and n_photons > 1:
+            rate = pixel_rate
+
+        # no data
+        if n_photons <= 1:
+            return {'centers': np.array([]), 'counts': np.array([])}, 3, rate
+
+        # make the phase histogram
+        phase_hist = self._histogramPhotons(phases)
+
+        # check if there is not enough data or too much
+        if len(phase_hist['centers']) == 0 or np.max(phase_hist['counts']) < 20:
+            flag = 3
+        elif rate > 1800:
+            flag = 10
+        else:
+            flag = None
+        return phase_hist, flag, rate
+
     def _checkParallelOptions(self):
         """
         Check to make sure options that are incompatible with parallel computing are not
@@ -1453,26 +1923,9 @@ class WaveCal:
                 # fit data
                 result = model.fit(phase_hist['counts'], setup, x=phase_hist['centers'],
                                    weights=1 / error)
-                # lm fit doesn't error if covariance wasn't calculated so check here
-                # replace with gaussian width if covariance couldn't be calculated
-                if result.covar is None:
-                    if self.cfg.model_name == 'gaussian_and_exp':
-                        result.covar = np.ones((5, 5)) * result.best_values['f'] / 2
-                if self.cfg.model_name == 'gaussian_and_exp':
-                    if result.covar[3, 3] == 0:
-                        result.covar = np.ones((5, 5)) * result.best_values['f'] / 2
-                # unpack results
-                if self.cfg.model_name == 'gaussian_and_exp':
-                    parameters = ['a', 'b', 'c', 'd', 'f']
-                    popt = [result.best_values[p] for p in parameters]
-                    current_order = result.var_names
-                    indices = []
-                    for p in parameters:
-                        for index, o in enumerate(current_order):
-                            if p == o:
-                                indices.append(index)
-                    pcov = result.covar[indices, :][:, indices]
-                fit_result = (popt, pcov)
+                # lm fit doesn't error if covariance wasn't calculated so check it
+                fit_result = self._unpackFit(result.best_values, result.var_names,
+                                             result.covar)
 
             except (RuntimeError, RuntimeWarning, ValueError) as error:
                 # RuntimeError catches failed minimization
@@ -1488,6 +1941,85 @@ class WaveCal:
 
         return fit_result
 
+    def _unpackFit(self, best_values, var_names, covar):
+        """
+        Returns the (popt, pcov) fit result from the best fit values, the names of the varied
+        parameters and their covariance (None if it couldn't be calculated)
+        """
+        if self.cfg.model_name == 'gaussian_and_exp':
+            # replace with gaussian width if covariance couldn't be calculated
+            if covar is None or covar[3, 3] == 0:
+                covar = np.ones((5, 5)) * best_values['f'] / 2
+            # unpack results
+            parameters = ['a', 'b', 'c', 'd', 'f']
+            popt = [best_values[p] for p in parameters]
+            indices = [var_names.index(p) for p in parameters if p in var_names]
+            pcov = covar[indices, :][:, indices]
+        else:
+            raise ValueError("{0} is not a valid fit model name".format(self.cfg.model_name))
+        return popt, pcov
+
+    def _fitPhaseHistograms(self, phase_hists, setups, pixels, batch_size=5000):
+        """
+        Fit many phase histograms to the gaussian_and_exp model at once with
+        batchfit.fitGaussianAndExp(). Histograms without a setup, setups that start a
+        varied parameter on one of its bounds (like the _numberGuess() and _medianGuess()
+        ones), fits that it doesn't finish and fits that end with a larger chi squared than
+        their guess are fit with _fitPhaseHistogram().
+
+        Args:
+            phase_hists: list of phase histograms
+            setups: list of the lm.Parameters guess for each histogram
+            pixels: list of the (row, column) of each histogram
+            batch_size: number of histograms to fit at a time
+
+        Returns:
+            list of the (popt, pcov) fit result of each histogram (see _fitPhaseHistogram())
+        """
+        fit_function = fitModels(self.cfg.model_name)
+        parameters = ['a', 'b', 'c', 'd', 'f']
+        fit_results = [None] * len(phase_hists)
+        # lmfit's internal parameters have no gradient at the bounds, and the batch steps
+        # can leave them differently than lmfit's do, so those guesses are left to lmfit
+        indices = [index for index, setup in enumerate(setups)
+                   if setup is not None and len(phase_hists[index]['centers']) > 0
+                   and not any(setup[p].vary and not setup[p].min < setup[p].value < setup[p].max
+                               for p in parameters)]
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            values = [[setups[index][p].value for p in parameters] for index in batch]
+            lower = [[setups[index][p].min for p in parameters] for index in batch]
+            upper = [[setups[index][p].max for p in parameters] for index in batch]
+            vary = np.array([[setups[index][p].vary for p in parameters] for index in batch])
+            result = fitGaussianAndExp([phase_hists[index]['centers'] for index in batch],
+                                       [phase_hists[index]['counts'] for index in batch],
+                                       values, lower, upper, vary)
+            for batch_index, index in enumerate(batch):
+                if not result['success'][batch_index]:
+                    continue
+                # don't trust a fit that is worse than where lmfit would start
+                phase_hist = phase_hists[index]
+                weights = 1 / (np.sqrt(phase_hist['counts'] + 0.25) + 0.5)
+                guess = np.clip(values[batch_index], lower[batch_index], upper[batch_index])
+                with np.errstate(over='ignore', invalid='ignore'):
+                    guess_chi2 = np.sum(((fit_function(phase_hist['centers'], *guess) -
+                                          phase_hist['counts']) * weights)**2)
+                chi2 = result['chi2'][batch_index]
+                if not np.isfinite(chi2) or (np.isfinite(guess_chi2) and chi2 > guess_chi2):
+                    continue
+                best_values = dict(zip(parameters, result['values'][batch_index].tolist()))
+                varied = np.flatnonzero(vary[batch_index])
+                covar = result['covar'][batch_index][varied, :][:, varied]
+                if not np.all(np.isfinite(covar)):
+                    covar = None
+                fit_results[index] = self._unpackFit(best_values,
+                                                     [parameters[i] for i in varied], covar)
+        for index, fit_result in enumerate(fit_results):
+            if fit_result is None:
+                fit_results[index] = self._fitPhaseHistogram(phase_hists[index], fit_function,
+                                                             setups[index], *pixels[index])
+        return fit_results
+
     def _evaluateFit(self, phase_hist, fit_result, fit_list, wavelength_index):
         """
         Evaluate the result of the fit and return a flag for different conditions.
@@ -1589,6 +2121,50 @@ class WaveCal:
         """
         start_time = datetime.now()
 
+        # get fit model
+        fit_function = fitModels(self.cfg.model_name)
+
+        # loop through bad fits and refit them
+        for wavelength_index in self._findRefits(fit_list):
+            # setup fit
+            phase_hist = fit_list[wavelength_index][3]
+            setup = self._setupFit(phase_hist, fit_list, wavelength_index, 10)
+
+            # fit histogram
+            fit_result = self._fitPhaseHistogram(phase_hist, fit_function, setup,
+                                                  row, column)
+
+            # evaluate and save the fit
+            self._saveRefit(fit_list, wavelength_index, fit_result, row, column, start_time)
+        return fit_list
+
+    def _reexamineFitsBatched(self, pixels, fit_data):
+        """
+        _reexamineFits() for all of the pixels at once. Each refit uses the ones done before
+        it for the same pixel, so the first refit of every pixel is fit in one batch, then
+        the second, ...
+        """
+        start_time = datetime.now()
+        refits = {pixel: self._findRefits(fit_data[pixel]) for pixel in pixels}
+        n_refits = max([len(indices) for indices in refits.values()], default=0)
+        for refit_number in range(n_refits):
+            batch = [(pixel, indices[refit_number]) for pixel, indices in refits.items()
+                     if len(indices) > refit_number]
+            phase_hists = [fit_data[pixel][wavelength_index][3]
+                           for pixel, wavelength_index in batch]
+            setups = [self._setupFit(phase_hist, fit_data[pixel], wavelength_index, 10)
+                      for phase_hist, (pixel, wavelength_index) in zip(phase_hists, batch)]
+            fit_results = self._fitPhaseHistograms(phase_hists, setups,
+                                                   [pixel for pixel, _ in batch])
+            for fit_result, (pixel, wavelength_index) in zip(fit_results, batch):
+                self._saveRefit(fit_data[pixel], wavelength_index, fit_result, *pixel,
+                                start_time)
+
+    def _findRefits(self, fit_list):
+        """
+        Returns the wavelength indices of the unsuccessful fits that have a successful
+        fit at a longer wavelength, in the order to refit them (longest first)
+        """
         # determine which fits worked
         flags = np.array([fit_list[ind][0] for ind in range(len(self.wavelengths))])
         successful = (flags == 0)
@@ -1599,42 +2175,33 @@ class WaveCal:
             # only recalculate if there is a longer wavelength fit availible
             if not success and any(successful[index + 1:]):
                 indices.append(index)
+        return list(reversed(indices))
 
-        # return the fit_list if nothing can be done
-        if len(indices) == 0:
-            return fit_list
-        # loop through bad fits and refit them
-        for wavelength_index in reversed(indices):
-            # setup fit
-            phase_hist = fit_list[wavelength_index][3]
-            setup = self._setupFit(phase_hist, fit_list, wavelength_index, 10)
+    def _saveRefit(self, fit_list, wavelength_index, fit_result, row, column, start_time):
+        """
+        Evaluates a refit from _reexamineFits() and saves it in the fit_list if it is
+        better than the original fit
+        """
+        phase_hist = fit_list[wavelength_index][3]
 
-            # get fit model
-            fit_function = fitModels(self.cfg.model_name)
+        # evaluate fit
+        flag = self._evaluateFit(phase_hist, fit_result, fit_list, wavelength_index)
 
-            # fit histogram
-            fit_result = self._fitPhaseHistogram(phase_hist, fit_function, setup,
-                                                  row, column)
+        # find best fit even if the fit failed
+        fit_results = [fit_result, fit_list[wavelength_index][1:3]]
+        fit_flags = [flag, fit_list[wavelength_index][0]]
+        fit_result, flag = self._findBestFit(fit_results, fit_flags, phase_hist)
 
-            # evaluate fit
-            flag = self._evaluateFit(phase_hist, fit_result, fit_list, wavelength_index)
-
-            # find best fit even if the fit failed
-            fit_results = [fit_result, fit_list[wavelength_index][1:3]]
-            fit_flags = [flag, fit_list[wavelength_index][0]]
-            fit_result, flag = self._findBestFit(fit_results, fit_flags, phase_hist)
-
-            # save data
-            fit_list[wavelength_index] = (flag, fit_result[0], fit_result[1],
-                                          phase_hist)
-            if flag == 0:
-                dt = round((datetime.now() - start_time).total_seconds(), 2)
-                dt = str(dt) + ' s'
-                message = "({0}, {1}) {2}nm: histogram fit recalculated " + \
-                          "- converged and validated : {3}"
-                self._log.info(message.format(row, column,
-                                             self.wavelengths[wavelength_index], dt))
-        return fit_list
+        # save data
+        fit_list[wavelength_index] = (flag, fit_result[0], fit_result[1],
+                                      phase_hist)
+        if flag == 0:
+            dt = round((datetime.now() - start_time).total_seconds(), 2)
+            dt = str(dt) + ' s'
+            message = "({0}, {1}) {2}nm: histogram fit recalculated " + \
+                      "- converged and validated : {3}"
+            self._log.info(message.format(row, column,
+                                         self.wavelengths[wavelength_index], dt))
 
     def _simultaneousFit(self, fit_list, row, column, vary=False):
         """
@@ -1797,6 +2364,79 @@ class WaveCal:
             chi2 = np.append(chi2, ((counts - fit) / error) / np.sqrt(nu_free))
         return chi2
 
+    def _getEnergyData(self, fit_results, energies):
+        """
+        Collects the phases, their standard deviations and errors, and the energies (from
+        the energies of all of the wavelengths) of the good histogram fits of a pixel, and
+        checks if they can be fit in calculateCoefficients(). 'flag' is 7 if the phases
+        aren't monotonic enough and 'fit' is True if there are enough points to fit.
+        """
+        # count the number of good fits and save their data
+        count = 0
+        indices = []
+        wavelengths = []
+        phases = []
+        std = []
+        errors = []
+        for index, fit_result in enumerate(fit_results):
+            if fit_result[0] == 0:
+                count += 1
+                indices.append(index)
+                wavelengths.append(self.wavelengths[index])
+                if self.cfg.model_name == 'gaussian_and_exp':
+                    phases.append(fit_result[1][3])
+                    std.append(fit_result[1][4])
+                    if fit_result[2][3, 3] <= 0:
+                        errors.append(np.sqrt(fit_result[1][4]))
+                    else:
+                        errors.append(np.sqrt(fit_result[2][3, 3]))
+                else:
+                    raise ValueError("{0} is not a valid fit model name"
+                                     .format(self.cfg.model_name))
+        data = {'phases': np.array(phases), 'std': np.array(std),
+                'errors': np.array(errors), 'flag': None, 'fit': False}
+
+        # mask out data points that are within error for monotonic consideration
+        if count > 1:
+            dE = np.diff(wavelengths) / np.mean(wavelengths)**2  # proportional to
+            diff = np.diff(data['phases'])
+            mask = np.ones(diff.shape, dtype=bool)
+            for ind, _ in enumerate(mask):
+                if diff[ind] < 0 and (-diff[ind] < errors[ind] or
+                                      -diff[ind] < errors[ind + 1]):
+                    mask[ind] = False
+
+        if count > 1 and ((diff < -2e8 * dE / np.mean(wavelengths))[mask].any()
+                          or sum(mask) == 0):
+            data['flag'] = 7  # data not monotonic enough
+        elif count > 2:
+            data['fit'] = True
+            data['energies'] = energies[indices]
+        return data
+
+    def _fitEnergies(self, fit_type, energy_data):
+        """
+        Fit the energy vs phase data of many pixels at once with
+        batchfit.fitPolynomial() (weighted least squares, not the fit of _fitEnergy()).
+        Returns a list of the (popt, pcov) fit result of each pixel (see _fitEnergy()), or
+        None for the fits that it can't do.
+        """
+        result = fitPolynomial([data['phases'] for data in energy_data],
+                               [data['energies'] for data in energy_data],
+                               [data['errors'] for data in energy_data], fit_type)
+        fit_results = []
+        for index, _ in enumerate(energy_data):
+            popt = tuple(result['values'][index].tolist())
+            pcov = result['covar'][index]
+            if not result['success'][index] or not np.all(np.isfinite(pcov)):
+                fit_results.append(None)
+            elif fit_type == 'quadratic':
+                fit_results.append((popt, pcov))
+            else:
+                # same popt types as _fitEnergy()
+                fit_results.append(((0,) + popt[1:], pcov))
+        return fit_results
+
     def _fitEnergy(self, fit_type, phases, energies, errors, row, column):
         """
         Fit the phase histogram to the specified fit fit_function
@@ -2132,6 +2772,50 @@ class Worker(mp.Process):
             pass
 
 
+class BlockWorker(mp.Process):
+    """
+    Worker class that opens the .h5 files itself and does the histogram fits for blocks
+    of pixels. Run by getPhaseHeightsBlocks.
+    """
+    def __init__(self, in_queue, out_queue, progress_queue, config_file, num, log):
+        super(BlockWorker, self).__init__()
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.progress_queue = progress_queue
+        self.config_file = config_file
+        self.num = num
+        self.daemon = True
+        self._log = log
+        self.start()
+
+    def run(self):
+        try:
+            w = WaveCal(config=self.config_file, master=False, worker_slave=True,
+                        pid=self.num, filelog=self._log)
+            w.cfg.verbose = False
+            w.cfg.summary_plot = False
+            if w.cfg.phase_cache is not None:
+                w.loadPhaseCache()
+
+            while True:
+                block = self.in_queue.get()
+                if block is None:
+                    break
+                if w.phase_caches is None:
+                    w.preloadPhotonData(block)
+                w.getPhaseHeights(pixels=block)
+                self.out_queue.put({tuple(pixel): w.fit_data[pixel[0], pixel[1]]
+                                    for pixel in block})
+                if self.progress_queue is not None:
+                    for _ in block:
+                        self.progress_queue.put(True)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        except Exception as error:
+            # let getPhaseHeightsBlocks raise it instead of waiting for the block forever
+            self.out_queue.put(error)
+
+
 class GateWorker(mp.Process):
     """
     Worker class in charge of opening and closing and reading .h5 files.
@@ -2209,12 +2893,19 @@ if __name__ == '__main__':
                         help='Only make h5 files')
     parser.add_argument('--forceh5', action='store_true', dest='forcehdf', default=False,
                         help='Force HDF creation')
+    parser.add_argument('--pyh5', action='store_true', dest='pyhdf', default=False,
+                        help='Make the h5 files in python (mkidpipeline.hdf.bin2hdf) instead of with Bin2HDF')
     parser.add_argument('-nc', type=int, dest='ncpu', default=0,
                         help='Number of CPUs to use, default is number of wavelengths')
     parser.add_argument('-s', type=str, dest='summary',
                         help='Generate a summary of the specified solution')
     parser.add_argument('--nolog', action='store_true', dest='nolog', default=False,
                         help='Disable logging')
+    parser.add_argument('--update', type=str, dest='update', default=None,
+                        help='Refit only the failed pixels of this solution file and copy the rest')
+    parser.add_argument('--reference', type=str, dest='reference', default=None,
+                        help='With --update, also refit the pixels that changed between good and bad '
+                             'since this solution file')
     args = parser.parse_args()
 
     if args.nolog:
@@ -2243,7 +2934,11 @@ if __name__ == '__main__':
         config.write(config.file+'.bak', forceconsistency=False)
         config.write(config.file)  # Make sure the file is consistent and save
 
-        scripts = makeHDFscripts(config)
+        if args.pyhdf and not args.scriptsonly:
+            makeHDFfiles(config, ncpu=min(args.ncpu, mp.cpu_count()))
+            scripts = []
+        else:
+            scripts = makeHDFscripts(config)
 
         if args.scriptsonly:
             exit()
@@ -2259,5 +2954,8 @@ if __name__ == '__main__':
     if args.h5only:
         exit()
 
-    WaveCal(config, filelog=flog).makeCalibration()
+    if args.update:
+        WaveCal(config, filelog=flog).updateCalibration(args.update, reference=args.reference)
+    else:
+        WaveCal(config, filelog=flog).makeCalibration()
 
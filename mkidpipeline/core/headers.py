@@ -122,6 +122,12 @@ class ObsFileCols(IsDescription):
     NoiseWeight = Float32Col(pos=4)
 
 
+class PixelIndexCols(IsDescription):
+    ResID = UInt32Col(pos=0)
+    StartRow = UInt64Col(pos=1)     # first row of this resID in /Photons/PhotonTable
+    NRows = UInt64Col(pos=2)        # number of photons for this resID
+
+
 timeMaskReasonList = []
 timeMaskReasonList.append("unknown");
 timeMaskReasonList.append("Flash in r0");
@@ -25,6 +25,7 @@
 #include <signal.h>
 #include <fcntl.h>
 #include <sys/stat.h>
+#include <sys/resource.h>
 #include "hdf5.h"
 #include "hdf5_hl.h"
 
@@ -42,9 +43,33 @@
 
 #define TSOFFS2017 1483228800 //difference between epoch and Jan 1 2017 UTC
 #define TSOFFS 1514764800 //difference between epoch and Jan 1 2018 UTC
+#define FIRMWARE_UPGRADE_TS 1518222559 //data before this need correctUnsortedTimestamps.py
+
+// single pass output layout
+#define NO_RESID ((uint32_t)(-1)) //BeamMap value for pixels without a ResID
+#ifndef PHOTON_CHUNK_ROWS
+#define PHOTON_CHUNK_ROWS 8192 //HDF5 chunk size of /Photons/PhotonTable
+#endif
+#ifndef PHOTON_COMPRESS
+#define PHOTON_COMPRESS 0 //1 to deflate /Photons/PhotonTable (slow, pixel flushes rewrite partial chunks); consolidatePhotonTables.py or ptrepack can apply blosc later
+#endif
+#define TIMEINDEX_CHUNK_TICKS 100000 //length of each /Photons/TimeIndex time chunk (100 ms)
+#define TIMEINDEX_BLOCK_COLS 1000 //number of PixelIndex entries per TimeIndex write
+#define NHEADERFIELD 16
+#define HDR_STR_SIZE 80
+
+// streaming
+#define NREADBUFFERS 3 //number of .bin files held in memory at once (one being parsed, the others being read)
+#ifndef PIXEL_BUFFER_MB
+#define PIXEL_BUFFER_MB 1024 //default memory for the single pass per pixel photon buffers (optional tenth config line), flushed to disk when full
+#endif
+#ifndef MIN_PIXEL_BUFFER
+#define MIN_PIXEL_BUFFER 256 //smallest per pixel buffer (photons) before PIXEL_BUFFER_MB is exceeded
+#endif
+#define MAX_PARSE_THREADS 64
+#define INSERTION_SORT_MAX 32 //shorter photon lists are insertion sorted, longer ones radix sorted
 
 // useful globals
-uint32_t residarr[10000] = {0};
 uint64_t tstart = 0;
 
 struct datapacket {
@@ -70,7 +95,95 @@ typedef struct photon {
     float wNoise;
 } photon;
 
-int ParseConfig(int argc, char *argv[], char *Path, int *FirstFile, int *nFiles, char *BeamFile, int *mapflag, int *beamCols, int *beamRows, char *outputDir)
+// one row of /Photons/PixelIndex (see mkidpipeline/core/headers.py PixelIndexCols)
+typedef struct pixelindex {
+    uint32_t resID;
+    uint64_t startRow;
+    uint64_t nRows;
+} pixelindex;
+
+// one row of /header/header (see mkidpipeline/core/headers.py ObsHeader)
+typedef struct obsheader {
+    char target[HDR_STR_SIZE];
+    char dataDir[HDR_STR_SIZE];
+    char beammapFile[HDR_STR_SIZE];
+    uint8_t isWvlCalibrated;
+    uint8_t isFlatCalibrated;
+    uint8_t isSpecCalibrated;
+    uint8_t isLinearityCorrected;
+    uint8_t isPhaseNoiseCorrected;
+    uint8_t isPhotonTailCorrected;
+    uint8_t timeMaskExists;
+    int32_t startTime;
+    int32_t expTime;
+    float wvlBinStart;
+    float wvlBinEnd;
+    float energyBinWidth;
+    char wvlCalFile[HDR_STR_SIZE];
+} obsheader;
+
+// ResID and flattened (x*beamRows + y) beammap index of a pixel, for sorting pixels by ResID
+typedef struct pixelresid {
+    uint32_t resID;
+    uint64_t pix;
+} pixelresid;
+
+// ring of .bin file buffers filled by a reader thread while the previous file is parsed
+typedef struct filereader {
+    char path[STR_SIZE];
+    int FirstFile;
+    int nFiles;
+    char *buf[NREADBUFFERS];
+    uint64_t bufSize[NREADBUFFERS]; //allocated bytes
+    uint64_t dataSize[NREADBUFFERS]; //bytes read from the file
+    int next; //next file to hand to the parser
+    sem_t filled;
+    sem_t empty;
+    pthread_t thread;
+} filereader;
+
+// one parser thread's share of a .bin file: the packets whose header is in words [wordStart, wordEnd)
+typedef struct parsejob {
+    char *fdata;
+    uint64_t nWords;
+    uint64_t wordStart;
+    uint64_t wordEnd;
+    int iFile;
+    int fill; //0: only count photons (and make the image), 1: also collect them in plist
+    int tsOffs;
+    int FirstFile;
+    uint32_t **BeamMap;
+    uint32_t **BeamFlag;
+    int mapflag;
+    int beamCols;
+    int beamRows;
+    uint16_t **image; //count image of the thread's packets
+    uint64_t *pixelCounts; //photons per pixel (indexed x*beamRows + y) in the thread's packets
+    uint64_t *pixelStarts; //first photon of each pixel in plist
+    uint64_t *pixelFill; //next free slot of each pixel in plist
+    photon *plist; //photons grouped by pixel, each pixel time ordered
+    uint64_t plistSize;
+    uint64_t nPhot;
+    uint64_t pcount;
+    pthread_t thread;
+} parsejob;
+
+// single pass per pixel photon buffers (indexed x*beamRows + y), flushed to their place in
+// /Photons/PhotonTable when full
+typedef struct photonbuffers {
+    photon *pool;
+    uint64_t *bufStart; //first photon of each pixel's buffer in pool
+    uint64_t *bufCap; //size of each pixel's buffer
+    uint64_t *bufFill; //photons in each pixel's buffer
+    uint64_t *pixelStarts; //first row of each pixel in the PhotonTable
+    uint64_t *written; //photons of each pixel already in the PhotonTable
+    uint32_t *lastTime; //last timestamp written for each pixel
+    char *unsorted; //1 if a flush of the pixel started before the previous one ended
+    hid_t did; //PhotonTable dataset
+    hid_t memtype; //compound type of photon
+} photonbuffers;
+
+int ParseConfig(int argc, char *argv[], char *Path, int *FirstFile, int *nFiles, char *BeamFile, int *mapflag, int *beamCols, int *beamRows, char *outputDir, int *singlePass, int *nThreads, int *pixelBufferMB)
 {
     FILE *fp;
     fp = fopen(argv[1],"r");
@@ -81,10 +194,129 @@ int ParseConfig(int argc, char *argv[], char *Path, int *FirstFile, int *nFiles,
     fscanf(fp,"%s\n",BeamFile);
     fscanf(fp,"%d\n",mapflag);
     fscanf(fp,"%s",outputDir);
+    // optional line: 1 to write the consolidated, indexed h5 file directly, 0 (default) for the per ResID tables
+    if( fscanf(fp,"%d",singlePass) != 1 ) *singlePass = 0;
+    // optional line: number of parser threads (default 1)
+    if( fscanf(fp,"%d",nThreads) != 1 ) *nThreads = 1;
+    if( *nThreads < 1 ) *nThreads = 1;
+    if( *nThreads > MAX_PARSE_THREADS ) *nThreads = MAX_PARSE_THREADS;
+    // optional line: MB of single pass per pixel photon buffers (default PIXEL_BUFFER_MB)
+    if( fscanf(fp,"%d",pixelBufferMB) != 1 || *pixelBufferMB < 1 ) *pixelBufferMB = PIXEL_BUFFER_MB;
     fclose(fp);
     return 1;
 }
 
+/*
+ * Wall clock time in seconds
+ */
+double WallTime()
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec*1e-6;
+}
+
+void PrintPeakRSS()
+{
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    printf("Peak RSS: %.1f MB\n", usage.ru_maxrss/1024.0); fflush(stdout);
+}
+
+/*
+ * Reader thread: reads the .bin files in order into the ring of buffers, waiting for a free buffer
+ */
+void *FileReaderThread(void *arg)
+{
+    filereader *reader = (filereader *) arg;
+    char fName[STR_SIZE];
+    struct stat st;
+    FILE *fp;
+    uint64_t fSize;
+    int i, b;
+
+    for(i=0; i < reader->nFiles; i++) {
+        sem_wait(&reader->empty);
+        b = i % NREADBUFFERS;
+        sprintf(fName,"%s/%d.bin",reader->path,reader->FirstFile+i);
+        fSize = (stat(fName, &st) == 0) ? (uint64_t) st.st_size : 0;
+        if( fSize > reader->bufSize[b] ) {
+            free(reader->buf[b]);
+            reader->buf[b] = (char *) malloc(fSize);
+            reader->bufSize[b] = fSize;
+        }
+        reader->dataSize[b] = 0;
+        fp = fopen(fName, "rb");
+        if( fp == NULL ) printf("Couldn't open %s\n",fName);
+        else {
+            reader->dataSize[b] = fread(reader->buf[b], 1, fSize, fp);
+            if( reader->dataSize[b] != fSize ) printf("Didn't read the entire file %s\n",fName);
+            fclose(fp);
+        }
+        sem_post(&reader->filled);
+    }
+    return NULL;
+}
+
+void StartFileReader(filereader *reader, char *path, int FirstFile, int nFiles)
+{
+    memset(reader, 0, sizeof(filereader));
+    strncpy(reader->path, path, STR_SIZE-1);
+    reader->FirstFile = FirstFile;
+    reader->nFiles = nFiles;
+    sem_init(&reader->filled, 0, 0);
+    sem_init(&reader->empty, 0, NREADBUFFERS);
+    pthread_create(&reader->thread, NULL, FileReaderThread, reader);
+}
+
+/*
+ * Waits for the next .bin file to be read and returns it, with its size in bytes in *size.
+ * Call ReleaseFile when done with it.
+ */
+char *GetNextFile(filereader *reader, uint64_t *size)
+{
+    int b = reader->next % NREADBUFFERS;
+    sem_wait(&reader->filled);
+    *size = reader->dataSize[b];
+    return reader->buf[b];
+}
+
+void ReleaseFile(filereader *reader)
+{
+    reader->next++;
+    sem_post(&reader->empty);
+}
+
+void StopFileReader(filereader *reader)
+{
+    int b;
+    pthread_join(reader->thread, NULL);
+    for(b=0; b<NREADBUFFERS; b++) free(reader->buf[b]);
+    sem_destroy(&reader->filled);
+    sem_destroy(&reader->empty);
+}
+
+/*
+ * Runs one of the python scripts that live next to the Bin2HDF executable (so Bin2HDF can be run
+ * from any working directory). Returns the exit status of the script.
+ */
+int RunPythonScript(const char *script, const char *args)
+{
+    char exeDir[STR_SIZE], cmd[4*STR_SIZE];
+    ssize_t len;
+    char *slash;
+
+    len = readlink("/proc/self/exe", exeDir, STR_SIZE-1);
+    if( len > 0 ) {
+        exeDir[len] = 0;
+        slash = strrchr(exeDir, '/');
+        if( slash != NULL ) *slash = 0;
+    }
+    else strcpy(exeDir, ".");
+    snprintf(cmd, sizeof(cmd), "python %s/%s %s", exeDir, script, args);
+    return system(cmd);
+}
+
 void FixOverflowTimestamps(struct hdrpacket* hdr, int fileNameTime, int tsOffs)
 {
     int fudgeFactor = 3; //account for early starts - misalign between FirstFile and real header timestamp
@@ -109,7 +341,7 @@ void ParsePacket( uint16_t **image, char *packet, uint64_t l, uint64_t *frame, i
     }
 }
 
-void AddPacket(char *packet, uint64_t l, hid_t file_id, size_t dst_size, size_t dst_offset[NFIELD], size_t dst_sizes[NFIELD], int tsOffs, int FirstFile, int iFile, uint32_t **BeamMap, uint64_t *nPhot, uint32_t **BeamFlag, int mapflag, char ***ResIdString, photon ***ptable, uint32_t **ptablect, int beamCols, int beamRows )
+void AddPacket(char *packet, uint64_t l, hid_t file_id, size_t dst_size, size_t dst_offset[NFIELD], size_t dst_sizes[NFIELD], int tsOffs, int FirstFile, int iFile, uint32_t **BeamMap, uint64_t *nPhot, uint32_t **BeamFlag, int mapflag, char ***ResIdString, photon ***ptable, uint32_t **ptablect, uint32_t **ptablecap, int beamCols, int beamRows )
 {
     uint64_t i,swp,swp1,swp2,swp3;
     int64_t basetime;
@@ -147,8 +379,8 @@ void AddPacket(char *packet, uint64_t l, hid_t file_id, size_t dst_size, size_t
 		if( data->xcoord >= beamCols || data->ycoord >= beamRows ) continue;
 		if( mapflag > 0 && BeamFlag[data->xcoord][data->ycoord] > 0) continue ; // if mapflag is set only record photons that were succesfully beammapped
 
-		// skip if we have some issue that takes us over 2500 cts/sec
-		if( ptablect[data->xcoord][data->ycoord] > 2498 ) continue;
+		// ptable is sized from the counting pass, so this only skips pixels without a ResID (no table)
+		if( ptablect[data->xcoord][data->ycoord] >= ptablecap[data->xcoord][data->ycoord] ) continue;
 
 		// add the photon to ptable and increment the appropriate counter
         ptable[data->xcoord][data->ycoord][ptablect[data->xcoord][data->ycoord]].resID = BeamMap[data->xcoord][data->ycoord];
@@ -163,58 +395,716 @@ void AddPacket(char *packet, uint64_t l, hid_t file_id, size_t dst_size, size_t
 
 
 /*
- * Sorts all photon tables in time order. Uses insertion sort (good for mostly ordered data)
+ * Sorts a list of n photons in time order. Uses insertion sort (good for short, mostly ordered lists)
  */
-void SortPhotonTables(photon ***ptable, uint32_t **ptablect, int beamCols, int beamRows)
+void InsertionSortPhotons(photon *plist, uint64_t n)
 {
     photon *photonToSortAddr; //address of element currently being sorted
     photon *curPhotonAddr; //address of element being compared to photonToSort
     photon *photonSwapAddr; //address of element being moved, once correct index for photonToSort has been found
     photon photonToSort; //stores the data in photonToSortAddr
+
+    //loop through photons in list, check if it is greater than previous elements (all previous elements are already sorted)
+    for(photonToSortAddr = plist+1; photonToSortAddr < plist + n; photonToSortAddr++)
+    {
+        //check elements before photonToSort (curPhotonAddr) until correct spot is found (curPhotonAddr->timestamp < photonToSortAddr->timestamp)
+        for(curPhotonAddr = photonToSortAddr-1; curPhotonAddr >= plist; curPhotonAddr--)
+        {
+            if(photonToSortAddr->timestamp >= curPhotonAddr->timestamp)
+            {
+                if(curPhotonAddr == photonToSortAddr-1)//this photon is already sorted
+                    break;
+
+                else //moves photonToSort into correct position
+                {
+                    photonToSort = *photonToSortAddr;
+                    for(photonSwapAddr = photonToSortAddr; photonSwapAddr > curPhotonAddr+1; photonSwapAddr--)
+                        *photonSwapAddr = *(photonSwapAddr-1);
+
+                    *(curPhotonAddr+1) = photonToSort;
+                    break;
+
+                }
+
+            }
+
+            else if(curPhotonAddr==plist) //Photon is smallest in the table
+            {
+                photonToSort = *photonToSortAddr;
+                for(photonSwapAddr = photonToSortAddr; photonSwapAddr > curPhotonAddr; photonSwapAddr--)
+                    *photonSwapAddr = *(photonSwapAddr-1);
+
+                *curPhotonAddr = photonToSort;
+                break;
+
+            }
+
+        }
+
+    }
+
+}
+
+/*
+ * Sorts a list of n photons in time order (stable). Lists that are already ordered are only
+ * checked, short lists are insertion sorted and longer ones are LSD radix sorted on the 32 bit
+ * timestamp, one byte per pass, skipping the bytes all photons share. Linear in n.
+ */
+void SortPhotons(photon *plist, uint64_t n)
+{
+    uint64_t i, pos, c, counts[256];
+    photon *tmp, *src, *dst, *swap;
+    int shift, b;
+
+    for(i=1; i<n && plist[i-1].timestamp <= plist[i].timestamp; i++);
+    if( i >= n ) return;
+    if( n <= INSERTION_SORT_MAX ) {
+        InsertionSortPhotons(plist, n);
+        return;
+    }
+
+    tmp = (photon *) malloc(n*sizeof(photon));
+    src = plist;
+    dst = tmp;
+    for(shift=0; shift<32; shift+=8) {
+        memset(counts, 0, sizeof(counts));
+        for(i=0; i<n; i++) counts[(src[i].timestamp >> shift) & 0xff]++;
+        if( counts[(src[0].timestamp >> shift) & 0xff] == n ) continue;
+        for(b=0, pos=0; b<256; b++) {
+            c = counts[b];
+            counts[b] = pos;
+            pos += c;
+        }
+        for(i=0; i<n; i++) dst[counts[(src[i].timestamp >> shift) & 0xff]++] = src[i];
+        swap = src;
+        src = dst;
+        dst = swap;
+    }
+    if( src != plist ) memcpy(plist, src, n*sizeof(photon));
+    free(tmp);
+}
+
+/*
+ * Sorts all photon tables in time order.
+ */
+void SortPhotonTables(photon ***ptable, uint32_t **ptablect, int beamCols, int beamRows)
+{
     int x,y; //beammap indices
 
     for(x=0; x<beamCols; x++)
         for(y=0; y<beamRows; y++)
-            //loop through photons in list, check if it is greater than previous elements (all previous elements are already sorted)
-            for(photonToSortAddr = ptable[x][y]+1; photonToSortAddr < ptable[x][y] + ptablect[x][y]; photonToSortAddr++)
-            {
-                //check elements before photonToSort (curPhotonAddr) until correct spot is found (curPhotonAddr->timestamp < photonToSortAddr->timestamp)
-                for(curPhotonAddr = photonToSortAddr-1; curPhotonAddr >= ptable[x][y]; curPhotonAddr--)
-                {
-                    if(photonToSortAddr->timestamp >= curPhotonAddr->timestamp)
-                    {
-                        if(curPhotonAddr == photonToSortAddr-1)//this photon is already sorted
-                            break;
+            SortPhotons(ptable[x][y], ptablect[x][y]);
+
+}
 
-                        else //moves photonToSort into correct position
-                        {
-                            photonToSort = *photonToSortAddr;
-                            for(photonSwapAddr = photonToSortAddr; photonSwapAddr > curPhotonAddr+1; photonSwapAddr--)
-                                *photonSwapAddr = *(photonSwapAddr-1);
+/*
+ * Single pass conversion helpers.
+ *
+ * Instead of one table per ResID that the python scripts consolidate, sort and index afterwards,
+ * the photons are counted per pixel in a first pass over the .bin files. A second pass collects
+ * them in per pixel buffers that are time ordered and flushed to their place in the ResID then
+ * Time ordered /Photons/PhotonTable when full. The header, /Photons/PixelIndex and
+ * /Photons/TimeIndex are written in the same file (same layout as consolidatePhotonTables.py).
+ */
+
+/*
+ * Time orders a pixel's buffer and writes it after the pixel's photons already in the PhotonTable
+ */
+void FlushPixelBuffer(photonbuffers *pb, uint64_t pix)
+{
+    photon *buf = &pb->pool[pb->bufStart[pix]];
+    uint64_t n = pb->bufFill[pix];
+    hsize_t start, count;
+    hid_t fsid, msid;
+
+    if( n == 0 ) return;
+    SortPhotons(buf, n);
+    if( pb->written[pix] > 0 && buf[0].timestamp < pb->lastTime[pix] ) pb->unsorted[pix] = 1;
+
+    start = pb->pixelStarts[pix] + pb->written[pix];
+    count = n;
+    fsid = H5Dget_space(pb->did);
+    H5Sselect_hyperslab(fsid, H5S_SELECT_SET, &start, NULL, &count, NULL);
+    msid = H5Screate_simple(1, &count, NULL);
+    H5Dwrite(pb->did, pb->memtype, msid, fsid, H5P_DEFAULT, buf);
+    H5Sclose(msid);
+    H5Sclose(fsid);
+
+    pb->written[pix] += n;
+    pb->lastTime[pix] = buf[n-1].timestamp;
+    pb->bufFill[pix] = 0;
+}
 
-                            *(curPhotonAddr+1) = photonToSort;
-                            break;
+/*
+ * Reads a pixel's rows back from the PhotonTable, time orders them and writes them back.
+ * Only needed for the rare pixels whose buffers weren't in order with each other.
+ */
+void ResortPixel(photonbuffers *pb, uint64_t pix, uint64_t nRows)
+{
+    photon *plist = (photon *) malloc(nRows*sizeof(photon));
+    hsize_t start = pb->pixelStarts[pix], count = nRows;
+    hid_t fsid, msid;
+
+    fsid = H5Dget_space(pb->did);
+    H5Sselect_hyperslab(fsid, H5S_SELECT_SET, &start, NULL, &count, NULL);
+    msid = H5Screate_simple(1, &count, NULL);
+    H5Dread(pb->did, pb->memtype, msid, fsid, H5P_DEFAULT, plist);
+    SortPhotons(plist, nRows);
+    H5Dwrite(pb->did, pb->memtype, msid, fsid, H5P_DEFAULT, plist);
+    H5Sclose(msid);
+    H5Sclose(fsid);
+    free(plist);
+}
 
-                        }
+/*
+ * Parses every photon of one packet that AddPacket would keep (and that has a ResID).
+ * If plist is NULL the photons are only counted in pixelCounts (indexed x*beamRows + y).
+ * Otherwise they are stored at plist[pixelFill[pix]++].
+ * Returns the number of photons kept.
+ */
+uint64_t ParsePacketPhotons(char *packet, uint64_t l, int tsOffs, int FirstFile, int iFile, uint32_t **BeamMap, uint32_t **BeamFlag, int mapflag, int beamCols, int beamRows, uint64_t *pixelCounts, photon *plist, uint64_t *pixelFill)
+{
+    uint64_t i,swp,swp1,pix,nKept=0;
+    int64_t basetime;
+    struct hdrpacket *hdr;
+    struct datapacket *data;
+    photon *p;
 
-                    }
+    swp = *((uint64_t *) (&packet[0]));
+    swp1 = __bswap_64(swp);
+    hdr = (struct hdrpacket *) (&swp1);
+    if (hdr->start != 0b11111111) {
+        printf("Error - packet does not start with a correctly formatted header packet!\n");
+        return 0;
+    }
 
-                    else if(curPhotonAddr==ptable[x][y]) //Photon is smallest in the table
-                    {
-                        photonToSort = *photonToSortAddr;
-                        for(photonSwapAddr = photonToSortAddr; photonSwapAddr > curPhotonAddr; photonSwapAddr--)
-                            *photonSwapAddr = *(photonSwapAddr-1);
+    FixOverflowTimestamps(hdr, FirstFile + iFile, tsOffs); //TEMPORARY FOR 20180625 MEC - REMOVE LATER
+    basetime = hdr->timestamp - tstart; // time since start of first file, in half ms
+    if( basetime < 0 ) return 0; // maybe have some packets out of order early in file
 
-                        *curPhotonAddr = photonToSort;
-                        break;
+    for(i=1;i<l/8;i++) {
+        swp = *((uint64_t *) (&packet[i*8]));
+        swp1 = __bswap_64(swp);
+        data = (struct datapacket *) (&swp1);
+        if( data->xcoord >= beamCols || data->ycoord >= beamRows ) continue;
+        if( mapflag > 0 && BeamFlag[data->xcoord][data->ycoord] > 0) continue ; // if mapflag is set only record photons that were succesfully beammapped
+        if( BeamMap[data->xcoord][data->ycoord] == NO_RESID ) continue;
+
+        pix = (uint64_t)data->xcoord*beamRows + data->ycoord;
+        nKept++;
+        if( plist == NULL ) {
+            pixelCounts[pix]++;
+            continue;
+        }
+        p = &plist[pixelFill[pix]++];
+        p->resID = BeamMap[data->xcoord][data->ycoord];
+        p->timestamp = (uint32_t) (basetime*500 + data->timestamp);
+        p->wvl = ((float) data->wvl)*RAD2DEG/32768.0;
+        p->wSpec = 1.0;
+        p->wNoise = 1.0;
+    }
+    return nKept;
+}
 
-                    }
+/*
+ * Returns the first word in [from, to) of a .bin file that is a header, or to if there is none
+ */
+uint64_t FindHeader(char *fdata, uint64_t from, uint64_t to)
+{
+    uint64_t j, swp, swp1;
+    struct hdrpacket *hdr;
 
-                }
+    for( j=from; j<to; j++) {
+        swp = *((uint64_t *) (&fdata[j*8]));
+        swp1 = __bswap_64(swp);
+        hdr = (struct hdrpacket *) (&swp1);
+        if (hdr->start == 0b11111111) break;
+    }
+    return j;
+}
 
+/*
+ * Parser thread: counts the photons of the packets starting in the job's word range and makes their
+ * image. With job->fill it then collects them in job->plist, grouped by pixel and time ordered.
+ * Only the job's own arrays are written so the threads need no locking.
+ */
+void *ParseJobThread(void *arg)
+{
+    parsejob *job = (parsejob *) arg;
+    uint64_t j, end, first, pix, n, nPix = (uint64_t)job->beamCols*job->beamRows;
+
+    memset(job->pixelCounts, 0, nPix*sizeof(uint64_t));
+    for(j=0; j<job->beamCols; j++)
+        memset(job->image[j], 0, job->beamRows*sizeof(uint16_t));
+    job->nPhot = 0;
+    job->pcount = 0;
+
+    // packets end at the next header (or the end of the file), which may be past wordEnd
+    first = FindHeader(job->fdata, job->wordStart, job->wordEnd);
+    for(j=first; j<job->wordEnd; j=end) {
+        end = FindHeader(job->fdata, j+1, job->nWords);
+        ParsePacket(job->image, &job->fdata[j*8], (end-j)*8, NULL, job->beamCols, job->beamRows);
+        job->nPhot += ParsePacketPhotons(&job->fdata[j*8], (end-j)*8, job->tsOffs, job->FirstFile, job->iFile, job->BeamMap, job->BeamFlag, job->mapflag, job->beamCols, job->beamRows, job->pixelCounts, NULL, NULL);
+        job->pcount++;
+    }
+    if( !job->fill ) return NULL;
+
+    for(pix=0, n=0; pix<nPix; pix++) {
+        job->pixelStarts[pix] = n;
+        job->pixelFill[pix] = n;
+        n += job->pixelCounts[pix];
+    }
+    if( n > job->plistSize ) {
+        free(job->plist);
+        job->plist = (photon *) malloc(n*sizeof(photon));
+        job->plistSize = n;
+    }
+    for(j=first; j<job->wordEnd; j=end) {
+        end = FindHeader(job->fdata, j+1, job->nWords);
+        ParsePacketPhotons(&job->fdata[j*8], (end-j)*8, job->tsOffs, job->FirstFile, job->iFile, job->BeamMap, job->BeamFlag, job->mapflag, job->beamCols, job->beamRows, NULL, job->plist, job->pixelFill);
+    }
+    for(pix=0; pix<nPix; pix++)
+        SortPhotons(&job->plist[job->pixelStarts[pix]], job->pixelCounts[pix]);
+    return NULL;
+}
+
+void InitParseJobs(parsejob *jobs, int nThreads, int tsOffs, int FirstFile, uint32_t **BeamMap, uint32_t **BeamFlag, int mapflag, int beamCols, int beamRows)
+{
+    int t, x;
+    uint64_t nPix = (uint64_t)beamCols*beamRows;
+
+    memset(jobs, 0, nThreads*sizeof(parsejob));
+    for(t=0; t<nThreads; t++) {
+        jobs[t].tsOffs = tsOffs;
+        jobs[t].FirstFile = FirstFile;
+        jobs[t].BeamMap = BeamMap;
+        jobs[t].BeamFlag = BeamFlag;
+        jobs[t].mapflag = mapflag;
+        jobs[t].beamCols = beamCols;
+        jobs[t].beamRows = beamRows;
+        jobs[t].image = (uint16_t **) malloc(beamCols*sizeof(uint16_t *));
+        for(x=0; x<beamCols; x++)
+            jobs[t].image[x] = (uint16_t *) malloc(beamRows*sizeof(uint16_t));
+        jobs[t].pixelCounts = (uint64_t *) malloc(nPix*sizeof(uint64_t));
+        jobs[t].pixelStarts = (uint64_t *) malloc(nPix*sizeof(uint64_t));
+        jobs[t].pixelFill = (uint64_t *) malloc(nPix*sizeof(uint64_t));
+    }
+}
+
+void FreeParseJobs(parsejob *jobs, int nThreads)
+{
+    int t, x;
+
+    for(t=0; t<nThreads; t++) {
+        for(x=0; x<jobs[t].beamCols; x++)
+            free(jobs[t].image[x]);
+        free(jobs[t].image);
+        free(jobs[t].pixelCounts);
+        free(jobs[t].pixelStarts);
+        free(jobs[t].pixelFill);
+        free(jobs[t].plist);
+    }
+}
+
+/*
+ * Parses a .bin file in memory with nThreads parser threads, each taking an equal contiguous share
+ * of the file's words. Unlike the per ResID conversion this also parses the last packet of the file.
+ * Adds the packets' counts to image and the photons per pixel to pixelCounts (either may be NULL).
+ * With fill, each job's plist holds its photons afterwards (see MergeParseJobs).
+ * Returns the number of photons kept, and the number of packets in *pcount.
+ */
+uint64_t ParseBinFile(char *fdata, uint64_t fsize, int iFile, parsejob *jobs, int nThreads, int fill, uint16_t **image, uint64_t *pixelCounts, uint64_t *pcount)
+{
+    uint64_t j, nWords = fsize/8, nPhot = 0, nPix = (uint64_t)jobs[0].beamCols*jobs[0].beamRows;
+    int t, x, y;
+
+    for(t=0; t<nThreads; t++) {
+        jobs[t].fdata = fdata;
+        jobs[t].nWords = nWords;
+        jobs[t].wordStart = nWords*t/nThreads;
+        jobs[t].wordEnd = nWords*(t+1)/nThreads;
+        jobs[t].iFile = iFile;
+        jobs[t].fill = fill;
+    }
+    if( nThreads == 1 ) ParseJobThread(&jobs[0]);
+    else {
+        for(t=0; t<nThreads; t++) pthread_create(&jobs[t].thread, NULL, ParseJobThread, &jobs[t]);
+        for(t=0; t<nThreads; t++) pthread_join(jobs[t].thread, NULL);
+    }
+
+    *pcount = 0;
+    for(t=0; t<nThreads; t++) {
+        nPhot += jobs[t].nPhot;
+        *pcount += jobs[t].pcount;
+        if( image != NULL )
+            for(x=0; x<jobs[t].beamCols; x++)
+                for(y=0; y<jobs[t].beamRows; y++)
+                    image[x][y] += jobs[t].image[x][y];
+        if( pixelCounts != NULL )
+            for(j=0; j<nPix; j++) pixelCounts[j] += jobs[t].pixelCounts[j];
+    }
+    return nPhot;
+}
+
+/*
+ * Adds the photons collected by the parser threads to the per pixel buffers, merging each pixel's
+ * time ordered lists from the threads (k-way merge on timestamp).
+ */
+void MergeParseJobs(parsejob *jobs, int nThreads, photonbuffers *pb, uint64_t nPix)
+{
+    uint64_t pix, pos[MAX_PARSE_THREADS], end[MAX_PARSE_THREADS];
+    photon *next;
+    int t, tMin;
+
+    for(pix=0; pix<nPix; pix++) {
+        for(t=0; t<nThreads; t++) {
+            pos[t] = jobs[t].pixelStarts[pix];
+            end[t] = pos[t] + jobs[t].pixelCounts[pix];
+        }
+        while( 1 ) {
+            tMin = -1;
+            for(t=0; t<nThreads; t++)
+                if( pos[t] < end[t] && (tMin < 0 || jobs[t].plist[pos[t]].timestamp < jobs[tMin].plist[pos[tMin]].timestamp) ) tMin = t;
+            if( tMin < 0 ) break;
+            next = &jobs[tMin].plist[pos[tMin]++];
+            if( pb->bufFill[pix] == pb->bufCap[pix] ) FlushPixelBuffer(pb, pix);
+            pb->pool[pb->bufStart[pix] + pb->bufFill[pix]++] = *next;
+        }
+    }
+}
+
+int ComparePixelResID(const void *a, const void *b)
+{
+    const pixelresid *pa = (const pixelresid *)a, *pb = (const pixelresid *)b;
+    if( pa->resID != pb->resID ) return (pa->resID < pb->resID) ? -1 : 1;
+    return (pa->pix < pb->pix) ? -1 : (pa->pix > pb->pix);
+}
+
+/*
+ * Orders the pixels with a ResID by ResID and computes where each pixel's photons start in the
+ * ResID ordered photon list (pixelStarts, indexed x*beamRows + y). Fills index with the
+ * PixelIndex entries of the pixels with photons and returns the number of entries.
+ */
+uint64_t MakePixelIndex(uint32_t **BeamMap, uint64_t *pixelCounts, int beamCols, int beamRows, uint64_t *pixelStarts, pixelindex *index)
+{
+    uint64_t pix, nPix=0, i, nIndex=0, row=0;
+    pixelresid *order = (pixelresid *) malloc((uint64_t)beamCols*beamRows*sizeof(pixelresid));
+
+    for(pix=0; pix<(uint64_t)beamCols*beamRows; pix++) {
+        if( BeamMap[pix/beamRows][pix%beamRows] == NO_RESID ) continue;
+        order[nPix].resID = BeamMap[pix/beamRows][pix%beamRows];
+        order[nPix].pix = pix;
+        nPix++;
+    }
+    qsort(order, nPix, sizeof(pixelresid), ComparePixelResID);
+
+    for(i=0; i<nPix; i++) {
+        pix = order[i].pix;
+        pixelStarts[pix] = row;
+        if( pixelCounts[pix] > 0 ) {
+            index[nIndex].resID = order[i].resID;
+            index[nIndex].startRow = row;
+            index[nIndex].nRows = pixelCounts[pix];
+            nIndex++;
+        }
+        row += pixelCounts[pix];
+    }
+    free(order);
+    return nIndex;
+}
+
+/*
+ * Writes /header/header with the same fields and defaults as addH5Header.py
+ */
+void WriteObsHeader(hid_t file_id, char *dataDir, char *beammapFile, int FirstFile, int nFiles)
+{
+    obsheader hdr;
+    hid_t gid, string_type, field_type[NHEADERFIELD];
+    int i;
+    const char *field_names[NHEADERFIELD] = { "target", "dataDir", "beammapFile", "isWvlCalibrated", "isFlatCalibrated",
+        "isSpecCalibrated", "isLinearityCorrected", "isPhaseNoiseCorrected", "isPhotonTailCorrected", "timeMaskExists",
+        "startTime", "expTime", "wvlBinStart", "wvlBinEnd", "energyBinWidth", "wvlCalFile" };
+    size_t field_offset[NHEADERFIELD] = { HOFFSET(obsheader, target), HOFFSET(obsheader, dataDir), HOFFSET(obsheader, beammapFile),
+        HOFFSET(obsheader, isWvlCalibrated), HOFFSET(obsheader, isFlatCalibrated), HOFFSET(obsheader, isSpecCalibrated),
+        HOFFSET(obsheader, isLinearityCorrected), HOFFSET(obsheader, isPhaseNoiseCorrected), HOFFSET(obsheader, isPhotonTailCorrected),
+        HOFFSET(obsheader, timeMaskExists), HOFFSET(obsheader, startTime), HOFFSET(obsheader, expTime), HOFFSET(obsheader, wvlBinStart),
+        HOFFSET(obsheader, wvlBinEnd), HOFFSET(obsheader, energyBinWidth), HOFFSET(obsheader, wvlCalFile) };
+
+    memset(&hdr, 0, sizeof(hdr));
+    strncpy(hdr.dataDir, dataDir, HDR_STR_SIZE);
+    strncpy(hdr.beammapFile, beammapFile, HDR_STR_SIZE);
+    hdr.startTime = FirstFile;
+    hdr.expTime = nFiles;
+    hdr.wvlBinStart = 700;
+    hdr.wvlBinEnd = 1500;
+    hdr.energyBinWidth = 0.1;
+
+    string_type = H5Tcopy(H5T_C_S1);
+    H5Tset_size(string_type, HDR_STR_SIZE);
+    field_type[0] = field_type[1] = field_type[2] = field_type[15] = string_type;
+    for(i=3; i<10; i++) field_type[i] = H5T_NATIVE_B8; // PyTables BoolCol
+    field_type[10] = field_type[11] = H5T_NATIVE_INT32;
+    field_type[12] = field_type[13] = field_type[14] = H5T_NATIVE_FLOAT;
+
+    gid = H5Gcreate2(file_id, "header", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    H5TBmake_table("Header", file_id, "/header/header", NHEADERFIELD, 1, sizeof(obsheader), field_names, field_offset, field_type, 1, NULL, 0, &hdr);
+    H5Tclose(string_type);
+    H5Gclose(gid);
+}
+
+/*
+ * Writes /Photons/PixelIndex (see mkidpipeline/core/headers.py PixelIndexCols)
+ */
+void WritePixelIndex(hid_t file_id, pixelindex *index, uint64_t nIndex)
+{
+    pixelindex p;
+    const char *field_names[3] = { "ResID", "StartRow", "NRows" };
+    size_t field_offset[3] = { HOFFSET(pixelindex, resID), HOFFSET(pixelindex, startRow), HOFFSET(pixelindex, nRows) };
+    hid_t field_type[3] = { H5T_STD_U32LE, H5T_STD_U64LE, H5T_STD_U64LE };
+
+    H5TBmake_table("ResID row offsets into PhotonTable", file_id, "/Photons/PixelIndex", 3, nIndex, sizeof(pixelindex),
+                   field_names, field_offset, field_type, 1024, NULL, 0, nIndex > 0 ? index : &p);
+}
+
+/*
+ * Writes /Photons/TimeIndex from the ResID then Time ordered PhotonTable (dataset did): a
+ * (nChunks+1, nIndex) uint32 array giving, for each PixelIndex entry, the row offset relative to
+ * StartRow of the first photon in each TIMEINDEX_CHUNK_TICKS long chunk. The last row is NRows.
+ * Same as writeTimeIndex() in consolidatePhotonTables.py, including the PhotonTable's filters.
+ * Only the Time column of one pixel is in memory at a time.
+ */
+void WriteTimeIndex(hid_t file_id, hid_t did_photons, pixelindex *index, uint64_t nIndex, int expTime)
+{
+    uint64_t nChunks, iIdx, iCol, nCols, iChunk, row, edge, nRows, maxRows = 0;
+    uint32_t *offsets, *times;
+    long chunkTicks = TIMEINDEX_CHUNK_TICKS;
+    hsize_t dims[2], start[2], count[2], chunk[2], pstart, pcount;
+    hid_t sid, did, msid, aid, asid, psid, pmsid, timetype, pdcpl, dcpl;
+    int iFilter, nFilters;
+    unsigned int flags, cdValues[16];
+    size_t nCdValues;
+    H5Z_filter_t filter;
+
+    if( nIndex == 0 ) return;
+    nChunks = ((uint64_t)expTime*1000000 + TIMEINDEX_CHUNK_TICKS - 1)/TIMEINDEX_CHUNK_TICKS;
+    if( nChunks < 1 ) nChunks = 1;
+    dims[0] = nChunks+1;
+    dims[1] = nIndex;
+    sid = H5Screate_simple(2, dims, NULL);
+
+    // same filters as the PhotonTable (filters need a chunked layout, of at most 1000x250 entries)
+    dcpl = H5Pcreate(H5P_DATASET_CREATE);
+    pdcpl = H5Dget_create_plist(did_photons);
+    nFilters = H5Pget_nfilters(pdcpl);
+    if( nFilters > 0 ) {
+        chunk[0] = (nChunks+1 < 1000) ? nChunks+1 : 1000;
+        chunk[1] = (nIndex < 250) ? nIndex : 250;
+        H5Pset_chunk(dcpl, 2, chunk);
+    }
+    for(iFilter=0; iFilter<nFilters; iFilter++) {
+        nCdValues = sizeof(cdValues)/sizeof(cdValues[0]);
+        filter = H5Pget_filter2(pdcpl, (unsigned) iFilter, &flags, &nCdValues, cdValues, 0, NULL, NULL);
+        H5Pset_filter(dcpl, filter, flags, nCdValues, cdValues);
+    }
+    H5Pclose(pdcpl);
+    did = H5Dcreate2(file_id, "/Photons/TimeIndex", H5T_STD_U32LE, sid, H5P_DEFAULT, dcpl, H5P_DEFAULT);
+    H5Pclose(dcpl);
+
+    // reads just the Time field of the photons
+    timetype = H5Tcreate(H5T_COMPOUND, sizeof(uint32_t));
+    H5Tinsert(timetype, "Time", 0, H5T_NATIVE_UINT32);
+    for(iIdx=0; iIdx<nIndex; iIdx++)
+        if( index[iIdx].nRows > maxRows ) maxRows = index[iIdx].nRows;
+    times = (uint32_t *) malloc(maxRows*sizeof(uint32_t));
+    psid = H5Dget_space(did_photons);
+
+    offsets = (uint32_t *) malloc((nChunks+1)*TIMEINDEX_BLOCK_COLS*sizeof(uint32_t));
+    for(iIdx=0; iIdx<nIndex; iIdx+=TIMEINDEX_BLOCK_COLS) {
+        nCols = (nIndex-iIdx < TIMEINDEX_BLOCK_COLS) ? nIndex-iIdx : TIMEINDEX_BLOCK_COLS;
+        for(iCol=0; iCol<nCols; iCol++) {
+            nRows = index[iIdx+iCol].nRows;
+            pstart = index[iIdx+iCol].startRow;
+            pcount = nRows;
+            H5Sselect_hyperslab(psid, H5S_SELECT_SET, &pstart, NULL, &pcount, NULL);
+            pmsid = H5Screate_simple(1, &pcount, NULL);
+            H5Dread(did_photons, timetype, pmsid, psid, H5P_DEFAULT, times);
+            H5Sclose(pmsid);
+
+            row = 0;
+            for(iChunk=0; iChunk<nChunks; iChunk++) {
+                edge = iChunk*TIMEINDEX_CHUNK_TICKS;
+                while( row < nRows && times[row] < edge ) row++;
+                offsets[iChunk*nCols + iCol] = (uint32_t) row;
             }
+            offsets[nChunks*nCols + iCol] = (uint32_t) nRows;
+        }
+        start[0] = 0; start[1] = iIdx;
+        count[0] = nChunks+1; count[1] = nCols;
+        msid = H5Screate_simple(2, count, NULL);
+        H5Sselect_hyperslab(sid, H5S_SELECT_SET, start, NULL, count, NULL);
+        H5Dwrite(did, H5T_NATIVE_UINT32, msid, sid, H5P_DEFAULT, offsets);
+        H5Sclose(msid);
+    }
+    free(offsets);
+    free(times);
+    H5Sclose(psid);
+    H5Tclose(timetype);
+
+    asid = H5Screate(H5S_SCALAR);
+    aid = H5Acreate2(did, "chunkTicks", H5T_NATIVE_LONG, asid, H5P_DEFAULT, H5P_DEFAULT);
+    H5Awrite(aid, H5T_NATIVE_LONG, &chunkTicks);
+    H5Aclose(aid);
+    H5Sclose(asid);
+    H5Dclose(did);
+    H5Sclose(sid);
+}
 
+/*
+ * Sets up the per pixel buffers: each pixel gets min(its photon count, an equal share of
+ * pixelBufferMB) photons (at least MIN_PIXEL_BUFFER). Returns the pool size in photons.
+ */
+uint64_t MakePhotonBuffers(photonbuffers *pb, uint64_t *pixelCounts, uint64_t *pixelStarts, uint64_t nPix, int pixelBufferMB)
+{
+    uint64_t pix, nWithPhotons = 0, share, poolSize = 0;
+
+    for(pix=0; pix<nPix; pix++)
+        if( pixelCounts[pix] > 0 ) nWithPhotons++;
+    share = nWithPhotons > 0 ? ((uint64_t)pixelBufferMB*1024*1024/sizeof(photon))/nWithPhotons : 0;
+    if( share < MIN_PIXEL_BUFFER ) share = MIN_PIXEL_BUFFER;
+
+    pb->bufStart = (uint64_t *) malloc(nPix*sizeof(uint64_t));
+    pb->bufCap = (uint64_t *) malloc(nPix*sizeof(uint64_t));
+    pb->bufFill = (uint64_t *) calloc(nPix, sizeof(uint64_t));
+    pb->written = (uint64_t *) calloc(nPix, sizeof(uint64_t));
+    pb->lastTime = (uint32_t *) calloc(nPix, sizeof(uint32_t));
+    pb->unsorted = (char *) calloc(nPix, sizeof(char));
+    pb->pixelStarts = pixelStarts;
+    for(pix=0; pix<nPix; pix++) {
+        pb->bufStart[pix] = poolSize;
+        pb->bufCap[pix] = pixelCounts[pix] < share ? pixelCounts[pix] : share;
+        poolSize += pb->bufCap[pix];
+    }
+    pb->pool = (photon *) malloc((poolSize > 0 ? poolSize : 1)*sizeof(photon));
+
+    pb->memtype = H5Tcreate(H5T_COMPOUND, sizeof(photon));
+    H5Tinsert(pb->memtype, "ResID", HOFFSET(photon, resID), H5T_NATIVE_UINT32);
+    H5Tinsert(pb->memtype, "Time", HOFFSET(photon, timestamp), H5T_NATIVE_UINT32);
+    H5Tinsert(pb->memtype, "Wavelength", HOFFSET(photon, wvl), H5T_NATIVE_FLOAT);
+    H5Tinsert(pb->memtype, "SpecWeight", HOFFSET(photon, wSpec), H5T_NATIVE_FLOAT);
+    H5Tinsert(pb->memtype, "NoiseWeight", HOFFSET(photon, wNoise), H5T_NATIVE_FLOAT);
+    return poolSize;
+}
 
+void FreePhotonBuffers(photonbuffers *pb)
+{
+    free(pb->pool);
+    free(pb->bufStart);
+    free(pb->bufCap);
+    free(pb->bufFill);
+    free(pb->written);
+    free(pb->lastTime);
+    free(pb->unsorted);
+    H5Tclose(pb->memtype);
+}
+
+/*
+ * Single pass conversion, streaming the .bin files from disk twice: count, then collect the photons
+ * in per pixel buffers that are flushed to their place in /Photons/PhotonTable (ResID then Time
+ * ordered) when full. Then writes PixelIndex and TimeIndex. Also writes the /Images/<timestamp>
+ * count images like the per ResID conversion. Memory use is bounded by NREADBUFFERS .bin files
+ * plus pixelBufferMB. Returns the number of photons.
+ */
+uint64_t ConvertSinglePass(hid_t file_id, char *path, int nFiles, int FirstFile, int tsOffs, uint32_t **BeamMap, uint32_t **BeamFlag, int mapflag, int beamCols, int beamRows, uint16_t **image, unsigned char *smimage, int nThreads, int pixelBufferMB)
+{
+    uint64_t i, j, nPix = (uint64_t)beamCols*beamRows, nPhot, tPhot = 0, pcount, nIndex, poolSize, fSize, nResorted = 0;
+    uint64_t *pixelCounts, *pixelStarts;
+    hsize_t nRows;
+    pixelindex *index;
+    photonbuffers pb;
+    filereader reader;
+    parsejob jobs[MAX_PARSE_THREADS];
+    char imname[STR_SIZE];
+    char *fdata;
+    double start, diff;
+    hid_t gid_photons;
+
+    const char *field_names[NFIELD]  = { "ResID","Time","Wavelength","SpecWeight","NoiseWeight"};
+    size_t dst_offset[NFIELD] = { HOFFSET( photon, resID), HOFFSET( photon, timestamp ), HOFFSET( photon, wvl ), HOFFSET( photon, wSpec ), HOFFSET( photon, wNoise) };
+    hid_t field_type[NFIELD] = { H5T_STD_U32LE, H5T_STD_U32LE, H5T_NATIVE_FLOAT, H5T_NATIVE_FLOAT, H5T_NATIVE_FLOAT };
+
+    pixelCounts = (uint64_t *) calloc(nPix, sizeof(uint64_t));
+    pixelStarts = (uint64_t *) calloc(nPix, sizeof(uint64_t));
+    index = (pixelindex *) malloc(nPix*sizeof(pixelindex));
+
+    InitParseJobs(jobs, nThreads, tsOffs, FirstFile, BeamMap, BeamFlag, mapflag, beamCols, beamRows);
+
+    // pass 1: count photons per pixel and make the images
+    start = WallTime();
+    for(j=0; j<beamCols; j++)
+        memset(image[j], 0, beamRows*sizeof(uint16_t));
+    StartFileReader(&reader, path, FirstFile, nFiles);
+    for(i=0; i < nFiles; i++) {
+        fdata = GetNextFile(&reader, &fSize);
+        nPhot = ParseBinFile(fdata, fSize, i, jobs, nThreads, 0, image, pixelCounts, &pcount);
+        ReleaseFile(&reader);
+        printf("File %ld: %ld packets, %ld photons.\n", i, pcount, nPhot);
+        tPhot += nPhot;
+
+        for( j=0; j < nPix; j++ ) {
+            smimage[j] =  (unsigned char) (image[j%beamCols][j/beamCols]/10);
+            if( smimage[j] > 2499 ) smimage[j] = 0;
+        }
+        sprintf(imname,"/Images/%ld",i+FirstFile);
+        H5IMmake_image_8bit( file_id, imname, (hsize_t)beamCols, (hsize_t)beamRows, smimage );
+        for(j=0; j<beamCols; j++)
+            memset(image[j], 0, beamRows*sizeof(uint16_t));
+    }
+    StopFileReader(&reader);
+    diff = WallTime()-start;
+    printf("Counted %ld photons in %f seconds with %d threads: %9.1f photons/sec.\n", tPhot, diff, nThreads, tPhot/diff); fflush(stdout);
+
+    // make the full size PhotonTable
+    nIndex = MakePixelIndex(BeamMap, pixelCounts, beamCols, beamRows, pixelStarts, index);
+    gid_photons = H5Gcreate2(file_id, "Photons", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    H5TBmake_table("Photon Table", file_id, "/Photons/PhotonTable", NFIELD, 0, sizeof(photon), field_names, dst_offset, field_type, PHOTON_CHUNK_ROWS, NULL, PHOTON_COMPRESS, NULL);
+    pb.did = H5Dopen2(file_id, "/Photons/PhotonTable", H5P_DEFAULT);
+    nRows = tPhot;
+    H5Dset_extent(pb.did, &nRows);
+
+    // pass 2: fill the per pixel buffers, flushing them when full
+    start = WallTime();
+    poolSize = MakePhotonBuffers(&pb, pixelCounts, pixelStarts, nPix, pixelBufferMB);
+    printf("Using %.1f MB of per pixel photon buffers (at most %d MB).\n", poolSize*sizeof(photon)/1048576.0, pixelBufferMB); fflush(stdout);
+    StartFileReader(&reader, path, FirstFile, nFiles);
+    for(i=0; i < nFiles; i++) {
+        fdata = GetNextFile(&reader, &fSize);
+        ParseBinFile(fdata, fSize, i, jobs, nThreads, 1, NULL, NULL, &pcount);
+        ReleaseFile(&reader);
+        MergeParseJobs(jobs, nThreads, &pb, nPix);
+    }
+    StopFileReader(&reader);
+    for(j=0; j < nPix; j++) FlushPixelBuffer(&pb, j);
+    for(j=0; j < nPix; j++) {
+        if( !pb.unsorted[j] ) continue;
+        ResortPixel(&pb, j, pixelCounts[j]);
+        nResorted++;
+    }
+    diff = WallTime()-start;
+    printf("Wrote %ld photons in %f seconds with %d threads: %9.1f photons/sec (%ld pixels resorted).\n", tPhot, diff, nThreads, tPhot/diff, nResorted); fflush(stdout);
+
+    start = WallTime();
+    WritePixelIndex(file_id, index, nIndex);
+    WriteTimeIndex(file_id, pb.did, index, nIndex, nFiles);
+    printf("Wrote PixelIndex and TimeIndex in %f seconds.\n", WallTime()-start);
+
+    H5Dclose(pb.did);
+    H5Gclose(gid_photons);
+    FreePhotonBuffers(&pb);
+    FreeParseJobs(jobs, nThreads);
+    free(pixelCounts);
+    free(pixelStarts);
+    free(index);
+    return tPhot;
 }
 
 void ParseBeamMapFile(char *BeamFile, uint32_t **BeamMap, uint32_t **BeamFlag)
@@ -253,17 +1143,15 @@ void InitializeBeamMap(uint32_t **BeamMap, uint32_t value, int beamCols, int bea
 
 int main(int argc, char *argv[])
 {
-    char path[STR_SIZE], fName[STR_SIZE], outputDir[STR_SIZE], BeamFile[STR_SIZE], outfile[STR_SIZE], imname[STR_SIZE], tname[STR_SIZE];
-    int FirstFile, nFiles,mapflag, beamCols, beamRows, nRoaches;
-    long fSize, rd, j, k;
-    struct stat st;
-    FILE *fp;
-    uint64_t **data, *dSize;
-    clock_t start, diff, olddiff;
+    char path[STR_SIZE], outputDir[STR_SIZE], BeamFile[STR_SIZE], outfile[STR_SIZE], imname[STR_SIZE], tname[STR_SIZE];
+    int FirstFile, nFiles,mapflag, beamCols, beamRows, nRoaches, singlePass, nThreads, pixelBufferMB;
+    long j, k;
+    uint64_t fSize;
+    filereader reader;
+    double start, diff;
     time_t fnStartTime, fnEndTime;
     uint64_t swp,swp1,i,pstart,pcount,firstHeader, nPhot, tPhot=0;
     struct hdrpacket *hdr;
-    char packet[808*16];
     char *olddata;
     uint16_t **image;
     unsigned char *smimage;
@@ -274,14 +1162,15 @@ int main(int argc, char *argv[])
     uint32_t *toWriteBeamFlag;
     uint32_t beamMapInitVal = (uint32_t)(-1);
     char ***ResIdString;
-    char addHeaderCmd[120] = "python addH5Header.py ";
-    char correctTimestampsCmd[120] = "python correctUnsortedTimestamps.py ";
-    char consolidatePhotonTablesCmd[120] = "python consolidatePhotonTables.py ";
-    char indexHDFCmd[120] = "python indexHDF.py ";
+    char scriptArgs[2*STR_SIZE+2];
+    int scriptStatus = 0;
     photon p1;
 
     photon ***ptable;
     uint32_t **ptablect;
+    uint32_t **ptablecap;
+    uint64_t *pixelCounts;
+    parsejob jobs[MAX_PARSE_THREADS];
 
 
     // hdf5 variables
@@ -323,17 +1212,19 @@ int main(int argc, char *argv[])
     field_type[3] = H5T_NATIVE_FLOAT;
     field_type[4] = H5T_NATIVE_FLOAT;
 
-    memset(packet, 0, sizeof(packet[0]) * 808 * 16);    // zero out array
-
     // Open config file and parse
     if( argc != 2 ) {
         printf("Bin2HDF error - First command line argument must be the configuration file.\n");
         exit(0);
     }
-    if (ParseConfig(argc,argv,path,&FirstFile,&nFiles,BeamFile,&mapflag,&beamCols,&beamRows,outputDir) == 0 ) {
+    if (ParseConfig(argc,argv,path,&FirstFile,&nFiles,BeamFile,&mapflag,&beamCols,&beamRows,outputDir,&singlePass,&nThreads,&pixelBufferMB) == 0 ) {
         printf("Bin2HDF error - Config parsing error.\n");
 		exit(1);
 	}
+    if( singlePass && FirstFile < FIRMWARE_UPGRADE_TS ) {
+        printf("Data from before the firmware upgrade need correctUnsortedTimestamps.py on the unsorted tables, using the per ResID conversion.\n");
+        singlePass = 0;
+    }
 
     startTs = (time_t)FirstFile;
     startTime = gmtime(&startTs);
@@ -348,10 +1239,6 @@ int main(int argc, char *argv[])
     nRoaches = beamRows*beamCols/1000;
     frame = (uint64_t*)malloc(nRoaches*sizeof(uint64_t));
 
-    // Set up memory structure for data
-    data = (uint64_t **) malloc( nFiles * sizeof(uint64_t *) );
-    dSize = (uint64_t *) malloc( nFiles * sizeof(uint64_t *) );
-
     // Set up memory structure for 2D "beammap" arrays
     BeamMap = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
     BeamFlag = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
@@ -359,6 +1246,7 @@ int main(int argc, char *argv[])
     smimage = (char *)malloc(beamCols * beamRows * sizeof(char));
     ptable = (photon***)malloc(beamCols * sizeof(photon**));
     ptablect = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
+    ptablecap = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
     ResIdString = (char***)malloc(beamCols * sizeof(char**));
     toWriteBeamMap = (uint32_t*)malloc(beamCols * beamRows * sizeof(uint32_t));
     toWriteBeamFlag = (uint32_t*)malloc(beamCols * beamRows * sizeof(uint32_t));
@@ -368,8 +1256,9 @@ int main(int argc, char *argv[])
         BeamMap[i] = (uint32_t*)malloc(beamRows * sizeof(uint32_t));
         BeamFlag[i] = (uint32_t*)malloc(beamRows * sizeof(uint32_t));
         image[i] = (uint16_t*)malloc(beamRows * sizeof(uint16_t));
-        ptable[i] = (photon**)malloc(beamRows * sizeof(photon*));
+        ptable[i] = (photon**)calloc(beamRows, sizeof(photon*));
         ptablect[i] = (uint32_t*)malloc(beamRows * sizeof(uint32_t));
+        ptablecap[i] = (uint32_t*)calloc(beamRows, sizeof(uint32_t));
         ResIdString[i] = (char**)malloc(beamRows * sizeof(char*));
         for(j=0; j<beamRows; j++)
             ResIdString[i][j] = (char*)malloc(20 * sizeof(char));
@@ -382,25 +1271,6 @@ int main(int argc, char *argv[])
     ParseBeamMapFile(BeamFile,BeamMap,BeamFlag);
     printf("Parsed beam map.\n"); fflush(stdout);
 
-    // Read all the data into memory
-    start = clock();
-    for(i=0; i < nFiles; i++) {
-        sprintf(fName,"%s/%ld.bin",path,FirstFile+i);
-        stat(fName, &st);
-        fSize = st.st_size;
-        printf("Reading %s - %ld bytes\n",fName,fSize);
-        data[i] = (uint64_t *) malloc( fSize * sizeof(uint64_t *) );
-        dSize[i] = (uint64_t) fSize;
-
-        fp = fopen(fName, "rb");
-        rd = fread( data[i], 1, fSize, fp);
-        if( rd != fSize) printf("Didn't read the entire file %s\n",fName);
-        fclose(fp);
-    }
-    diff = clock()-start;
-    olddiff = diff;
-    printf("Read data to memory in %f ms.\n",(float)diff*1000.0/CLOCKS_PER_SEC);
-
     // Create H5 file and set attributes
     sprintf(outfile,"%s/%d.h5",outputDir,FirstFile);
     file_id = H5Fcreate (outfile, H5F_ACC_TRUNC, H5P_DEFAULT, H5P_DEFAULT);
@@ -431,9 +1301,22 @@ int main(int argc, char *argv[])
 
     gid_beammap = H5Gcreate2(file_id, "Images", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
 
-    // Step through .bin files that are now in memory, suck out the data, convert it into the new packet format
+    if( singlePass ) {
+        start = WallTime();
+        tPhot = ConvertSinglePass(file_id, path, nFiles, FirstFile, tsOffs, BeamMap, BeamFlag, mapflag, beamCols, beamRows, image, smimage, nThreads, pixelBufferMB);
+        WriteObsHeader(file_id, path, BeamFile, FirstFile, nFiles);
+        diff = WallTime()-start;
+        printf("Converted %ld photons in %f seconds: %9.1f photons/sec.\n",tPhot,diff,((double)tPhot)/diff);
+        PrintPeakRSS();
+
+        H5Gclose(gid_beammap);
+        H5Fclose(file_id);
+        exit(0);
+    }
+
+    // Step through the .bin files as the reader thread loads them, suck out the data, convert it into the new packet format
     // and write it to the h5 file
-    start = clock();
+    start = WallTime();
 
     gid_photons = H5Gcreate2(file_id, "Photons", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
 
@@ -454,7 +1337,6 @@ int main(int argc, char *argv[])
 
             }
 
-			ptable[i][j] = (photon *) malloc( 2500 * sizeof(photon) );	// allocate memory for ptable
 			sprintf(tname,"/Photons/%d",BeamMap[i][j]);
 			memcpy(ResIdString[i][j],tname,20); 	// store the table name string in an array
 			// make the table
@@ -464,31 +1346,49 @@ int main(int argc, char *argv[])
 
 	printf("Made individual photon data tables.\n"); fflush(stdout);
 
+    InitParseJobs(jobs, nThreads, tsOffs, FirstFile, BeamMap, BeamFlag, mapflag, beamCols, beamRows);
+    pixelCounts = (uint64_t *) malloc(beamCols * beamRows * sizeof(uint64_t));
+
+    StartFileReader(&reader, path, FirstFile, nFiles);
     for(i=0; i < nFiles; i++) {
-        olddata = (char *) data[i];
+        olddata = GetNextFile(&reader, &fSize);
         pstart = 0;
         pcount = 0;
         nPhot = 0;
+        firstHeader = fSize/8;
         for(j=0; j<beamCols; j++)
             memset(ptablect[j],0,sizeof(uint32_t)*beamRows); // zero out the count table
 
+        // count the photons of each pixel first and grow its ptable to fit them
+        memset(pixelCounts, 0, beamCols * beamRows * sizeof(uint64_t));
+        ParseBinFile(olddata, fSize, i, jobs, nThreads, 0, NULL, pixelCounts, &pcount);
+        pcount = 0;
+        for(j=0; j < beamCols; j++) {
+            for(k=0; k < beamRows; k++) {
+                if( pixelCounts[j*beamRows + k] <= ptablecap[j][k] ) continue;
+                ptablecap[j][k] = (uint32_t) pixelCounts[j*beamRows + k];
+                free(ptable[j][k]);
+                ptable[j][k] = (photon *) malloc( ptablecap[j][k] * sizeof(photon) );
+            }
+        }
+
         printf("File %ld: ",i);
 
         // .bin may not always start with a header packet, so search until we find the first header
-        for( j=0; j<dSize[i]/8; j++) {
+        for( j=0; j<fSize/8; j++) {
             swp = *((uint64_t *) (&olddata[j*8]));
             swp1 = __bswap_64(swp);
             hdr = (struct hdrpacket *) (&swp1);
             if (hdr->start == 0b11111111) {
                 firstHeader = j;
-                pstart = j;
+                pstart = j*8;
                 if( firstHeader != 0 ) printf("First header at %ld\n",firstHeader);
                 break;
             }
         }
 
         // reformat all the packets into memory then dump to disk for speed
-        for( j=firstHeader+1; j<dSize[i]/8; j++) {
+        for( j=firstHeader+1; j<fSize/8; j++) {
 
             swp = *((uint64_t *) (&olddata[j*8]));
             swp1 = __bswap_64(swp);
@@ -497,19 +1397,22 @@ int main(int argc, char *argv[])
             if (hdr->start == 0b11111111) {        // found new packet header!
                 // fill packet and parse
                 //printf("Found next header at %d\n",j*8); fflush(stdout);
-                memmove(packet,&olddata[pstart],j*8 - pstart);
                 pcount++;
                 // parse into image
-                ParsePacket(image, packet, j*8 - pstart, frame, beamCols, beamRows);
+                ParsePacket(image, &olddata[pstart], j*8 - pstart, frame, beamCols, beamRows);
                 // add to HDF5 file
-                AddPacket(packet,j*8-pstart,file_id,dst_size,dst_offset,dst_sizes,tsOffs,FirstFile,i,BeamMap,&nPhot,BeamFlag,mapflag,ResIdString,ptable,ptablect,beamCols,beamRows);
+                AddPacket(&olddata[pstart],j*8-pstart,file_id,dst_size,dst_offset,dst_sizes,tsOffs,FirstFile,i,BeamMap,&nPhot,BeamFlag,mapflag,ResIdString,ptable,ptablect,ptablecap,beamCols,beamRows);
 		        pstart = j*8;   // move start location for next packet
-		        if( pcount%1000 == 0 ) printf("."); fflush(stdout);
+		        if( pcount%1000 == 0 ) {
+		            printf("."); fflush(stdout);
+		        }
             }
         }
+        ReleaseFile(&reader);
 
-        //printf("\nSorting photon tables...\n");
-        //SortPhotonTables(ptable, ptablect);
+        // time order each pixel's photons (files are in time order, so the tables are too). Data from
+        // before the firmware upgrade are left in packet order for correctUnsortedTimestamps.py
+        if( FirstFile >= FIRMWARE_UPGRADE_TS ) SortPhotonTables(ptable, ptablect, beamCols, beamRows);
 
         // save photon tables to hdf5
         for(j=0; j < beamCols; j++) {
@@ -536,30 +1439,26 @@ int main(int argc, char *argv[])
         for(j=0; j<beamCols; j++)
             memset(image[j], 0, beamRows*sizeof(uint16_t));
 
-        printf(" %ld packets, %ld photons. %ld photons/packet.\n",pcount,nPhot,nPhot/pcount);
+        printf(" %ld packets, %ld photons. %ld photons/packet.\n",pcount,nPhot,pcount ? nPhot/pcount : 0);
         tPhot += nPhot;
     }
+    StopFileReader(&reader);
 
     H5Gclose(gid_photons);
 
-    diff = clock()-start;
-    printf("Parsed %ld photons in %f seconds: %9.1f photons/sec.\n",tPhot,(float)(diff+olddiff)/CLOCKS_PER_SEC,((float)tPhot)/((float)(diff+olddiff)/CLOCKS_PER_SEC));
+    diff = WallTime()-start;
+    printf("Parsed %ld photons in %f seconds: %9.1f photons/sec.\n",tPhot,diff,((double)tPhot)/diff);
+    PrintPeakRSS();
 
     // Close up
     H5Gclose(gid_beammap);
     H5Fclose(file_id);
 
-     // make photon tables for every resid
-    for(i=0; i < beamCols; i++) {
-		for(j=0; j < beamRows; j++) {
-			if( BeamMap[i][j] == 0 ) continue;
+    for(i=0; i < beamCols; i++)
+		for(j=0; j < beamRows; j++)
 			free(ptable[i][j]);
-		}
-	}
-
-    for(i=0; i < nFiles; i++) free(data[i]);
-    free(data);
-    free(dSize);
+    FreeParseJobs(jobs, nThreads);
+    free(pixelCounts);
 
     for(i=0; i<beamCols; i++)
     {
@@ -568,6 +1467,7 @@ int main(int argc, char *argv[])
         free(image[i]);
         free(ptable[i]);
         free(ptablect[i]);
+        free(ptablecap[i]);
         free(ResIdString[i]);
 
     }
@@ -577,6 +1477,7 @@ int main(int argc, char *argv[])
     free(image);
     free(ptable);
     free(ptablect);
+    free(ptablecap);
     free(ResIdString);
     free(toWriteBeamMap);
     free(toWriteBeamFlag);
@@ -584,32 +1485,27 @@ int main(int argc, char *argv[])
     free(yearStartTime);
 
     printf("adding header\n"); fflush(stdout);
-    strcat(addHeaderCmd, argv[1]);
-    strcat(addHeaderCmd, " ");
-    strcat(addHeaderCmd, outfile);
-    system(addHeaderCmd);
+    snprintf(scriptArgs, sizeof(scriptArgs), "%s %s", argv[1], outfile);
+    scriptStatus |= RunPythonScript("addH5Header.py", scriptArgs);
 
-    if(FirstFile < 1518222559) //before firmware upgrade
+    if(FirstFile < FIRMWARE_UPGRADE_TS) //before firmware upgrade
     {
         printf("correcting timestamps\n"); fflush(stdout);
-        strcat(correctTimestampsCmd, outfile);
-        system(correctTimestampsCmd);
+        scriptStatus |= RunPythonScript("correctUnsortedTimestamps.py", outfile);
 
     }
 
     fnStartTime = time(NULL);
     printf("Consolidating photon tables...\n"); fflush(stdout);
-    strcat(consolidatePhotonTablesCmd, outfile);
-    system(consolidatePhotonTablesCmd);
+    scriptStatus |= RunPythonScript("consolidatePhotonTables.py", outfile);
     fnEndTime = time(NULL) - fnStartTime;
     printf("Done consolidating photon tables in %d seconds\n", (int)fnEndTime);
 
     fnStartTime = time(NULL);
     printf("indexing HDF file\n"); fflush(stdout);
-    strcat(indexHDFCmd, outfile);
-    system(indexHDFCmd);
+    scriptStatus |= RunPythonScript("indexHDF.py", outfile);
     fnEndTime = time(NULL) - fnStartTime;
     printf("Done indexing HDF file in %d seconds\n", (int)fnEndTime);
-    exit(0);
+    exit(scriptStatus != 0);
 
 }
@@ -0,0 +1,288 @@
+"""
+Converts many .bin sequences to h5 files by running several Bin2HDF processes at once.
+
+The conversions come either from a dither (a Dither2HDF.cfg style config with a [Data] section
+pointing to the ditherStack file with nPos, startTimes and stopTimes) or from a
+batchConvertBin2HDF.sh style config whose third and fourth lines are lists of start timestamps
+and integration times.
+
+Each conversion runs in its own working directory (<workDir>/<startTime>/) holding its Bin2HDF
+config file and log, so conversions don't share temporary files. The number of conversions
+running at once is limited by the number of processes and by a memory budget, using a rough
+estimate of each conversion's peak memory. Outputs that already exist and are complete are
+skipped, so an interrupted batch can simply be run again.
+
+usage: python batchBin2HDF.py <Dither2HDF.cfg or batch config> [--bufferTime sec] [--nProcs n]
+           [--memBudget GB] [--nThreads n] [--pixelBufferMB n] [--perResID] [--workDir dir] [--noResume]
+"""
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+import time
+from configparser import ConfigParser
+
+import tables
+
+from mkidpipeline.utils.readDict import readDict
+
+# Bin2HDF buffers (see NREADBUFFERS and PIXEL_BUFFER_MB in Bin2HDF.c), the pixel buffer size is
+# written to each conversion's config file
+nReadBuffers = 3
+defaultPixelBufferMB = 1024
+photonBytes = 20
+overheadBytes = 64*1024**2
+
+
+def getDitherJobs(ditherStackFile, bufferTime=1):
+    """
+    Returns (startTime, nFiles) of each dither position, leaving out bufferTime seconds at
+    the beginning and end of each position (like Dither2H5.py).
+    """
+    ditherData = readDict()
+    ditherData.read_from_file(ditherStackFile)
+    jobs = []
+    for i in range(ditherData['nPos']):
+        startTime = int(ditherData['startTimes'][i]) + bufferTime
+        stopTime = int(ditherData['stopTimes'][i]) - bufferTime
+        jobs.append((startTime, stopTime - startTime))
+    return jobs
+
+
+def readDitherConfig(cfgFile, bufferTime=1):
+    """
+    Reads a Dither2HDF.cfg style config file.
+
+    Returns
+    -------
+    dict with keys xPix, yPix, binPath, outPath, beamFile, mapFlag, b2hPath and jobs, a list of
+    (startTime, nFiles)
+    """
+    config = ConfigParser()
+    config.read(cfgFile)
+    data = config['Data']
+    return {'xPix': ast.literal_eval(data['XPIX']),
+            'yPix': ast.literal_eval(data['YPIX']),
+            'binPath': ast.literal_eval(data['binPath']),
+            'outPath': ast.literal_eval(data['outPath']),
+            'beamFile': ast.literal_eval(data['beamFile']),
+            'mapFlag': ast.literal_eval(data['mapFlag']),
+            'b2hPath': ast.literal_eval(data['b2hPath']),
+            'jobs': getDitherJobs(ast.literal_eval(data['ditherStackFile']), bufferTime)}
+
+
+def readBatchConfig(cfgFile):
+    """
+    Reads a batchConvertBin2HDF.sh style config file: a Bin2HDF config file whose third and
+    fourth lines are whitespace separated lists of start timestamps and integration times.
+    The Bin2HDF executable is the one next to this script.
+
+    Returns
+    -------
+    same dict as readDitherConfig
+    """
+    with open(cfgFile) as f:
+        lines = f.read().splitlines()
+    xPix, yPix = [int(v) for v in lines[0].split()]
+    startTimes = [int(v) for v in lines[2].split()]
+    intTimes = [int(v) for v in lines[3].split()]
+    if len(intTimes) == 1:
+        intTimes = intTimes*len(startTimes)
+    if len(intTimes) != len(startTimes):
+        raise ValueError('{}: need one integration time or one per start timestamp'.format(cfgFile))
+    return {'xPix': xPix, 'yPix': yPix, 'binPath': lines[1], 'outPath': lines[6].strip(),
+            'beamFile': lines[4], 'mapFlag': int(lines[5]),
+            'b2hPath': os.path.dirname(os.path.abspath(__file__)),
+            'jobs': list(zip(startTimes, intTimes))}
+
+
+def writeBin2HDFConfig(cfgFile, xPix, yPix, binPath, startTime, nFiles, beamFile, mapFlag, outPath,
+                       singlePass=True, nThreads=1, pixelBufferMB=defaultPixelBufferMB):
+    """Writes a Bin2HDF config file (see README.md for the format)"""
+    with open(cfgFile, 'w') as f:
+        f.write('{} {}\n'.format(xPix, yPix))
+        f.write(binPath + '\n')
+        f.write('{}\n'.format(startTime))
+        f.write('{}\n'.format(nFiles))
+        f.write(beamFile + '\n')
+        f.write('{}\n'.format(mapFlag))
+        f.write(outPath + '\n')
+        f.write('{}\n'.format(int(singlePass)))
+        f.write('{}\n'.format(nThreads))
+        f.write('{}\n'.format(pixelBufferMB))
+
+
+def getOutputFile(outPath, startTime):
+    """Path of the h5 file Bin2HDF writes for a conversion starting at startTime"""
+    return os.path.join(outPath, '{}.h5'.format(startTime))
+
+
+def isValidOutput(h5File, nFiles=None):
+    """
+    True if h5File is a complete Bin2HDF output: it opens, has a header (with expTime nFiles,
+    if given), a PhotonTable and a PixelIndex. Bin2HDF writes the header and PixelIndex last,
+    so an interrupted conversion is never valid.
+    """
+    if not os.path.isfile(h5File):
+        return False
+    try:
+        with tables.open_file(h5File, mode='r') as f:
+            if '/Photons/PhotonTable' not in f or '/Photons/PixelIndex' not in f:
+                return False
+            header = f.root.header.header.read()
+            return nFiles is None or int(header['expTime'][0]) == nFiles
+    except Exception:
+        return False
+
+
+def estimateJobMemory(binPath, startTime, nFiles, singlePass=True, pixelBufferMB=defaultPixelBufferMB):
+    """
+    Rough peak memory (bytes) of converting nFiles .bin files starting at startTime: the read
+    buffers, plus the per pixel photon buffers of at most pixelBufferMB (single pass), or one
+    file's photon tables and the python post processing that reads the whole PhotonTable (per ResID).
+    """
+    sizes = []
+    for i in range(nFiles):
+        binFile = os.path.join(binPath, '{}.bin'.format(startTime + i))
+        sizes.append(os.path.getsize(binFile) if os.path.isfile(binFile) else 0)
+    maxSize = max(sizes, default=0)
+    nPhotons = sum(sizes)//8
+    if singlePass:
+        return nReadBuffers*maxSize + min(nPhotons*photonBytes, pixelBufferMB*1024**2) + overheadBytes
+    return nReadBuffers*maxSize + maxSize//8*photonBytes + 2*nPhotons*photonBytes + overheadBytes
+
+
+def getAvailableMemory():
+    """Available memory in bytes (MemAvailable from /proc/meminfo, or the physical memory)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+
+def batchConvert(config, workDir, nProcs=None, memBudget=None, nThreads=1, singlePass=True, resume=True,
+                 pollInterval=1, pixelBufferMB=defaultPixelBufferMB):
+    """
+    Runs the conversions in config (see readDitherConfig), at most nProcs at once and with the
+    summed memory estimates of the running conversions within memBudget (a conversion that needs
+    more than memBudget runs alone).
+
+    Parameters
+    ----------
+    config: dict
+        from readDitherConfig or readBatchConfig
+    workDir: string
+        directory for the per conversion working directories
+    nProcs: int
+        maximum number of Bin2HDF processes, default os.cpu_count()//nThreads
+    memBudget: int
+        memory budget in bytes, default 80% of the available memory
+    nThreads: int
+        parser threads of each Bin2HDF process
+    singlePass: bool
+        write the consolidated, indexed file directly (see README.md), otherwise per ResID tables
+        and the python post processing
+    resume: bool
+        skip conversions whose output is already valid
+    pollInterval: float
+        seconds between checks of the running conversions
+    pixelBufferMB: int
+        memory for the single pass per pixel photon buffers of each Bin2HDF process
+
+    Returns
+    -------
+    dict with keys converted, skipped and failed: lists of output file names
+    """
+    if nProcs is None:
+        nProcs = max(1, (os.cpu_count() or 1)//nThreads)
+    if memBudget is None:
+        memBudget = int(0.8*getAvailableMemory())
+    b2hExe = os.path.join(os.path.abspath(config['b2hPath']), 'Bin2HDF')
+    os.makedirs(config['outPath'], exist_ok=True)
+
+    result = {'converted': [], 'skipped': [], 'failed': []}
+    pending = []
+    for startTime, nFiles in config['jobs']:
+        outFile = getOutputFile(config['outPath'], startTime)
+        if resume and isValidOutput(outFile, nFiles):
+            print('Skipping {}, already converted'.format(outFile))
+            result['skipped'].append(outFile)
+            continue
+        memory = estimateJobMemory(config['binPath'], startTime, nFiles, singlePass, pixelBufferMB)
+        pending.append((startTime, nFiles, outFile, memory))
+
+    running = []
+    memUsed = 0
+    nJobs = len(pending)
+    tStart = time.time()
+    while pending or running:
+        # start conversions while processes and memory allow (always one if nothing is running)
+        while pending and len(running) < nProcs and (not running or memUsed + pending[0][3] <= memBudget):
+            startTime, nFiles, outFile, memory = pending.pop(0)
+            jobDir = os.path.join(workDir, str(startTime))
+            os.makedirs(jobDir, exist_ok=True)
+            cfgFile = os.path.join(jobDir, 'Bin2HDF.cfg')
+            writeBin2HDFConfig(cfgFile, config['xPix'], config['yPix'], config['binPath'], startTime, nFiles,
+                               config['beamFile'], config['mapFlag'], config['outPath'], singlePass, nThreads,
+                               pixelBufferMB)
+            log = open(os.path.join(jobDir, 'Bin2HDF.log'), 'w')
+            process = subprocess.Popen([b2hExe, cfgFile], cwd=jobDir, stdout=log, stderr=subprocess.STDOUT)
+            running.append((process, log, outFile, nFiles, memory))
+            memUsed += memory
+            print('Started {} ({} s, ~{:.1f} GB), {} running'.format(outFile, nFiles, memory/1024**3, len(running)))
+
+        time.sleep(pollInterval)
+        for job in running[:]:
+            process, log, outFile, nFiles, memory = job
+            if process.poll() is None:
+                continue
+            log.close()
+            running.remove(job)
+            memUsed -= memory
+            if process.returncode == 0 and isValidOutput(outFile, nFiles):
+                result['converted'].append(outFile)
+                print('Finished {}'.format(outFile))
+            else:
+                result['failed'].append(outFile)
+                print('Failed {} (exit code {}), see {}'.format(outFile, process.returncode, log.name))
+    print('Converted {} of {} files in {:.0f} s, skipped {}, {} failed'.format(
+        len(result['converted']), nJobs, time.time() - tStart, len(result['skipped']), len(result['failed'])))
+    return result
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert a dither stack or a list of timestamps into hdf5 files '
+                                                 'with parallel Bin2HDF processes.')
+    parser.add_argument('cfgFile', help='Dither2HDF.cfg style config file, or batchConvertBin2HDF.sh style config file')
+    parser.add_argument('--bufferTime', type=int, default=1,
+                        help='Seconds to exclude from the beginning and end of each dither position')
+    parser.add_argument('--nProcs', type=int, default=None, help='Maximum number of Bin2HDF processes')
+    parser.add_argument('--memBudget', type=float, default=None, help='Memory budget in GB')
+    parser.add_argument('--nThreads', type=int, default=1, help='Parser threads per Bin2HDF process')
+    parser.add_argument('--pixelBufferMB', type=int, default=defaultPixelBufferMB,
+                        help='Memory for the single pass per pixel photon buffers of each Bin2HDF process')
+    parser.add_argument('--perResID', action='store_true',
+                        help='Write per ResID tables and run the python post processing instead of the single pass mode')
+    parser.add_argument('--workDir', default=None, help='Directory for the per conversion working directories')
+    parser.add_argument('--noResume', action='store_true', help='Convert again even if an output is already valid')
+    args = parser.parse_args()
+
+    cfgParser = ConfigParser()
+    try:
+        isDither = bool(cfgParser.read(args.cfgFile)) and cfgParser.has_section('Data')
+    except Exception:
+        isDither = False
+    config = readDitherConfig(args.cfgFile, args.bufferTime) if isDither else readBatchConfig(args.cfgFile)
+    workDir = args.workDir if args.workDir is not None else os.path.join(config['outPath'], 'bin2hdfJobs')
+    memBudget = None if args.memBudget is None else int(args.memBudget*1024**3)
+
+    result = batchConvert(config, workDir, nProcs=args.nProcs, memBudget=memBudget, nThreads=args.nThreads,
+                          singlePass=not args.perResID, resume=not args.noResume,
+                          pixelBufferMB=args.pixelBufferMB)
+    sys.exit(1 if result['failed'] else 0)
@@ -0,0 +1,376 @@
+"""
+Converts .bin files into an h5 file in python, without compiling Bin2HDF.c.
+
+convert() writes the same file as the single pass Bin2HDF (see README.md): the header, the
+beammap, the count images, a ResID and time sorted /Photons/PhotonTable (with Bin2HDF's chunk
+size unless chunkRows is given), its PixelIndex and its TimeIndex. The packets are decoded with
+parsePacketDump.parseBinWords (optionally in several processes) and each second's photons are
+sorted by ResID and time by BinFileParser. If all of the photons fit in maxPhotons each second
+is copied straight to its place in the PhotonTable; otherwise the seconds are appended to a
+scratch table and moved into the PhotonTable in groups of ResIDs (moveSecondsByResID), which
+liveBin2HDF.py also does at the end of an observation.
+
+Data from before the February 2018 firmware upgrade are kept in packet order within each pixel
+and corrected with correctUnsortedTimestamps.correctPhotonTableTimestamps.
+
+usage: python bin2hdf.py <Bin2HDF.cfg> [--nProcs n] [--maxPhotons n]
+"""
+
+import argparse
+import calendar
+import multiprocessing as mp
+import os
+import time
+import warnings
+
+import numpy as np
+import tables
+
+from mkidpipeline.core.headers import ObsFileCols, ObsHeader
+from mkidpipeline.hdf.consolidatePhotonTables import createPhotonTable, writePixelIndex, writeTimeIndex
+from mkidpipeline.hdf.correctUnsortedTimestamps import correctPhotonTableTimestamps
+from mkidpipeline.utils.parsePacketDump import parseBinWords, readBinWords
+
+noResID = 2**32-1 #BeamMap value of pixels without a ResID (as in Bin2HDF)
+firmwareUpgradeTime = 1518222559 #data before this need correctUnsortedTimestamps.py (FIRMWARE_UPGRADE_TS in Bin2HDF.c)
+bin2hdfChunkRows = 8192 #PhotonTable chunk size of Bin2HDF (PHOTON_CHUNK_ROWS in Bin2HDF.c)
+
+
+def readBin2HDFConfig(cfgFile):
+    """
+    Reads a Bin2HDF config file (see README.md for the format).
+
+    Returns
+    -------
+    dict with keys xPix, yPix, binPath, startTime, nFiles, beamFile, mapFlag and outPath
+    """
+    with open(cfgFile) as f:
+        lines = f.read().splitlines()
+    xPix, yPix = [int(v) for v in lines[0].split()]
+    return {'xPix': xPix, 'yPix': yPix, 'binPath': lines[1], 'startTime': int(lines[2]), 'nFiles': int(lines[3]),
+            'beamFile': lines[4], 'mapFlag': int(lines[5]), 'outPath': lines[6].strip()}
+
+
+def readBeammap(beammapFile, nXPix, nYPix):
+    """
+    Reads a beammap file with lines of ResID, flag, x, y like Bin2HDF does: pixels that aren't
+    in the file get ResID noResID and flag 1, flags above 1 become 2.
+
+    Returns
+    -------
+    beamMap, beamFlag: (nXPix, nYPix) arrays of uint32
+    """
+    beamMap = np.full((nXPix, nYPix), noResID, dtype=np.uint32)
+    beamFlag = np.ones((nXPix, nYPix), dtype=np.uint32)
+    resIDs, flags, xCoords, yCoords = np.loadtxt(beammapFile, dtype=np.int64, unpack=True, ndmin=2)
+    beamMap[xCoords, yCoords] = resIDs
+    beamFlag[xCoords, yCoords] = np.minimum(flags, 2)
+    return beamMap, beamFlag
+
+
+def getYearStart(timestamp):
+    """UTC timestamp of the start of timestamp's year, which .bin header times are relative to"""
+    return calendar.timegm((time.gmtime(timestamp).tm_year, 1, 1, 0, 0, 0))
+
+
+class BinFileParser:
+    """
+    Turns .bin files into photon lists in the PhotonTable format. It only holds arrays, so it
+    can be sent to other processes (e.g. pool.imap(parser.parseSecond, timestamps)).
+
+    Parameters
+    ----------
+    binPath: string
+        directory of the .bin files
+    beamMap, beamFlag: (nXPix, nYPix) arrays
+        from readBeammap
+    mapFlag: int
+        if >0 only photons of successfully beammapped pixels (flag 0) are kept
+    startTime: int
+        timestamp of the first .bin file; photon times are relative to it
+
+    Attributes
+    ----------
+    resIDs: sorted array of the ResIDs whose photons are kept
+    pixelCols: (nXPix, nYPix) array of each pixel's index in resIDs, -1 if its photons aren't kept
+    """
+
+    def __init__(self, binPath, beamMap, beamFlag, mapFlag, startTime):
+        self.binPath = binPath
+        self.nXPix, self.nYPix = beamMap.shape
+        self.startTime = startTime
+        #pre upgrade data stay in packet order for correctUnsortedTimestamps.py
+        self.sortTimes = startTime >= firmwareUpgradeTime
+
+        goodPixels = beamMap != noResID
+        if mapFlag > 0:
+            goodPixels &= beamFlag == 0
+        self.resIDs = np.unique(beamMap[goodPixels])
+        self.pixelCols = np.full(beamMap.shape, -1, dtype=np.int64)
+        self.pixelCols[goodPixels] = np.searchsorted(self.resIDs, beamMap[goodPixels])
+
+        #header times are half ms since the start of the year
+        self.yearStart = getYearStart(startTime)
+        self.startTicks = (startTime - self.yearStart)*1000000
+
+    def getBinFile(self, timestamp):
+        """Path of the .bin file of the second starting at timestamp"""
+        return os.path.join(self.binPath, '{}.bin'.format(timestamp))
+
+    def emptySecond(self):
+        """parseSecond() result of a second without photons"""
+        return (np.zeros(0, dtype=tables.dtype_from_descr(ObsFileCols)), np.zeros(len(self.resIDs), dtype=np.int64),
+                np.zeros((self.nXPix, self.nYPix), dtype=np.int64))
+
+    def parseSecond(self, timestamp):
+        """
+        Parses the .bin file of one second. A missing file is a second without photons.
+
+        Returns
+        -------
+        photons: structured array (ObsFileCols dtype) of the kept photons, sorted by ResID and time
+        pixelCounts: number of photons of each ResID in resIDs
+        image: (nXPix, nYPix) count image of all photons in the array
+        """
+        binFile = self.getBinFile(timestamp)
+        if not os.path.isfile(binFile):
+            return self.emptySecond()
+        parsed = parseBinWords(readBinWords(binFile))
+        ticks = parsed['timestamp'].astype(np.int64)
+        #header timestamps wrap every 2**20 s in some data (FixOverflowTimestamps in Bin2HDF.c)
+        nWraps = np.maximum((timestamp - self.yearStart - ticks//1000000 + 3)//1048576, 0)
+        ticks += nWraps*1048576*1000000 - self.startTicks
+
+        inArray = (parsed['x'] < self.nXPix) & (parsed['y'] < self.nYPix)
+        xCoords = parsed['x'][inArray].astype(np.int64)
+        yCoords = parsed['y'][inArray].astype(np.int64)
+        image = np.bincount(xCoords*self.nYPix + yCoords, minlength=self.nXPix*self.nYPix).reshape(self.nXPix, self.nYPix)
+
+        cols = self.pixelCols[xCoords, yCoords]
+        keep = (cols >= 0) & (ticks[inArray] >= 0)
+        cols = cols[keep]
+        ticks = ticks[inArray][keep]
+        if self.sortTimes:
+            #one stable sort on a (column, time) key is faster than np.lexsort; times are < 2**32
+            order = np.argsort((cols << 32) | ticks, kind='stable')
+        else:
+            order = np.argsort(cols, kind='stable')
+        photons = np.zeros(len(cols), dtype=tables.dtype_from_descr(ObsFileCols))
+        photons['ResID'] = self.resIDs[cols[order]]
+        photons['Time'] = ticks[order]
+        photons['Wavelength'] = parsed['phase'][inArray][keep][order]
+        photons['SpecWeight'] = 1
+        photons['NoiseWeight'] = 1
+        return photons, np.bincount(cols, minlength=len(self.resIDs)), image
+
+
+def createObsFile(fileName, startTime, expTime, binPath, beammapFile, beamMap, beamFlag):
+    """
+    Creates an h5 file with the header, the beammap and empty /Photons and /Images groups.
+
+    Returns
+    -------
+    tables.File, open for writing
+    """
+    hfile = tables.open_file(fileName, mode='w')
+    hfile.create_group('/', 'header', 'Header')
+    headerTable = hfile.create_table('/header', 'header', ObsHeader, 'Header')
+    headerContents = headerTable.row
+    headerContents['startTime'] = startTime
+    headerContents['expTime'] = expTime
+    headerContents['wvlBinStart'] = 700
+    headerContents['wvlBinEnd'] = 1500
+    headerContents['energyBinWidth'] = 0.1
+    headerContents['dataDir'] = binPath
+    headerContents['beammapFile'] = beammapFile
+    headerContents.append()
+    headerTable.flush()
+
+    hfile.create_group('/', 'BeamMap')
+    hfile.create_array('/BeamMap', 'Map', beamMap)
+    hfile.create_array('/BeamMap', 'Flag', beamFlag)
+    hfile.create_group('/', 'Images')
+    hfile.create_group('/', 'Photons')
+    return hfile
+
+
+def writeImage(hfile, timestamp, image):
+    """
+    Writes one second's count image as /Images/<timestamp>, an 8 bit HDF5 image of counts/10
+    (transposed, like Bin2HDF writes it).
+    """
+    smallImage = (image.T//10).astype(np.uint8)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=tables.NaturalNameWarning) #timestamp names, as in Bin2HDF
+        node = hfile.create_array('/Images', str(timestamp), smallImage)
+    node.attrs.IMAGE_SUBCLASS = np.bytes_('IMAGE_INDEXED')
+    node.attrs.IMAGE_VERSION = np.bytes_('1.2')
+
+
+def moveSecondsByResID(secondTable, pixelCounts, photonTable, chunkSize=10000000):
+    """
+    Appends the photons of secondTable, consecutive seconds that are each sorted by ResID, to
+    photonTable sorted by ResID (keeping the order within each ResID). The photons are moved in
+    groups of ResIDs with about chunkSize photons, each group being one contiguous slice of
+    every second.
+
+    Parameters
+    ----------
+    secondTable: tables.Table
+        the seconds' photons
+    pixelCounts: (nSeconds, nResIDs) array of ints
+        number of photons of each ResID (in ResID order) in each second
+    photonTable: tables.Table
+        table to append to
+    chunkSize: int
+        photons per group
+    """
+    if pixelCounts.size == 0:
+        return
+    secondStarts = np.concatenate(([0], np.cumsum(pixelCounts.sum(axis=1, dtype=np.int64))[:-1]))
+    pixelTotals = pixelCounts.sum(axis=0, dtype=np.int64)
+    cumTotals = np.cumsum(pixelTotals)
+
+    groupStart = 0
+    while groupStart < pixelCounts.shape[1]:
+        groupEnd = int(np.searchsorted(cumTotals, cumTotals[groupStart] - pixelTotals[groupStart] + chunkSize,
+                                       side='right'))
+        groupEnd = max(groupEnd, groupStart+1)
+        groupCounts = pixelCounts[:, groupStart:groupEnd].sum(axis=1, dtype=np.int64)
+        slices = [secondTable.read(secondStarts[i], secondStarts[i]+groupCounts[i]) for i in np.flatnonzero(groupCounts)]
+        secondStarts += groupCounts
+        if slices:
+            photons = np.concatenate(slices)
+            photonTable.append(photons[np.argsort(photons['ResID'], kind='stable')])
+        groupStart = groupEnd
+    photonTable.flush()
+
+
+def writePhotonIndexes(hfile, resIDs, pixelTotals, correctTimes=False):
+    """
+    Writes the PixelIndex and TimeIndex of a ResID sorted PhotonTable with pixelTotals photons
+    of each ResID in resIDs. If correctTimes the timestamps are corrected first (pre upgrade data).
+    """
+    pixelTotals = np.asarray(pixelTotals, dtype=np.int64)
+    hasPhotons = pixelTotals > 0
+    startRows = np.cumsum(pixelTotals) - pixelTotals
+    writePixelIndex(hfile, resIDs[hasPhotons], startRows[hasPhotons], pixelTotals[hasPhotons])
+    if correctTimes:
+        correctPhotonTableTimestamps(hfile) #also writes the TimeIndex
+    else:
+        writeTimeIndex(hfile)
+
+
+def convert(binPath, startTime, nFiles, beammapFile, outFile, nXPix=80, nYPix=125, mapFlag=1, nProcs=1,
+            maxPhotons=50000000, filters=None, chunkRows=bin2hdfChunkRows, progress=None):
+    """
+    Converts nFiles .bin files starting at startTime into an h5 file with the single pass
+    Bin2HDF layout (see the module docstring).
+
+    Parameters
+    ----------
+    binPath: string
+        directory of the .bin files
+    startTime: int
+        timestamp of the first .bin file
+    nFiles: int
+        number of seconds to convert (missing files are seconds without photons)
+    beammapFile: string
+        beammap file (ResID, flag, x, y)
+    outFile: string
+        h5 file to write, replaced if it exists
+    nXPix, nYPix: int
+        array size
+    mapFlag: int
+        if >0 only photons of successfully beammapped pixels (flag 0) are kept
+    nProcs: int
+        number of processes parsing .bin files
+    maxPhotons: int
+        above this many (estimated) photons the seconds go through a scratch file instead of memory
+    filters, chunkRows:
+        PhotonTable layout (see consolidatePhotonTables.createPhotonTable). chunkRows defaults to
+        Bin2HDF's, not consolidatePhotonTables.defaultChunkRows, so that the file is the same
+    progress: function
+        called as progress(timestamp, nPhotons) after each second is parsed
+
+    Returns
+    -------
+    dict with keys outFile, nPhotons, missingFiles (list of timestamps) and photonsPerSec
+    """
+    start = time.time()
+    beamMap, beamFlag = readBeammap(beammapFile, nXPix, nYPix)
+    parser = BinFileParser(binPath, beamMap, beamFlag, mapFlag, startTime)
+    timestamps = list(range(startTime, startTime+nFiles))
+    binFiles = [parser.getBinFile(timestamp) for timestamp in timestamps]
+    missingFiles = [timestamp for timestamp, binFile in zip(timestamps, binFiles) if not os.path.isfile(binFile)]
+    inMemory = sum(os.path.getsize(binFile) for binFile in binFiles if os.path.isfile(binFile))//8 <= maxPhotons
+
+    hfile = createObsFile(outFile, startTime, nFiles, binPath, beammapFile, beamMap, beamFlag)
+    scratchFile = outFile + '.scratch'
+    if inMemory:
+        seconds = []
+    else:
+        scratch = tables.open_file(scratchFile, mode='w')
+        secondTable = scratch.create_table('/', 'seconds', ObsFileCols, chunkshape=(chunkRows,))
+    pixelCounts = np.zeros((nFiles, len(parser.resIDs)), dtype=np.uint32)
+
+    pool = mp.Pool(nProcs) if nProcs > 1 else None
+    try:
+        results = pool.imap(parser.parseSecond, timestamps) if pool else map(parser.parseSecond, timestamps)
+        for i, (photons, counts, image) in enumerate(results):
+            pixelCounts[i] = counts
+            writeImage(hfile, timestamps[i], image)
+            if inMemory:
+                seconds.append(photons)
+            else:
+                secondTable.append(photons)
+            if progress is not None:
+                progress(timestamps[i], len(photons))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    pixelTotals = pixelCounts.sum(axis=0, dtype=np.int64)
+    nPhotons = int(pixelTotals.sum())
+    photonTable = createPhotonTable(hfile, nPhotons, filters, chunkRows)
+    if inMemory:
+        #each second's photons of a ResID go right after that ResID's photons from the earlier seconds
+        allPhotons = np.zeros(nPhotons, dtype=photonTable.dtype)
+        destStarts = np.cumsum(pixelTotals) - pixelTotals
+        for photons, counts in zip(seconds, pixelCounts.astype(np.int64)):
+            cols = np.repeat(np.arange(len(counts)), counts)
+            colStarts = np.cumsum(counts) - counts
+            allPhotons[destStarts[cols] + np.arange(len(photons)) - colStarts[cols]] = photons
+            destStarts += counts
+        del seconds
+        photonTable.append(allPhotons)
+        photonTable.flush()
+    else:
+        moveSecondsByResID(secondTable, pixelCounts, photonTable)
+        scratch.close()
+        os.remove(scratchFile)
+    writePhotonIndexes(hfile, parser.resIDs, pixelTotals, correctTimes=not parser.sortTimes)
+    hfile.close()
+
+    return {'outFile': outFile, 'nPhotons': nPhotons, 'missingFiles': missingFiles,
+            'photonsPerSec': nPhotons/(time.time()-start)}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert .bin files into an h5 file (python version of Bin2HDF).')
+    parser.add_argument('cfgFile', help='Bin2HDF config file')
+    parser.add_argument('--nProcs', type=int, default=1, help='Number of processes parsing .bin files')
+    parser.add_argument('--maxPhotons', type=int, default=50000000,
+                        help='Above this many photons the conversion goes through a scratch file')
+    args = parser.parse_args()
+
+    config = readBin2HDFConfig(args.cfgFile)
+    outFile = os.path.join(config['outPath'], '{}.h5'.format(config['startTime']))
+    result = convert(config['binPath'], config['startTime'], config['nFiles'], config['beamFile'], outFile,
+                     config['xPix'], config['yPix'], config['mapFlag'], args.nProcs, args.maxPhotons,
+                     progress=lambda timestamp, nPhotons: print('{}: {} photons'.format(timestamp, nPhotons)))
+    for timestamp in result['missingFiles']:
+        print("Couldn't open {}".format(os.path.join(config['binPath'], '{}.bin'.format(timestamp))))
+    print('Converted {} photons to {}: {:.1f} photons/sec.'.format(result['nPhotons'], outFile,
+                                                                    result['photonsPerSec']))
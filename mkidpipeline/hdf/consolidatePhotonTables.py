@@ -1,33 +1,261 @@
-import sys
+"""
+Consolidates the per-ResID photon tables made by Bin2HDF into a single ResID-sorted
+/Photons/PhotonTable, and writes the /Photons/PixelIndex table giving the (StartRow, NRows)
+of every ResID so ObsFile can read a pixel's photons with a contiguous slice.
+
+Also writes /Photons/TimeIndex, a (nChunks+1, nPixelIndexRows) array giving, for each
+PixelIndex entry, the row offset (relative to StartRow) of the first photon in each
+chunkTicks long time chunk. The last row is always NRows. ObsFile uses it to read only
+the rows in a time window.
+
+The PhotonTable layout (compression filters and rows per HDF5 chunk) is set with
+getPhotonTableFilters and chunkRows. By default the table is uncompressed, so any HDF5 reader
+can open it. Blosc (with LZ4 or Zstd) and byte-shuffle shrink the table a lot, since times are
+nearly sorted and weights are mostly 1, but need the Blosc filter plugin to read outside of
+PyTables, so they are opt-in (e.g. --complib blosc:lz4 --complevel 5).
+See examples/photonTableLayoutBenchmark.py for sizes and read times of different layouts.
+
+usage: python consolidatePhotonTables.py [--complib lib] [--complevel n] [--noshuffle] [--chunkrows n] <path to h5 file>
+       python consolidatePhotonTables.py --index-only <path to h5 file>
+           (only add a PixelIndex and TimeIndex to an already consolidated file)
+"""
+
+import argparse
+import warnings
 
 import numpy as np
 import tables
 
-from mkidpipeline.core.headers import ObsFileCols
+from mkidpipeline.core.headers import ObsFileCols, PixelIndexCols
+
+# default PhotonTable layout (uncompressed)
+defaultComplib = 'zlib'
+defaultComplevel = 0
+defaultShuffle = True
+defaultChunkRows = 65536
+
+
+def getPhotonTableFilters(complib=defaultComplib, complevel=defaultComplevel, shuffle=defaultShuffle):
+    """
+    Returns the tables.Filters for a PhotonTable (and its column indexes).
+
+    Parameters
+    ----------
+    complib: string
+        compression library, e.g. 'blosc:lz4', 'blosc:zstd', 'blosc2:lz4' or 'zlib' (see tables.filters.all_complibs)
+    complevel: int
+        0 (no compression) to 9
+    shuffle: bool
+        byte-shuffle the rows before compressing
+    """
+    return tables.Filters(complevel=complevel, complib=complib, shuffle=shuffle and complevel>0)
+
+
+def createPhotonTable(hfile, expectedRows, filters=None, chunkRows=defaultChunkRows):
+    """
+    Creates an empty /Photons/PhotonTable.
+
+    Parameters
+    ----------
+    hfile: tables.File
+        Open (writable) h5 file with a /Photons group
+    expectedRows: int
+        Expected number of photons
+    filters: tables.Filters
+        From getPhotonTableFilters, default is getPhotonTableFilters()
+    chunkRows: int
+        Rows per HDF5 chunk
+
+    Returns
+    -------
+    tables.Table
+    """
+    if filters is None:
+        filters = getPhotonTableFilters()
+    return hfile.create_table('/Photons', 'PhotonTable', ObsFileCols, 'Photon Table', filters=filters,
+                              expectedrows=expectedRows, chunkshape=(chunkRows,))
+
+
+def writePixelIndex(hfile, resIDs, startRows, nRows):
+    """
+    Writes /Photons/PixelIndex, replacing it if it already exists.
+
+    Parameters
+    ----------
+    hfile: tables.File
+        Open (writable) h5 file
+    resIDs: array of ints
+        ResIDs present in the PhotonTable, in table order
+    startRows: array of ints
+        Row in PhotonTable where each resID starts
+    nRows: array of ints
+        Number of photons for each resID
+    """
+    if '/Photons/PixelIndex' in hfile:
+        hfile.remove_node('/Photons/PixelIndex')
+    indexTable = hfile.create_table('/Photons', 'PixelIndex', PixelIndexCols, 'ResID row offsets into PhotonTable',
+                                    expectedrows=len(resIDs))
+    pixelIndex = np.zeros(len(resIDs), dtype=indexTable.dtype)
+    pixelIndex['ResID'] = resIDs
+    pixelIndex['StartRow'] = startRows
+    pixelIndex['NRows'] = nRows
+    indexTable.append(pixelIndex)
+    indexTable.flush()
+
+
+def writeTimeIndex(hfile, chunkTicks=100000, nPixPerRead=1000):
+    """
+    Writes /Photons/TimeIndex, replacing it if it already exists, with the PhotonTable's filters.
+    Requires a PixelIndex and photons that are time ordered within each pixel; if they aren't,
+    no TimeIndex is written.
+
+    Parameters
+    ----------
+    hfile: tables.File
+        Open (writable) h5 file
+    chunkTicks: int
+        Length of each time chunk in ticks (default is 100 ms)
+    nPixPerRead: int
+        Number of pixels to read from the Time column at a time
+    """
+    if '/Photons/TimeIndex' in hfile:
+        hfile.remove_node('/Photons/TimeIndex')
+    photonTable = hfile.root.Photons.PhotonTable
+    pixelIndex = hfile.root.Photons.PixelIndex.read()
+    if len(pixelIndex)==0:
+        return
+    expTicks = int(np.ceil(hfile.root.header.header[0]['expTime']*1e6))
+    nChunks = max(int(np.ceil(expTicks/chunkTicks)), 1)
+    chunkEdges = np.arange(nChunks, dtype=np.uint64)*chunkTicks
+
+    timeIndex = hfile.create_carray('/Photons', 'TimeIndex', tables.UInt32Atom(), shape=(nChunks+1, len(pixelIndex)),
+                                    title='Row offset of each time chunk, relative to PixelIndex StartRow',
+                                    filters=photonTable.filters)
+    for iPix in range(0, len(pixelIndex), nPixPerRead):
+        pixels = pixelIndex[iPix:iPix+nPixPerRead]
+        startRow = int(pixels['StartRow'][0])
+        times = photonTable.read(startRow, int(pixels['StartRow'][-1] + pixels['NRows'][-1]), field='Time')
+
+        # pixel number in the high bits and time in the low bits makes a key that is sorted over the whole block
+        pixelOrdinal = np.repeat(np.arange(len(pixels), dtype=np.uint64), pixels['NRows'].astype(np.int64))
+        keys = (pixelOrdinal<<np.uint64(32)) + times
+        if np.any(keys[1:]<keys[:-1]):
+            warnings.warn('Photons are not time ordered within each pixel, not writing a TimeIndex')
+            hfile.remove_node('/Photons/TimeIndex')
+            return
+        edgeKeys = (np.arange(len(pixels), dtype=np.uint64)[:, np.newaxis]<<np.uint64(32)) + chunkEdges
+        pixelStarts = (pixels['StartRow'] - startRow).astype(np.int64)[:, np.newaxis]
+        offsets = np.empty((len(pixels), nChunks+1), dtype=np.uint32)
+        offsets[:, :-1] = np.searchsorted(keys, edgeKeys, side='left') - pixelStarts
+        offsets[:, -1] = pixels['NRows']
+        timeIndex[:, iPix:iPix+len(pixels)] = offsets.T
+    timeIndex.attrs.chunkTicks = chunkTicks
+    timeIndex.flush()
+
+
+def makePixelIndex(photonTable, chunkSize=10000000):
+    """
+    Computes the PixelIndex of an existing, ResID-sorted PhotonTable by reading only the
+    ResID column, chunkSize rows at a time.
+
+    Returns
+    -------
+    resIDs, startRows, nRows: arrays of ints
+    """
+    resIDs = []
+    startRows = []
+    lastResID = None
+    for chunkStart in range(0, photonTable.nrows, chunkSize):
+        chunkResIDs = photonTable.read(chunkStart, chunkStart+chunkSize, field='ResID')
+        resIDDiffs = np.diff(chunkResIDs.astype(np.int64))
+        if np.any(resIDDiffs<0) or (lastResID is not None and chunkResIDs[0]<lastResID):
+            raise ValueError('PhotonTable is not sorted by ResID!')
+        boundaryInds = np.where(resIDDiffs>0)[0] + 1 #indices where ResID changes
+        if lastResID is None or chunkResIDs[0]!=lastResID:
+            boundaryInds = np.insert(boundaryInds, 0, 0)
+        resIDs.append(chunkResIDs[boundaryInds])
+        startRows.append(boundaryInds + chunkStart)
+        lastResID = chunkResIDs[-1]
+    resIDs = np.concatenate(resIDs) if resIDs else np.zeros(0, dtype=np.uint32)
+    startRows = np.concatenate(startRows) if startRows else np.zeros(0, dtype=np.uint64)
+    nRows = np.diff(np.append(startRows, photonTable.nrows))
+    return resIDs, startRows, nRows
+
+
+def consolidatePhotonTables(hfile, filters=None, chunkRows=defaultChunkRows):
+    """
+    Moves all of the /Photons/<resID> tables into /Photons/PhotonTable in ResID order,
+    recording the PixelIndex as it goes. filters and chunkRows set the layout (see createPhotonTable).
+    """
+    nRows = 0
+    for pixTable in hfile.iter_nodes('/Photons'):
+        nRows += pixTable.shape[0]
+
+    photonTable = createPhotonTable(hfile, nRows, filters, chunkRows)
+
+    beamMap = hfile.get_node('/BeamMap/Map').read()
+    resIDList = np.sort(beamMap.flatten())
+
+    indexResIDs = []
+    indexStartRows = []
+    indexNRows = []
+    for resID in resIDList:
+        if resID==2**32-1:
+            continue
+        pixelTable = hfile.get_node('/Photons/' + str(resID)).read()
+        if len(pixelTable)>0:
+            indexResIDs.append(resID)
+            indexStartRows.append(photonTable.nrows)
+            indexNRows.append(len(pixelTable))
+        photonTable.append(pixelTable)
+        photonTable.flush()
+        hfile.remove_node('/Photons/' + str(resID))
+
+    writePixelIndex(hfile, indexResIDs, indexStartRows, indexNRows)
+    writeTimeIndex(hfile)
+
 
-if(len(sys.argv)<2):
-    print("Usage: python consolidatePhotonTables.py <filename>")
-    exit(1)
+def addLayoutArguments(parser, chunkRows=True):
+    """
+    Adds the --complib, --complevel, --noshuffle and (if chunkRows) --chunkrows options to an
+    argparse.ArgumentParser. Unset options are None, getLayoutArgs fills in the defaults.
+    """
+    parser.add_argument('--complib', default=None,
+                        help="Compression library, e.g. 'zlib', 'blosc:lz4' or 'blosc:zstd' (default {})".format(defaultComplib))
+    parser.add_argument('--complevel', type=int, default=None,
+                        help='Compression level, 0 (none) to 9 (default {})'.format(defaultComplevel))
+    parser.add_argument('--noshuffle', action='store_true', help='Do not byte-shuffle before compressing')
+    if chunkRows:
+        parser.add_argument('--chunkrows', type=int, default=None,
+                            help='Rows per HDF5 chunk (default {})'.format(defaultChunkRows))
 
-fn = sys.argv[1]
-hfile = tables.open_file(fn, mode='a')
 
-nRows = 0
-for pixTable in hfile.iter_nodes('/Photons'):
-    nRows += pixTable.shape[0]
+def getLayoutArgs(args):
+    """
+    Returns the PhotonTable layout from options parsed with a parser set up by addLayoutArguments.
 
-print(ObsFileCols)
-photonTable = hfile.create_table('/Photons', 'PhotonTable', ObsFileCols, 'Photon Table', expectedrows=nRows, chunkshape=300)
+    Returns
+    -------
+    filters, chunkRows
+    """
+    complib = defaultComplib if args.complib is None else args.complib
+    complevel = defaultComplevel if args.complevel is None else args.complevel
+    chunkRows = getattr(args, 'chunkrows', None) or defaultChunkRows
+    return getPhotonTableFilters(complib, complevel, defaultShuffle and not args.noshuffle), chunkRows
 
-beamMap = hfile.get_node('/BeamMap/Map').read()
-resIDList = np.sort(beamMap.flatten())
 
-for resID in resIDList:
-    if resID==2**32-1:
-        continue
-    pixelTable = hfile.get_node('/Photons/' + str(resID)).read()
-    photonTable.append(pixelTable)
-    photonTable.flush()
-    hfile.remove_node('/Photons/' + str(resID))
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Consolidate the per-ResID photon tables of an h5 file into one PhotonTable.')
+    parser.add_argument('fileName', help='h5 file made by Bin2HDF')
+    parser.add_argument('--index-only', action='store_true',
+                        help='Only add a PixelIndex and TimeIndex to an already consolidated file')
+    addLayoutArguments(parser)
+    args = parser.parse_args()
 
-hfile.close()
+    hfile = tables.open_file(args.fileName, mode='a')
+    if args.index_only:
+        writePixelIndex(hfile, *makePixelIndex(hfile.root.Photons.PhotonTable))
+        writeTimeIndex(hfile)
+    else:
+        consolidatePhotonTables(hfile, *getLayoutArgs(args))
+    hfile.close()
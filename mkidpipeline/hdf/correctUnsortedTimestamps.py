@@ -1,7 +1,12 @@
 """
-This script corrects a firmware timing bug present through PAL2017b. It directly modifies the 
+This script corrects a firmware timing bug present through PAL2017b. It directly modifies the
 timestamps of the provided HDF5 file, so it only needs to be run once.
 
+Works on the per-ResID tables written by Bin2HDF and, a chunk of rows at a time, on a
+consolidated /Photons/PhotonTable (photons still in their original order within each pixel,
+as consolidatePhotonTables.py leaves them). For a consolidated file the TimeIndex is written
+afterwards, since each pixel is then time ordered.
+
 usage: python correctUnsortedTimestamps.py <path to h5 file>
 """
 
@@ -10,6 +15,61 @@ import sys
 import numpy as np
 import tables
 
+from mkidpipeline.hdf.consolidatePhotonTables import writeTimeIndex
+
+tickWrap = 500 #photon timestamps count ticks (us) since the header timestamp, which is in half ms
+
+
+def _correctHeaderTimes(timestamps, newPixel=None):
+    """
+    Linear time core of correctTimeStamps. Every time the photon part of a timestamp
+    (timestamp%500) goes backwards the header part must have advanced by at least 500, and the
+    header part never goes below the recorded one. The smallest corrected header times satisfying
+    this are
+
+        U[i] = max(hdr[i], U[i-1] + 500*(photon[i]<photon[i-1]))
+
+    which is U = D + maximum.accumulate(hdr - D), where D is the cumulative sum of the 500 tick
+    steps. The result is time ordered.
+
+    This is the minimal correction, which is not always what the original iterative version
+    gave: it added 500 to photons using header times from before earlier steps in the same pass,
+    so it could add more than needed, e.g. [1007, 1004, 1506, 1018] became
+    [1007, 1504, 1506, 2018] where this gives [1007, 1504, 1506, 1518].
+
+    Parameters
+    ----------
+    timestamps: numpy array of integers
+        timestamps in original, unsorted order
+    newPixel: numpy array of bools
+        True where a new pixel's photons start (the correction restarts there). Default is
+        one pixel.
+
+    Returns
+    -------
+    Corrected timestamps, int64
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    photonTimestamps = timestamps%tickWrap
+    hdrTimestamps = timestamps - photonTimestamps
+    if len(timestamps)==0:
+        return timestamps
+
+    steps = np.zeros(len(timestamps), dtype=np.int64)
+    steps[1:] = tickWrap*(photonTimestamps[1:]<photonTimestamps[:-1])
+    if newPixel is not None:
+        steps[newPixel] = 0
+    cumSteps = np.cumsum(steps)
+    runningMax = hdrTimestamps - cumSteps
+    if newPixel is not None and np.any(newPixel[1:]):
+        # restart the running maximum at each pixel by lifting each pixel above all previous ones
+        pixelOrdinal = np.cumsum(newPixel) - newPixel[0]
+        lift = np.int64(runningMax.max() - runningMax.min() + 1)
+        runningMax = np.maximum.accumulate(runningMax + pixelOrdinal*lift) - pixelOrdinal*lift
+    else:
+        runningMax = np.maximum.accumulate(runningMax)
+    return runningMax + cumSteps + photonTimestamps
+
 
 def correctTimeStamps(timestamps):
     """
@@ -25,23 +85,41 @@ def correctTimeStamps(timestamps):
     -------
     Array of corrected timestamps, dtype is uint32
     """
-    timestamps = np.array(timestamps, dtype=np.int64) #convert timestamps to signed values
-    photonTimestamps = timestamps%500
-    hdrTimestamps = timestamps - photonTimestamps
-
-    unsortedInds = np.where(np.diff(timestamps)<0)[0]+1 #mark locations n where T(n)<T(n-1)
-
-    for ind in unsortedInds:
-        indsToIncrement = np.where(hdrTimestamps==hdrTimestamps[ind])[0]
-        indsToIncrement = indsToIncrement[indsToIncrement>=ind]
-        hdrTimestamps[indsToIncrement] += 500
+    return np.array(_correctHeaderTimes(timestamps), dtype=np.uint32)
 
-    correctedTimestamps = hdrTimestamps + photonTimestamps
 
-    if(np.any(np.diff(correctedTimestamps)<0)):
-        correctedTimestamps = correctTimeStamps(correctedTimestamps)
+def correctPhotonTableTimestamps(hfile, chunkSize=10000000):
+    """
+    Corrects the timestamps of a consolidated /Photons/PhotonTable in place, reading only the
+    ResID and Time columns chunkSize rows at a time, then writes the TimeIndex.
 
-    return np.array(correctedTimestamps, dtype=np.uint32)
+    Parameters
+    ----------
+    hfile: tables.File
+        Open (writable) h5 file with a ResID sorted /Photons/PhotonTable
+    chunkSize: int
+        Number of rows per read
+    """
+    photonTable = hfile.root.Photons.PhotonTable
+    lastResID = None
+    lastTime = None
+    for chunkStart in range(0, photonTable.nrows, chunkSize):
+        chunkStop = min(chunkStart+chunkSize, photonTable.nrows)
+        resIDs = photonTable.read(chunkStart, chunkStop, field='ResID')
+        times = photonTable.read(chunkStart, chunkStop, field='Time')
+
+        # carry the previous chunk's last (corrected) photon in as the first element
+        newPixel = np.ones(len(resIDs)+1, dtype=bool)
+        newPixel[2:] = resIDs[1:]!=resIDs[:-1]
+        newPixel[1] = lastResID is None or resIDs[0]!=lastResID
+        correctedTimes = _correctHeaderTimes(np.append(0 if lastTime is None else lastTime, times), newPixel)[1:]
+
+        photonTable.modify_column(chunkStart, chunkStop, column=correctedTimes.astype(np.uint32), colname='Time')
+        lastResID = resIDs[-1]
+        lastTime = correctedTimes[-1]
+    photonTable.flush()
+    if '/Photons/PixelIndex' in hfile:
+        writeTimeIndex(hfile)
 
 
 if __name__=='__main__':
@@ -51,23 +129,28 @@ if __name__=='__main__':
     noResIDFlag = 2**32-1
     filename = sys.argv[1]
     hfile = tables.open_file(filename, mode='a')
+
+    if '/Photons/PhotonTable' in hfile:
+        correctPhotonTableTimestamps(hfile)
+        hfile.close()
+        exit(0)
+
     beamMap = hfile.root.BeamMap.Map.read()
 
     imShape = np.shape(beamMap)
-    
+
     for x in range(imShape[0]):
         for y in range(imShape[1]):
             #print('Correcting pixel', x, y, ', resID =', obsfl.beamImage[x,y])
-            resID = beamMap[x,y] 
+            resID = beamMap[x,y]
             if resID == noResIDFlag:
                 print('Table not found for pixel', x, ',', y)
                 continue
             photonTable = hfile.get_node('/Photons/' + str(resID))
-            photonList = photonTable.read()
-            timeList = photonList['Time']
+            timeList = photonTable.col('Time')
             correctedTimeList = correctTimeStamps(timeList)
 
             assert len(photonTable)==len(timeList), 'Timestamp list does not match length of photon list!'
-            photonTable.modify_column(column=timeList, colname='Time')
+            photonTable.modify_column(column=correctedTimeList, colname='Time')
             photonTable.flush()
-                            
+    hfile.close()
@@ -12,35 +12,39 @@ and apply wavelength and flat calibration.
 
 Class Obsfile:
 ====Helper functions====
-__init__(self,fileName,mode='read',verbose=False)
+__init__(self,fileName,mode='read',verbose=False,chunkSize=None)
 __del__(self)
 loadFile(self, fileName)
 getFromHeader(self, name)
 pixelIsBad(self, xCoord, yCoord, forceWvl=False, forceWeights=False, forceTPFWeights=False)
 
 ====Single pixel access functions====
-getPixelPhotonList(self, xCoord, yCoord, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None, forceRawPhase=False)
+getPixelPhotonList(self, xCoord, yCoord, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None, forceRawPhase=False, columns=None)
 getListOfPixelsPhotonList(self, posList, **kwargs)
+getBatchedPixelPhotonList(self, posList, firstSec=0, integrationTime=-1, wvlStart=None, wvlStop=None, forceRawPhase=False, returnViews=False, maxGap=1000, columns=None)
 getPixelCount(self, *args, applyWeight=True, applyTPFWeight=True, applyTimeMask=False, **kwargs)
 getPixelLightCurve(self,*args,lastSec=-1, cadence=1, scaleByEffInt=True, **kwargs)
+getLightCurve(self, firstSec=0, lastSec=-1, cadence=1, wvlStart=None, wvlStop=None, applyWeight=False, applyTPFWeight=False, flagToUse=0)
 
 ====Array access functions====
 !!!!These functions need some work!!!!
 !!!!They aren't robust to edge cases yet!!!!
 getPixelCountImage(self, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None,applyWeight=True, applyTPFWeight=True, applyTimeMask=False, scaleByEffInt=False, flagToUse=0)
 getCircularAperturePhotonList(self, centerXCoord, centerYCoord, radius, firstSec=0, integrationTime=-1, wvlStart=None,wvlStop=None, flagToUse=0)
+iterTimeFrames(self, firstSec=0, lastSec=-1, frameDuration=1, wvlStart=None, wvlStop=None)
 _makePixelSpectrum(self, photonList, **kwargs)
 getSpectralCube(self, firstSec=0, integrationTime=-1, applySpecWeight=False, applyTPFWeight=False, wvlStart=700, wvlStop=1500,wvlBinWidth=None, energyBinWidth=None, wvlBinEdges=None, timeSpacingCut=None, flagToUse=0)
 getPixelSpectrum(self, xCoord, yCoord, firstSec=0, integrationTime= -1,applySpecWeight=False, applyTPFWeight=False, wvlStart=None, wvlStop=None,wvlBinWidth=None, energyBinWidth=None, wvlBinEdges=None,timeSpacingCut=None)
 makeWvlBins(energyBinWidth=.1, wvlStart=700, wvlStop=1500)
 
 ====Data write functions for calibrating====
-applyWaveCal(self, file_name)
+applyWaveCal(self, file_name, bulk=True, chunkSize=None)
 updateWavelengths(self, xCoord, yCoord, wvlCalArr)
 __applyColWeight(self, resID, weightArr, colName)
 applySpecWeight(self, resID, weightArr)
 applyTPFWeight(self, resID, weightArr)
-applyFlatCal(self, calSolnPath,verbose=False)
+applyFlatCal(self, calSolnPath, verbose=False, makePlots=False, chunkSize=None)
+plotFlatCalSolutions(self, calSolnPath, pdfFullPath=None, coeffs=None, goodPixMask=None)
 applyFlag(self, xCoord, yCoord, flag)
 undoFlag(self, xCoord, yCoord, flag)
 modifyHeaderEntry(self, headerTitle, headerValue)
@@ -61,6 +65,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tables
 from interval import interval
+from numpy.lib.recfunctions import repack_fields
 from matplotlib.backends.backend_pdf import PdfPages
 from regions import CirclePixelRegion, PixCoord
 
@@ -71,9 +76,10 @@ class ObsFile:
     h = astropy.constants.h.to('eV s').value  #4.135668e-15 #eV s
     c = astropy.constants.c.to('m/s').value   #'2.998e8 #m/s
     nCalCoeffs = 3
+    flatCalWvlRange = (700, 1500)  #nm, photons outside get a flat weight of 0
     tickDuration = 1e-6    #each integer value is 1 microsecond
     
-    def __init__(self, fileName, mode='read', verbose=False):
+    def __init__(self, fileName, mode='read', verbose=False, chunkSize=None):
         """
         Create ObsFile object and load in specified HDF5 file.
 
@@ -86,6 +92,10 @@ class ObsFile:
                 unless you are applying a calibration.
             verbose: bool
                 Prints debug messages if True
+            chunkSize: int
+                If not None, array functions (getPixelCountImage, getSpectralCube, getLightCurve)
+                stream through the PhotonTable chunkSize rows at a time instead of loading
+                every photon in the time window, so memory use is bounded.
         Returns
         -------
             ObsFile instance
@@ -101,6 +111,7 @@ class ObsFile:
         self.wvlLowerLimit = None
         self.wvlUpperLimit = None
         self.filterIsApplied = False
+        self.chunkSize = chunkSize
         #self.timeMaskExists = False
         #self.makeMaskVersion = None
         
@@ -174,7 +185,261 @@ class ObsFile:
         beamShape = self.beamImage.shape
         self.nXPix = beamShape[0]
         self.nYPix = beamShape[1]
+        self._makeResIDLookup()
+        self._loadPixelIndex()
 
+    def _makeResIDLookup(self):
+        """
+        Builds a dense lookup table from ResID to flattened (x, y) index in beamImage.
+        Index is x*nYPix + y, matching beamImage.flatten(). ResIDs that aren't in the
+        beammap map to -1.
+        """
+        flatResIDs = self.beamImage.flatten()
+        goodPixInds = np.where(flatResIDs != self.noResIDFlag)[0]
+        maxResID = int(flatResIDs[goodPixInds].max()) if len(goodPixInds)>0 else 0
+        self.resIDToPixelInd = np.full(maxResID+1, -1, dtype=np.int64)
+        self.resIDToPixelInd[flatResIDs[goodPixInds]] = goodPixInds
+
+    def _loadPixelIndex(self):
+        """
+        Loads the /Photons/PixelIndex table (written by consolidatePhotonTables.py, or by
+        Bin2HDF in single pass mode) into images of each pixel's first row (pixelStartRows)
+        and number of rows (pixelNRows) in the PhotonTable. Both are None if the file doesn't have a PixelIndex, in which case
+        pixel photon lists are found with a table query.
+
+        Also opens the /Photons/TimeIndex (self.timeIndex, None if it doesn't exist), which
+        gives the row offset of each time chunk within each PixelIndex entry.
+        pixelIndexCols maps each pixel to its PixelIndex entry (-1 if it has none).
+        """
+        self.pixelIndex = None
+        self.pixelStartRows = None
+        self.pixelNRows = None
+        self.pixelIndexCols = None
+        self.timeIndex = None
+        self.timeIndexChunkTicks = None
+        if '/Photons/PixelIndex' not in self.file:
+            return
+        timeIndex = None
+        chunkTicks = None
+        if '/Photons/TimeIndex' in self.file:
+            timeIndex = self.file.get_node('/Photons/TimeIndex')
+            chunkTicks = timeIndex.attrs.chunkTicks
+        self._setPixelIndex(self.file.get_node('/Photons/PixelIndex').read(), timeIndex, chunkTicks)
+
+    def _setPixelIndex(self, pixelIndex, timeIndex=None, chunkTicks=None):
+        """
+        Makes the pixelStartRows, pixelNRows and pixelIndexCols images from a PixelIndex
+        (structured array with ResID, StartRow and NRows) and sets the TimeIndex (anything
+        indexed like the /Photons/TimeIndex array, or None) and its chunkTicks.
+        """
+        self.pixelIndex = pixelIndex
+        pixInds = self._getPixelIndices(self.pixelIndex['ResID'])
+        inBeam = pixInds >= 0
+        self.pixelStartRows = np.zeros((self.nXPix, self.nYPix), dtype=np.int64)
+        self.pixelNRows = np.zeros((self.nXPix, self.nYPix), dtype=np.int64)
+        self.pixelIndexCols = np.full((self.nXPix, self.nYPix), -1, dtype=np.int64)
+        self.pixelStartRows.flat[pixInds[inBeam]] = self.pixelIndex['StartRow'][inBeam]
+        self.pixelNRows.flat[pixInds[inBeam]] = self.pixelIndex['NRows'][inBeam]
+        self.pixelIndexCols.flat[pixInds[inBeam]] = np.where(inBeam)[0]
+        if timeIndex is not None:
+            self.timeIndex = timeIndex
+            self.timeIndexChunkTicks = int(chunkTicks)
+
+    def _getTimeIndexRows(self, startTime=0, endTime=None):
+        """
+        Returns the (startChunk, stopChunk) rows of the TimeIndex bracketing the time window
+        [startTime, endTime) (in ticks). The rows between the offsets in these TimeIndex rows
+        are a superset of the photons in the window.
+        """
+        nChunks = self.timeIndex.shape[0]-1
+        startChunk = min(int(startTime)//self.timeIndexChunkTicks, nChunks)
+        if endTime is None:
+            stopChunk = nChunks
+        else:
+            stopChunk = min(-(-int(endTime)//self.timeIndexChunkTicks), nChunks)
+        return startChunk, stopChunk
+
+    def _getWindowRowRanges(self, startTime=0, endTime=None):
+        """
+        Uses the TimeIndex to find the rows of every PixelIndex entry that may contain
+        photons in [startTime, endTime) (in ticks).
+
+        Returns
+        -------
+        startRows, stopRows: arrays of ints, one element per PixelIndex entry
+        """
+        startChunk, stopChunk = self._getTimeIndexRows(startTime, endTime)
+        pixelStartRows = self.pixelIndex['StartRow'].astype(np.int64)
+        return pixelStartRows + self.timeIndex[startChunk], pixelStartRows + self.timeIndex[stopChunk]
+
+    def _readRowRanges(self, startRows, stopRows, maxGap=0, columns=None):
+        """
+        Reads the PhotonTable rows [startRows[i], stopRows[i]) for all i into a single photon
+        list, in the order given. Ranges are sorted by row and merged into as few reads as
+        possible: ranges separated by at most maxGap rows are read as one block (the rows in
+        between are discarded).
+
+        Parameters
+        ----------
+        startRows, stopRows: arrays of ints
+            Row ranges to read. Empty ranges (stopRows <= startRows) are allowed.
+        maxGap: int
+            Largest number of unneeded rows to read in order to merge two reads
+        columns: list of strings
+            PhotonTable columns to read. If None, reads all columns.
+
+        Returns
+        -------
+        Structured Numpy Array. The photons of range i are at
+        photonList[offsets[i]:offsets[i+1]], with offsets = [0, cumsum(stopRows-startRows)].
+        """
+        startRows = np.asarray(startRows, dtype=np.int64)
+        stopRows = np.maximum(np.asarray(stopRows, dtype=np.int64), startRows)
+        offsets = np.insert(np.cumsum(stopRows-startRows), 0, 0)
+        photonList = np.zeros(offsets[-1], dtype=self._getPhotonDtype(columns))
+
+        order = np.argsort(startRows, kind='mergesort')
+        order = order[stopRows[order] > startRows[order]]
+        if len(order)==0:
+            return photonList
+        sortedStarts = startRows[order]
+        sortedStops = stopRows[order]
+        readStops = np.maximum.accumulate(sortedStops)
+        newRead = np.insert(sortedStarts[1:] - readStops[:-1] > maxGap, 0, True)
+        readBoundaries = np.append(np.where(newRead)[0], len(order))
+
+        for iRead in range(len(readBoundaries)-1):
+            ranges = order[readBoundaries[iRead]:readBoundaries[iRead+1]]
+            readStart = sortedStarts[readBoundaries[iRead]]
+            readStop = readStops[readBoundaries[iRead+1]-1]
+            if np.all(np.diff(ranges)==1) and np.all(startRows[ranges[1:]]==stopRows[ranges[:-1]]):
+                #ranges are back to back in both the table and the output, so read straight into the output
+                self._readRows(readStart, readStop, columns, out=photonList[offsets[ranges[0]]:offsets[ranges[-1]+1]])
+                continue
+            block = self._readRows(readStart, readStop, columns)
+            for i in ranges:
+                photonList[offsets[i]:offsets[i+1]] = block[startRows[i]-readStart:stopRows[i]-readStart]
+        return photonList
+
+    def _getPhotonDtype(self, columns=None):
+        """
+        Returns the dtype of a photon list with only the given PhotonTable columns
+        (all columns if columns is None)
+        """
+        if columns is None:
+            return self.photonTable.dtype
+        return np.dtype([(col, self.photonTable.coldtypes[col]) for col in columns])
+
+    def _readRows(self, startRow, stopRow, columns=None, out=None):
+        """
+        Reads PhotonTable rows [startRow, stopRow). If columns is given, only those columns
+        are read (one column read each) into a photon list with just those fields.
+        """
+        if columns is None:
+            return self.photonTable.read(startRow, stopRow, out=out)
+        if out is None:
+            out = np.zeros(stopRow-startRow, dtype=self._getPhotonDtype(columns))
+        for col in columns:
+            out[col] = self.photonTable.read(startRow, stopRow, field=col)
+        return out
+
+    @staticmethod
+    def _getReadColumns(columns, needTime=False, needWvl=False):
+        """
+        Adds the columns needed to apply time and wavelength cuts to columns
+        (None means all columns)
+        """
+        if columns is None:
+            return None
+        readColumns = list(columns)
+        if needTime and 'Time' not in readColumns:
+            readColumns.append('Time')
+        if needWvl and 'Wavelength' not in readColumns:
+            readColumns.append('Wavelength')
+        return readColumns
+
+    @staticmethod
+    def _projectColumns(photonList, columns=None):
+        """
+        Returns photonList with only the given columns (all columns if columns is None)
+        """
+        if columns is None or list(photonList.dtype.names)==list(columns):
+            return photonList
+        return repack_fields(photonList[list(columns)])
+
+    def _getPixelIndices(self, resIDList):
+        """
+        Returns the flattened beamImage index for each ResID in resIDList (-1 if the
+        ResID is not in the beammap)
+        """
+        resIDList = np.asarray(resIDList, dtype=np.int64)
+        pixInds = np.full(len(resIDList), -1, dtype=np.int64)
+        inRange = resIDList < len(self.resIDToPixelInd)
+        pixInds[inRange] = self.resIDToPixelInd[resIDList[inRange]]
+        return pixInds
+
+    def _getGoodPixelMask(self, flagToUse=0):
+        """
+        Returns a boolean image that is True for pixels with a resID whose flags are all
+        contained in flagToUse
+        """
+        flags = self.beamFlagImage.read()
+        return (self.beamImage != self.noResIDFlag) & ((flags | flagToUse) == flagToUse)
+
+    def _binPhotonsByPixel(self, resIDList, weights=None):
+        """
+        Sums photons (or their weights) into a count image in a single pass.
+
+        Parameters
+        ----------
+        resIDList: array of ints
+            ResID of each photon
+        weights: array of floats
+            Weight of each photon. If None, each photon counts as 1.
+
+        Returns
+        -------
+        2D numpy array (nXPix, nYPix) of (weighted) counts
+        """
+        pixInds = self._getPixelIndices(resIDList)
+        inBeam = pixInds >= 0
+        if weights is not None:
+            weights = weights[inBeam]
+        counts = np.bincount(pixInds[inBeam], weights=weights, minlength=self.nXPix*self.nYPix)
+        return np.reshape(counts.astype(np.float64), (self.nXPix, self.nYPix))
+
+    def _binPhotonsByPixelAndWvl(self, resIDList, wvlList, wvlBinEdges, weights=None):
+        """
+        Sums photons (or their weights) into a spectral cube in a single pass. Each photon is
+        assigned a (pixel, wavelength bin) index and the whole list is histogrammed with one
+        bincount. Bins follow np.histogram conventions (last bin includes its upper edge).
+
+        Parameters
+        ----------
+        resIDList: array of ints
+            ResID of each photon
+        wvlList: array of floats
+            Wavelength (or phase) of each photon
+        wvlBinEdges: array of floats
+            Monotonically increasing wavelength bin edges
+        weights: array of floats
+            Weight of each photon. If None, each photon counts as 1.
+
+        Returns
+        -------
+        3D numpy array (nXPix, nYPix, nWvlBins) of (weighted) counts
+        """
+        nWvlBins = len(wvlBinEdges)-1
+        pixInds = self._getPixelIndices(resIDList)
+        wvlBinInds = np.searchsorted(wvlBinEdges, wvlList, side='right') - 1
+        wvlBinInds[wvlList == wvlBinEdges[-1]] = nWvlBins-1
+        inCube = (pixInds >= 0) & (wvlBinInds >= 0) & (wvlBinInds < nWvlBins)
+        cubeInds = pixInds[inCube]*nWvlBins + wvlBinInds[inCube]
+        if weights is not None:
+            weights = weights[inCube]
+        cube = np.zeros((self.nXPix, self.nYPix, nWvlBins), dtype=np.float64)
+        cube.flat[:] = np.bincount(cubeInds, weights=weights, minlength=cube.size)
+        return cube
 
     def getFromHeader(self, name):
         """
@@ -204,16 +469,32 @@ class ObsFile:
         resID = self.beamImage[xCoord][yCoord]
         if resID==self.noResIDFlag: return True     # No resID was given during readout
         pixelFlags = self.beamFlagImage[xCoord, yCoord]
+        deadFlags = self._getDeadFlags(forceWvl, forceWeights, forceTPFWeights)
+        return (pixelFlags & deadFlags)>0
+
+    def _getDeadFlags(self, forceWvl=False, forceWeights=False, forceTPFWeights=False):
+        """
+        Returns the bitmask of pixel flags that make a pixel bad (see pixelIsBad)
+        """
         deadFlags = h5FileFlags['noDacTone']
         if forceWvl and self.getFromHeader('isWvlCalibrated'): deadFlags+=h5FileFlags['waveCalFailed']
         if forceWeights and self.getFromHeader('isFlatCalibrated'): deadFlags+=h5FileFlags['flatCalFailed']
         #if forceWeights and self.getFromHeader('isLinearityCorrected'): deadFlags+=h5FileFlags['linCalFailed']
         #if forceTPFWeights and self.getFromHeader('isPhaseNoiseCorrected'): deadFlags+=h5FileFlags['phaseNoiseCalFailed']
-        return (pixelFlags & deadFlags)>0
+        return deadFlags
 
-    def getPixelPhotonList(self, xCoord, yCoord, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None, forceRawPhase=False):
+    def _getBadPixelMask(self, forceWvl=False, forceWeights=False, forceTPFWeights=False):
+        """
+        Image version of pixelIsBad(). Returns a boolean image that is True for bad pixels.
+        """
+        deadFlags = self._getDeadFlags(forceWvl, forceWeights, forceTPFWeights)
+        return (self.beamImage==self.noResIDFlag) | ((self.beamFlagImage.read() & deadFlags)>0)
+
+    def getPixelPhotonList(self, xCoord, yCoord, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None, forceRawPhase=False, columns=None):
         """
         Retrieves a photon list for a single pixel using the attached beammap.
+        If the file has a /Photons/PixelIndex the photons are read as a contiguous slice of
+        the PhotonTable, otherwise the PhotonTable is queried by ResID.
 
         Parameters
         ----------
@@ -239,12 +520,17 @@ class ObsFile:
             If the ObsFile is wavelength calibrated (ObsFile.getFromHeader('isWvlCalibrated') = True) then:
              - forceRawPhase=True will return all the photons in the list (might be phase heights instead of wavelengths)
              - forceRawPhase=False is guarenteed to only return properly wavelength calibrated photons in the photon list
+        columns: list of strings
+            PhotonTable columns to return, eg. ('Time',). If None, returns all columns.
+            With a PixelIndex only these columns (and those needed for the time and
+            wavelength cuts) are read from the file.
 
         Returns
         -------
         Structured Numpy Array
             Each row is a photon.
             Columns have the following keys: 'Time', 'Wavelength', 'SpecWeight', 'NoiseWeight'
+            (or just the requested columns)
         
         Time is in microseconds
         Wavelength is in degrees of phase height or nanometers
@@ -258,8 +544,11 @@ class ObsFile:
            or ((wvlStart!=None) and (wvlStop!=None) and (wvlStop<wvlStart))):       # wavelength range invalid
             ##print('BadPixel')
             #print((wvlStop<wvlStart))
-            return self.photonTable.read_where('(Time < 0)') #use dummy condition to get empty photon list of correct format
-            
+            return np.zeros(0, dtype=self._getPhotonDtype(columns)) #empty photon list of correct format
+
+        if self.pixelNRows is not None:
+            return self._getIndexedPixelPhotonList(xCoord, yCoord, firstSec, integrationTime, wvlStart, wvlStop, columns)
+
         query='(ResID == resID)'
         startTime=0
         if firstSec>0:
@@ -279,7 +568,65 @@ class ObsFile:
                 stopWvl=wvlStop
                 query+=' & (Wavelength < stopWvl)'
 
-        return self.photonTable.read_where(query)
+        return self._projectColumns(self.photonTable.read_where(query), columns)
+
+    def _getIndexedPixelPhotonList(self, xCoord, yCoord, firstSec=0, integrationTime=-1, wvlStart=None, wvlStop=None,
+                                   columns=None):
+        """
+        getPixelPhotonList() for files with a PixelIndex. Reads the pixel's photons as one
+        contiguous slice of the PhotonTable and selects the time range with a searchsorted
+        on the Time column.
+        """
+        startTime = int(firstSec*self.ticksPerSec) if firstSec>0 else 0
+        endTime = startTime + int(integrationTime*self.ticksPerSec) if integrationTime!=-1 else None
+
+        startRow = self.pixelStartRows[xCoord, yCoord]
+        stopRow = startRow + self.pixelNRows[xCoord, yCoord]
+        if self.timeIndex is not None and (startTime>0 or endTime is not None) and stopRow>startRow:
+            startChunk, stopChunk = self._getTimeIndexRows(startTime, endTime)
+            pixelIndexCol = self.pixelIndexCols[xCoord, yCoord]
+            startRow, stopRow = (startRow + self.timeIndex[startChunk, pixelIndexCol],
+                                 startRow + self.timeIndex[stopChunk, pixelIndexCol])
+        cutTime = startTime>0 or endTime is not None
+        photonList = self._readRows(startRow, stopRow, self._getReadColumns(columns, cutTime, wvlStart is not None or wvlStop is not None))
+
+        if cutTime:
+            photonList = photonList[self._getTimeSelection(photonList['Time'], startTime, endTime)]
+
+        return self._projectColumns(self._applyWvlCut(photonList, wvlStart, wvlStop), columns)
+
+    @staticmethod
+    def _applyWvlCut(photonList, wvlStart=None, wvlStop=None):
+        """
+        Returns the photons in photonList with wvlStart <= Wavelength < wvlStop (or
+        Wavelength == wvlStart if wvlStart == wvlStop). None means no limit.
+        """
+        if wvlStart is not None and wvlStart==wvlStop:
+            return photonList[photonList['Wavelength']==wvlStart]
+        if wvlStart is None and wvlStop is None:
+            return photonList
+        wvlMask = np.ones(len(photonList), dtype=bool)
+        if wvlStart is not None:
+            wvlMask &= photonList['Wavelength']>=wvlStart
+        if wvlStop is not None:
+            wvlMask &= photonList['Wavelength']<wvlStop
+        return photonList[wvlMask]
+
+    @staticmethod
+    def _getTimeSelection(timestamps, startTime=0, endTime=None):
+        """
+        Returns an index selecting the photons with startTime <= timestamps < endTime.
+        This is a slice found with searchsorted if timestamps is sorted, otherwise a boolean
+        mask.
+        """
+        if np.all(np.diff(timestamps.astype(np.int64))>=0):
+            startInd = np.searchsorted(timestamps, startTime, side='left')
+            endInd = len(timestamps) if endTime is None else np.searchsorted(timestamps, endTime, side='left')
+            return slice(startInd, endInd)
+        timeMask = timestamps>=startTime
+        if endTime is not None:
+            timeMask &= timestamps<endTime
+        return timeMask
 
     def getListOfPixelsPhotonList(self, posList, **kwargs):
         """
@@ -300,15 +647,249 @@ class ObsFile:
                 Columns have the following keys: 'Time', 'Wavelength', 'SpecWeight', 'NoiseWeight'
 
         """
+        return self.getBatchedPixelPhotonList(posList, returnViews=True, **kwargs)
+
+    def getBatchedPixelPhotonList(self, posList, firstSec=0, integrationTime=-1, wvlStart=None, wvlStop=None,
+                                  forceRawPhase=False, returnViews=False, maxGap=1000, columns=None):
+        """
+        Retrieves photon lists for a list of pixels in one I/O pass. With a PixelIndex, the row
+        ranges of all of the pixels are merged into a minimal set of contiguous PhotonTable reads
+        (see _readRowRanges); otherwise getPixelPhotonList is called for each pixel.
+
+        Parameters
+        ----------
+        posList: Nx2 array of ints (or list of 2 element tuples)
+            List of (x, y) beammap indices for desired pixels
+        firstSec, integrationTime, wvlStart, wvlStop, forceRawPhase:
+            See getPixelPhotonList()
+        returnViews: bool
+            If True, return a list of per-pixel photon lists that are views into the
+            concatenated photon list (no copies)
+        maxGap: int
+            Largest number of unneeded rows to read in order to merge two reads
+        columns: list of strings
+            PhotonTable columns to return (see getPixelPhotonList)
+
+        Returns
+        -------
+        If returnViews is False, a dictionary with keys:
+            'photonList': Structured Numpy Array, the photon lists of all pixels concatenated in
+                          posList order
+            'offsets': array of ints with len(posList)+1 elements. The photons of the ith pixel
+                       are photonList[offsets[i]:offsets[i+1]]
+        If returnViews is True, a list of Structured Numpy Arrays; the ith element is the photon
+        list of the ith pixel in posList
+        """
+        posList = np.reshape(np.asarray(posList, dtype=np.int64), (-1, 2))
+        if self.pixelNRows is None:
+            photonLists = [self.getPixelPhotonList(xCoord, yCoord, firstSec, integrationTime, wvlStart, wvlStop, forceRawPhase, columns)
+                           for xCoord, yCoord in posList]
+            if returnViews:
+                return photonLists
+            offsets = np.insert(np.cumsum([len(photonList) for photonList in photonLists], dtype=np.int64), 0, 0)
+            photonList = np.concatenate(photonLists) if photonLists else np.zeros(0, dtype=self._getPhotonDtype(columns))
+            return {'photonList':photonList, 'offsets':offsets}
+
+        xCoords = posList[:, 0]
+        yCoords = posList[:, 1]
+        startRows = self.pixelStartRows[xCoords, yCoords]
+        stopRows = startRows + self.pixelNRows[xCoords, yCoords]
+        startTime = int(firstSec*self.ticksPerSec) if firstSec>0 else 0
+        endTime = startTime + int(integrationTime*self.ticksPerSec) if integrationTime!=-1 else None
+        if self.timeIndex is not None and (startTime>0 or endTime is not None):
+            startChunk, stopChunk = self._getTimeIndexRows(startTime, endTime)
+            pixelIndexCols = self.pixelIndexCols[xCoords, yCoords]
+            hasIndex = pixelIndexCols>=0
+            startRows[hasIndex], stopRows[hasIndex] = (startRows[hasIndex] + self.timeIndex[startChunk][pixelIndexCols[hasIndex]],
+                                                       startRows[hasIndex] + self.timeIndex[stopChunk][pixelIndexCols[hasIndex]])
+
+        isBad = self._getBadPixelMask(forceWvl=not forceRawPhase)[xCoords, yCoords]
+        if (firstSec>float(self.getFromHeader('expTime'))
+           or ((wvlStart!=None) and (wvlStop!=None) and (wvlStop<wvlStart))):
+            isBad[:] = True
+        stopRows[isBad] = startRows[isBad]
+
+        cutTime = startTime>0 or endTime is not None
+        cutWvl = wvlStart is not None or wvlStop is not None
+        photonList = self._readRowRanges(startRows, stopRows, maxGap, self._getReadColumns(columns, cutTime, cutWvl))
+        nPhotons = stopRows-startRows
+        if cutTime or cutWvl:
+            pixelOrdinals = np.repeat(np.arange(len(posList)), nPhotons)
+            keepMask = np.ones(len(photonList), dtype=bool)
+            if cutTime:
+                keepMask &= photonList['Time']>=startTime
+            if endTime is not None:
+                keepMask &= photonList['Time']<endTime
+            if wvlStart is not None and wvlStart==wvlStop:
+                keepMask &= photonList['Wavelength']==wvlStart
+            else:
+                if wvlStart is not None:
+                    keepMask &= photonList['Wavelength']>=wvlStart
+                if wvlStop is not None:
+                    keepMask &= photonList['Wavelength']<wvlStop
+            photonList = photonList[keepMask]
+            nPhotons = np.bincount(pixelOrdinals[keepMask], minlength=len(posList))
+        photonList = self._projectColumns(photonList, columns)
+        offsets = np.insert(np.cumsum(nPhotons), 0, 0)
+
+        if returnViews:
+            return [photonList[offsets[i]:offsets[i+1]] for i in range(len(posList))]
+        return {'photonList':photonList, 'offsets':offsets}
+
+    def _getPhotonsInWindow(self, startTime=0, endTime=None, wvlStart=None, wvlStop=None, columns=None):
+        """
+        Returns all photons with startTime <= Time < endTime (in ticks; endTime=None goes to the
+        end of the file) and wvlStart <= Wavelength < wvlStop (see getPixelPhotonList).
+
+        If the file has a TimeIndex only the rows of each pixel that fall in the window's
+        time chunks are read, otherwise the PhotonTable is queried.
+        If columns is given, the photon list has at least those columns (plus any needed
+        for the cuts); only they are read from the file if there's a TimeIndex.
+        """
+        if self.timeIndex is None:
+            query='(Time >= startTime)'
+            if endTime is not None:
+                query+=' & (Time < endTime)'
+            if wvlStart is not None and wvlStop is not None and wvlStart==wvlStop:
+                wvl=wvlStart
+                query+=' & (Wavelength == wvl)'
+            else:
+                if wvlStart is not None:
+                    startWvl=wvlStart
+                    query+=' & (Wavelength >= startWvl)'
+                if wvlStop is not None:
+                    stopWvl=wvlStop
+                    query+=' & (Wavelength < stopWvl)'
+            return self.photonTable.read_where(query)
+
+        cutTime = startTime>0 or endTime is not None
+        readColumns = self._getReadColumns(columns, cutTime, wvlStart is not None or wvlStop is not None)
+        if not cutTime:
+            photonList = self._readRows(0, self.photonTable.nrows, readColumns)
+        else:
+            photonList = self._readRowRanges(*self._getWindowRowRanges(startTime, endTime), columns=readColumns)
+            timeMask = photonList['Time']>=startTime
+            if endTime is not None:
+                timeMask &= photonList['Time']<endTime
+            photonList = photonList[timeMask]
+        return self._applyWvlCut(photonList, wvlStart, wvlStop)
+
+    def _iterPhotonsInWindow(self, startTime=0, endTime=None, wvlStart=None, wvlStop=None, columns=None):
+        """
+        Generator version of _getPhotonsInWindow(). If self.chunkSize is None the whole window
+        is yielded at once. Otherwise the PhotonTable is read self.chunkSize rows at a time
+        (only the rows in the window if there's a TimeIndex, otherwise the whole table), so
+        memory use is independent of the exposure time.
+        """
+        if self.chunkSize is None:
+            yield self._getPhotonsInWindow(startTime, endTime, wvlStart, wvlStop, columns)
+            return
+
+        if self.timeIndex is not None and (startTime>0 or endTime is not None):
+            startRows, stopRows = self._getWindowRowRanges(startTime, endTime)
+        else:
+            startRows, stopRows = np.array([0]), np.array([self.photonTable.nrows])
+        cutTime = startTime>0 or endTime is not None
+        readColumns = self._getReadColumns(columns, cutTime, wvlStart is not None or wvlStop is not None)
+        for chunkStartRows, chunkStopRows in self._splitRowRanges(startRows, stopRows, self.chunkSize):
+            photonList = self._readRowRanges(chunkStartRows, chunkStopRows, columns=readColumns)
+            if cutTime:
+                timeMask = photonList['Time']>=startTime
+                if endTime is not None:
+                    timeMask &= photonList['Time']<endTime
+                photonList = photonList[timeMask]
+            yield self._applyWvlCut(photonList, wvlStart, wvlStop)
+
+    @staticmethod
+    def _splitRowRanges(startRows, stopRows, chunkSize):
+        """
+        Splits the row ranges [startRows[i], stopRows[i]) into consecutive groups of ranges
+        covering chunkSize rows each (the last group may be smaller). Ranges are split across
+        groups where needed.
 
-        photonLists = []
-        nPix = np.shape(posList)[0]
-        for i in range(nPix):
-            photonLists.append(self.getPixelPhotonList(posList[i][0], posList[i][1], **kwargs))
+        Yields
+        ------
+        (chunkStartRows, chunkStopRows) arrays for each group
+        """
+        startRows = np.asarray(startRows, dtype=np.int64)
+        stopRows = np.maximum(np.asarray(stopRows, dtype=np.int64), startRows)
+        rangeOffsets = np.insert(np.cumsum(stopRows-startRows), 0, 0)
+        for chunkStart in range(0, rangeOffsets[-1], chunkSize):
+            chunkStop = min(chunkStart+chunkSize, rangeOffsets[-1])
+            firstRange = np.searchsorted(rangeOffsets, chunkStart, side='right')-1
+            lastRange = np.searchsorted(rangeOffsets, chunkStop, side='left')
+            chunkStartRows = startRows[firstRange:lastRange].copy()
+            chunkStopRows = stopRows[firstRange:lastRange].copy()
+            chunkStartRows[0] += chunkStart - rangeOffsets[firstRange]
+            chunkStopRows[-1] -= rangeOffsets[lastRange] - chunkStop
+            yield chunkStartRows, chunkStopRows
 
-        return photonLists
+    @staticmethod
+    def _getWeightColumns(applySpecWeight=False, applyTPFWeight=False):
+        """
+        Returns the list of weight columns needed by _getPhotonWeights()
+        """
+        return ['SpecWeight']*bool(applySpecWeight) + ['NoiseWeight']*bool(applyTPFWeight)
+
+    @staticmethod
+    def _getPhotonWeights(photonList, applySpecWeight=False, applyTPFWeight=False):
+        """
+        Returns the product of the requested weight columns of photonList, or None if
+        neither is applied
+        """
+        if not (applySpecWeight or applyTPFWeight):
+            return None
+        weights = np.ones(len(photonList))
+        if applySpecWeight:
+            weights *= photonList['SpecWeight']
+        if applyTPFWeight:
+            weights *= photonList['NoiseWeight']
+        return weights
 
+    def iterTimeFrames(self, firstSec=0, lastSec=-1, frameDuration=1, wvlStart=None, wvlStop=None):
+        """
+        Iterates over consecutive time frames of the whole array, yielding the photon list of
+        each frame. With a TimeIndex the index rows for all of the frame boundaries are read
+        once up front, and each frame only reads its own rows of the PhotonTable.
 
+        Parameters
+        ----------
+        firstSec: float
+            Start time of the first frame, in seconds relative to beginning of file
+        lastSec: float
+            End time of the last frame. If -1, goes to end of file
+        frameDuration: float
+            Length of each frame in seconds. The last frame is cut off at lastSec.
+        wvlStart, wvlStop: float
+            Wavelength range, see getPixelPhotonList()
+
+        Yields
+        ------
+        (frameFirstSec, photonList)
+            frameFirstSec: float, start time of the frame in seconds
+            photonList: Structured Numpy Array of the frame's photons (see getPixelPhotonList)
+        """
+        if lastSec==-1:
+            lastSec = self.getFromHeader('expTime')
+        frameStarts = np.arange(firstSec, lastSec, frameDuration)
+        frameBoundaries = np.append((frameStarts*self.ticksPerSec).astype(np.int64), int(lastSec*self.ticksPerSec))
+
+        if self.timeIndex is None:
+            for i, frameStart in enumerate(frameStarts):
+                yield frameStart, self._getPhotonsInWindow(frameBoundaries[i], frameBoundaries[i+1], wvlStart, wvlStop)
+            return
+
+        chunkRows = np.array([self._getTimeIndexRows(frameBoundaries[i], frameBoundaries[i+1])
+                              for i in range(len(frameStarts))], dtype=np.int64).reshape(-1, 2)
+        neededRows, rowInds = np.unique(chunkRows, return_inverse=True)
+        rowInds = rowInds.reshape(chunkRows.shape)
+        chunkOffsets = [self.timeIndex[row] for row in neededRows]
+        pixelStartRows = self.pixelIndex['StartRow'].astype(np.int64)
+        for i, frameStart in enumerate(frameStarts):
+            photonList = self._readRowRanges(pixelStartRows + chunkOffsets[rowInds[i, 0]],
+                                             pixelStartRows + chunkOffsets[rowInds[i, 1]])
+            timeMask = (photonList['Time']>=frameBoundaries[i]) & (photonList['Time']<frameBoundaries[i+1])
+            yield frameStart, self._applyWvlCut(photonList[timeMask], wvlStart, wvlStop)
 
     def getPixelCount(self, *args, applyWeight=True, applyTPFWeight=True, applyTimeMask=False, **kwargs):
         """
@@ -406,6 +987,57 @@ class ObsFile:
             return np.asarray([x['counts'] for x in data])
 
 
+    def getLightCurve(self, firstSec=0, lastSec=-1, cadence=1, wvlStart=None, wvlStop=None,
+                      applyWeight=False, applyTPFWeight=False, flagToUse=0):
+        """
+        Returns the light curve of the whole array, summed over all of the good pixels.
+        Photons are binned in time with one bincount per chunk of the photon table, so this
+        streams if the ObsFile was made with a chunkSize.
+
+        Parameters
+        ----------
+        firstSec: float
+            Start time of the light curve, in seconds relative to beginning of file
+        lastSec: float
+            End time of the light curve. If -1, goes to end of file
+        cadence: float
+            Width of each time bin in seconds. The last bin is cut off at lastSec.
+        wvlStart, wvlStop: float
+            Wavelength range, see getPixelPhotonList()
+        applyWeight: bool
+            If True, applies the spectral/flat/linearity weight
+        applyTPFWeight: bool
+            If True, applies the true positive fraction (noise) weight
+        flagToUse: int
+            Specifies (bitwise) pixel flags that are suitable to include. For flag
+            definitions see 'h5FileFlags' in Headers/pipelineFlags.py
+
+        Returns
+        -------
+        Dictionary with keys:
+            'lightCurve': 1D numpy array, (weighted) counts in each time bin
+            'timeBinEdges': 1D numpy array, time bin edges in seconds
+        """
+        if lastSec==-1:
+            lastSec = self.getFromHeader('expTime')
+        timeBinEdges = np.append(np.arange(firstSec, lastSec, cadence), lastSec)
+        tickBinEdges = (timeBinEdges*self.ticksPerSec).astype(np.int64)
+        nTimeBins = len(timeBinEdges)-1
+        goodPixMask = self._getGoodPixelMask(flagToUse).flatten()
+
+        lightCurve = np.zeros(nTimeBins, dtype=np.float64)
+        columns = ['ResID', 'Time'] + self._getWeightColumns(applyWeight, applyTPFWeight)
+        for photonList in self._iterPhotonsInWindow(tickBinEdges[0], tickBinEdges[-1], wvlStart, wvlStop, columns):
+            pixInds = self._getPixelIndices(photonList['ResID'])
+            isGood = pixInds>=0
+            isGood[isGood] = goodPixMask[pixInds[isGood]]
+            photonList = photonList[isGood]
+            timeBins = np.searchsorted(tickBinEdges, photonList['Time'], side='right')-1
+            weights = self._getPhotonWeights(photonList, applyWeight, applyTPFWeight)
+            lightCurve += np.bincount(timeBins, weights=weights, minlength=nTimeBins)
+
+        return {'lightCurve':lightCurve, 'timeBinEdges':timeBinEdges}
+
     def getPixelCountImage(self, firstSec=0, integrationTime= -1, wvlStart=None,wvlStop=None,
                                  applyWeight=True, applyTPFWeight=True, applyTimeMask=False, 
                                  scaleByEffInt=False, flagToUse=0):
@@ -414,7 +1046,8 @@ class ObsFile:
         well as wavelength range.
         
         Does NOT loop over getPixelCount() because it's too slow.
-        Instead, grab all the photon data from the H5 file and sort it into pixels with python.
+        Instead, grab all the photon data from the H5 file and bin it into pixels in one pass
+        with np.bincount, using the ResID -> pixel lookup table made when the file is loaded.
 
         Parameters
         ----------
@@ -450,68 +1083,20 @@ class ObsFile:
             totInt = self.getFromHeader('expTime')-firstSec
         else:
             totInt = integrationTime
-        effIntTimes = np.zeros((self.nXPix, self.nYPix), dtype=np.float64)  #default is zero for bad pixel
-        #effIntTimes.fill(np.nan)   #Just in case an element doesn't get filled for some reason.
-        countImage = np.zeros((self.nXPix, self.nYPix), dtype=np.float64)
-        countImage.fill(np.nan)     #default count value is np.nan if it's a bad pixel
-        #rawCounts.fill(np.nan)   #Just in case an element doesn't get filled for some reason.
-        
-        #if integrationTime==-1:
-        #    integrationTime = self.getFromHeader('expTime')-firstSec
-        #startTs = firstSec*1.e6
-        #endTs = startTs + integrationTime*1.e6
-        #if wvlRange is None:
-        #    photonList = self.photonTable.read_where('((Time >= startTs) & (Time < endTs))')
-        #else:
-        #    startWvl = wvlRange[0]
-        #    endWvl = wvlRange[1]
-        #    photonList = self.photonTable.read_where('(Wavelength >= startWvl) & (Wavelength < endWvl) & (Time >= startTs) & (Time < endTs)')
         startTime = int(firstSec*self.ticksPerSec) #convert to us
-        query='(Time >= startTime)'
+        endTime = None
         if integrationTime!=-1:
             endTime = startTime + int(integrationTime*self.ticksPerSec)
-            query+=' & (Time < endTime)'
-        if wvlStart is not None and wvlStop is not None and wvlStart==wvlStop:
-            wvl=startWvl
-            query+=' & (Wavelength == wvl)'
-        else:
-            if wvlStart is not None:
-                startWvl=wvlStart
-                query+=' & (Wavelength >= startWvl)'
-            if wvlStop is not None:
-                stopWvl=wvlStop
-                query+=' & (Wavelength < stopWvl)'
-        photonList = self.photonTable.read_where(query)
+        countImage = np.zeros((self.nXPix, self.nYPix), dtype=np.float64)
+        columns = ['ResID'] + self._getWeightColumns(applyWeight, applyTPFWeight)
+        for photonList in self._iterPhotonsInWindow(startTime, endTime, wvlStart, wvlStop, columns):
+            weights = self._getPhotonWeights(photonList, applyWeight, applyTPFWeight)
+            countImage += self._binPhotonsByPixel(photonList['ResID'], weights)
 
-        resIDDiffs = np.diff(photonList['ResID'])
-        if(np.any(resIDDiffs<0)):
-            warnings.warn('Photon list not sorted by ResID! This could take a while...')
-            photonList = np.sort(photonList, order='ResID', kind='mergsort') #mergesort is stable, so time order will be preserved
-            resIDDiffs = np.diff(photonList['ResID'])
-        
-        resIDBoundaryInds = np.where(resIDDiffs>0)[0]+1 #indices in photonList where ResID changes; ie marks boundaries between pixel tables
-        resIDBoundaryInds = np.insert(resIDBoundaryInds, 0, 0)
-        resIDList = photonList['ResID'][resIDBoundaryInds]
-        resIDBoundaryInds = np.append(resIDBoundaryInds, len(photonList['ResID']))
-
-        for xCoord in range(self.nXPix): 
-            for yCoord in range(self.nYPix): 
-                flag = self.beamFlagImage[xCoord, yCoord]
-                if(self.beamImage[xCoord, yCoord]!=self.noResIDFlag and (flag|flagToUse)==flagToUse):
-                    effIntTimes[xCoord, yCoord] = totInt
-                    countImage[xCoord, yCoord] = 0
-                    resIDInd = np.where(resIDList==self.beamImage[xCoord, yCoord])[0]
-                    if(np.shape(resIDInd)[0]>0):
-                        resIDInd = resIDInd[0]
-                        if applyWeight==False and applyTPFWeight==False:
-                            countImage[xCoord, yCoord] = resIDBoundaryInds[resIDInd+1] - resIDBoundaryInds[resIDInd]
-                        else:
-                            weights = np.ones(resIDBoundaryInds[resIDInd+1] - resIDBoundaryInds[resIDInd])
-                            if applyWeight:
-                                weights *= photonList['SpecWeight'][resIDBoundaryInds[resIDInd]:resIDBoundaryInds[resIDInd+1]]
-                            if applyTPFWeight:
-                                weights *= photonList['NoiseWeight'][resIDBoundaryInds[resIDInd]:resIDBoundaryInds[resIDInd+1]] 
-                            countImage[xCoord, yCoord] = np.sum(weights)
+        goodPixMask = self._getGoodPixelMask(flagToUse)
+        countImage[~goodPixMask] = np.nan     #default count value is np.nan if it's a bad pixel
+        effIntTimes = np.zeros((self.nXPix, self.nYPix), dtype=np.float64)  #default is zero for bad pixel
+        effIntTimes[goodPixMask] = totInt
 
         #for i,resID in enumerate(resIDList):
         #    coords = np.where(self.beamFlagImage==resID)
@@ -581,28 +1166,55 @@ class ObsFile:
         apertureMaskCoords = np.transpose(np.array(np.where(boolApertureMask))) #valid coordinates within aperture mask
         photonListCoords = apertureMaskCoords + np.array([apertureRegion.bounding_box.ixmin, apertureRegion.bounding_box.iymin]) #pixel coordinates in image
 
-        # loop through valid coordinates, grab photon lists and store in photonList
-        photonList = None
+        # find valid coordinates, then grab all of their photon lists at once
+        inAperture = []
+        flags = self.beamFlagImage.read()
         for i,coords in enumerate(photonListCoords):
             if coords[0]<0 or coords[0]>=self.nXPix or coords[1]<0 or coords[1]>=self.nYPix:
                 exactApertureMask[apertureMaskCoords[i,0], apertureMaskCoords[i,1]] = 0
                 continue
-            flag = self.beamFlagImage[coords[0], coords[1]]
+            flag = flags[coords[0], coords[1]]
             if (flag | flagToUse) != flagToUse:
                 exactApertureMask[apertureMaskCoords[i,0], apertureMaskCoords[i,1]] = 0
                 continue
-            resID = self.beamImage[coords[0], coords[1]]
-            pixPhotonList = self.getPixelPhotonList(coords[0], coords[1], firstSec, integrationTime, wvlStart, wvlStop)
-            pixPhotonList['NoiseWeight'] *= exactApertureMask[apertureMaskCoords[i,0], apertureMaskCoords[i,1]]
-            if photonList is None:
-                photonList = pixPhotonList
-            else:
-                photonList = np.append(photonList, pixPhotonList)
+            inAperture.append(i)
+
+        photonLists = self.getBatchedPixelPhotonList(photonListCoords[inAperture], firstSec, integrationTime, wvlStart, wvlStop)
+        photonList = photonLists['photonList']
+        pixelWeights = exactApertureMask[apertureMaskCoords[inAperture,0], apertureMaskCoords[inAperture,1]]
+        photonList['NoiseWeight'] *= np.repeat(pixelWeights, np.diff(photonLists['offsets']))
 
         photonList = np.sort(photonList, order='Time')
         return photonList, exactApertureMask
 
 
+    def _getWvlBinEdges(self, applySpecWeight=False, wvlStart=None, wvlStop=None, wvlBinWidth=None,
+                        energyBinWidth=None, wvlBinEdges=None):
+        """
+        Returns the wavelength bin edges for a spectrum given the bin specification options
+        of getPixelSpectrum()/getSpectralCube()
+        """
+        wvlStart=wvlStart if (wvlStart!=None and wvlStart>0.) else (self.wvlLowerLimit if (self.wvlLowerLimit!=None and self.wvlLowerLimit>0.) else 700)
+        wvlStop=wvlStop if (wvlStop!=None and wvlStop>0.) else (self.wvlUpperLimit if (self.wvlUpperLimit!=None and self.wvlUpperLimit>0.) else 1500)
+
+        if (wvlBinWidth is None) and (energyBinWidth is None) and (wvlBinEdges is None): #use default/flat cal supplied bins
+            return self.defaultWvlBins
+
+        #use specified bins
+        if applySpecWeight and self.info['isFlatCalibrated']:
+            raise ValueError('Using flat cal, so flat cal bins must be used')
+        elif wvlBinEdges is not None:
+            assert wvlBinWidth is None and energyBinWidth is None, 'Histogram bins are overspecified!'
+            return np.asarray(wvlBinEdges)
+        elif energyBinWidth is not None:
+            assert wvlBinWidth is None, 'Cannot specify both wavelength and energy bin widths!'
+            return ObsFile.makeWvlBins(energyBinWidth=energyBinWidth, wvlStart=wvlStart, wvlStop=wvlStop)
+        elif wvlBinWidth is not None:
+            nWvlBins = int((wvlStop - wvlStart)/wvlBinWidth)
+            return np.linspace(wvlStart, wvlStop, nWvlBins+1)
+        else:
+            raise Exception('Something is wrong with getPixelSpectrum...')
+
     def _makePixelSpectrum(self, photonList, **kwargs):
         """
         Makes a histogram using the provided photon list
@@ -611,14 +1223,14 @@ class ObsFile:
         applyTPFWeight = kwargs.pop('applyTPFWeight', False)
         wvlStart = kwargs.pop('wvlStart', None)
         wvlStop = kwargs.pop('wvlStop', None)
-        wvlBinWidth = kwargs.pop('wvlBinWidht', None)
+        wvlBinWidth = kwargs.pop('wvlBinWidth', None)
         energyBinWidth = kwargs.pop('energyBinWidth', None)
         wvlBinEdges = kwargs.pop('wvlBinEdges', None)
         timeSpacingCut = kwargs.pop('timeSpacingCut', None)
-        
-        wvlStart=wvlStart if (wvlStart!=None and wvlStart>0.) else (self.wvlLowerLimit if (self.wvlLowerLimit!=None and self.wvlLowerLimit>0.) else 700)
-        wvlStop=wvlStop if (wvlStop!=None and wvlStop>0.) else (self.wvlUpperLimit if (self.wvlUpperLimit!=None and self.wvlUpperLimit>0.) else 1500)
 
+        wvlBinEdges = self._getWvlBinEdges(applySpecWeight=applySpecWeight, wvlStart=wvlStart, wvlStop=wvlStop,
+                                           wvlBinWidth=wvlBinWidth, energyBinWidth=energyBinWidth,
+                                           wvlBinEdges=wvlBinEdges)
 
         wvlList = photonList['Wavelength']
         rawCounts = len(wvlList)
@@ -631,25 +1243,7 @@ class ObsFile:
         if applyTPFWeight:
             weights *= photonList['NoiseWeight']
 
-        if (wvlBinWidth is None) and (energyBinWidth is None) and (wvlBinEdges is None): #use default/flat cal supplied bins
-            spectrum, wvlBinEdges = np.histogram(wvlList, bins=self.defaultWvlBins, weights=weights)
-
-        else: #use specified bins
-            if applySpecWeight and self.info['isFlatCalibrated']:
-                raise ValueError('Using flat cal, so flat cal bins must be used')
-            elif wvlBinEdges is not None:
-                assert wvlBinWidth is None and energyBinWidth is None, 'Histogram bins are overspecified!'
-                spectrum, wvlBinEdges = np.histogram(wvlList, bins=wvlBinEdges, weights=weights)
-            elif energyBinWidth is not None:
-                assert wvlBinWidth is None, 'Cannot specify both wavelength and energy bin widths!'
-                wvlBinEdges = ObsFile.makeWvlBins(energyBinWidth=energyBinWidth, wvlStart=wvlStart, wvlStop=wvlStop)
-                spectrum, wvlBinEdges = np.histogram(wvlList, bins=wvlBinEdges, weights=weights)
-            elif wvlBinWidth is not None:
-                nWvlBins = int((wvlStop - wvlStart)/wvlBinWidth)
-                spectrum, wvlBinEdges = np.histogram(wvlList, bins=nWvlBins, range=(wvlStart, wvlStop), weights=weights)
-
-            else:
-                raise Exception('Something is wrong with getPixelSpectrum...')
+        spectrum, wvlBinEdges = np.histogram(wvlList, bins=wvlBinEdges, weights=weights)
 
         if self.filterIsApplied == True:
             if not np.array_equal(self.filterWvlBinEdges, wvlBinEdges):
@@ -666,50 +1260,38 @@ class ObsFile:
         If integration time is -1, all time after firstSec is used.
         If weighted is True, flat cal weights are applied.
         If fluxWeighted is True, spectral shape weights are applied.
-        """
 
-        cube = [[[] for yCoord in range(self.nYPix)] for xCoord in range(self.nXPix)]
-        effIntTime = np.zeros((self.nXPix,self.nYPix))
-        rawCounts = np.zeros((self.nXPix,self.nYPix))
+        The photon list is read once and binned into the (nXPix, nYPix, nWvlBins) cube with a
+        single weighted bincount (see _binPhotonsByPixelAndWvl); bin edges follow the same
+        rules as getPixelSpectrum().
+        """
+        wvlBinEdges = self._getWvlBinEdges(applySpecWeight=applySpecWeight, wvlStart=wvlStart, wvlStop=wvlStop,
+                                           wvlBinWidth=wvlBinWidth, energyBinWidth=energyBinWidth,
+                                           wvlBinEdges=wvlBinEdges)
         if integrationTime==-1:
             integrationTime = self.getFromHeader('expTime')
         
-        startTime = firstSec*1.e6
-        endTime = (firstSec + integrationTime)*1.e6
+        startTime = int(np.ceil(firstSec*self.ticksPerSec))
+        endTime = int(np.ceil((firstSec + integrationTime)*self.ticksPerSec))
+
+        cube = np.zeros((self.nXPix, self.nYPix, len(wvlBinEdges)-1), dtype=np.float64)
+        rawCounts = np.zeros((self.nXPix, self.nYPix), dtype=np.float64)
+        columns = ['ResID', 'Wavelength'] + self._getWeightColumns(applySpecWeight, applyTPFWeight)
+        for photonList in self._iterPhotonsInWindow(startTime, endTime, columns=columns):
+            weights = self._getPhotonWeights(photonList, applySpecWeight, applyTPFWeight)
+            cube += self._binPhotonsByPixelAndWvl(photonList['ResID'], photonList['Wavelength'], wvlBinEdges, weights)
+            rawCounts += self._binPhotonsByPixel(photonList['ResID'])
+
+        flags = self.beamFlagImage.read()
+        badPixMask = (flags|flagToUse)!=flagToUse
+        cube[badPixMask] = 0
+        rawCounts[badPixMask] = 0
+        effIntTime = np.full((self.nXPix,self.nYPix), integrationTime, dtype=np.float64)
 
-        masterPhotonList = self.photonTable.read_where('(Time>=startTime)&(Time<endTime)')
-        emptyPhotonList = self.photonTable.read_where('Time<0')
-        
-        resIDDiffs = np.diff(masterPhotonList['ResID'])
-        if(np.any(resIDDiffs<0)):
-            warnings.warn('Photon list not sorted by ResID! This could take a while...')
-            masterPhotonList = np.sort(masterPhotonList, order='ResID', kind='mergsort') #mergesort is stable, so time order will be preserved
-            resIDDiffs = np.diff(masterPhotonList['ResID'])
-        
-        resIDBoundaryInds = np.where(resIDDiffs>0)[0]+1 #indices in masterPhotonList where ResID changes; ie marks boundaries between pixel tables
-        resIDBoundaryInds = np.insert(resIDBoundaryInds, 0, 0)
-        resIDList = masterPhotonList['ResID'][resIDBoundaryInds]
-        resIDBoundaryInds = np.append(resIDBoundaryInds, len(masterPhotonList['ResID']))
-
-        for xCoord in range(self.nXPix):    
-            for yCoord in range(self.nYPix):  
-                resID = self.beamImage[xCoord, yCoord]
-                flag = self.beamFlagImage[xCoord, yCoord]
-                resIDInd = np.where(resIDList==resID)[0]
-                if(np.shape(resIDInd)[0]>0 and (flag|flagToUse)==flagToUse):
-                    resIDInd = resIDInd[0]
-                    photonList = masterPhotonList[resIDBoundaryInds[resIDInd]:resIDBoundaryInds[resIDInd+1]]
-                else:
-                    photonList = emptyPhotonList
-                x = self._makePixelSpectrum(photonList, applySpecWeight=applySpecWeight,
-                                  applyTPFWeight=applyTPFWeight, wvlStart=wvlStart, wvlStop=wvlStop,
-                                  wvlBinWidth=wvlBinWidth, energyBinWidth=energyBinWidth,
-                                  wvlBinEdges=wvlBinEdges, timeSpacingCut=timeSpacingCut)
-                cube[xCoord][yCoord] = x['spectrum']
-                effIntTime[xCoord][yCoord] = integrationTime
-                rawCounts[xCoord][yCoord] = x['rawCounts']
-                wvlBinEdges = x['wvlBinEdges']
-        cube = np.array(cube)
+        if self.filterIsApplied == True:
+            if not np.array_equal(self.filterWvlBinEdges, wvlBinEdges):
+                raise ValueError("Synthetic filter wvlBinEdges do not match pixel spectrum wvlBinEdges!")
+            cube*=self.filterTrans
         return {'cube':cube,'wvlBinEdges':wvlBinEdges,'effIntTime':effIntTime, 'rawCounts':rawCounts}
 
     def getPixelSpectrum(self, xCoord, yCoord, firstSec=0, integrationTime= -1,
@@ -792,10 +1374,21 @@ class ObsFile:
         raise NotImplementedError
 
 
-    def applyWaveCal(self, file_name):
+    def applyWaveCal(self, file_name, bulk=True, chunkSize=None):
         """
         loads the wavelength cal coefficients from a given file and applies them to the
         wavelengths table for each pixel. ObsFile must be loaded in write mode.
+
+        Parameters
+        ----------
+        file_name: string
+            wavecal solution file
+        bulk: bool
+            If True, the PhotonTable is calibrated in large row chunks (see _applyWaveCalBulk),
+            otherwise pixel by pixel with updateWavelengths().
+        chunkSize: int
+            Number of rows per chunk in bulk mode. Defaults to self.chunkSize, or 10 million
+            rows if that isn't set.
         """
         # check file_name and status of obsFile
         assert not self.info['isWvlCalibrated'], \
@@ -808,20 +1401,23 @@ class ObsFile:
         try:
             # appy waveCal
             calsoln = wave_cal.root.wavecal.calsoln.read()
-            for (row, column), resID in np.ndenumerate(self.beamImage):
-                index = np.where(resID == np.array(calsoln['resid']))
-                if len(index[0]) == 1 and (calsoln['wave_flag'][index] == 4 or
-                                           calsoln['wave_flag'][index] == 5):
-                    poly = calsoln['polyfit'][index]
-                    photon_list = self.getPixelPhotonList(row, column)
-                    phases = photon_list['Wavelength']
-                    poly = np.array(poly)
-                    poly = poly.flatten()
-                    energies = np.polyval(poly, phases)
-                    wavelengths = self.h * self.c / energies * 1e9  # wavelengths in nm
-                    self.updateWavelengths(row, column, wavelengths)
-                else:
-                    self.applyFlag(row, column, 0b00000010)  # failed waveCal
+            if bulk:
+                self._applyWaveCalBulk(calsoln, chunkSize)
+            else:
+                for (row, column), resID in np.ndenumerate(self.beamImage):
+                    index = np.where(resID == np.array(calsoln['resid']))
+                    if len(index[0]) == 1 and (calsoln['wave_flag'][index] == 4 or
+                                               calsoln['wave_flag'][index] == 5):
+                        poly = calsoln['polyfit'][index]
+                        photon_list = self.getPixelPhotonList(row, column)
+                        phases = photon_list['Wavelength']
+                        poly = np.array(poly)
+                        poly = poly.flatten()
+                        energies = np.polyval(poly, phases)
+                        wavelengths = self.h * self.c / energies * 1e9  # wavelengths in nm
+                        self.updateWavelengths(row, column, wavelengths)
+                    else:
+                        self.applyFlag(row, column, 0b00000010)  # failed waveCal
             self.modifyHeaderEntry(headerTitle='isWvlCalibrated', headerValue=True)
             self.modifyHeaderEntry(headerTitle='wvlCalFile',headerValue=str.encode(file_name))
         finally:
@@ -829,6 +1425,74 @@ class ObsFile:
             self.photonTable.autoindex = True # turn on autoindexing 
             wave_cal.close()
 
+    def _getWaveCalCoeffs(self, calsoln):
+        """
+        Maps the wavecal solutions onto the beammap.
+
+        Returns a (nXPix*nYPix, nCoeffs) array of polynomial coefficients for each pixel
+        (indexed like beamImage.flatten()) and a boolean mask of the pixels with a good
+        solution: exactly one calsoln row for the pixel's resID with wave_flag 4 or 5.
+        """
+        flatResIDs = self.beamImage.flatten()
+        solnResIDs, solnInds, solnCounts = np.unique(calsoln['resid'], return_index=True, return_counts=True)
+        matchInds = np.clip(np.searchsorted(solnResIDs, flatResIDs), 0, max(len(solnResIDs)-1, 0))
+        hasSoln = (len(solnResIDs)>0) & (solnResIDs[matchInds]==flatResIDs) & (solnCounts[matchInds]==1)
+        calsolnRows = solnInds[matchInds]
+        goodPixMask = hasSoln & np.isin(calsoln['wave_flag'][calsolnRows], (4, 5))
+        coeffs = np.array(calsoln['polyfit'][calsolnRows], dtype=np.float64).reshape(len(flatResIDs), -1)
+        return coeffs, goodPixMask
+
+    def _applyWaveCalBulk(self, calsoln, chunkSize=None):
+        """
+        Applies the wavecal solutions in calsoln to the whole PhotonTable in one pass.
+
+        Each pixel's polynomial is looked up once, then the table is read in chunks of
+        chunkSize rows (ResID and Wavelength columns only). Each photon's energy is
+        evaluated with its pixel's coefficients and the Wavelength column of the chunk is
+        written back with a single modify_column. Photons of pixels without a good solution
+        (and of resIDs not in the beammap) are left untouched, and those pixels are flagged
+        as failed waveCal.
+        """
+        if self.mode!='write':
+            raise Exception("Must open file in write mode to do this!")
+        if chunkSize is None:
+            chunkSize = self.chunkSize if self.chunkSize is not None else 10000000
+
+        coeffs, goodPixMask = self._getWaveCalCoeffs(calsoln)
+
+        for startRow in range(0, self.photonTable.nrows, chunkSize):
+            stopRow = min(startRow+chunkSize, self.photonTable.nrows)
+            photonList = self._readRows(startRow, stopRow, ['ResID', 'Wavelength'])
+            pixelInds = self._getPixelIndices(photonList['ResID'])
+            calMask = pixelInds>=0
+            calMask[calMask] = goodPixMask[pixelInds[calMask]]
+            if not np.any(calMask):
+                continue
+            energies = self._evalPixelPolynomials(coeffs[pixelInds[calMask]], photonList['Wavelength'][calMask])
+            wavelengths = photonList['Wavelength']
+            wavelengths[calMask] = self.h * self.c / energies * 1e9  # wavelengths in nm
+            self.photonTable.modify_column(start=startRow, stop=stopRow, column=wavelengths, colname='Wavelength')
+        self.photonTable.flush()
+
+        beamFlags = self.beamFlagImage.read()
+        beamFlags[~goodPixMask.reshape(beamFlags.shape)] |= 0b00000010  # failed waveCal
+        self.beamFlagImage[:] = beamFlags
+        self.beamFlagImage.flush()
+
+    @staticmethod
+    def _evalPixelPolynomials(photonCoeffs, x):
+        """
+        Evaluates a different polynomial for every photon. photonCoeffs is a (nPhotons, nCoeffs)
+        array of coefficients (highest power first, as in np.polyval) and x the value for
+        each photon. Uses Horner's method, so it's the same as np.polyval row by row.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        values = photonCoeffs[:, 0].astype(np.float64)
+        for i in range(1, photonCoeffs.shape[1]):
+            values *= x
+            values += photonCoeffs[:, i]
+        return values
+
 
     @staticmethod
     def makeWvlBins(energyBinWidth=.1, wvlStart=700, wvlStop=1500):
@@ -1008,14 +1672,19 @@ class ObsFile:
         """
         self.__applyColWeight(resID, weightArr, 'NoiseWeight')
 
-    def applyFlatCal(self, calSolnPath,verbose=False):
+    def applyFlatCal(self, calSolnPath, verbose=False, makePlots=False, chunkSize=None):
         """
-        Applies a flat calibration to the "SpecWeight" column of a single pixel.
+        Applies a flat calibration to the "SpecWeight" column of every pixel.
 
         Weights are multiplied in and replaced; if "weights" are the contents
         of the "SpecWeight" column, weights = weights*weightArr. NOT reversible
         unless the original contents (or weightArr) is saved.
 
+        All the FlatCal solution files are read once and each good pixel's weights are fit
+        with a 10th order polynomial in wavelength (see _getFlatCalCoeffs), averaged over
+        the solution files. The PhotonTable is then calibrated in chunks of chunkSize rows,
+        with one modify_column per chunk. Photons outside 700-1500 nm get a weight of 0.
+
         Parameters
         ----------
         calSolnPath: string
@@ -1023,98 +1692,170 @@ class ObsFile:
             should contain the base filename of these solution files
             e.g '/mnt/data0/isabel/DeltaAnd/Flats/DeltaAndFlatSoln.h5')
             Code will grab all files titled DeltaAndFlatSoln#.h5 from that directory
-        if verbose: will print resID, row, and column of pixels which have a successful FlatCal
-                    will print averaged flat weights of pixels which have a successful FlatCal.
-        Will write plots of flatcal solution (5 second increments over a single flat exposure) 
-             with average weights overplotted to a pdf for pixels which have a successful FlatCal.
-             Written to the calSolnPath+'FlatCalSolnPlotsPerPixel.pdf'
+        verbose: bool
+            if True, prints the number of pixels with a successful FlatCal
+        makePlots: bool
+            if True, also writes plots of the flatcal solutions with the fit weights
+            overplotted to calSolnPath+'FlatCalSolnPlotsPerPixel.pdf' (see plotFlatCalSolutions)
+        chunkSize: int
+            Number of rows per chunk. Defaults to self.chunkSize, or 10 million
+            rows if that isn't set.
         """
-        baseh5path=calSolnPath.split('.h5')
-        flatList=glob.glob(baseh5path[0]+'*.h5')     
-        assert os.path.exists(flatList[0]), "{0} does not exist".format(flatList[0])  
+        flatList = self._getFlatCalFileList(calSolnPath)
         assert not self.info['isSpecCalibrated'], \
                "the data is already Flat calibrated"
-        pdfFullPath = baseh5path[0]+'FlatCalSolnPlotsPerPixel.pdf'
+        if self.mode!='write':
+            raise Exception("Must open file in write mode to do this!")
+        if chunkSize is None:
+            chunkSize = self.chunkSize if self.chunkSize is not None else 10000000
+
+        coeffs, goodPixMask = self._getFlatCalCoeffs(self._loadFlatCalSolutions(flatList))
+        if verbose:
+            print('Applying FlatCal to', np.count_nonzero(goodPixMask), 'pixels')
+
+        for startRow in range(0, self.photonTable.nrows, chunkSize):
+            stopRow = min(startRow+chunkSize, self.photonTable.nrows)
+            photonList = self._readRows(startRow, stopRow, ['ResID', 'Wavelength', 'SpecWeight'])
+            pixelInds = self._getPixelIndices(photonList['ResID'])
+            calMask = pixelInds>=0
+            calMask[calMask] = goodPixMask[pixelInds[calMask]]
+            if not np.any(calMask):
+                continue
+            phases = photonList['Wavelength'][calMask]
+            weightArr = self._evalPixelPolynomials(coeffs[pixelInds[calMask]], phases)
+            weightArr[(phases < self.flatCalWvlRange[0]) | (phases > self.flatCalWvlRange[1])] = 0.0
+            specWeights = photonList['SpecWeight']
+            specWeights[calMask] = weightArr*specWeights[calMask]
+            self.photonTable.modify_column(start=startRow, stop=stopRow, column=specWeights, colname='SpecWeight')
+        self.photonTable.flush()
+
+        if makePlots:
+            self.plotFlatCalSolutions(calSolnPath, coeffs=coeffs, goodPixMask=goodPixMask)
+        self.modifyHeaderEntry(headerTitle='isSpecCalibrated', headerValue=True)
+
+    @staticmethod
+    def _getFlatCalFileList(calSolnPath):
+        """
+        Returns all the FlatCal solution files matching calSolnPath (see applyFlatCal)
+        """
+        baseh5path=calSolnPath.split('.h5')
+        flatList=sorted(glob.glob(baseh5path[0]+'*.h5'))
+        assert flatList and os.path.exists(flatList[0]), "{0} does not exist".format(calSolnPath)
+        return flatList
+
+    @staticmethod
+    def _loadFlatCalSolutions(flatList):
+        """
+        Reads the calsoln table and wavelength bins of each FlatCal solution file once.
+
+        Returns a list with a dict for each file with keys 'calsoln', 'bins', 'weights' and
+        'weightUncertainties'. These are the wavelength bins and the (nSolns, nBins) weights
+        (and uncertainties) padded with a weight of 1 outside the calibrated range, as used
+        for the weight fits.
+        """
+        heads=np.arange(0,700,100)
+        tails=np.arange(1600,2100,100)
+        flatSolns = []
+        for FlatCalFile in flatList:
+            with tables.open_file(FlatCalFile, mode='r') as flat_cal:
+                calsoln = flat_cal.root.flatcal.calsoln.read()
+                bins = np.array(flat_cal.root.flatcal.wavelengthBins.read()).flatten()
+            nSolns = len(calsoln)
+            padding = (np.ones((nSolns, len(heads))), np.ones((nSolns, len(tails)+1)))
+            weights = np.array(calsoln['weights'], dtype=np.float64).reshape(nSolns, -1)
+            weightUncertainties = np.array(calsoln['weightUncertainties'], dtype=np.float64).reshape(nSolns, -1)
+            flatSolns.append({'calsoln': calsoln,
+                              'bins': np.concatenate((heads, bins, tails)),
+                              'weights': np.hstack((padding[0], weights, padding[1])),
+                              'weightUncertainties': np.hstack((padding[0], weightUncertainties, padding[1]))})
+        return flatSolns
+
+    def _getFlatCalCoeffs(self, flatSolns, polyOrder=10):
+        """
+        Fits the FlatCal weights of every pixel and solution file with a polynomial in
+        wavelength, all pixels of a file at once (np.polyfit with one column per pixel).
+
+        Returns a (nXPix*nYPix, polyOrder+1) array of coefficients (indexed like
+        beamImage.flatten()), averaged over the files with a solution for the pixel, and a
+        boolean mask of the pixels to calibrate: good pixels (see pixelIsBad with forceWvl, so
+        pixels whose wavecal failed are skipped) with exactly one calsoln row in at least one
+        file.
+        """
+        flatResIDs = self.beamImage.flatten()
+        goodPixels = ~self._getBadPixelMask(forceWvl=True).flatten()
+        coeffSum = np.zeros((len(flatResIDs), polyOrder+1))
+        nSolns = np.zeros(len(flatResIDs), dtype=int)
+        for flatSoln in flatSolns:
+            solnResIDs, solnInds, solnCounts = np.unique(flatSoln['calsoln']['resid'], return_index=True, return_counts=True)
+            if len(solnResIDs)==0:
+                continue
+            matchInds = np.clip(np.searchsorted(solnResIDs, flatResIDs), 0, len(solnResIDs)-1)
+            hasSoln = goodPixels & (solnResIDs[matchInds]==flatResIDs) & (solnCounts[matchInds]==1)
+            if not np.any(hasSoln):
+                continue
+            weights = flatSoln['weights'][solnInds[matchInds[hasSoln]]]
+            coeffSum[hasSoln] += np.polyfit(flatSoln['bins'], weights.T, polyOrder).T
+            nSolns[hasSoln] += 1
+        goodPixMask = nSolns>0
+        coeffSum[goodPixMask] /= nSolns[goodPixMask, np.newaxis]
+        return coeffSum, goodPixMask
+
+    def plotFlatCalSolutions(self, calSolnPath, pdfFullPath=None, coeffs=None, goodPixMask=None):
+        """
+        Writes plots of the flatcal solution weights of each calibrated pixel (one curve per
+        solution file) with the fit weight function applied by applyFlatCal overplotted.
+
+        Parameters
+        ----------
+        calSolnPath: string
+            FlatCal solution files (see applyFlatCal)
+        pdfFullPath: string
+            Output pdf. Defaults to calSolnPath+'FlatCalSolnPlotsPerPixel.pdf'
+        coeffs, goodPixMask:
+            Output of _getFlatCalCoeffs(), if already computed
+        """
+        baseh5path=calSolnPath.split('.h5')
+        if pdfFullPath is None:
+            pdfFullPath = baseh5path[0]+'FlatCalSolnPlotsPerPixel.pdf'
+        flatSolns = self._loadFlatCalSolutions(self._getFlatCalFileList(calSolnPath))
+        if coeffs is None or goodPixMask is None:
+            coeffs, goodPixMask = self._getFlatCalCoeffs(flatSolns)
+        minwavelength, maxwavelength = self.flatCalWvlRange
+        wvls = np.linspace(minwavelength, maxwavelength, 200)
+
         pp = PdfPages(pdfFullPath)
         nPlotsPerRow = 2
         nPlotsPerCol = 4
         nPlotsPerPage = nPlotsPerRow*nPlotsPerCol
-        iPlot = 0 
-        matplotlib.rcParams['font.size'] = 4 
-        for (row, column), resID in np.ndenumerate(self.beamImage):
-                photon_list = self.getPixelPhotonList(row, column)
-                phases = photon_list['Wavelength']
-                calarray=[]
-                weightarray=[]
-                weightarrayUncertainty=[]
-                minwavelength=700
-                maxwavelength=1500
-                heads=np.arange(0,700,100)
-                tails=np.arange(1600,2100,100)
-                headsweight=np.array([0,0,0,0,0,0,0])+1
-                tailsweight=np.array([0,0,0,0,0,0])+1
-                for FlatCalFile in flatList:
-                      flat_cal = tables.open_file(FlatCalFile, mode='r')
-                      calsoln = flat_cal.root.flatcal.calsoln.read()
-                      bins=np.array(flat_cal.root.flatcal.wavelengthBins.read())
-                      bins=bins.flatten()
-                      bins=np.append(heads,bins)
-                      bins=np.append(bins,tails)
-                      index = np.where(resID == np.array(calsoln['resid']))
-                      #if len(index[0]) == 1 and (calsoln['flag'][index] == 0):
-                      if len(index[0]) == 1 and not self.pixelIsBad(row, column):
-                           print('resID', resID, 'row', row, 'column', column)
-                           weights = calsoln['weights'][index]
-                           print(weights)
-                           weightFlags=calsoln['weightFlags'][index]
-                           weightUncertainties=calsoln['weightUncertainties'][index]
-
-                           weights=np.array(weights)
-                           weights=weights.flatten()
-                           weightsheads=np.zeros(len(heads))+1
-                           weightstails=np.zeros(len(tails)+1)+1
-                           weights=np.append(weightsheads,weights)
-                           weights=np.append(weights,weightstails)
-                           weightarray.append(weights)
-
-                           weightUncertainties=np.array(weightUncertainties)
-                           weightUncertainties=weightUncertainties.flatten()
-                           weightUncertainties=np.append(headsweight,weightUncertainties)
-                           weightUncertainties=np.append(weightUncertainties,tailsweight)
-                           weightarrayUncertainty.append(weightUncertainties)
-
-                           weightfxncoeffs10=np.polyfit(bins,weights,10)
-                           weightfxn10=np.poly1d(weightfxncoeffs10)
-
-                           weightArr=weightfxn10(phases)                    
-                           weightArr[np.where(phases < minwavelength)]=0.0
-                           weightArr[np.where(phases > maxwavelength)]=0.0
-                           calarray.append(weightArr)       
-                           
-                if calarray and calarray[0].all:
-                     calweights = np.average(calarray,axis=0)
-                     self.applySpecWeight(resID=resID, weightArr=calweights)
-                     if verbose:
-                        print('CALWEIGHTS', calweights)
-                        print('resID', resID, 'row', row, 'column', column)
-                        if iPlot % nPlotsPerPage == 0:
-                           fig = plt.figure(figsize=(10,10),dpi=100)
-                        ax = fig.add_subplot(nPlotsPerCol,nPlotsPerRow,iPlot%nPlotsPerPage+1)
-                        ax.set_ylim(0,5)
-                        ax.set_xlim(minwavelength,maxwavelength)
-                        for i in range(len(weightarray)):
-                            ax.plot(bins,weightarray[i],'-',label='weights')
-                            ax.errorbar(bins,weightarray[i],yerr=weightarrayUncertainty[i],label='weights')
-                        ax.plot(phases, calweights, '.', markersize=5)
-                        ax.set_title('p %d,%d'%(row,column))
-                        ax.set_ylabel('weight')
-                        #ax.set_xlabel(r'$\lambda$ ($\AA$)')
-
-                        if iPlot%nPlotsPerPage == nPlotsPerPage-1 or (row == self.nXPix-1 and column == self.nYPix-1):
-                           pp.savefig(fig)
-                        iPlot += 1
+        iPlot = 0
+        matplotlib.rcParams['font.size'] = 4
+        fig = None
+        for pixelInd in np.where(goodPixMask)[0]:
+            row, column = np.unravel_index(pixelInd, self.beamImage.shape)
+            resID = self.beamImage[row, column]
+            if iPlot % nPlotsPerPage == 0:
+                fig = plt.figure(figsize=(10,10),dpi=100)
+            ax = fig.add_subplot(nPlotsPerCol,nPlotsPerRow,iPlot%nPlotsPerPage+1)
+            ax.set_ylim(0,5)
+            ax.set_xlim(minwavelength,maxwavelength)
+            for flatSoln in flatSolns:
+                index = np.where(resID == flatSoln['calsoln']['resid'])[0]
+                if len(index) != 1:
+                    continue
+                ax.plot(flatSoln['bins'], flatSoln['weights'][index[0]], '-', label='weights')
+                ax.errorbar(flatSoln['bins'], flatSoln['weights'][index[0]],
+                            yerr=flatSoln['weightUncertainties'][index[0]], label='weights')
+            ax.plot(wvls, np.polyval(coeffs[pixelInd], wvls), '.', markersize=5)
+            ax.set_title('p %d,%d'%(row,column))
+            ax.set_ylabel('weight')
+            if iPlot%nPlotsPerPage == nPlotsPerPage-1:
+                pp.savefig(fig)
+                plt.close(fig)
+            iPlot += 1
+        if fig is not None and iPlot%nPlotsPerPage != 0:
+            pp.savefig(fig)
+            plt.close(fig)
         pp.close()
-        self.modifyHeaderEntry(headerTitle='isSpecCalibrated', headerValue=True)
 
     def applyFlag(self, xCoord, yCoord, flag):
         """
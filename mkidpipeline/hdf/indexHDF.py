@@ -1,30 +1,51 @@
-import sys
+"""
+Adds completely sorted indexes on the Time, ResID and Wavelength columns of /Photons/PhotonTable.
+The index filters default to the PhotonTable's own filters (see consolidatePhotonTables.py).
+
+usage: python indexHDF.py [--complib lib] [--complevel n] [--noshuffle] <path to h5 file>
+"""
+
+import argparse
 
 import tables
 
-if len(sys.argv)<2:
-    print('Must specify H5 filename')
-    exit(0)
+from mkidpipeline.hdf.consolidatePhotonTables import addLayoutArguments, getLayoutArgs
+
+
+def indexPhotonTable(hfile, filters=None, columns=('Time', 'ResID', 'Wavelength')):
+    """
+    Creates completely sorted indexes on columns of /Photons/PhotonTable.
+
+    Parameters
+    ----------
+    hfile: tables.File
+        Open (writable) h5 file
+    filters: tables.Filters
+        Filters of the indexes, default is the PhotonTable's
+    columns: list of strings
+        Columns to index
+    """
+    photonTable = hfile.root.Photons.PhotonTable
+    if filters is None:
+        filters = photonTable.filters
+    for column in columns:
+        photonTable.cols._f_col(column).create_csindex(filters=filters)
+    photonTable.flush()
 
-hfile = tables.open_file(sys.argv[1], 'a')
-hfile.set_node_attr('/', 'PYTABLES_FORMAT_VERSION', '2.0')
-hfile.format_version = '2.0'
 
-#filterObj = tables.Filters(complevel=5, complib='lzo')
-filterObj = tables.Filters(complevel=0, complib='lzo')
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Add sorted indexes on the Time, ResID and Wavelength columns of an h5 file.')
+    parser.add_argument('fileName', help='h5 file with a /Photons/PhotonTable')
+    addLayoutArguments(parser, chunkRows=False)
+    args = parser.parse_args()
 
-print('Opened file')
+    hfile = tables.open_file(args.fileName, 'a')
+    hfile.set_node_attr('/', 'PYTABLES_FORMAT_VERSION', '2.0')
+    hfile.format_version = '2.0'
 
-# for photonTable in hfile.iter_nodes('/Photons'):
-#     print('Indexing table', photonTable)
-#     photonTable.cols.Time.create_index()
-#     photonTable.cols.Wavelength.create_index()
-#     photonTable.flush()
+    print('Opened file')
 
-photonTable = hfile.root.Photons.PhotonTable
-photonTable.cols.Time.create_csindex(filters=filterObj)
-photonTable.cols.ResID.create_csindex(filters=filterObj)
-photonTable.cols.Wavelength.create_csindex(filters=filterObj)
-photonTable.flush()
+    filters = getLayoutArgs(args)[0] if args.complib is not None or args.complevel is not None else None
+    indexPhotonTable(hfile, filters)
 
-hfile.close()
+    hfile.close()
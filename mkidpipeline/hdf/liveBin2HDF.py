@@ -0,0 +1,231 @@
+"""
+Converts .bin files into an h5 file while they are being written during observing.
+
+LiveBin2HDF watches the .bin directory (polling it every pollTime seconds) and parses each
+<timestamp>.bin file with parsePacketDump.parseBinWords as soon as it is complete, i.e. when
+the next second's file exists or the file hasn't changed for settleTime seconds. Each second's
+photons are sorted by ResID and time and appended to /Photons/PhotonTable, and the number of photons of
+each ResID in that second is appended as a row of /Photons/LiveIndex (columns in the order of
+its resIDs attribute), so the rows of any pixel and second can be found while observing. The
+header's expTime is kept up to date and the file is flushed after every second, so other
+processes can open it with ObsFile (which uses table queries, since there is no PixelIndex
+yet). HDF5 locks files that are open for writing, so they have to set the environment variable
+HDF5_USE_FILE_LOCKING=FALSE.
+
+A rolling count image of the last rollingTime seconds is kept (getRollingImage()) and, if an
+image directory is given, written as <timestamp>.img files that quickLook_img.py can show.
+
+When the observation ends (after nFiles seconds, no new file for timeout seconds, or Ctrl-C)
+the file is rewritten in the consolidated layout that Bin2HDF and consolidatePhotonTables.py
+make: a ResID and time sorted PhotonTable with a PixelIndex and a TimeIndex (see bin2hdf.py,
+which has the parsing and writing shared with the offline python conversion).
+
+usage: python liveBin2HDF.py <Bin2HDF.cfg> [--imgPath dir] [--rollingTime sec] [--pollTime sec]
+           [--settleTime sec] [--timeout sec]
+"""
+
+import argparse
+import collections
+import os
+import time
+
+import numpy as np
+import tables
+
+from mkidpipeline.core.headers import ObsFileCols
+from mkidpipeline.hdf.bin2hdf import BinFileParser, createObsFile, moveSecondsByResID, readBeammap, \
+    readBin2HDFConfig, writeImage, writePhotonIndexes
+from mkidpipeline.hdf.consolidatePhotonTables import createPhotonTable, defaultChunkRows
+
+
+class LiveBin2HDF:
+    """
+    Appends the photons of each new .bin file to a growing h5 file (see the module docstring).
+
+    Parameters
+    ----------
+    binPath: string
+        directory the .bin files are written to
+    outFile: string
+        h5 file to write, replaced if it exists
+    beammapFile: string
+        beammap file (ResID, flag, x, y)
+    startTime: int
+        timestamp of the first .bin file
+    nXPix, nYPix: int
+        array size
+    mapFlag: int
+        if >0 only photons of successfully beammapped pixels (flag 0) are kept
+    rollingTime: int
+        number of seconds in the rolling count image
+    imgPath: string
+        if given, the rolling count image is written there as <timestamp>.img after every second
+    filters, chunkRows:
+        layout of the consolidated PhotonTable (see consolidatePhotonTables.createPhotonTable)
+    """
+
+    def __init__(self, binPath, outFile, beammapFile, startTime, nXPix=80, nYPix=125, mapFlag=1, rollingTime=10,
+                 imgPath=None, filters=None, chunkRows=defaultChunkRows):
+        self.binPath = binPath
+        self.outFile = outFile
+        self.beammapFile = beammapFile
+        self.startTime = startTime
+        self.nXPix = nXPix
+        self.nYPix = nYPix
+        self.imgPath = imgPath
+        self.filters = filters
+        self.chunkRows = chunkRows
+
+        self.beamMap, self.beamFlag = readBeammap(beammapFile, nXPix, nYPix)
+        self.parser = BinFileParser(binPath, self.beamMap, self.beamFlag, mapFlag, startTime)
+        self.resIDs = self.parser.resIDs
+
+        self.nextTime = startTime
+        self.nPhotons = 0
+        self.rollingImages = collections.deque(maxlen=rollingTime)
+        self.rollingImage = np.zeros((nXPix, nYPix), dtype=np.int64)
+        self._createFile()
+
+    def _createFile(self):
+        """Creates the live h5 file with its header, beammap, live PhotonTable and LiveIndex"""
+        self.hfile = createObsFile(self.outFile, self.startTime, 0, self.binPath, self.beammapFile, self.beamMap,
+                                   self.beamFlag)
+        #uncompressed while observing, the consolidated table gets self.filters
+        self.photonTable = self.hfile.create_table('/Photons', 'PhotonTable', ObsFileCols, 'Photon Table',
+                                                   chunkshape=(self.chunkRows,))
+        self.liveIndex = self.hfile.create_earray('/Photons', 'LiveIndex', tables.UInt32Atom(),
+                                                  shape=(0, len(self.resIDs)),
+                                                  title='Photons of each ResID in each second',
+                                                  chunkshape=(1, len(self.resIDs)))
+        self.liveIndex.attrs.resIDs = self.resIDs
+        self.hfile.flush()
+
+    def getImgFile(self, timestamp):
+        """Path of the rolling count image written after the second starting at timestamp"""
+        return os.path.join(self.imgPath, '{}.img'.format(timestamp))
+
+    def addSecond(self, timestamp, missing=False):
+        """
+        Appends the photons of the .bin file of timestamp (or nothing, if it is missing) to
+        the h5 file and updates the rolling count image. Returns the number of photons added.
+        """
+        if missing:
+            photons, pixelCounts, image = self.parser.emptySecond()
+        else:
+            photons, pixelCounts, image = self.parser.parseSecond(timestamp)
+
+        self.photonTable.append(photons)
+        self.liveIndex.append(pixelCounts[np.newaxis].astype(np.uint32))
+        writeImage(self.hfile, timestamp, image)
+        self.hfile.root.header.header.cols.expTime[0] = timestamp - self.startTime + 1
+        self.hfile.flush()
+        self.nPhotons += len(photons)
+        self.nextTime = timestamp + 1
+
+        if len(self.rollingImages) == self.rollingImages.maxlen:
+            self.rollingImage -= self.rollingImages[0]
+        self.rollingImages.append(image)
+        self.rollingImage += image
+        if self.imgPath is not None:
+            np.minimum(self.rollingImage, 2**16-1).astype(np.uint16).tofile(self.getImgFile(timestamp))
+        return len(photons)
+
+    def getRollingImage(self):
+        """
+        Returns the (nXPix, nYPix) count image of the last rollingTime seconds (or fewer at the
+        start), in counts per second.
+        """
+        return self.rollingImage/max(len(self.rollingImages), 1)
+
+    def update(self, settleTime=2, stopTime=None):
+        """
+        Adds the .bin files that are complete: those followed by a later file, and the last
+        one if it hasn't been modified for settleTime seconds. Seconds without a file before
+        a complete one are added as missing. Files at or after stopTime (if given) aren't
+        added.
+
+        Returns
+        -------
+        Number of seconds added
+        """
+        binTimes = []
+        for fileName in os.listdir(self.binPath):
+            name, ext = os.path.splitext(fileName)
+            if ext == '.bin' and name.isdigit() and int(name) >= self.nextTime:
+                binTimes.append(int(name))
+        binTimes.sort()
+        if binTimes and time.time() - os.path.getmtime(self.parser.getBinFile(binTimes[-1])) < settleTime:
+            binTimes.pop()
+        if stopTime is not None:
+            binTimes = [timestamp for timestamp in binTimes if timestamp < stopTime]
+
+        nAdded = 0
+        for timestamp in binTimes:
+            for missingTime in range(self.nextTime, timestamp):
+                print('No .bin file for {}'.format(missingTime))
+                self.addSecond(missingTime, missing=True)
+                nAdded += 1
+            nPhotons = self.addSecond(timestamp)
+            print('Added {} photons from {}'.format(nPhotons, self.parser.getBinFile(timestamp)))
+            nAdded += 1
+        return nAdded
+
+    def watch(self, nFiles=0, pollTime=0.5, settleTime=2, timeout=60):
+        """
+        Adds new .bin files as they are written, until nFiles seconds have been added (0 for no
+        limit), no new file was found for timeout seconds, or KeyboardInterrupt.
+        """
+        lastNew = time.time()
+        stopTime = self.startTime + nFiles if nFiles > 0 else None
+        try:
+            while stopTime is None or self.nextTime < stopTime:
+                if self.update(settleTime, stopTime) > 0:
+                    lastNew = time.time()
+                elif time.time() - lastNew > timeout:
+                    print('No new .bin files for {} s'.format(timeout))
+                    break
+                else:
+                    time.sleep(pollTime)
+        except KeyboardInterrupt:
+            print('Stopped watching {}'.format(self.binPath))
+
+    def finalize(self, chunkSize=10000000):
+        """
+        Rewrites the live file in the consolidated layout: the PhotonTable sorted by ResID (and
+        time within each ResID, see bin2hdf.moveSecondsByResID), a PixelIndex and a TimeIndex.
+        The live file is closed afterwards.
+        """
+        pixelCounts = self.liveIndex.read()
+        tmpFile = self.outFile + '.tmp'
+        newFile = createObsFile(tmpFile, self.startTime, self.nextTime - self.startTime, self.binPath,
+                                self.beammapFile, self.beamMap, self.beamFlag)
+        self.hfile.copy_children('/Images', newFile.root.Images)
+        photonTable = createPhotonTable(newFile, self.nPhotons, self.filters, self.chunkRows)
+        moveSecondsByResID(self.photonTable, pixelCounts, photonTable, chunkSize)
+        writePhotonIndexes(newFile, self.resIDs, pixelCounts.sum(axis=0, dtype=np.int64),
+                           correctTimes=not self.parser.sortTimes)
+        newFile.close()
+        self.hfile.close()
+        os.replace(tmpFile, self.outFile)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert .bin files into an h5 file while they are written.')
+    parser.add_argument('cfgFile', help='Bin2HDF config file (nFiles 0 to convert until no new files come)')
+    parser.add_argument('--imgPath', default=None, help='Directory for the rolling count .img files')
+    parser.add_argument('--rollingTime', type=int, default=10, help='Seconds in the rolling count image')
+    parser.add_argument('--pollTime', type=float, default=0.5, help='Seconds between checks for new .bin files')
+    parser.add_argument('--settleTime', type=float, default=2,
+                        help='Seconds the newest .bin file must be unchanged before it is converted')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Stop after this many seconds without a new .bin file')
+    args = parser.parse_args()
+
+    config = readBin2HDFConfig(args.cfgFile)
+    outFile = os.path.join(config['outPath'], '{}.h5'.format(config['startTime']))
+    live = LiveBin2HDF(config['binPath'], outFile, config['beamFile'], config['startTime'], config['xPix'],
+                       config['yPix'], config['mapFlag'], args.rollingTime, args.imgPath)
+    live.watch(config['nFiles'], args.pollTime, args.settleTime, args.timeout)
+    start = time.time()
+    live.finalize()
+    print('Wrote {} photons to {} in {:.1f} s'.format(live.nPhotons, outFile, time.time() - start))
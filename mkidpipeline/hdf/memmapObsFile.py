@@ -0,0 +1,207 @@
+"""
+Exports the PhotonTable of an obs file to flat, memory-mappable .npy files, and reads them
+back through the ObsFile interface.
+
+exportMemmap writes one .npy file per PhotonTable column (ResID.npy, Time.npy, Wavelength.npy,
+SpecWeight.npy, NoiseWeight.npy), the pixel row offsets (PixelIndex.npy, the same ResID,
+StartRow, NRows entries as /Photons/PixelIndex) and, if the file has one, TimeIndex.npy into a
+directory next to the h5 file (<file>_memmap by default). The file needs a PixelIndex, see
+consolidatePhotonTables.py --index-only.
+
+MemmapObsFile is an ObsFile (same read functions: getPixelPhotonList, getPixelCountImage,
+getSpectralCube, ...) whose photons come from np.load(mmap_mode='r') column arrays instead of
+HDF5 chunk reads. There is no query or decompression overhead, each function only touches the
+columns it needs, and repeated passes over an observation run from the OS page cache.
+getPixelPhotonColumns returns a pixel's photons as slices of the column arrays, without copying.
+The header, beammap and pixel flags are still read from the h5 file.
+
+The export is a copy of the PhotonTable: calibrations applied to the h5 file afterwards (with
+ObsFile in write mode) are not seen until it is exported again. MemmapObsFile warns if the h5
+file was modified after the export.
+
+usage: python memmapObsFile.py <path to h5 file> [memmap dir] [--chunkSize n]
+"""
+
+import argparse
+import os
+import warnings
+
+import numpy as np
+import tables
+
+from mkidpipeline.hdf.darkObsFile import ObsFile
+
+exportInfoDtype = np.dtype([('nPhotons', np.int64), ('sourceMTime', np.float64), ('chunkTicks', np.int64)])
+
+
+def getMemmapDir(fileName):
+    """Default export directory of an h5 file: <file without .h5>_memmap"""
+    return os.path.splitext(fileName)[0] + '_memmap'
+
+
+def exportMemmap(fileName, memmapDir=None, chunkSize=10000000):
+    """
+    Writes the PhotonTable columns, PixelIndex and TimeIndex of an h5 file to .npy files
+    (see the module docstring), replacing an existing export.
+
+    Parameters
+    ----------
+    fileName: string
+        h5 file with a /Photons/PixelIndex
+    memmapDir: string
+        output directory, getMemmapDir(fileName) if None
+    chunkSize: int
+        number of PhotonTable rows to read at a time
+
+    Returns
+    -------
+    memmapDir
+    """
+    if memmapDir is None:
+        memmapDir = getMemmapDir(fileName)
+    os.makedirs(memmapDir, exist_ok=True)
+    infoFile = os.path.join(memmapDir, 'exportInfo.npy')
+    if os.path.exists(infoFile):
+        os.remove(infoFile)  #written last, marks a complete export
+
+    with tables.open_file(fileName, mode='r') as hfile:
+        if '/Photons/PixelIndex' not in hfile:
+            raise ValueError('{} has no PixelIndex, run consolidatePhotonTables.py --index-only on it first'.format(fileName))
+        photonTable = hfile.root.Photons.PhotonTable
+        columns = {}
+        for col in photonTable.colnames:
+            columns[col] = np.lib.format.open_memmap(os.path.join(memmapDir, col + '.npy'), mode='w+',
+                                                     dtype=photonTable.coldtypes[col], shape=(int(photonTable.nrows),))
+        for chunkStart in range(0, photonTable.nrows, chunkSize):
+            photons = photonTable.read(chunkStart, chunkStart+chunkSize)
+            for col in columns:
+                columns[col][chunkStart:chunkStart+len(photons)] = photons[col]
+        for column in columns.values():
+            column.flush()
+        del columns
+
+        np.save(os.path.join(memmapDir, 'PixelIndex.npy'), hfile.root.Photons.PixelIndex.read())
+        chunkTicks = 0
+        timeIndexFile = os.path.join(memmapDir, 'TimeIndex.npy')
+        if '/Photons/TimeIndex' in hfile:
+            np.save(timeIndexFile, hfile.root.Photons.TimeIndex.read())
+            chunkTicks = int(hfile.root.Photons.TimeIndex.attrs.chunkTicks)
+        elif os.path.exists(timeIndexFile):
+            os.remove(timeIndexFile)
+        exportInfo = np.array([(photonTable.nrows, os.path.getmtime(fileName), chunkTicks)], dtype=exportInfoDtype)
+    np.save(infoFile, exportInfo)
+    return memmapDir
+
+
+class MemmapObsFile(ObsFile):
+    """
+    Read only ObsFile whose photons are read from an exportMemmap export (see the module
+    docstring). If the export doesn't exist it is made first.
+
+    Parameters
+    ----------
+    fileName: string
+        h5 file
+    memmapDir: string
+        export directory, getMemmapDir(fileName) if None
+    verbose, chunkSize:
+        see ObsFile
+    """
+
+    def __init__(self, fileName, memmapDir=None, verbose=False, chunkSize=None):
+        self.memmapDir = getMemmapDir(fileName) if memmapDir is None else memmapDir
+        if not os.path.exists(os.path.join(self.memmapDir, 'exportInfo.npy')):
+            exportMemmap(fileName, self.memmapDir)
+        super().__init__(fileName, mode='read', verbose=verbose, chunkSize=chunkSize)
+
+    def _loadPixelIndex(self):
+        """
+        Opens the exported column arrays (self.photonColumns) and loads the exported
+        PixelIndex and TimeIndex instead of the ones in the h5 file.
+        """
+        exportInfo = np.load(os.path.join(self.memmapDir, 'exportInfo.npy'))[0]
+        if os.path.getmtime(self.fullFileName) > exportInfo['sourceMTime']:
+            warnings.warn('{} was modified after it was exported to {}, run exportMemmap again if its photons '
+                          'changed'.format(self.fullFileName, self.memmapDir))
+        self.photonColumns = {}
+        for col in self.file.root.Photons.PhotonTable.colnames:
+            self.photonColumns[col] = np.load(os.path.join(self.memmapDir, col + '.npy'), mmap_mode='r')
+        self.nPhotons = int(exportInfo['nPhotons'])
+
+        self.timeIndex = None
+        self.timeIndexChunkTicks = None
+        timeIndex = None
+        if exportInfo['chunkTicks'] > 0:
+            timeIndex = np.load(os.path.join(self.memmapDir, 'TimeIndex.npy'), mmap_mode='r')
+        self._setPixelIndex(np.load(os.path.join(self.memmapDir, 'PixelIndex.npy')), timeIndex,
+                            exportInfo['chunkTicks'])
+
+    def _getPhotonDtype(self, columns=None):
+        """
+        Returns the dtype of a photon list with only the given columns (all columns if
+        columns is None)
+        """
+        if columns is None:
+            columns = self.photonColumns.keys()
+        return np.dtype([(col, self.photonColumns[col].dtype) for col in columns])
+
+    def _readRows(self, startRow, stopRow, columns=None, out=None):
+        """
+        Copies rows [startRow, stopRow) of the column arrays into a photon list (with only
+        the given columns, if columns isn't None)
+        """
+        stopRow = min(stopRow, self.nPhotons)
+        if out is None:
+            out = np.zeros(max(stopRow-startRow, 0), dtype=self._getPhotonDtype(columns))
+        for col in out.dtype.names:
+            out[col] = self.photonColumns[col][startRow:stopRow]
+        return out
+
+    def getPixelPhotonColumns(self, xCoord, yCoord, firstSec=0, integrationTime=-1, forceRawPhase=False,
+                              columns=None):
+        """
+        Returns the photons of a pixel as a dictionary of column arrays that are read only
+        slices of the memory-mapped columns (no copy is made, unless the pixel's photons aren't
+        time ordered and there's a time cut). Use getPixelPhotonList for wavelength cuts.
+
+        Parameters
+        ----------
+        xCoord, yCoord, firstSec, integrationTime, forceRawPhase:
+            see getPixelPhotonList()
+        columns: list of strings
+            columns to return, all of them if None
+
+        Returns
+        -------
+        Dictionary with a 1D array for each column
+        """
+        if columns is None:
+            columns = list(self.photonColumns.keys())
+        if self.pixelIsBad(xCoord, yCoord, not forceRawPhase) or firstSec>float(self.getFromHeader('expTime')):
+            return {col: self.photonColumns[col][:0] for col in columns}
+
+        startTime = int(firstSec*self.ticksPerSec) if firstSec>0 else 0
+        endTime = startTime + int(integrationTime*self.ticksPerSec) if integrationTime!=-1 else None
+        startRow = self.pixelStartRows[xCoord, yCoord]
+        stopRow = startRow + self.pixelNRows[xCoord, yCoord]
+        cutTime = startTime>0 or endTime is not None
+        if self.timeIndex is not None and cutTime and stopRow>startRow:
+            startChunk, stopChunk = self._getTimeIndexRows(startTime, endTime)
+            pixelIndexCol = self.pixelIndexCols[xCoord, yCoord]
+            startRow, stopRow = (startRow + int(self.timeIndex[startChunk, pixelIndexCol]),
+                                 startRow + int(self.timeIndex[stopChunk, pixelIndexCol]))
+
+        selection = slice(None)
+        if cutTime:
+            selection = self._getTimeSelection(self.photonColumns['Time'][startRow:stopRow], startTime, endTime)
+        return {col: self.photonColumns[col][startRow:stopRow][selection] for col in columns}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Export the PhotonTable of an h5 file to memory-mappable .npy files.')
+    parser.add_argument('fileName', help='h5 file with a PixelIndex')
+    parser.add_argument('memmapDir', nargs='?', default=None, help='Output directory (default <file>_memmap)')
+    parser.add_argument('--chunkSize', type=int, default=10000000, help='PhotonTable rows to read at a time')
+    args = parser.parse_args()
+    memmapDir = exportMemmap(args.fileName, args.memmapDir, args.chunkSize)
+    print('Exported {} to {}'.format(args.fileName, memmapDir))
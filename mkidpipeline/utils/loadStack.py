@@ -1,10 +1,9 @@
 import os
-import struct
 
 import numpy as np
 import tables
 
-from mkidpipeline.utils.parsePacketDump import parsePacketData
+from mkidpipeline.utils.parsePacketDump import makeImage, parseBinFile, parsePacketData, readBinWords
 
 """
 Utilities for loading sets of image stacks from either .IMG or .bin files
@@ -19,14 +18,7 @@ def loadIMGStack(dataDir, start, stop, nCols=80, nRows=125, verbose=True):
             if useImg==False:
                 imagePath = os.path.join(dataDir,str(ts)+'.bin')
                 print(imagePath)
-                with open(imagePath,'rb') as dumpFile:
-                    data = dumpFile.read()
-
-                nBytes = len(data)
-                nWords = nBytes/8 #64 bit words
-
-                #break into 64 bit words
-                words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),dtype=object)
+                words = readBinWords(imagePath)
                 parseDict = parsePacketData(words,verbose=False)
                 image = parseDict['image']
 
@@ -53,14 +45,7 @@ def loadBINStack(dataDir, start, stop, nCols=80, nRows=125):
             if useImg==False:
                 imagePath = os.path.join(dataDir,str(ts)+'.bin')
                 print(imagePath)
-                with open(imagePath,'rb') as dumpFile:
-                    data = dumpFile.read()
-
-                nBytes = len(data)
-                nWords = nBytes/8 #64 bit words
-
-                #break into 64 bit words
-                words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),dtype=object)
+                words = readBinWords(imagePath)
                 parseDict = parsePacketData(words,verbose=False)
                 image = parseDict['image']
 
@@ -85,21 +70,12 @@ def loadBINStack(dataDir, start, stop, nCols=80, nRows=125):
             if useImg==False:
                 imagePath = os.path.join(dataDir,str(ts)+'.bin')
                 print(imagePath)
-                with open(imagePath,'rb') as dumpFile:
-                    data = dumpFile.read()
-
-                nBytes = len(data)
-                nWords = nBytes/8 #64 bit words
-
-                #break into 64 bit words
-                words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),type=object)
-                parseDict = parsePacketData(words,verbose=False)
-                image = parseDict['image']
+                image = makeImage(parseBinFile(imagePath), nRows, nCols)
 
             else:
                 imagePath = os.path.join(dataDir,str(ts)+'.img')
                 print(imagePath)
-                image = np.fromfile(open(imagePath, mode='rb'),type=np.uint16)
+                image = np.fromfile(open(imagePath, mode='rb'),dtype=np.uint16)
                 image = np.transpose(np.reshape(image, (nCols, nRows)))
 
         
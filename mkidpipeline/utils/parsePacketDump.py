@@ -5,147 +5,196 @@ Author:    Matt Strader
 """
 
 import os
-import struct
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 from mkidpipeline.utils import binTools
-from mkidpipeline.utils.arrayPopup import plotArray
 
 nRows = 125
 nCols = 80
 
-def parsePacketData(words,verbose=False):
+fakePhotonWord = 2**63-1
+headerFirstByte = 0xff
+
+#header format: 8 bits all ones, 8 bits roach num, 12 bits frame num, ufix36_1 bit timestamp
+nBitsHdrTstamp = 36
+binPtHdrTstamp = 1
+nBitsHdrNum = 12
+nBitsHdrRoach = 8
+
+#photon format: 20 bits id, 9 bits ts, fix18_15 phase, fix17_14 base
+nBitsPhtId = 20
+nBitsXCoord = 10
+nBitsYCoord = 10
+nBitsPhtTstamp = 9
+nBitsPhtPhase = 18
+binPtPhtPhase = 15
+nBitsPhtBase = 17
+binPtPhtBase = 14
+
+#compact photon list returned by parseBinWords. timestamp is in microseconds:
+#header timestamp (0.5 ms ticks) + photon timestamp (us)
+photonDtype = np.dtype([('roach', np.uint8), ('frame', np.uint16), ('timestamp', np.uint64),
+                        ('x', np.uint16), ('y', np.uint16), ('phase', np.float32), ('baseline', np.float32)])
+
+
+def readBinWords(path, useMemmap=False):
+    """
+    Reads a .bin file as an array of big-endian 64 bit words.
+    If useMemmap, the file is memory mapped instead of read into memory.
+    """
+    if useMemmap:
+        return np.memmap(path, dtype='>u8', mode='r')
+    return np.fromfile(path, dtype='>u8')
+
+
+def _bitField(words, shift, nBits):
+    """
+    Extracts the nBits wide unsigned field starting shift bits from the LSB of each uint64 word
+    """
+    return (words >> np.uint64(shift)) & np.uint64(binTools.bitmask(nBits))
+
+
+def _signedFixedPoint(values, nBits, binaryPoint):
+    """
+    Vectorized binTools.reinterpretBin: converts nBits wide two's complement fixed point fields
+    with binaryPoint fractional bits to floats.
+    """
+    values = values.astype(np.int64)
+    values[values >= 2**(nBits-1)] -= 2**nBits
+    return values / 2.**binaryPoint
+
+
+def _splitWords(words):
+    """
+    Returns the indices of the headers and the real (non header, non fake) photons in words
+    """
+    firstBytes = _bitField(words, 64-8, 8)
+    isHeader = firstBytes == headerFirstByte
+    headerIdx = np.flatnonzero(isHeader)
+    realIdx = np.flatnonzero(~isHeader & (words != np.uint64(fakePhotonWord)))
+    return headerIdx, realIdx
+
+
+def parseBinWords(words):
+    """
+    Decodes the 64 bit words of a .bin file with vectorized uint64 masks and shifts.
+
+    Parameters
+    ----------
+    words: array of uint64
+        eg. from readBinWords()
+
+    Returns
+    -------
+    Structured numpy array with dtype photonDtype and one row per real photon:
+    roach and frame number of the photon's packet header, timestamp (us), x and y
+    coordinates and phase and baseline (degrees).
+    """
+    words = np.asarray(words, dtype=np.uint64)
+    headerIdx, realIdx = _splitWords(words)
+    headers = words[headerIdx]
+    realPhotons = words[realIdx]
 
-    nWords = len(words)
+    photons = np.zeros(len(realPhotons), dtype=photonDtype)
+    if len(headers) > 0:
+        #find each photon's corresponding header
+        photonsHeader = headers[np.searchsorted(headerIdx, realIdx)-1]
+        photons['roach'] = _bitField(photonsHeader, nBitsHdrNum+nBitsHdrTstamp, nBitsHdrRoach)
+        photons['frame'] = _bitField(photonsHeader, nBitsHdrTstamp, nBitsHdrNum)
+        photons['timestamp'] = _bitField(photonsHeader, 0, nBitsHdrTstamp) * np.uint64(1000//2**binPtHdrTstamp)
+
+    photons['timestamp'] += _bitField(realPhotons, nBitsPhtPhase+nBitsPhtBase, nBitsPhtTstamp)
+    pixelIds = _bitField(realPhotons, nBitsPhtTstamp+nBitsPhtPhase+nBitsPhtBase, nBitsPhtId)
+    photons['x'] = _bitField(pixelIds, nBitsYCoord, nBitsXCoord)
+    photons['y'] = _bitField(pixelIds, 0, nBitsYCoord)
+    photons['phase'] = 180./np.pi * _signedFixedPoint(_bitField(realPhotons, nBitsPhtBase, nBitsPhtPhase),
+                                                     nBitsPhtPhase, binPtPhtPhase)
+    photons['baseline'] = 180./np.pi * _signedFixedPoint(_bitField(realPhotons, 0, nBitsPhtBase),
+                                                        nBitsPhtBase, binPtPhtBase)
+    return photons
+
+
+def parseBinFile(path, useMemmap=False):
+    """
+    Reads and decodes a .bin file. Returns the photon list from parseBinWords()
+    """
+    return parseBinWords(readBinWords(path, useMemmap))
+
+
+def makeImage(photons, nRows=nRows, nCols=nCols):
+    """
+    Returns an (nRows, nCols) image of photon counts from a parseBinWords() photon list.
+    Photons with coordinates outside the image are ignored.
+    """
+    inImage = (photons['x'] < nCols) & (photons['y'] < nRows)
+    pixelInds = photons['y'][inImage].astype(np.int64)*nCols + photons['x'][inImage]
+    return np.bincount(pixelInds, minlength=nRows*nCols).reshape(nRows, nCols).astype(float)
 
-    fakePhotonWord = 2**63-1
-    headerFirstByte = 0xff
 
-    firstBytes = words >> (64-8)
+def parsePacketData(words,verbose=False):
+    """
+    Decodes the 64 bit words of a .bin file (see parseBinWords) and returns a dict with
+    the photons' basesDeg, phasesDeg, photonTimestamps (ms), pixelIds, xCoords and
+    yCoords, the raw photon and header words, the header roachNums and a count image.
+    """
+    words = np.asarray(words, dtype=np.uint64)
+    nWords = len(words)
     if verbose:
+        #the plots are only imported here, so the parser loads on hosts without a display
+        import matplotlib.pyplot as plt
         print(nWords,' words parsed')
-    headerIdx = np.where(firstBytes == headerFirstByte)[0]
-    headers = words[firstBytes == headerFirstByte]
-    if verbose:
-        print(len(headerIdx),'headers')
 
+    headerIdx, realIdx = _splitWords(words)
+    headers = words[headerIdx]
+    realPhotons = words[realIdx]
     if verbose:
+        print(len(headerIdx),'headers')
         fig,ax = plt.subplots(1,1)
         ax.plot(np.diff(headerIdx))
         ax.set_title('frame size')
         print(np.max(np.diff(headerIdx)),'max frame size')
+        print(np.count_nonzero(words == np.uint64(fakePhotonWord)),'fake photons')
 
-    fakeIdx = np.where(words == fakePhotonWord)[0]
-    if verbose:
-        print(len(fakeIdx),'fake photons')
-
-    #header format: 8 bits all ones, 8 bits roach num, 12 bits frame num, ufix36_1 bit timestamp
-    nBitsHdrTstamp = 36
-    binPtHdrTstamp = 1
-    nBitsHdrNum = 12
-    nBitsHdrRoach = 8
-
-    roachNumMask = binTools.bitmask(nBitsHdrRoach)
-    roachNums = (headers >> (nBitsHdrNum+nBitsHdrTstamp)) & roachNumMask
-    roachList = np.unique(roachNums)
+    roachNums = _bitField(headers, nBitsHdrNum+nBitsHdrTstamp, nBitsHdrRoach)
     if verbose:
         print(np.unique(roachNums))
-
-    frameNumMask = binTools.bitmask(nBitsHdrNum)
-    frameNums = (headers >> nBitsHdrTstamp) & frameNumMask
-    frameNumDiff = np.diff(frameNums)
-
-    #for roach in roachList:
-    #    frameNumsByRoach.append(frameNums[roachNums==roach])
-
-    nMissedFrames = np.sum(np.logical_and(frameNumDiff != 1,frameNumDiff != -((2**nBitsHdrNum) - 1)))
-    if verbose:
+        frameNums = _bitField(headers, nBitsHdrTstamp, nBitsHdrNum).astype(np.int64)
+        frameNumDiff = np.diff(frameNums)
+        nMissedFrames = np.sum(np.logical_and(frameNumDiff != 1,frameNumDiff != -((2**nBitsHdrNum) - 1)))
         fig,ax = plt.subplots(1,1)
         ax.plot(np.diff(frameNums))
         ax.set_title('frame nums')
         print(nMissedFrames,'missed frames')
+        print(len(realPhotons),'real photons parsed')
 
-
-    realIdx = np.where(np.logical_and(firstBytes != headerFirstByte, words != fakePhotonWord))[0]
-    realPhotons = words[realIdx]
-    nRealPhotons = len(realPhotons)
-    if verbose:
-        print(nRealPhotons,'real photons parsed')
-    #photon format: 20 bits id, 9 bits ts, fix18_15 phase, fix17_14 base
-    nBitsPhtId = 20
-    nBitsXCoord = 10
-    nBitsYCoord = 10
-    nBitsPhtTstamp = 9
-    nBitsPhtPhase = 18
-    binPtPhtPhase = 15
-    nBitsPhtBase = 17
-    binPtPhtBase = 14
-
-    #find each photon's corresponding header
-    photonIdMask = binTools.bitmask(nBitsPhtId)
-    pixelIds = (realPhotons >> (nBitsPhtTstamp+nBitsPhtPhase+nBitsPhtBase)) & photonIdMask
-    xMask = binTools.bitmask(nBitsXCoord)
-    yMask = binTools.bitmask(nBitsYCoord)
-
-    xCoords = (pixelIds >> nBitsYCoord) & xMask
-    yCoords = pixelIds & yMask
-    #selectId = 34
-    #selectMask = pixelIds==selectId
-    #realIdx = realIdx[selectMask]
-    #realPhotons = realPhotons[selectMask]
-
-    photonsHeaderIdx = np.searchsorted(headerIdx,realIdx)-1
-
-    photonsHeader = headers[photonsHeaderIdx]
-    #now get the timestamp from this
-    headerTimestampBitmask = int('1'*nBitsHdrTstamp,2)
-    headerTimestamps = ((headerTimestampBitmask & photonsHeader)/2.)
-
-    headerFrameNumBitmask = int('1'*nBitsHdrNum,2)
-    headerFrameNums = headerFrameNumBitmask & (photonsHeader>>nBitsHdrTstamp)
-
-    photonTimestampMask = binTools.bitmask(nBitsPhtTstamp)
-    photonTimestamps = (realPhotons >> (nBitsPhtPhase+nBitsPhtBase)) & photonTimestampMask
-
-    photonTimestamps = photonTimestamps*1.e-3 + headerTimestamps #convert us to ms
-    dt = np.diff(photonTimestamps)
+    photons = parseBinWords(words)
+    photonTimestamps = photons['timestamp']*1.e-3 #convert us to ms
     if verbose:
         fig,ax = plt.subplots(1,1)
         ax.plot(photonTimestamps)
         ax.set_title('timestamps')
 
-    phtPhaseMask = int('1'*nBitsPhtPhase,2)
-    phases = (realPhotons >> nBitsPhtBase) & phtPhaseMask
-    phasesDeg = 180./np.pi * binTools.reinterpretBin(phases,nBits=nBitsPhtPhase,binaryPoint=binPtPhtPhase)
-
-    phtBaseMask = int('1'*nBitsPhtBase,2)
-    bases = (realPhotons) & phtPhaseMask
-    basesDeg = 180./np.pi * binTools.reinterpretBin(bases,nBits=nBitsPhtBase,binaryPoint=binPtPhtBase)
-
-    image = np.zeros((nRows,nCols))
-    for x,y in zip(xCoords,yCoords):
-        image[y,x] += 1
-
-
-    return {'basesDeg':basesDeg,'phasesDeg':phasesDeg,'photonTimestamps':photonTimestamps,'pixelIds':pixelIds,'photons':realPhotons,'headers':headers,'roachNums':roachNums,'image':image,'xCoords':xCoords,'yCoords':yCoords}
+    pixelIds = _bitField(realPhotons, nBitsPhtTstamp+nBitsPhtPhase+nBitsPhtBase, nBitsPhtId)
+    phasesDeg = 180./np.pi * _signedFixedPoint(_bitField(realPhotons, nBitsPhtBase, nBitsPhtPhase),
+                                               nBitsPhtPhase, binPtPhtPhase)
+    basesDeg = 180./np.pi * _signedFixedPoint(_bitField(realPhotons, 0, nBitsPhtBase), nBitsPhtBase, binPtPhtBase)
+    return {'basesDeg':basesDeg,'phasesDeg':phasesDeg,
+            'photonTimestamps':photonTimestamps,'pixelIds':pixelIds,'photons':realPhotons,'headers':headers,
+            'roachNums':roachNums,'image':makeImage(photons),'xCoords':photons['x'],'yCoords':photons['y']}
 
 if __name__=='__main__':
+    import matplotlib.pyplot as plt
+    from mkidpipeline.utils.arrayPopup import plotArray
+
     if len(sys.argv) > 1:
         path = sys.argv[1]
     else:
         path = 'photonDump.bin'
 
     pathTstamp = os.path.splitext(os.path.basename(path))[0]
-    with open(path,'rb') as dumpFile:
-        data = dumpFile.read()
-
-    nBytes = len(data)
-    nWords = nBytes/8 #64 bit words
-    #break into 64 bit words
-    words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),dtype=object)
+    words = readBinWords(path)
 
     parseDict = parsePacketData(words,verbose=True)
 
@@ -9,7 +9,6 @@ TODO:
 """
 
 import os
-import struct
 import sys
 
 import matplotlib
@@ -19,7 +18,7 @@ from PyQt5 import QtCore, QtWidgets
 matplotlib.use('Qt5agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-from mkidpipeline.utils.parsePacketDump import parsePacketData
+from mkidpipeline.utils.parsePacketDump import makeImage, parseBinFile, parsePacketData, readBinWords
 from mkidpipeline.hotpix import darkHotPixMask as dhpm
 
 basePath = '/mnt/data0/ScienceData/'
@@ -185,16 +184,7 @@ class DarkQuick(QtWidgets.QMainWindow):
             try:
                 imagePath = os.path.join(self.dataPath,str(ts)+'.bin')
                 print(imagePath)
-                with open(imagePath,'rb') as dumpFile:
-                    data = dumpFile.read()
-
-                nBytes = len(data)
-                nWords = nBytes/8 #64 bit words
-                
-                #break into 64 bit words
-                words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),dtype=object)
-                parseDict = parsePacketData(words,verbose=False)
-                image = parseDict['image']
+                image = makeImage(parseBinFile(imagePath))
                 
                 if self.beammap is not None:
                     newImage = np.zeros(image.shape)
@@ -249,14 +239,7 @@ class DarkQuick(QtWidgets.QMainWindow):
             try:
                 imagePath = os.path.join(self.dataPath,str(ts)+'.bin')
                 print(imagePath)
-                with open(imagePath,'rb') as dumpFile:
-                    data = dumpFile.read()
-
-                nBytes = len(data)
-                nWords = nBytes//8 #64 bit words
-                
-                #break into 64 bit words
-                words = np.array(struct.unpack('>{:d}Q'.format(nWords), data),dtype=object)
+                words = readBinWords(imagePath)
                 parseDict = parsePacketData(words,verbose=False)
 
                 photonTimes = np.array(parseDict['photonTimestamps'])
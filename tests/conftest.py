@@ -0,0 +1,120 @@
+"""
+Shared fixtures: synthetic .bin files and beammaps in the format parsePacketDump decodes, and
+phase to energy data for the wavecal fits. Also makes darkObsFile importable without pyinterval.
+"""
+
+import calendar
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+try:
+    import interval
+except ImportError:
+    # pyinterval often doesn't build (it needs crlibm). darkObsFile only uses it for time masks,
+    # which the tests don't, so a stand-in that can make and compare intervals is enough to
+    # import ObsFile.
+    class _IntervalType(type):
+        def __getitem__(cls, bounds):
+            return cls(bounds)
+
+    class _Interval(metaclass=_IntervalType):
+        def __init__(self, *components):
+            self.components = components
+
+        def __eq__(self, other):
+            return isinstance(other, _Interval) and self.components == other.components
+
+    sys.modules['interval'] = types.SimpleNamespace(interval=_Interval)
+
+startTime = 1530000000  #after the firmware upgrade, so the photons are time sorted
+nXPix = 10
+nYPix = 8
+
+
+def writeBeammap(fileName, nXPix=nXPix, nYPix=nYPix):
+    """
+    Writes a beammap (ResID, flag, x, y) with ResIDs 1000 + x*nYPix + y. Pixel (0, 0) is
+    missing and pixel (1, 1) is flagged. Returns the (nXPix, nYPix) ResID array.
+    """
+    resIDs = (np.arange(nXPix*nYPix) + 1000).reshape(nXPix, nYPix)
+    with open(fileName, 'w') as f:
+        for x in range(nXPix):
+            for y in range(nYPix):
+                if (x, y) != (0, 0):
+                    f.write('{} {} {} {}\n'.format(resIDs[x, y], int((x, y) == (1, 1)), x, y))
+    return resIDs
+
+
+def writeBinFile(fileName, timestamp, rate=500, nRoaches=2, nXPix=nXPix, nYPix=nYPix, seed=0):
+    """
+    Writes one second of packets (2000 0.5 ms frames per roach, each a header word, photon
+    words and a fake photon word) with about rate photons per pixel per second.
+    """
+    rng = np.random.default_rng(seed)
+    yearStart = calendar.timegm((time.gmtime(timestamp).tm_year, 1, 1, 0, 0, 0))
+    words = []
+    for packet in range(2000):
+        for roach in range(nRoaches):
+            headerTime = (timestamp - yearStart)*2000 + packet
+            words.append(np.array([(0xff << 56) | (roach << 48) | ((packet % 4096) << 36) | headerTime],
+                                  dtype=np.uint64))
+            nPhotons = rng.poisson(rate*nXPix*nYPix/2000/nRoaches)
+            x = rng.integers(0, nXPix//nRoaches, nPhotons)*nRoaches + roach
+            y = rng.integers(0, nYPix, nPhotons)
+            photonTime = np.sort(rng.integers(0, 500, nPhotons))
+            phase = rng.integers(0, 2**18, nPhotons)
+            baseline = rng.integers(0, 2**17, nPhotons)
+            words.append(((x.astype(np.uint64) << np.uint64(54)) | (y.astype(np.uint64) << np.uint64(44)) |
+                          (photonTime.astype(np.uint64) << np.uint64(35)) |
+                          (phase.astype(np.uint64) << np.uint64(17)) | baseline.astype(np.uint64)))
+            words.append(np.array([2**63 - 1], dtype=np.uint64))
+    np.concatenate(words).astype('>u8').tofile(fileName)
+
+
+@pytest.fixture
+def binData(tmp_path):
+    """
+    Three seconds of .bin files and a beammap in tmp_path/bin. Returns a dict with binPath,
+    beamFile, startTime, nFiles, nXPix, nYPix and resIDs.
+    """
+    binPath = tmp_path/'bin'
+    binPath.mkdir()
+    resIDs = writeBeammap(str(binPath/'beammap.txt'))
+    nFiles = 3
+    for second in range(nFiles):
+        writeBinFile(str(binPath/'{}.bin'.format(startTime + second)), startTime + second, seed=second)
+    return {'binPath': str(binPath), 'beamFile': str(binPath/'beammap.txt'), 'startTime': startTime,
+            'nFiles': nFiles, 'nXPix': nXPix, 'nYPix': nYPix, 'resIDs': resIDs}
+
+
+def settleFiles(binPath, age=10):
+    """Sets the modification time of the .bin files age seconds into the past"""
+    past = time.time() - age
+    for fileName in os.listdir(binPath):
+        os.utime(os.path.join(binPath, fileName), (past, past))
+
+
+def makeEnergyData(fitType, nFits=30, seed=2):
+    """
+    Phases of three to five laser energies on random quadratic or linear energy solutions,
+    scattered by their errors
+    """
+    rng = np.random.default_rng(seed)
+    energy = np.array([1.53, 1.35, 1.26, 1.11, 0.95])
+    phases, energies, errors = [], [], []
+    for _ in range(nFits):
+        a = rng.uniform(-2e-5, 0) if fitType == 'quadratic' else 0
+        b = rng.uniform(-0.03, -0.012)
+        c = rng.uniform(-0.2, 0.3) if fitType != 'linear_zero' else 0
+        phase = np.array([np.roots([a, b, c - e])[-1].real if a else (e - c)/b for e in energy])
+        error = rng.uniform(0.05, 0.5, len(phase))
+        keep = np.sort(rng.permutation(len(phase))[:rng.integers(3, len(phase) + 1)])
+        phases.append((phase + rng.normal(0, 1, len(phase))*error)[keep])
+        energies.append(energy[keep])
+        errors.append(error[keep])
+    return phases, energies, errors
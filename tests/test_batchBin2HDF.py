@@ -0,0 +1,112 @@
+import os
+import stat
+import sys
+
+import numpy as np
+
+from mkidpipeline.hdf.batchBin2HDF import batchConvert, estimateJobMemory, getOutputFile, isValidOutput
+from mkidpipeline.hdf.bin2hdf import createObsFile
+from mkidpipeline.hdf.consolidatePhotonTables import createPhotonTable, writePixelIndex
+
+# stands in for Bin2HDF: writes a minimal complete output for its config file, logs its start
+# and end times, and fails for start times listed in the FAIL environment variable
+fakeBin2HDF = '''#!{python}
+import os, sys, time
+sys.path[:0] = [{testDir!r}, {repoDir!r}]
+from test_batchBin2HDF import writeOutput
+lines = open(sys.argv[1]).read().splitlines()
+startTime, nFiles, outPath = int(lines[2]), int(lines[3]), lines[6]
+with open(os.path.join(outPath, 'runs.log'), 'a') as f:
+    f.write('start {{}} {{}} {{}}\\n'.format(startTime, time.time(), lines[9]))
+time.sleep(0.3)
+fail = str(startTime) in os.environ.get('FAIL', '').split()
+if not fail:
+    writeOutput(os.path.join(outPath, '{{}}.h5'.format(startTime)), startTime, nFiles)
+with open(os.path.join(outPath, 'runs.log'), 'a') as f:
+    f.write('end {{}} {{}}\\n'.format(startTime, time.time()))
+sys.exit(int(fail))
+'''
+
+
+def writeOutput(fileName, startTime, nFiles, pixelIndex=True):
+    beamMap = np.arange(4, dtype=np.uint32).reshape(2, 2)
+    hfile = createObsFile(fileName, startTime, nFiles, '', '', beamMap, np.zeros_like(beamMap))
+    createPhotonTable(hfile, 0)
+    if pixelIndex:
+        writePixelIndex(hfile, [], [], [])
+    hfile.close()
+
+
+def makeConfig(tmp_path, startTimes, nFiles=2):
+    b2hPath = tmp_path/'b2h'
+    b2hPath.mkdir()
+    exe = b2hPath/'Bin2HDF'
+    testDir = os.path.dirname(os.path.abspath(__file__))
+    exe.write_text(fakeBin2HDF.format(python=sys.executable, testDir=testDir, repoDir=os.path.dirname(testDir)))
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    outPath = tmp_path/'out'
+    return {'xPix': 2, 'yPix': 2, 'binPath': str(tmp_path/'bin'), 'outPath': str(outPath),
+            'beamFile': 'beammap.txt', 'mapFlag': 1, 'b2hPath': str(b2hPath),
+            'jobs': [(startTime, nFiles) for startTime in startTimes]}
+
+
+def readRuns(outPath):
+    with open(os.path.join(outPath, 'runs.log')) as f:
+        return [line.split() for line in f]
+
+
+def maxRunning(runs):
+    events = sorted((float(run[2]), 1 if run[0]=='start' else -1) for run in runs)
+    return max(np.cumsum([change for _, change in events]))
+
+
+def test_isValidOutput(tmp_path):
+    fileName = str(tmp_path/'obs.h5')
+    assert not isValidOutput(fileName)
+    with open(fileName, 'w') as f:
+        f.write('not an h5 file')
+    assert not isValidOutput(fileName)
+    writeOutput(fileName, 1530000000, 5, pixelIndex=False)
+    assert not isValidOutput(fileName)
+    writeOutput(fileName, 1530000000, 5)
+    assert isValidOutput(fileName)
+    assert isValidOutput(fileName, 5)
+    assert not isValidOutput(fileName, 4)
+
+
+def test_estimateJobMemory_pixelBuffer(tmp_path):
+    (tmp_path/'1530000000.bin').write_bytes(bytes(8*1024**2))
+    small = estimateJobMemory(str(tmp_path), 1530000000, 1, pixelBufferMB=1)
+    large = estimateJobMemory(str(tmp_path), 1530000000, 1, pixelBufferMB=1024)
+    assert large - small == 1024**2*20 - 1024**2
+
+
+def test_batchConvert_pool_and_resume(tmp_path):
+    startTimes = [1530000000, 1530000010, 1530000020, 1530000030, 1530000040]
+    config = makeConfig(tmp_path, startTimes)
+    result = batchConvert(config, str(tmp_path/'work'), nProcs=2, memBudget=10*1024**3, pollInterval=0.05,
+                          pixelBufferMB=64)
+    assert sorted(result['converted']) == [getOutputFile(config['outPath'], t) for t in startTimes]
+    assert result['skipped'] == result['failed'] == []
+    runs = readRuns(config['outPath'])
+    assert maxRunning(runs) == 2
+    assert all(run[3]=='64' for run in runs if run[0]=='start')
+    assert os.path.isfile(os.path.join(str(tmp_path/'work'), str(startTimes[0]), 'Bin2HDF.log'))
+
+    # a rerun skips the complete outputs and converts the missing one
+    os.remove(getOutputFile(config['outPath'], startTimes[2]))
+    os.remove(os.path.join(config['outPath'], 'runs.log'))
+    result = batchConvert(config, str(tmp_path/'work'), nProcs=2, pollInterval=0.05)
+    assert result['converted'] == [getOutputFile(config['outPath'], startTimes[2])]
+    assert len(result['skipped']) == 4
+    assert [run[1] for run in readRuns(config['outPath']) if run[0]=='start'] == [str(startTimes[2])]
+
+
+def test_batchConvert_memory_budget_and_failures(tmp_path, monkeypatch):
+    startTimes = [1530000000, 1530000010, 1530000020]
+    config = makeConfig(tmp_path, startTimes)
+    monkeypatch.setenv('FAIL', str(startTimes[1]))
+    result = batchConvert(config, str(tmp_path/'work'), nProcs=3, memBudget=1, pollInterval=0.05)
+    assert result['failed'] == [getOutputFile(config['outPath'], startTimes[1])]
+    assert len(result['converted']) == 2
+    assert maxRunning(readRuns(config['outPath'])) == 1
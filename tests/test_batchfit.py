@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from conftest import makeEnergyData
+from mkidpipeline.calibration.batchfit import fitGaussianAndExp, fitPolynomial
+from mkidpipeline.calibration.wavecalplots import fitModels
+
+lm = pytest.importorskip('lmfit')
+
+parameters = ['a', 'b', 'c', 'd', 'f']
+
+
+def assertCovarClose(covar, reference, rtol=1e-3):
+    """Elementwise, relative to the standard deviations of the reference covariance"""
+    scale = np.sqrt(np.outer(np.diag(reference), np.diag(reference)))
+    assert np.all(np.abs(covar - reference) <= rtol*scale)
+
+
+def makeHistograms(nFits=40, seed=0):
+    """
+    Noisy gaussian_and_exp phase histograms with wavecal style guesses and bounds (see
+    WaveCal._setupFit). Returns centers, counts and a list of lm.Parameters.
+    """
+    rng = np.random.default_rng(seed)
+    fitFunction = fitModels('gaussian_and_exp')
+    centers, counts, setups = [], [], []
+    for _ in range(nFits):
+        x = np.arange(-150, -10, 2.0)
+        truth = [rng.uniform(20, 200), rng.uniform(0.01, 0.05), rng.uniform(200, 2000),
+                 rng.uniform(-110, -50), rng.uniform(5, 15)]
+        y = rng.poisson(fitFunction(x, *truth)).astype(float)
+        params = lm.Parameters()
+        params.add('a', value=truth[0]*rng.uniform(0.5, 2), min=0, max=np.inf)
+        params.add('b', value=0.03, min=-1, max=np.inf)
+        params.add('c', value=1.1*np.max(y)/2, min=0, max=1.1*np.max(y))
+        params.add('d', value=truth[3] + rng.uniform(-10, 10), min=np.min(x), max=0)
+        params.add('f', value=10, min=0.1, max=np.inf)
+        centers.append(x)
+        counts.append(y)
+        setups.append(params)
+    return centers, counts, setups
+
+
+def test_fitGaussianAndExp_matches_lmfit():
+    centers, counts, setups = makeHistograms()
+    result = fitGaussianAndExp(centers, counts, [[s[p].value for p in parameters] for s in setups],
+                               [[s[p].min for p in parameters] for s in setups],
+                               [[s[p].max for p in parameters] for s in setups],
+                               [[s[p].vary for p in parameters] for s in setups])
+    assert np.all(result['success'])
+    model = lm.Model(fitModels('gaussian_and_exp'))
+    for index, (x, y, setup) in enumerate(zip(centers, counts, setups)):
+        fit = model.fit(y, setup, x=x, weights=1/(np.sqrt(y + 0.25) + 0.5))
+        values = np.array([fit.best_values[p] for p in parameters])
+        assert np.allclose(result['values'][index], values, rtol=1e-5, atol=1e-8)
+        assert np.isclose(result['chi2'][index], fit.chisqr, rtol=1e-8)
+        assertCovarClose(result['covar'][index], fit.covar)
+
+
+def test_fitGaussianAndExp_independent_of_batch():
+    centers, counts, setups = makeHistograms(12, seed=3)
+    for index in range(0, 12, 3):
+        centers[index], counts[index] = centers[index][20:], counts[index][20:]
+        setups[index]['d'].min = np.min(centers[index])
+    arguments = [[[s[p].value for p in parameters] for s in setups],
+                 [[s[p].min for p in parameters] for s in setups],
+                 [[s[p].max for p in parameters] for s in setups],
+                 [[s[p].vary for p in parameters] for s in setups]]
+    result = fitGaussianAndExp(centers, counts, *arguments)
+    for index in range(12):
+        alone = fitGaussianAndExp(centers[index:index + 1], counts[index:index + 1],
+                                  *[argument[index:index + 1] for argument in arguments])
+        for key in result:
+            assert np.array_equal(result[key][index], alone[key][0]), key
+
+
+def test_fitGaussianAndExp_fixed_parameter_and_too_few_bins():
+    centers, counts, setups = makeHistograms(3, seed=1)
+    setups[0]['b'].vary = False
+    centers[2], counts[2] = centers[2][:4], counts[2][:4]
+    result = fitGaussianAndExp(centers, counts, [[s[p].value for p in parameters] for s in setups],
+                               [[s[p].min for p in parameters] for s in setups],
+                               [[s[p].max for p in parameters] for s in setups],
+                               [[s[p].vary for p in parameters] for s in setups])
+    assert list(result['success']) == [True, True, False]
+    assert result['values'][0][1] == 0.03
+    assert np.all(result['covar'][0][1] == 0) and np.all(result['covar'][0][:, 1] == 0)
+
+    fit = lm.Model(fitModels('gaussian_and_exp')).fit(counts[0], setups[0], x=centers[0],
+                                                       weights=1/(np.sqrt(counts[0] + 0.25) + 0.5))
+    assert np.allclose(result['values'][0], [fit.best_values[p] for p in parameters], rtol=1e-5)
+    varied = [parameters.index(p) for p in fit.var_names]
+    assertCovarClose(result['covar'][0][varied, :][:, varied], fit.covar)
+
+
+@pytest.mark.parametrize('fitType, powers', [('quadratic', [2, 1, 0]), ('linear', [1, 0]), ('linear_zero', [1])])
+def test_fitPolynomial_weighted_least_squares(fitType, powers):
+    phases, energies, errors = makeEnergyData(fitType)
+    # too few points for a quadratic
+    phases[0], energies[0], errors[0] = phases[0][:2], energies[0][:2], errors[0][:2]
+    result = fitPolynomial(phases, energies, errors, fitType)
+    assert result['success'][0] == (fitType != 'quadratic')
+    assert np.all(result['success'][1:])
+
+    fitted = [[2, 1, 0].index(power) for power in powers]
+    for index, (phase, energy, error) in enumerate(zip(phases, energies, errors)):
+        if not result['success'][index]:
+            continue
+        # the energy errors are the phase errors times the slope of the unweighted fit
+        design = phase[:, np.newaxis]**powers
+        guess = np.linalg.lstsq(design, energy, rcond=None)[0]
+        slope = sum(power*value*phase**(power - 1) for power, value in zip(powers, guess) if power > 0)
+        weights = 1/(slope*error)**2
+        values = np.linalg.lstsq(design*np.sqrt(weights)[:, np.newaxis], energy*np.sqrt(weights), rcond=None)[0]
+        assert np.allclose(result['values'][index][fitted], values, rtol=1e-8)
+        assert np.all(np.delete(result['values'][index], fitted) == 0)
+
+        chi2 = np.sum(weights*(design @ values - energy)**2)
+        assert np.isclose(result['chi2'][index], chi2, rtol=1e-8)
+        if len(phase) == len(powers):
+            assert np.all(result['covar'][index] == 0)
+            continue
+        covar = np.linalg.inv(design.T @ (weights[:, np.newaxis]*design))*chi2/(len(phase) - len(powers))
+        assertCovarClose(result['covar'][index][fitted, :][:, fitted], covar, rtol=1e-8)
@@ -0,0 +1,81 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import tables
+
+from mkidpipeline.hdf.batchBin2HDF import getOutputFile, writeBin2HDFConfig
+from mkidpipeline.hdf.bin2hdf import convert
+
+b2hSource = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mkidpipeline', 'hdf',
+                         'Bin2HDF.c')
+
+
+@pytest.fixture(scope='module')
+def bin2hdfExe(tmp_path_factory):
+    """Bin2HDF compiled with h5cc (see the top of Bin2HDF.c), skips the test if h5cc isn't installed"""
+    if shutil.which('h5cc') is None:
+        pytest.skip('h5cc is needed to compile Bin2HDF')
+    exeDir = tmp_path_factory.mktemp('b2h')
+    subprocess.run(['h5cc', '-O2', '-o', 'Bin2HDF', b2hSource, '-lhdf5_hl', '-lpthread', '-lm'], check=True,
+                   cwd=str(exeDir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return str(exeDir/'Bin2HDF')
+
+
+def readFile(fileName):
+    with tables.open_file(fileName) as f:
+        return {'photons': f.root.Photons.PhotonTable.read(),
+                'chunkshape': f.root.Photons.PhotonTable.chunkshape,
+                'pixelIndex': f.root.Photons.PixelIndex.read(),
+                'timeIndex': f.root.Photons.TimeIndex.read(),
+                'beamMap': f.root.BeamMap.Map.read(),
+                'beamFlag': f.root.BeamMap.Flag.read(),
+                'images': {name: f.get_node('/Images', name).read() for name in f.root.Images._v_children},
+                'expTime': f.root.header.header.cols.expTime[0]}
+
+
+def assertSameFile(file1, file2):
+    a, b = readFile(file1), readFile(file2)
+    assert len(a['photons']) == len(b['photons']) > 0
+    assert a['chunkshape'] == b['chunkshape']
+    assert np.array_equal(a['photons']['ResID'], b['photons']['ResID'])
+    assert np.array_equal(a['photons']['Time'], b['photons']['Time'])
+    assert np.allclose(a['photons']['Wavelength'], b['photons']['Wavelength'])
+    for key in ('pixelIndex', 'timeIndex', 'beamMap', 'beamFlag'):
+        assert np.array_equal(a[key], b[key]), key
+    assert a['images'].keys() == b['images'].keys()
+    assert all(np.array_equal(a['images'][name], b['images'][name]) for name in a['images'])
+    assert a['expTime'] == b['expTime']
+
+
+def test_convert_matches_Bin2HDF(binData, tmp_path, bin2hdfExe):
+    outPath = tmp_path/'b2h'
+    outPath.mkdir()
+    cfgFile = str(tmp_path/'Bin2HDF.cfg')
+    writeBin2HDFConfig(cfgFile, binData['nXPix'], binData['nYPix'], binData['binPath'], binData['startTime'],
+                       binData['nFiles'], binData['beamFile'], 1, str(outPath), pixelBufferMB=16)
+    subprocess.run([bin2hdfExe, cfgFile], check=True, stdout=subprocess.DEVNULL)
+
+    outFile = str(tmp_path/'python.h5')
+    result = convert(binData['binPath'], binData['startTime'], binData['nFiles'], binData['beamFile'], outFile,
+                     binData['nXPix'], binData['nYPix'])
+    assert result['missingFiles'] == []
+    assertSameFile(outFile, getOutputFile(str(outPath), binData['startTime']))
+
+
+def test_convert_through_scratch_file(binData, tmp_path):
+    args = (binData['binPath'], binData['startTime'], binData['nFiles'] + 1, binData['beamFile'])
+    inMemory = convert(*args, str(tmp_path/'memory.h5'), binData['nXPix'], binData['nYPix'])
+    scratch = convert(*args, str(tmp_path/'scratch.h5'), binData['nXPix'], binData['nYPix'], maxPhotons=0,
+                      nProcs=2)
+    assert inMemory['missingFiles'] == scratch['missingFiles'] == [binData['startTime'] + binData['nFiles']]
+    assert not os.path.exists(str(tmp_path/'scratch.h5.scratch'))
+    assertSameFile(str(tmp_path/'memory.h5'), str(tmp_path/'scratch.h5'))
+
+    photons = readFile(str(tmp_path/'memory.h5'))['photons']
+    assert np.all(np.diff(photons['ResID'].astype(np.int64)) >= 0)
+    sameResID = photons['ResID'][1:] == photons['ResID'][:-1]
+    assert np.all(np.diff(photons['Time'].astype(np.int64))[sameResID] >= 0)
+    assert not np.isin(binData['resIDs'][[0, 1], [0, 1]], photons['ResID']).any()
@@ -0,0 +1,61 @@
+import argparse
+
+import numpy as np
+import pytest
+import tables
+
+from mkidpipeline.hdf.bin2hdf import createObsFile
+from mkidpipeline.hdf.consolidatePhotonTables import (addLayoutArguments, createPhotonTable, defaultChunkRows,
+                                                      getLayoutArgs, getPhotonTableFilters, writePixelIndex,
+                                                      writeTimeIndex)
+
+
+def parseLayout(argv, chunkRows=True):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fileName')
+    addLayoutArguments(parser, chunkRows)
+    return parser.parse_args(argv)
+
+
+def test_default_layout_is_uncompressed():
+    filters, chunkRows = getLayoutArgs(parseLayout(['file.h5']))
+    assert filters.complevel == 0
+    assert chunkRows == defaultChunkRows
+
+
+def test_layout_options():
+    filters, chunkRows = getLayoutArgs(parseLayout(['--complib', 'blosc:lz4', '--complevel', '5', '--noshuffle',
+                                                    '--chunkrows', '8192', 'file.h5']))
+    assert (filters.complib, filters.complevel, filters.shuffle) == ('blosc:lz4', 5, False)
+    assert chunkRows == 8192
+    filters, _ = getLayoutArgs(parseLayout(['file.h5', '--complib', 'blosc:zstd', '--complevel', '3']))
+    assert (filters.complib, filters.shuffle) == ('blosc:zstd', True)
+
+
+@pytest.mark.parametrize('argv', [['file.h5', '--complib'], ['--level', '5', 'file.h5']])
+def test_bad_layout_options(argv):
+    with pytest.raises(SystemExit):
+        parseLayout(argv)
+
+
+def test_no_chunkrows_option():
+    with pytest.raises(SystemExit):
+        parseLayout(['--chunkrows', '10', 'file.h5'], chunkRows=False)
+    assert getLayoutArgs(parseLayout(['file.h5'], chunkRows=False))[1] == defaultChunkRows
+
+
+def test_timeIndex_uses_photonTable_filters(tmp_path):
+    beamMap = np.arange(4, dtype=np.uint32).reshape(2, 2)
+    hfile = createObsFile(str(tmp_path/'obs.h5'), 1530000000, 2, '', '', beamMap, np.zeros_like(beamMap))
+    photonTable = createPhotonTable(hfile, 100, getPhotonTableFilters('zlib', 1), 1024)
+    photons = np.zeros(100, dtype=photonTable.dtype)
+    photons['ResID'] = np.repeat(np.arange(4), 25)
+    photons['Time'] = np.tile(np.arange(25)*80000, 4)
+    photonTable.append(photons)
+    writePixelIndex(hfile, np.arange(4), np.arange(4)*25, np.full(4, 25))
+    writeTimeIndex(hfile)
+    timeIndex = hfile.root.Photons.TimeIndex
+    assert (timeIndex.filters.complib, timeIndex.filters.complevel) == ('zlib', 1)
+    assert timeIndex.shape == (21, 4)
+    assert np.all(timeIndex[:, 0] == np.append(np.ceil(np.arange(20)*100000/80000), 25))
+    hfile.close()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import tables
+
+from mkidpipeline.hdf.bin2hdf import createObsFile
+from mkidpipeline.hdf.consolidatePhotonTables import createPhotonTable, writePixelIndex, writeTimeIndex
+from mkidpipeline.hdf.correctUnsortedTimestamps import correctPhotonTableTimestamps, correctTimeStamps
+
+
+def test_minimal_correction():
+    # the iterative correction before the linear time version gave [1007, 1504, 1506, 2018]
+    assert np.array_equal(correctTimeStamps([1007, 1004, 1506, 1018]), [1007, 1504, 1506, 1518])
+
+
+def test_corrected_times_are_sorted():
+    rng = np.random.default_rng(0)
+    timestamps = np.sort(rng.integers(0, 100, 1000))*500 + rng.integers(0, 500, 1000)
+    corrected = correctTimeStamps(timestamps)
+    assert corrected.dtype == np.uint32
+    assert np.all(np.diff(corrected.astype(np.int64)) >= 0)
+    assert np.all(corrected%500 == timestamps%500)
+    assert np.all(corrected >= timestamps)
+
+
+def writeConsolidatedFile(fileName, pixelTimes):
+    """A consolidated PhotonTable with pixelTimes[i] (in packet order) as the photons of ResID i"""
+    beamMap = np.arange(len(pixelTimes), dtype=np.uint32).reshape(-1, 1)
+    hfile = createObsFile(fileName, 1500000000, 1, '', '', beamMap, np.zeros_like(beamMap))
+    photonTable = createPhotonTable(hfile, sum(len(times) for times in pixelTimes))
+    photons = np.zeros(sum(len(times) for times in pixelTimes), dtype=photonTable.dtype)
+    photons['ResID'] = np.repeat(np.arange(len(pixelTimes)), [len(times) for times in pixelTimes])
+    photons['Time'] = np.concatenate(pixelTimes)
+    photonTable.append(photons)
+    nRows = np.array([len(times) for times in pixelTimes])
+    hasPhotons = nRows > 0
+    writePixelIndex(hfile, np.arange(len(pixelTimes))[hasPhotons], (np.cumsum(nRows) - nRows)[hasPhotons],
+                    nRows[hasPhotons])
+    hfile.close()
+
+
+@pytest.mark.parametrize('chunkSize', [7, 1, 10000000])
+def test_correctPhotonTableTimestamps(tmp_path, chunkSize):
+    rng = np.random.default_rng(1)
+    pixelTimes = [np.sort(rng.integers(0, 2000, n))*500 + rng.integers(0, 500, n) for n in (50, 0, 1, 23, 7, 120)]
+    fileName = str(tmp_path/'obs.h5')
+    writeConsolidatedFile(fileName, pixelTimes)
+    with tables.open_file(fileName, mode='a') as hfile:
+        correctPhotonTableTimestamps(hfile, chunkSize)
+    with tables.open_file(fileName) as hfile:
+        times = hfile.root.Photons.PhotonTable.col('Time')
+        timeIndex = hfile.root.Photons.TimeIndex.read()
+    assert np.array_equal(times, np.concatenate([correctTimeStamps(t) for t in pixelTimes]))
+
+    # the TimeIndex is that of the corrected times
+    fileName = str(tmp_path/'corrected.h5')
+    writeConsolidatedFile(fileName, [correctTimeStamps(t) for t in pixelTimes])
+    with tables.open_file(fileName, mode='a') as hfile:
+        writeTimeIndex(hfile)
+        assert np.array_equal(timeIndex, hfile.root.Photons.TimeIndex.read())
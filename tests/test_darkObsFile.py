@@ -0,0 +1,299 @@
+import numpy as np
+import pytest
+import tables
+
+pytest.importorskip('regions')
+
+from mkidpipeline.core.headers import FlatCalSoln_Description, WaveCalDescription
+from mkidpipeline.core.pixelflags import h5FileFlags
+from mkidpipeline.hdf.bin2hdf import convert
+from mkidpipeline.hdf.darkObsFile import ObsFile
+
+# (firstSec, integrationTime) windows, in and across the TimeIndex chunks of one second
+windows = [(0, -1), (0.5, 1), (1, 1), (1.2, 0.0001), (1.9999, 1.5), (2.5, -1), (0, 5), (1, 0)]
+
+
+@pytest.fixture
+def obsFileName(binData, tmp_path):
+    fileName = str(tmp_path/'obs.h5')
+    convert(binData['binPath'], binData['startTime'], binData['nFiles'], binData['beamFile'], fileName,
+            binData['nXPix'], binData['nYPix'])
+    return fileName
+
+
+@pytest.fixture
+def obsFile(obsFileName):
+    obs = ObsFile(obsFileName)
+    yield obs
+    obs.file.close()
+
+
+def setRandomWeights(fileName, seed=0):
+    """Random SpecWeight and NoiseWeight columns, so that weighted and plain counts differ"""
+    rng = np.random.default_rng(seed)
+    with tables.open_file(fileName, mode='a') as f:
+        photonTable = f.root.Photons.PhotonTable
+        for column in ('SpecWeight', 'NoiseWeight'):
+            photonTable.modify_column(column=rng.uniform(0, 1, photonTable.nrows), colname=column)
+
+
+def selectPhotons(photons, firstSec=0, integrationTime=-1, resID=None):
+    """The photons of the window (and ResID), found without any of the indexes"""
+    startTime = int(firstSec*10**6)
+    keep = photons['Time'] >= startTime
+    if integrationTime != -1:
+        keep &= photons['Time'] < startTime + int(integrationTime*10**6)
+    if resID is not None:
+        keep &= photons['ResID'] == resID
+    return photons[keep]
+
+
+def test_pixelCountImage(obsFileName):
+    setRandomWeights(obsFileName)
+    for chunkSize in (None, 1000):
+        obs = ObsFile(obsFileName, chunkSize=chunkSize)
+        photons = obs.photonTable.read()
+        for firstSec, integrationTime in windows:
+            window = selectPhotons(photons, firstSec, integrationTime)
+            totInt = 3 - firstSec if integrationTime == -1 else integrationTime
+            for applyWeight, applyTPFWeight in [(False, False), (True, False), (True, True)]:
+                weights = np.ones(len(window))
+                if applyWeight:
+                    weights *= window['SpecWeight']
+                if applyTPFWeight:
+                    weights *= window['NoiseWeight']
+                expected = np.full((obs.nXPix, obs.nYPix), np.nan)
+                for (x, y), resID in np.ndenumerate(obs.beamImage):
+                    if (x, y) not in [(0, 0), (1, 1)]:
+                        expected[x, y] = np.sum(weights[window['ResID'] == resID])
+                result = obs.getPixelCountImage(firstSec, integrationTime, applyWeight=applyWeight,
+                                                applyTPFWeight=applyTPFWeight)
+                assert np.allclose(result['image'], expected, rtol=1e-10, equal_nan=True)
+                assert np.all(result['effIntTimes'][np.isfinite(expected)] == totInt)
+                assert np.all(result['effIntTimes'][np.isnan(expected)] == 0)
+
+        # (1, 1) is flagged (noDacTone) and has no photons, (0, 0) has no ResID
+        image = obs.getPixelCountImage(0.5, 1, applyWeight=False, flagToUse=h5FileFlags['noDacTone'])['image']
+        assert image[1, 1] == 0 and np.isnan(image[0, 0])
+        assert np.array_equal(image, obs.getPixelCountImage(0.5, 1, applyWeight=False, scaleByEffInt=True,
+                                                            flagToUse=h5FileFlags['noDacTone'])['image'],
+                              equal_nan=True)
+        assert np.nansum(image) > 0
+        obs.file.close()
+
+
+def test_spectralCube(obsFileName):
+    setRandomWeights(obsFileName, seed=1)
+    obs = ObsFile(obsFileName)
+    photons = obs.photonTable.read()
+    wvlBinEdges = np.percentile(photons['Wavelength'], [5, 20, 50, 60, 95])
+    wvlBinEdges[-1] = photons['Wavelength'].max()  # the last bin includes its upper edge
+    for firstSec, integrationTime in [(0, -1), (0.5, 1), (1, 1.5)]:
+        window = selectPhotons(photons, firstSec, integrationTime)
+        for applySpecWeight, applyTPFWeight in [(False, False), (True, True)]:
+            weights = np.ones(len(window))
+            if applySpecWeight:
+                weights *= window['SpecWeight']
+            if applyTPFWeight:
+                weights *= window['NoiseWeight']
+            result = obs.getSpectralCube(firstSec, integrationTime, applySpecWeight, applyTPFWeight,
+                                         wvlBinEdges=wvlBinEdges)
+            assert np.array_equal(result['wvlBinEdges'], wvlBinEdges)
+            for (x, y), resID in np.ndenumerate(obs.beamImage):
+                inPixel = window['ResID'] == resID
+                spectrum, _ = np.histogram(window['Wavelength'][inPixel], wvlBinEdges, weights=weights[inPixel])
+                assert np.allclose(result['cube'][x, y], spectrum, rtol=1e-10)
+                assert result['rawCounts'][x, y] == np.count_nonzero(inPixel)
+    assert result['cube'].sum() > 0
+
+    # flagged pixels are zeroed unless flagToUse includes their flags
+    obs.file.close()
+    obs = ObsFile(obsFileName, mode='write')
+    obs.applyFlag(4, 3, h5FileFlags['beamMapFailed'])
+    assert not obs.getSpectralCube(wvlBinEdges=wvlBinEdges)['cube'][4, 3].any()
+    assert obs.getSpectralCube(wvlBinEdges=wvlBinEdges, flagToUse=h5FileFlags['beamMapFailed'])['cube'][4, 3].any()
+    obs.file.close()
+
+
+def test_pixelPhotonList_through_pixelIndex(obsFile):
+    photons = obsFile.photonTable.read()
+    assert obsFile.pixelNRows is not None
+    obsFile.timeIndex = None
+    wvlStart, wvlStop = np.percentile(photons['Wavelength'], [20, 70])
+    pixels = [(0, 0), (1, 1), (0, 1), (4, 3), (9, 7)]
+    indexed = {}
+    for firstSec, integrationTime in windows:
+        for x, y in pixels:
+            expected = selectPhotons(photons, firstSec, integrationTime, obsFile.beamImage[x, y])
+            indexed[x, y, firstSec, integrationTime] = obsFile.getPixelPhotonList(x, y, firstSec, integrationTime)
+            assert np.array_equal(indexed[x, y, firstSec, integrationTime], expected)
+            photonList = obsFile.getPixelPhotonList(x, y, firstSec, integrationTime, wvlStart, wvlStop,
+                                                    columns=['Time'])
+            inRange = (expected['Wavelength'] >= wvlStart) & (expected['Wavelength'] < wvlStop)
+            assert photonList.dtype.names == ('Time',)
+            assert np.array_equal(photonList['Time'], expected['Time'][inRange])
+    assert len(indexed[4, 3, 0, -1]) > 0
+
+    # the same as a table query
+    obsFile.pixelNRows = None
+    for firstSec, integrationTime in windows:
+        for x, y in pixels:
+            assert np.array_equal(obsFile.getPixelPhotonList(x, y, firstSec, integrationTime),
+                                  indexed[x, y, firstSec, integrationTime])
+
+
+def test_windowed_reads_through_timeIndex(obsFile):
+    photons = obsFile.photonTable.read()
+    assert obsFile.timeIndex is not None
+    for firstSec, integrationTime in windows:
+        for x, y in [(0, 1), (4, 3), (9, 7)]:
+            expected = selectPhotons(photons, firstSec, integrationTime, obsFile.beamImage[x, y])
+            assert np.array_equal(obsFile.getPixelPhotonList(x, y, firstSec, integrationTime), expected)
+
+    withIndex = {window: obsFile.getPixelCountImage(*window)['image'] for window in windows}
+    frames = list(obsFile.iterTimeFrames(0.5, 2.75, 0.5))
+    assert [frameStart for frameStart, _ in frames] == [0.5, 1.0, 1.5, 2.0, 2.5]
+    obsFile.timeIndex = None
+    for window in windows:
+        assert np.array_equal(withIndex[window], obsFile.getPixelCountImage(*window)['image'], equal_nan=True)
+    noIndexFrames = list(obsFile.iterTimeFrames(0.5, 2.75, 0.5))
+    assert len(frames) == len(noIndexFrames)
+    for (frameStart, photonList), (noIndexStart, noIndexList) in zip(frames, noIndexFrames):
+        assert frameStart == noIndexStart
+        photonList = np.sort(photonList, order=['ResID', 'Time'])
+        assert np.array_equal(photonList, np.sort(noIndexList, order=['ResID', 'Time']))
+        expected = selectPhotons(photons, frameStart, min(0.5, 2.75 - frameStart))
+        assert np.array_equal(photonList, np.sort(expected, order=['ResID', 'Time']))
+        assert len(photonList) > 0
+
+
+def test_batchedPixelPhotonList(obsFile):
+    photons = obsFile.photonTable.read()
+    posList = [(x, y) for x in range(obsFile.nXPix) for y in range(obsFile.nYPix)][::-3]
+    nPhotons = 0
+    for firstSec, integrationTime in windows:
+        batch = obsFile.getBatchedPixelPhotonList(posList, firstSec, integrationTime, maxGap=10)
+        views = obsFile.getBatchedPixelPhotonList(posList, firstSec, integrationTime, returnViews=True)
+        for i, (x, y) in enumerate(posList):
+            expected = selectPhotons(photons, firstSec, integrationTime, obsFile.beamImage[x, y])
+            assert np.array_equal(batch['photonList'][batch['offsets'][i]:batch['offsets'][i+1]], expected)
+            assert np.array_equal(views[i], expected)
+        nPhotons += len(batch['photonList'])
+    assert nPhotons > 0
+
+
+def writeWaveCal(fileName, beamImage, polyfit, waveFlags):
+    """A wavecal solution file with one calsoln row for each pixel that has a ResID"""
+    with tables.open_file(fileName, mode='w') as f:
+        group = f.create_group('/', 'wavecal')
+        calsoln = f.create_table(group, 'calsoln', WaveCalDescription(3))
+        rows = np.zeros(beamImage.size, dtype=calsoln.dtype)
+        rows['pixel_row'], rows['pixel_col'] = np.indices(beamImage.shape).reshape(2, -1)
+        rows['resid'] = beamImage.flatten()
+        rows['wave_flag'] = waveFlags.flatten()
+        rows['polyfit'] = polyfit.reshape(-1, 3)
+        calsoln.append(rows[rows['resid'] != 2**32 - 1])
+
+
+def makeWaveCal(obsFileName, fileName):
+    """
+    Random energy solutions (positive for all of the phases) with wave_flag 4 or 5, except for
+    the failed fit of pixel (4, 3)
+    """
+    with tables.open_file(obsFileName) as f:
+        beamImage = f.root.BeamMap.Map.read()
+    rng = np.random.default_rng(2)
+    polyfit = np.stack([rng.uniform(-2e-6, 2e-6, beamImage.shape), rng.uniform(-3e-3, -1e-3, beamImage.shape),
+                        rng.uniform(1.1, 1.3, beamImage.shape)], axis=-1)
+    waveFlags = rng.choice([4, 5], beamImage.shape)
+    waveFlags[4, 3] = 7
+    writeWaveCal(fileName, beamImage, polyfit, waveFlags)
+    return polyfit
+
+
+def test_applyWaveCal_bulk(obsFileName, tmp_path):
+    polyfit = makeWaveCal(obsFileName, str(tmp_path/'wavecal.h5'))
+    perPixelFile = str(tmp_path/'perPixel.h5')
+    with tables.open_file(obsFileName) as f:
+        f.copy_file(perPixelFile)
+        phases = f.root.Photons.PhotonTable.col('Wavelength')
+        resIDs = f.root.Photons.PhotonTable.col('ResID')
+
+    obs = ObsFile(obsFileName, mode='write')
+    obs.applyWaveCal(str(tmp_path/'wavecal.h5'), bulk=True, chunkSize=1000)
+    wavelengths = obs.photonTable.col('Wavelength')
+    flags = obs.beamFlagImage.read()
+    assert obs.getFromHeader('isWvlCalibrated')
+    obs.file.close()
+
+    for (x, y), resID in np.ndenumerate(obs.beamImage):
+        inPixel = resIDs == resID
+        if (x, y) == (4, 3):
+            assert np.array_equal(wavelengths[inPixel], phases[inPixel]) and inPixel.any()
+        else:
+            expected = ObsFile.h*ObsFile.c/np.polyval(polyfit[x, y], phases[inPixel])*1e9
+            assert np.allclose(wavelengths[inPixel], expected.astype(np.float32), rtol=1e-6)
+    assert flags[4, 3] & 0b10 and flags[0, 0] & 0b10 and not flags[0, 1] & 0b10
+
+    # what the pixel by pixel version gives
+    obs = ObsFile(perPixelFile, mode='write')
+    obs.applyWaveCal(str(tmp_path/'wavecal.h5'), bulk=False)
+    assert np.array_equal(obs.photonTable.col('Wavelength'), wavelengths)
+    assert np.array_equal(obs.beamFlagImage.read(), flags)
+    obs.file.close()
+
+
+def writeFlatCal(fileName, resIDs, weights, wvlBinEdges):
+    with tables.open_file(fileName, mode='w') as f:
+        group = f.create_group('/', 'flatcal')
+        f.create_array(group, 'wavelengthBins', wvlBinEdges)
+        calsoln = f.create_table(group, 'calsoln', FlatCalSoln_Description(len(wvlBinEdges) - 1))
+        rows = np.zeros(len(resIDs), dtype=calsoln.dtype)
+        rows['resid'] = resIDs
+        rows['weights'] = weights
+        calsoln.append(rows)
+
+
+def test_applyFlatCal(obsFileName, tmp_path):
+    makeWaveCal(obsFileName, str(tmp_path/'wavecal.h5'))
+    obs = ObsFile(obsFileName, mode='write')
+    obs.applyWaveCal(str(tmp_path/'wavecal.h5'))
+    # pixel (4, 3) failed the wavecal fit (see makeWaveCal) and (9, 7) is flagged waveCalFailed
+    obs.applyFlag(9, 7, h5FileFlags['waveCalFailed'])
+    obs.file.close()
+    with tables.open_file(obsFileName) as f:
+        photons = f.root.Photons.PhotonTable.read()
+        beamImage = f.root.BeamMap.Map.read()
+
+    # two solution files, pixel (0, 1) only in the second one and (2, 5) in neither
+    rng = np.random.default_rng(3)
+    wvlBinEdges = np.linspace(700, 1500, 9)
+    resIDs = beamImage.flatten()
+    resIDs = resIDs[(resIDs != 2**32 - 1) & (resIDs != beamImage[2, 5])]
+    weights = [rng.uniform(0.5, 1.5, (len(resIDs), 8)) for _ in range(2)]
+    writeFlatCal(str(tmp_path/'flat1.h5'), resIDs[resIDs != beamImage[0, 1]], weights[0][resIDs != beamImage[0, 1]],
+                 wvlBinEdges)
+    writeFlatCal(str(tmp_path/'flat2.h5'), resIDs, weights[1], wvlBinEdges)
+
+    obs = ObsFile(obsFileName, mode='write', chunkSize=1000)
+    obs.applyFlatCal(str(tmp_path/'flat.h5'))
+    specWeights = obs.photonTable.col('SpecWeight')
+    assert obs.getFromHeader('isSpecCalibrated')
+    obs.file.close()
+
+    bins = np.concatenate((np.arange(0, 700, 100), wvlBinEdges, np.arange(1600, 2100, 100)))
+    for (x, y), resID in np.ndenumerate(beamImage):
+        inPixel = photons['ResID'] == resID
+        if (x, y) in [(0, 0), (1, 1), (2, 5), (9, 7)]:
+            assert np.array_equal(specWeights[inPixel], photons['SpecWeight'][inPixel])
+            continue
+        solutions = [w[resIDs == resID][0] for w in weights if (x, y) != (0, 1) or w is weights[1]]
+        coeffs = np.mean([np.polyfit(bins, np.concatenate((np.ones(7), w, np.ones(6))), 10) for w in solutions],
+                         axis=0)
+        wavelengths = photons['Wavelength'][inPixel]
+        expected = np.polyval(coeffs, wavelengths)
+        expected[(wavelengths < 700) | (wavelengths > 1500)] = 0
+        assert np.allclose(specWeights[inPixel], expected.astype(np.float32), rtol=1e-5, atol=1e-6)
+    inPixel = photons['ResID'] == beamImage[9, 7]
+    assert inPixel.any() and np.all(specWeights[inPixel] == 1)
+    assert np.any(specWeights == 0) and np.any((specWeights > 0) & (specWeights != 1))
@@ -0,0 +1,32 @@
+import numpy as np
+import tables
+
+from conftest import settleFiles
+from mkidpipeline.hdf.liveBin2HDF import LiveBin2HDF
+
+
+def test_watch_stops_after_nFiles(binData, tmp_path):
+    settleFiles(binData['binPath'])
+    outFile = str(tmp_path/'live.h5')
+    live = LiveBin2HDF(binData['binPath'], outFile, binData['beamFile'], binData['startTime'],
+                       binData['nXPix'], binData['nYPix'])
+    live.watch(nFiles=2, pollTime=0, settleTime=0, timeout=0)
+    assert live.nextTime == binData['startTime'] + 2
+    assert live.liveIndex.nrows == 2
+    live.finalize()
+
+    with tables.open_file(outFile) as f:
+        photons = f.root.Photons.PhotonTable.read()
+        assert f.root.header.header.cols.expTime[0] == 2
+    assert len(photons) == live.nPhotons > 0
+    assert np.all(photons['Time'] < 2*10**6)
+
+
+def test_update_adds_complete_files(binData, tmp_path):
+    settleFiles(binData['binPath'])
+    live = LiveBin2HDF(binData['binPath'], str(tmp_path/'live.h5'), binData['beamFile'], binData['startTime'],
+                       binData['nXPix'], binData['nYPix'])
+    assert live.update(settleTime=0, stopTime=binData['startTime'] + 1) == 1
+    assert live.update(settleTime=0) == binData['nFiles'] - 1
+    assert live.update(settleTime=0) == 0
+    live.finalize()
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import tables
+
+from mkidpipeline.calibration.phasecache import PhaseCache, PhaseCacheWriter, getCacheFile
+
+
+def test_getCacheFile_key(tmp_path):
+    laserFile = tmp_path/'laser'/'1530000000.h5'
+    laserFile.parent.mkdir()
+    laserFile.write_bytes(b'\0'*100)
+    cacheDirectory = str(tmp_path/'cache')
+    cacheFile = getCacheFile(cacheDirectory, str(laserFile), 1e-5)
+    assert os.path.dirname(cacheFile) == cacheDirectory
+    assert os.path.basename(cacheFile).startswith('1530000000_') and cacheFile.endswith('.h5')
+    assert getCacheFile(cacheDirectory, str(laserFile), 1e-5) == cacheFile
+
+    # a new file for a new dt, laser file size or modification time
+    assert getCacheFile(cacheDirectory, str(laserFile), 2e-5) != cacheFile
+    stat = os.stat(str(laserFile))
+    os.utime(str(laserFile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    touched = getCacheFile(cacheDirectory, str(laserFile), 1e-5)
+    assert touched != cacheFile
+    laserFile.write_bytes(b'\0'*101)
+    os.utime(str(laserFile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert getCacheFile(cacheDirectory, str(laserFile), 1e-5) not in (cacheFile, touched)
+
+    # and for a laser file with the same name in another directory
+    otherFile = tmp_path/'1530000000.h5'
+    otherFile.write_bytes(b'\0'*101)
+    os.utime(str(otherFile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert getCacheFile(cacheDirectory, str(otherFile), 1e-5) != getCacheFile(cacheDirectory, str(laserFile), 1e-5)
+
+
+def test_PhaseCache_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    cacheFile = str(tmp_path/'cache'/'laser_key.h5')
+    writer = PhaseCacheWriter(cacheFile, 3, 4, str(tmp_path/'laser.h5'), 1e-5)
+    pixels = [[(0, 1), (2, 3), (1, 0)], [(0, 0), (2, 0)]]
+    phases = [[-rng.uniform(10, 100, 50), np.array([]), -rng.uniform(10, 100, 7)],
+              [-rng.uniform(10, 100, 3), -rng.uniform(10, 100, 200)]]
+    nPhotons = [[60, 1, 9], [3, 250]]
+    rates = [[1200.5, None, 30.25], [8.0, 5000.0]]
+    for block in range(2):
+        writer.addPixels(pixels[block], phases[block], nPhotons[block], rates[block])
+    writer.addPixels([], [], [], [])
+    # the file only gets its name when it's complete
+    assert not os.path.exists(cacheFile)
+    writer.close()
+    assert os.listdir(os.path.dirname(cacheFile)) == ['laser_key.h5']
+
+    with tables.open_file(cacheFile) as f:
+        assert f.root._v_attrs.source_file == str(tmp_path/'laser.h5')
+        assert f.root._v_attrs.dt == 1e-5
+    cache = PhaseCache(cacheFile)
+    try:
+        for block in range(2):
+            for pixel, pixelPhases, n, rate in zip(pixels[block], phases[block], nPhotons[block], rates[block]):
+                cached, cachedN, cachedRate = cache.getPixelPhases(*pixel)
+                assert cached.dtype == np.float32
+                assert np.array_equal(cached, pixelPhases.astype(np.float32))
+                assert cachedN == n
+                assert np.isnan(cachedRate) if rate is None else cachedRate == rate
+        # pixels that weren't added have no phases
+        cached, cachedN, cachedRate = cache.getPixelPhases(1, 1)
+        assert len(cached) == 0 and cachedN == 0 and np.isnan(cachedRate)
+    finally:
+        cache.close()
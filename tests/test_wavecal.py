@@ -0,0 +1,238 @@
+import types
+
+import numpy as np
+import pytest
+import tables
+
+pytest.importorskip('regions')
+
+from conftest import makeEnergyData
+from mkidpipeline.calibration.wavecal import WaveCal, findRefitPixels
+from mkidpipeline.calibration.wavecalplots import fitModels
+from mkidpipeline.utils.pipelinelog import getLogger
+
+
+def makeWaveCal(cfg, **attributes):
+    """A WaveCal with only the given config options and attributes, without config or h5 files"""
+    wavecal = WaveCal.__new__(WaveCal)
+    wavecal.cfg = types.SimpleNamespace(**cfg)
+    wavecal._log = getLogger('devnull')
+    wavecal._log.disabled = True
+    for name, value in attributes.items():
+        setattr(wavecal, name, value)
+    return wavecal
+
+
+def makeBlockWaveCal(beamImage, pixelNRows, block_photons=20000000):
+    """A WaveCal for _getPixelBlocks, with one obs per pixelNRows"""
+    return makeWaveCal({'block_photons': block_photons},
+                       obs=[types.SimpleNamespace(beamImage=beamImage, pixelNRows=nRows) for nRows in pixelNRows])
+
+
+@pytest.mark.parametrize('n_processes, block_photons', [(1, 20000000), (3, 20000000), (2, 500), (50, 20000000)])
+def test_getPixelBlocks(n_processes, block_photons):
+    rng = np.random.default_rng(0)
+    beamImage = rng.permutation(100).reshape(10, 10) + 1000
+    pixelNRows = [rng.integers(0, 200, (10, 10)), None, rng.integers(0, 20, (10, 10))]
+    wavecal = makeBlockWaveCal(beamImage, pixelNRows, block_photons)
+    pixels = [(row, column) for row in range(10) for column in range(10) if (row + column) % 3]
+    blocks = wavecal._getPixelBlocks(pixels, n_processes)
+
+    # all of the pixels, once, in ResID order
+    ordered = [pixel for block in blocks for pixel in block]
+    assert sorted(ordered) == sorted(pixels)
+    assert np.all(np.diff([beamImage[pixel] for pixel in ordered]) > 0)
+    assert all(isinstance(index, int) for pixel in ordered for index in pixel)
+
+    # each block starts a new multiple of the block size (a quarter of a worker's photons, at
+    # most block_photons), the obs without a PixelIndex counts one photon per pixel
+    n_photons = {pixel: 1 + pixelNRows[0][pixel] + pixelNRows[2][pixel] for pixel in pixels}
+    size = min(sum(n_photons.values()) / (4 * n_processes), block_photons)
+    start = 0
+    for i, block in enumerate(blocks):
+        block_start = start
+        start += sum(n_photons[pixel] for pixel in block)
+        assert start - n_photons[block[-1]] < (block_start // size + 1) * size
+        if i > 0:
+            assert block_start // size > (block_start - n_photons[blocks[i - 1][-1]]) // size
+    assert len(blocks) > 1
+
+
+def test_getPixelBlocks_without_photons():
+    wavecal = makeBlockWaveCal(np.arange(6).reshape(2, 3), [None])
+    assert wavecal._getPixelBlocks([(1, 2), (0, 0), (0, 1)], 2) == [[(0, 0)], [(0, 1)], [(1, 2)]]
+
+
+def makePhaseHistograms(wavecal, nPixels, seed=0):
+    """Phase histograms of a gaussian peak above exponential noise, like the laser data's"""
+    rng = np.random.default_rng(seed)
+    phaseHists = []
+    for _ in range(nPixels):
+        threshold = rng.uniform(-40, -15)
+        nPeak = int(rng.uniform(300, 8000))
+        nNoise = int(nPeak*rng.uniform(0.05, 1.5))
+        phases = np.concatenate([rng.normal(rng.uniform(-130, -50), rng.uniform(4, 15), nPeak),
+                                 threshold - rng.exponential(rng.uniform(3, 15), nNoise)])
+        phaseHists.append(wavecal._histogramPhotons(phases[phases <= threshold]))
+    return phaseHists
+
+
+def test_fitPhaseHistograms_matches_lmfit():
+    wavecal = makeWaveCal({'model_name': 'gaussian_and_exp', 'bin_width': 2},
+                          wavelengths=np.array([808., 920., 980., 1120., 1310.]))
+    phaseHists = makePhaseHistograms(wavecal, 40)
+    pixels = [(index, 0) for index in range(len(phaseHists))]
+    fitFunction = fitModels('gaussian_and_exp')
+    # the box, median and three _numberGuess guesses of pixels without good fits yet, the median
+    # and first _numberGuess ones start the exponential amplitude on its lower bound
+    for fitNumber in range(5):
+        setups = [wavecal._setupFit(phaseHist, [], 0, fitNumber) for phaseHist in phaseHists]
+        if fitNumber in (1, 2):
+            assert all(setup['a'].value == setup['a'].min for setup in setups)
+        results = wavecal._fitPhaseHistograms(phaseHists, setups, pixels)
+        for phaseHist, setup, result, pixel in zip(phaseHists, setups, results, pixels):
+            expected = wavecal._fitPhaseHistogram(phaseHist, fitFunction, setup, *pixel)
+            flag = wavecal._evaluateFit(phaseHist, expected, [], 0)
+            assert wavecal._evaluateFit(phaseHist, result, [], 0) == flag
+            # the rejected fits are degenerate (no gaussian or no noise) and aren't used
+            if flag != 0:
+                continue
+            assert np.allclose(result[0], expected[0], rtol=1e-6)
+            scale = np.sqrt(np.outer(np.diag(expected[1]), np.diag(expected[1])))
+            assert np.all(np.abs(result[1] - expected[1]) <= 1e-2*scale)
+
+
+@pytest.mark.parametrize('fitType', ['quadratic', 'linear', 'linear_zero'])
+def test_fitEnergies_vs_fitEnergy(fitType):
+    wavecal = makeWaveCal({'model_name': 'gaussian_and_exp', 'logging': False})
+    phases, energies, errors = makeEnergyData(fitType, nFits=200)
+    results = wavecal._fitEnergies(fitType, [{'phases': phase, 'energies': energy, 'errors': error}
+                                             for phase, energy, error in zip(phases, energies, errors)])
+    differences = []
+    for phase, energy, error, result in zip(phases, energies, errors, results):
+        popt, pcov = wavecal._fitEnergy(fitType, phase, energy, error, 0, 0)
+        assert result is not None and popt is not False
+        assert len(result[0]) == len(popt) == 3 and result[1].shape == pcov.shape == (3, 3)
+        x = np.linspace(phase.min(), phase.max(), 50)
+        differences.append(np.max(np.abs(np.polyval(result[0], x)/np.polyval(popt, x) - 1)))
+    # weighted least squares isn't lmfit's fit, the energies typically agree to better than 0.1%
+    # and at most to a few percent (see the batchfit module docstring)
+    assert np.median(differences) < 1e-3
+    assert np.percentile(differences, 95) < 5e-3
+    assert np.max(differences) < 5e-2
+
+
+def makeSolutionWaveCal(calFile, beamImage, nBins=10, seed=0):
+    """
+    A WaveCal with good histogram and quadratic energy fits for every pixel, ready for
+    exportData (see setPixelFit)
+    """
+    wavecal = makeWaveCal({'model_name': 'gaussian_and_exp', 'verbose': False},
+                          wavelengths=np.array([808., 1310.]), cal_file=str(calFile),
+                          file_names=['1530000000.h5', '1530000100.h5'], rows=beamImage.shape[0],
+                          columns=beamImage.shape[1], obs=[types.SimpleNamespace(beamImage=beamImage)])
+    wavecal.fit_data = np.empty(beamImage.shape, dtype=object)
+    wavecal.wavelength_cal = np.empty(beamImage.shape, dtype=object)
+    for pixel in np.ndindex(beamImage.shape):
+        setPixelFit(wavecal, pixel, nBins=nBins, seed=seed)
+    return wavecal
+
+
+def setPixelFit(wavecal, pixel, histFlags=(0, 0), waveFlag=4, nBins=10, seed=0):
+    """Sets the fit_data and wavelength_cal results of a pixel, with random histograms and fits"""
+    rng = np.random.default_rng((seed,) + tuple(pixel))
+    fitList = []
+    for flag in histFlags:
+        histogram = {'centers': -10 - 2.0*np.arange(nBins)[::-1], 'counts': rng.poisson(50, nBins)}
+        if flag == 0:
+            fitList.append((flag, rng.uniform(1, 2, 5)*[100, 0.1, 500, -60, 8], np.eye(5), histogram))
+        else:
+            fitList.append((flag, False, False, histogram))
+    wavecal.fit_data[pixel] = fitList
+    if waveFlag in (4, 5, 9):
+        wavecal.wavelength_cal[pixel] = (waveFlag, rng.uniform(1, 2, 3)*[-1e-5, -0.02, 0.1], np.eye(3))
+    else:
+        wavecal.wavelength_cal[pixel] = (waveFlag, False, False)
+
+
+def test_findRefitPixels(tmp_path):
+    beamImage = np.random.default_rng(1).permutation(12).reshape(3, 4) + 100
+    wavecal = makeSolutionWaveCal(tmp_path/'reference.h5', beamImage)
+    setPixelFit(wavecal, (1, 0), waveFlag=7)
+    wavecal.exportData()
+
+    wavecal.cal_file = str(tmp_path/'solution.h5')
+    setPixelFit(wavecal, (0, 1), histFlags=(1, 0), waveFlag=6)
+    setPixelFit(wavecal, (0, 3), histFlags=(0, 3))
+    setPixelFit(wavecal, (1, 0))
+    setPixelFit(wavecal, (1, 2), waveFlag=7)
+    setPixelFit(wavecal, (2, 0), histFlags=(0, 2), waveFlag=5)
+    setPixelFit(wavecal, (2, 3), waveFlag=8)
+    setPixelFit(wavecal, (0, 0), waveFlag=6)
+    wavecal.exportData(pixels=[pixel for pixel in np.ndindex(beamImage.shape) if pixel != (2, 2)])
+
+    # failed histogram (either wavelength) or energy fits
+    solution = str(tmp_path/'solution.h5')
+    assert findRefitPixels(solution) == [(0, 1), (1, 2), (2, 0), (2, 3)]
+    assert findRefitPixels(solution, flags=(3, 6)) == [(0, 0), (0, 1), (0, 3)]
+    # missing pixels and changed ResIDs
+    newBeamImage = beamImage.copy()
+    newBeamImage[1, 1] = 200
+    assert findRefitPixels(solution, beam_image=newBeamImage) == [(0, 1), (1, 1), (1, 2), (2, 0), (2, 2), (2, 3)]
+    # pixels that went from good to bad (wave flag 6) or bad to good since the reference
+    refit = findRefitPixels(solution, reference=str(tmp_path/'reference.h5'))
+    assert refit == [(0, 0), (0, 1), (1, 0), (1, 2), (2, 0), (2, 3)]
+    assert all(type(index) is int for pixel in refit for index in pixel)
+
+
+@pytest.mark.parametrize('nBins', [6, 14])
+def test_exportData_previous_solution(tmp_path, nBins):
+    beamImage = np.random.default_rng(2).permutation(12).reshape(3, 4) + 100
+    previous = makeSolutionWaveCal(tmp_path/'previous.h5', beamImage)
+    setPixelFit(previous, (1, 2), histFlags=(1, 0), waveFlag=7)
+    previous.exportData()
+
+    # refit two pixels with histograms of a different length, and give another one a new ResID
+    newBeamImage = beamImage.copy()
+    newBeamImage[1, 1] = 200
+    wavecal = makeSolutionWaveCal(tmp_path/'update.h5', newBeamImage, nBins=nBins, seed=1)
+    refit = [(2, 0), (0, 1), (1, 1)]
+    wavecal.exportData(pixels=refit, previous_solution=str(tmp_path/'previous.h5'))
+
+    with tables.open_file(str(tmp_path/'previous.h5')) as f:
+        oldCalsoln = f.root.wavecal.calsoln.read()
+        oldDebug = f.root.debug.debug_info.read()
+    with tables.open_file(str(tmp_path/'update.h5')) as f:
+        calsoln = f.root.wavecal.calsoln.read()
+        debug = f.root.debug.debug_info.read()
+        assert f.root.header._v_attrs.previous_solution == str(tmp_path/'previous.h5')
+        assert f.root.header.refitPixels.read().tolist() == [list(pixel) for pixel in refit]
+
+    # every pixel once, sorted by ResID
+    for table in (calsoln, debug):
+        assert np.array_equal(table['resid'], np.sort(newBeamImage.ravel()))
+        assert np.array_equal(table['resid'], newBeamImage[table['pixel_row'], table['pixel_col']])
+
+    length = max(nBins, 10)
+    assert debug['phase_centers0'].shape[1] == length
+    for calRow, debugRow in zip(calsoln, debug):
+        pixel = (int(calRow['pixel_row']), int(calRow['pixel_col']))
+        if pixel in refit:
+            fitList = wavecal.fit_data[pixel]
+            assert calRow['wave_flag'] == wavecal.wavelength_cal[pixel][0]
+            assert np.allclose(calRow['polyfit'], wavecal.wavelength_cal[pixel][1])
+            expected, bins = [fitList[index][3] for index in range(2)], nBins
+        else:
+            old = np.flatnonzero(oldCalsoln['resid'] == calRow['resid'])[0]
+            assert calRow == oldCalsoln[old]
+            for name in ('hist_flag', 'hist_fit0', 'hist_cov1', 'poly_cov', 'bin_width'):
+                assert np.array_equal(debugRow[name], oldDebug[old][name])
+            expected = [{'centers': oldDebug[old]['phase_centers' + str(index)],
+                         'counts': oldDebug[old]['phase_counts' + str(index)]} for index in range(2)]
+            bins = 10
+        # the shorter histograms are padded with centers of 1 and counts of -1
+        for index in range(2):
+            assert np.array_equal(debugRow['phase_centers' + str(index)][:bins], expected[index]['centers'][:bins])
+            assert np.array_equal(debugRow['phase_counts' + str(index)][:bins], expected[index]['counts'][:bins])
+            assert np.all(debugRow['phase_centers' + str(index)][bins:] == 1)
+            assert np.all(debugRow['phase_counts' + str(index)][bins:] == -1)